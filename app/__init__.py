@@ -6,25 +6,18 @@ import threading # Cần import threading
 from . import config # Luôn import config trước
 from . import token_storage
 from . import firebase_client
-from . import ml_handler # Import ml_handler
+from . import ml_handler # Import ml_handler (torch chỉ được import khi tải model)
 from . import routes
 # from . import scheduler # Import scheduler ngay cả khi không dùng để tránh lỗi nếu có import vòng
-from . import udp_server
-
-def create_app():
-    """Tạo và cấu hình Flask application instance."""
-    app = flask.Flask(__name__)
-
-    # --- Cấu hình Logging ---
-    # Sử dụng cấu hình từ config.py đã được thực hiện ở đó
-    # logging.basicConfig(level=config.LOG_LEVEL, format=config.LOG_FORMAT) # Không cần gọi lại nếu config đã gọi
-    app.logger.setLevel(config.LOG_LEVEL) # Đảm bảo logger của Flask cũng dùng level này
-    # Ghi log vào file nếu được cấu hình trong config.py
-    # if config.LOG_TO_FILE:
-    #     # ... (thêm file handler như trong config)
-    logging.info("--- Khởi tạo ứng dụng Flask ---")
-    app.logger.info("Logger của Flask đã được cấu hình.")
+# udp_server (kéo theo torch) chỉ được import khi chạy UDP listener trong process này
+from . import ingest_ipc
+from . import s3_client
 
+def _initialize_services(app):
+    """
+    Khởi tạo các dịch vụ chậm: Firebase, S3 client, model ML (+ warm-up) và UDP listener.
+    Chạy ở luồng nền (ML_BACKGROUND_LOAD=true) để web tier trả lời ngay; /ready cho biết khi nào xong.
+    """
     # --- Khởi tạo Firebase Admin SDK ---
     if not firebase_client.initialize_firebase():
         app.logger.error("KHÔNG THỂ KHỞI TẠO FIREBASE ADMIN SDK. KIỂM TRA LẠI TỆP KEY VÀ CẤU HÌNH.")
@@ -33,14 +26,40 @@ def create_app():
     else:
         app.logger.info("Firebase Admin SDK đã được khởi tạo.")
 
-    # --- Tải Model Machine Learning ---
+    # --- Khởi tạo S3 client (import boto3) ---
+    s3_client.get_client()
+
+    if config.INGEST_MODE == 'external':
+        # Model và UDP listener chạy trong process riêng (run_ingest.py)
+        app.logger.info("INGEST_MODE=external: Bỏ qua tải model trong process web.")
+        return
+
+    # --- Tải Model Machine Learning và warm-up ---
     app.logger.info("Đang tải model Machine Learning...")
-    if not ml_handler.load_model():
+    if not ml_handler.load_and_warmup():
          app.logger.warning("Không thể tải model ML khi khởi động. Chức năng dự đoán sẽ không hoạt động.")
          # Server vẫn có thể chạy nhưng chức năng ML sẽ bị vô hiệu hóa
     else:
          app.logger.info("Model Machine Learning đã được tải thành công.")
 
+    # Khởi chạy UDP Listener Thread sau khi model sẵn sàng để chunk đầu tiên không bị chậm
+    from . import udp_server
+    udp_server.start_udp_thread()
+    app.logger.info("Luồng UDP Listener đã bắt đầu.")
+
+def create_app():
+    """Tạo và cấu hình Flask application instance."""
+    app = flask.Flask(__name__)
+
+    # --- Cấu hình Logging ---
+    # Sử dụng cấu hình từ config.py đã được thực hiện ở đó
+    # logging.basicConfig(level=config.LOG_LEVEL, format=config.LOG_FORMAT) # Không cần gọi lại nếu config đã gọi
+    app.logger.setLevel(config.LOG_LEVEL) # Đảm bảo logger của Flask cũng dùng level này
+    # Ghi log vào file nếu được cấu hình trong config.py
+    # if config.LOG_TO_FILE:
+    #     # ... (thêm file handler như trong config)
+    logging.info("--- Khởi tạo ứng dụng Flask ---")
+    app.logger.info("Logger của Flask đã được cấu hình.")
 
     # --- Đăng ký các route ---
     routes.register_routes(app)
@@ -55,12 +74,23 @@ def create_app():
     #   1. Chỉ chạy thread trong worker chính (khó thực hiện với Gunicorn).
     #   2. Sử dụng công cụ quản lý task/process riêng biệt (Celery, Supervisor, systemd) để chạy listener và scheduler độc lập với web server.
     #   3. (Đơn giản nhất cho dự án nhỏ): Chạy Gunicorn/Waitress với CHỈ MỘT worker (`gunicorn --workers 1 run:app`).
+    # Đã hỗ trợ giải pháp 2: đặt INGEST_MODE=external và chạy `python run_ingest.py` riêng,
+    # khi đó có thể chạy nhiều worker (`gunicorn --workers 4 run:app`).
 
     app.logger.info("Khởi chạy các luồng nền...")
 
-    # Khởi chạy UDP Listener Thread
-    udp_server.start_udp_thread()
-    app.logger.info("Luồng UDP Listener đã bắt đầu.")
+    if config.INGEST_MODE == 'external':
+        # Nhận sự kiện trực tiếp (SSE, xóa cache khi có cảnh báo) từ process ingest.
+        # Raise nếu INGEST_IPC_AUTHKEY chưa đặt: không chạy kênh IPC (pickle) với authkey mẫu.
+        ingest_ipc.start_event_relay()
+        app.logger.info("Luồng relay IPC tới process ingest đã bắt đầu.")
+
+    # Firebase, S3, model ML và UDP listener
+    if config.ML_BACKGROUND_LOAD:
+        threading.Thread(target=_initialize_services, args=(app,), name="ServiceInitThread", daemon=True).start()
+        app.logger.info("Đang khởi tạo Firebase/S3/model ở luồng nền (xem /ready).")
+    else:
+        _initialize_services(app)
 
     # Khởi chạy Scheduler Thread (chỉ nếu được bật trong config)
     if config.SCHEDULE_ENABLED:
@@ -81,5 +111,5 @@ def create_app():
          app.logger.info("Scheduler bị tắt trong cấu hình.")
 
 
-    app.logger.info("--- Ứng dụng Flask đã sẵn sàng ---")
+    app.logger.info("--- Ứng dụng Flask đã sẵn sàng nhận request ---")
     return app
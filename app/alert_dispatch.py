@@ -0,0 +1,91 @@
+# app/alert_dispatch.py
+# Gửi cảnh báo (chờ upload clip, FCM, ghi Firestore, lấy số điện thoại, gửi lệnh về thiết bị) qua một thread
+# pool có giới hạn, để luồng phát hiện (UDP / inference) chỉ cập nhật trạng thái rồi đi tiếp.
+# Quá ALERT_DISPATCH_MAX_PENDING cảnh báo đang chờ thì cảnh báo mới bị bỏ (ghi log + /metrics) thay vì
+# tạo thêm luồng không giới hạn.
+import concurrent.futures
+import logging
+import threading
+
+from . import config
+from . import metrics
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(config.ALERT_DISPATCH_MAX_PENDING)
+_futures = set() # Cảnh báo đã gửi vào pool chưa xong (chờ khi drain)
+_futures_lock = threading.Lock()
+_rejected = 0
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.ALERT_DISPATCH_WORKERS, thread_name_prefix="AlertDispatch")
+        return _executor
+
+
+def _run(description: str, fn, args):
+    try:
+        fn(*args)
+    except Exception as e:
+        logging.error(f"Alert Dispatch: Lỗi khi gửi {description}: {e}", exc_info=True)
+
+
+def submit(description: str, fn, *args) -> bool:
+    """
+    Đưa fn(*args) vào pool gửi cảnh báo. Trả về False (không chặn) nếu đã có ALERT_DISPATCH_MAX_PENDING
+    cảnh báo đang chờ hoặc pool đã dừng.
+    """
+    global _rejected
+    if not _pending.acquire(blocking=False):
+        with _futures_lock:
+            _rejected += 1
+        logging.error(f"Alert Dispatch: Đã có {config.ALERT_DISPATCH_MAX_PENDING} cảnh báo đang chờ, bỏ qua {description}.")
+        return False
+    try:
+        future = _get_executor().submit(_run, description, fn, args)
+    except RuntimeError as e: # Pool đã shutdown
+        _pending.release()
+        logging.error(f"Alert Dispatch: Không thể gửi {description}: {e}")
+        return False
+    with _futures_lock:
+        _futures.add(future)
+    future.add_done_callback(_dispatch_done)
+    return True
+
+
+def _dispatch_done(future: concurrent.futures.Future):
+    _pending.release()
+    with _futures_lock:
+        _futures.discard(future)
+
+
+def drain(timeout_s: float) -> bool:
+    """
+    Chờ các cảnh báo đã gửi vào pool xong tối đa timeout_s giây rồi dừng pool (lần submit sau tạo pool mới).
+    Trả về False nếu còn cảnh báo chưa xong khi hết thời gian.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is None:
+        return True
+    with _futures_lock:
+        futures = list(_futures)
+    _, not_done = concurrent.futures.wait(futures, timeout=max(0.0, timeout_s))
+    executor.shutdown(wait=False)
+    if not_done:
+        logging.warning(f"Alert Dispatch: Còn {len(not_done)} cảnh báo chưa gửi xong sau {timeout_s:.1f}s.")
+    return not not_done
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    with _futures_lock:
+        pending, rejected = len(_futures), _rejected
+    return (metrics.gauge_lines('scream_alert_dispatch_pending', 'Số cảnh báo đang chờ/đang gửi.', pending)
+            + metrics.gauge_lines('scream_alert_dispatch_rejected_total', 'Số cảnh báo bị bỏ vì hàng đợi gửi đã đầy.',
+                                  rejected, 'counter'))
@@ -0,0 +1,223 @@
+# app/alert_stats.py
+# Bộ đếm tổng hợp (rollup) số cảnh báo theo ngày (múi giờ local) và theo thiết bị.
+# Mỗi ngày có một document trong collection 'alert_stats_daily' với ID dạng 'YYYY-MM-DD':
+#   {
+#       'date': 'YYYY-MM-DD',
+#       'total': <số cảnh báo trong ngày>,
+#       'devices': {'<ip-dạng-gạch-ngang>': <số cảnh báo>, ...},
+#       'updated_at': SERVER_TIMESTAMP
+#   }
+# Nhờ đó /statistics/weekly chỉ cần đọc tối đa 7 document thay vì stream toàn bộ 'alert_history'.
+# google.cloud.firestore được import trong từng hàm để web tier khởi động nhanh.
+import logging
+import datetime
+from datetime import timedelta
+
+import pytz
+
+from . import config
+
+ALERT_HISTORY_COLLECTION = 'alert_history'
+# Cảnh báo của detector bổ sung (EXTRA_MODELS) ghi riêng: không tính vào thống kê/lịch sử tiếng hét
+DETECTOR_ALERT_HISTORY_COLLECTION = 'detector_alert_history'
+ROLLUP_COLLECTION = 'alert_stats_daily'
+
+LOCAL_TIMEZONE = pytz.timezone(config.LOCAL_TIMEZONE_NAME)
+
+# Mapping từ weekday() (0-6) sang key trả về cho ứng dụng Android
+WEEKDAY_KEYS = {0: "monday", 1: "tuesday", 2: "wednesday", 3: "thursday",
+                4: "friday", 5: "saturday", 6: "sunday"}
+
+
+def device_key(client_ip: str) -> str:
+    """Chuyển IP thành key an toàn cho field path của Firestore (dấu '.' không được phép)."""
+    return client_ip.replace('.', '-')
+
+
+def local_day_key(timestamp: float | datetime.datetime) -> str:
+    """Trả về ID document rollup ('YYYY-MM-DD') của một thời điểm theo múi giờ local."""
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=pytz.utc)
+        dt_local = timestamp.astimezone(LOCAL_TIMEZONE)
+    else:
+        dt_local = datetime.datetime.fromtimestamp(timestamp, tz=pytz.utc).astimezone(LOCAL_TIMEZONE)
+    return dt_local.date().isoformat()
+
+
+def local_day_bounds_utc(day: datetime.date) -> tuple[datetime.datetime, datetime.datetime]:
+    """Trả về (start, end) của một ngày local, đã chuyển sang UTC để truy vấn Firestore."""
+    start_local = LOCAL_TIMEZONE.localize(datetime.datetime.combine(day, datetime.time.min))
+    end_local = LOCAL_TIMEZONE.localize(datetime.datetime.combine(day, datetime.time.max))
+    return start_local.astimezone(pytz.utc), end_local.astimezone(pytz.utc)
+
+
+def add_rollup_increment(batch, firestore_db, client_ip: str, timestamp: float | datetime.datetime):
+    """
+    Thêm thao tác tăng bộ đếm rollup vào một WriteBatch có sẵn.
+    Dùng cùng batch với việc ghi 'alert_history' để hai thao tác được commit nguyên tử.
+    timestamp phải là đúng giá trị ghi vào trường 'timestamp' của document cảnh báo, để ngày rollup
+    luôn khớp ngày của document (cảnh báo sát nửa đêm, máy lệch giờ).
+    """
+    from google.cloud import firestore
+    day_key = local_day_key(timestamp)
+    rollup_ref = firestore_db.collection(ROLLUP_COLLECTION).document(day_key)
+    batch.set(rollup_ref, {
+        'date': day_key,
+        'total': firestore.Increment(1),
+        'devices': {device_key(client_ip): firestore.Increment(1)},
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+    return day_key
+
+
+def _count_alerts_in_day(firestore_db, day: datetime.date) -> int:
+    """Đếm số cảnh báo trong một ngày local bằng aggregation query (tính phí theo index, không theo document)."""
+    from google.cloud import firestore
+    start_utc, end_utc = local_day_bounds_utc(day)
+    query = firestore_db.collection(ALERT_HISTORY_COLLECTION).where(
+        filter=firestore.FieldFilter('timestamp', '>=', start_utc)
+    ).where(
+        filter=firestore.FieldFilter('timestamp', '<=', end_utc)
+    )
+    results = query.count(alias='total').get()
+    # get() trả về danh sách các nhóm kết quả, mỗi nhóm là danh sách AggregationResult
+    for result_group in results:
+        for result in result_group:
+            if result.alias == 'total':
+                return int(result.value)
+    return 0
+
+
+def get_week_counts(firestore_db, week_start_date: datetime.date) -> dict:
+    """
+    Lấy số cảnh báo của 7 ngày bắt đầu từ week_start_date (Thứ Hai).
+    Đọc tối đa 7 document rollup trong một lần get_all(). Ngày nào thiếu rollup sẽ
+    dùng aggregation count làm phương án dự phòng (không có số liệu theo thiết bị).
+
+    Returns:
+        dict: {'total_alerts', 'alerts_per_day', 'alerts_per_device', 'fallback_days'}
+    """
+    from google.cloud import firestore
+    days = [week_start_date + timedelta(days=i) for i in range(7)]
+    rollup_col = firestore_db.collection(ROLLUP_COLLECTION)
+    refs = [rollup_col.document(day.isoformat()) for day in days]
+
+    snapshots = {snap.id: snap for snap in firestore_db.get_all(refs)}
+
+    alerts_per_day = {key: 0 for key in WEEKDAY_KEYS.values()}
+    alerts_per_device = {}
+    fallback_days = []
+    today_local = datetime.datetime.now(LOCAL_TIMEZONE).date()
+
+    for day in days:
+        day_key = WEEKDAY_KEYS[day.weekday()]
+        snap = snapshots.get(day.isoformat())
+
+        if snap is not None and snap.exists:
+            data = snap.to_dict() or {}
+            alerts_per_day[day_key] = int(data.get('total', 0))
+            for dev, count in (data.get('devices') or {}).items():
+                alerts_per_device[dev] = alerts_per_device.get(dev, 0) + int(count)
+            continue
+
+        if day > today_local:
+            # Ngày trong tương lai: chắc chắn chưa có cảnh báo, không cần truy vấn
+            continue
+
+        # Không có rollup cho ngày này -> dùng aggregation count
+        count = _count_alerts_in_day(firestore_db, day)
+        alerts_per_day[day_key] = count
+        fallback_days.append(day.isoformat())
+        logging.info(f"Alert Stats: Rollup thiếu cho ngày {day.isoformat()}, dùng aggregation count = {count}.")
+
+        # Ngày đã qua và không có cảnh báo: ghi lại rollup rỗng để lần sau không phải đếm lại.
+        # (Nếu count > 0 thì cần chạy backfill để có số liệu theo thiết bị.)
+        if count == 0 and day < today_local:
+            try:
+                rollup_col.document(day.isoformat()).set({
+                    'date': day.isoformat(),
+                    'total': 0,
+                    'devices': {},
+                    'updated_at': firestore.SERVER_TIMESTAMP,
+                })
+            except Exception as e:
+                logging.warning(f"Alert Stats: Không thể ghi rollup rỗng cho ngày {day.isoformat()}: {e}")
+
+    return {
+        'total_alerts': sum(alerts_per_day.values()),
+        'alerts_per_day': alerts_per_day,
+        'alerts_per_device': alerts_per_device,
+        'fallback_days': fallback_days,
+    }
+
+
+def rebuild_daily_rollups(firestore_db, start_date: datetime.date | None = None,
+                          end_date: datetime.date | None = None, dry_run: bool = False) -> dict:
+    """
+    Tính lại (backfill/sửa chữa) các document rollup từ dữ liệu 'alert_history'.
+    Các ngày trong khoảng [start_date, end_date] sẽ bị GHI ĐÈ, kể cả ngày không có cảnh báo (total = 0).
+    Nếu không truyền start_date/end_date thì duyệt toàn bộ collection.
+
+    Returns:
+        dict: {'YYYY-MM-DD': {'total': int, 'devices': {...}}, ...} đã tính được.
+    """
+    from google.cloud import firestore
+    query = firestore_db.collection(ALERT_HISTORY_COLLECTION)
+    if start_date:
+        start_utc, _ = local_day_bounds_utc(start_date)
+        query = query.where(filter=firestore.FieldFilter('timestamp', '>=', start_utc))
+    if end_date:
+        _, end_utc = local_day_bounds_utc(end_date)
+        query = query.where(filter=firestore.FieldFilter('timestamp', '<=', end_utc))
+
+    rollups = {}
+    scanned = 0
+    for doc in query.stream():
+        scanned += 1
+        doc_data = doc.to_dict()
+        timestamp = doc_data.get('timestamp')
+        if not isinstance(timestamp, datetime.datetime):
+            logging.warning(f"Alert Stats: Document {doc.id} có timestamp thiếu hoặc không hợp lệ: {timestamp}")
+            continue
+        day_key = local_day_key(timestamp)
+        day_rollup = rollups.setdefault(day_key, {'total': 0, 'devices': {}})
+        day_rollup['total'] += 1
+        client_ip = doc_data.get('client_ip')
+        if client_ip:
+            dev = device_key(client_ip)
+            day_rollup['devices'][dev] = day_rollup['devices'].get(dev, 0) + 1
+
+    # Điền các ngày không có cảnh báo trong khoảng đã chọn để không phải dùng fallback
+    if rollups or (start_date and end_date):
+        first_day = start_date or datetime.date.fromisoformat(min(rollups))
+        last_day = end_date or datetime.date.fromisoformat(max(rollups))
+        day = first_day
+        while day <= last_day:
+            rollups.setdefault(day.isoformat(), {'total': 0, 'devices': {}})
+            day += timedelta(days=1)
+
+    logging.info(f"Alert Stats: Đã quét {scanned} cảnh báo, tính được rollup cho {len(rollups)} ngày.")
+    if dry_run:
+        return rollups
+
+    # Firestore giới hạn 500 thao tác mỗi batch
+    rollup_col = firestore_db.collection(ROLLUP_COLLECTION)
+    batch = firestore_db.batch()
+    pending = 0
+    for day_key, data in sorted(rollups.items()):
+        batch.set(rollup_col.document(day_key), {
+            'date': day_key,
+            'total': data['total'],
+            'devices': data['devices'],
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        })
+        pending += 1
+        if pending >= 450:
+            batch.commit()
+            batch = firestore_db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    logging.info(f"Alert Stats: Đã ghi {len(rollups)} document rollup vào '{ROLLUP_COLLECTION}'.")
+    return rollups
@@ -0,0 +1,214 @@
+# app/audio_urls.py
+# Cache pre-signed URL của S3 cho các file audio cảnh báo.
+# - URL được dùng lại cho tới trước khi hết hạn AWS_S3_URL_REUSE_MARGIN_S giây.
+# - Tập "known keys" lưu các key chắc chắn tồn tại (do server này upload hoặc đã head_object thành công)
+#   để bỏ qua head_object (một round-trip tới S3) ở các lần sau.
+# - Các key mới được đánh dấu cũng nằm trong một log ngắn (recent_known_keys) để process ingest
+#   chuyển cho worker web qua ingest_ipc.
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from . import s3_client
+from . import metrics
+
+_MAX_CACHED_URLS = 5000
+_MAX_KNOWN_KEYS = 20000
+_KNOWN_LOG_SIZE = 512
+
+_url_cache = OrderedDict() # s3_key -> (url, expires_at) theo thứ tự LRU
+_known_keys = OrderedDict() # s3_key -> True (chỉ dùng như một tập có giới hạn, LRU)
+_known_log = deque(maxlen=_KNOWN_LOG_SIZE) # (seq, s3_key) các key vừa được đánh dấu
+_known_seq = itertools.count(1)
+_lock = threading.Lock()
+_presign_executor = None # ThreadPoolExecutor tạo khi cần (ký URL song song)
+_stats = {'url_hits': 0, 'url_misses': 0, 'head_skipped': 0, 'head_calls': 0, 'not_found': 0}
+
+
+class AudioNotFoundError(LookupError):
+    """S3 key không tồn tại trong bucket."""
+
+
+class AudioStorageError(RuntimeError):
+    """Lỗi khác khi truy cập S3 (bọc botocore ClientError để route không phải import botocore)."""
+
+    def __init__(self, code: str | None, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def _get_s3_client():
+    return s3_client.get_client()
+
+
+def is_configured() -> bool:
+    """S3 đã được cấu hình và client đã khởi tạo thành công."""
+    return bool(config.S3_CONFIGURED and _get_s3_client())
+
+
+def mark_known(s3_key: str, presigned_url: str | None = None, generated_at: float | None = None):
+    """
+    Đánh dấu key là đã tồn tại trên S3 (ví dụ ngay sau khi upload thành công).
+    Nếu có sẵn URL vừa tạo thì đưa luôn vào cache.
+    """
+    with _lock:
+        if s3_key not in _known_keys:
+            _known_log.append((next(_known_seq), s3_key))
+        _known_keys[s3_key] = True
+        _known_keys.move_to_end(s3_key)
+        while len(_known_keys) > _MAX_KNOWN_KEYS:
+            _known_keys.popitem(last=False)
+        if presigned_url:
+            issued = generated_at if generated_at is not None else time.time()
+            _store_url_locked(s3_key, presigned_url, issued + config.AWS_S3_URL_EXPIRATION_S)
+
+
+def recent_known_keys(after_seq: int) -> tuple[int, list[str]]:
+    """
+    Các key được đánh dấu sau `after_seq` (chỉ trong log ngắn gần nhất) và seq mới nhất.
+    Key rơi khỏi log chỉ khiến process nhận phải head_object một lần.
+    """
+    with _lock:
+        latest = _known_log[-1][0] if _known_log else after_seq
+        return latest, [key for seq, key in _known_log if seq > after_seq]
+
+
+def forget(s3_key: str):
+    """Xóa key khỏi cache (ví dụ khi file bị xóa khỏi S3)."""
+    with _lock:
+        _known_keys.pop(s3_key, None)
+        _url_cache.pop(s3_key, None)
+
+
+def _store_url_locked(s3_key: str, url: str, expires_at: float):
+    _url_cache[s3_key] = (url, expires_at)
+    _url_cache.move_to_end(s3_key)
+    while len(_url_cache) > _MAX_CACHED_URLS:
+        _url_cache.popitem(last=False)
+
+
+def _cached_url(s3_key: str, now: float, min_remaining_s: float) -> str | None:
+    with _lock:
+        entry = _url_cache.get(s3_key)
+        if entry and entry[1] - min_remaining_s > now:
+            _url_cache.move_to_end(s3_key)
+            _stats['url_hits'] += 1
+            return entry[0]
+        if entry:
+            del _url_cache[s3_key] # Sắp hết hạn, tạo URL mới
+        _stats['url_misses'] += 1
+        return None
+
+
+def _ensure_exists(client, s3_key: str):
+    """head_object nếu key chưa có trong tập known keys. Raise AudioNotFoundError nếu 404."""
+    with _lock:
+        if s3_key in _known_keys:
+            _known_keys.move_to_end(s3_key)
+            _stats['head_skipped'] += 1
+            return
+        _stats['head_calls'] += 1
+    from botocore.exceptions import ClientError
+    try:
+        client.head_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=s3_key)
+    except ClientError as e:
+        error_code = e.response.get('Error', {}).get('Code')
+        if error_code in ('404', 'NoSuchKey', 'NotFound'):
+            with _lock:
+                _stats['not_found'] += 1
+            raise AudioNotFoundError(s3_key) from e
+        raise AudioStorageError(error_code, str(e)) from e
+    mark_known(s3_key)
+
+
+def get_presigned_url(s3_key: str, check_exists: bool = True, min_remaining_s: float | None = None) -> str:
+    """
+    Trả về pre-signed URL (GET) cho s3_key, dùng lại URL trong cache nếu còn hạn
+    ít nhất min_remaining_s giây (mặc định AWS_S3_URL_REUSE_MARGIN_S).
+
+    Raises:
+        AudioNotFoundError: key không tồn tại (chỉ khi check_exists=True).
+        RuntimeError: S3 chưa được cấu hình.
+        AudioStorageError: lỗi khác từ S3.
+    """
+    client = _get_s3_client()
+    if not client or not config.S3_CONFIGURED:
+        raise RuntimeError("S3 not configured")
+
+    if min_remaining_s is None:
+        min_remaining_s = config.AWS_S3_URL_REUSE_MARGIN_S
+    # Kiểm tra tồn tại trước cả khi dùng URL trong cache: URL có thể đã được ký với check_exists=False
+    # (ví dụ /alert_history), còn key chỉ vào tập known keys sau head_object/upload thành công
+    if check_exists:
+        _ensure_exists(client, s3_key)
+
+    now = time.time()
+    url = _cached_url(s3_key, now, min_remaining_s)
+    if url:
+        return url
+
+    # generate_presigned_url chỉ ký cục bộ, không gọi mạng
+    url = client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': config.AWS_S3_BUCKET_NAME, 'Key': s3_key},
+        ExpiresIn=config.AWS_S3_URL_EXPIRATION_S
+    )
+    with _lock:
+        _store_url_locked(s3_key, url, now + config.AWS_S3_URL_EXPIRATION_S)
+    return url
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _presign_executor
+    with _lock:
+        if _presign_executor is None:
+            _presign_executor = ThreadPoolExecutor(max_workers=config.AWS_S3_PRESIGN_WORKERS,
+                                                   thread_name_prefix="S3Presign")
+        return _presign_executor
+
+
+def get_presigned_urls(s3_keys: list[str], check_exists: bool = True,
+                       min_remaining_s: float | None = None) -> tuple[dict, list]:
+    """
+    Tạo URL cho nhiều key một lần, song song trên thread pool.
+    Returns:
+        tuple: ({s3_key: url}, [các key không tồn tại])
+    """
+    unique_keys = list(dict.fromkeys(s3_keys)) # Bỏ trùng, giữ thứ tự
+    if not unique_keys:
+        return {}, []
+
+    def _one(s3_key):
+        try:
+            return s3_key, get_presigned_url(s3_key, check_exists=check_exists, min_remaining_s=min_remaining_s)
+        except AudioNotFoundError:
+            return s3_key, None
+
+    if len(unique_keys) == 1:
+        results = [_one(unique_keys[0])]
+    else:
+        results = list(_get_executor().map(_one, unique_keys))
+
+    urls = {key: url for key, url in results if url}
+    missing = [key for key, url in results if not url]
+    return urls, missing
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    stats = get_stats()
+    lines = []
+    for name in ('url_hits', 'url_misses', 'head_skipped', 'head_calls', 'not_found'):
+        lines += metrics.gauge_lines(f'scream_audio_url_{name}_total', f'Cache pre-signed URL: {name}.', stats[name], 'counter')
+    return lines
+
+
+def get_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats['cached_urls'] = len(_url_cache)
+        stats['known_keys'] = len(_known_keys)
+    return stats
@@ -0,0 +1,341 @@
+# app/chunk_store.py
+# Kho cột (columnar) chỉ-ghi-thêm cho kết quả từng chunk: (timestamp, device, rms, label, confidence).
+# Dùng cho phân tích (lập kế hoạch tải, chỉnh ngưỡng) mà không tốn lượt đọc Firestore.
+#
+# Bố cục trên đĩa (CHUNK_STORE_DIR):
+#   devices.json, labels.json      từ điển chuỗi -> id (chỉ thêm), cột device/label lưu id
+#   p_<epoch bắt đầu>/             một partition cho mỗi CHUNK_STORE_PARTITION_S giây (UTC)
+#       count                      số dòng đã ghi xong (uint64), cập nhật SAU khi ghi các cột
+#       timestamp.f8 device.u2 rms.f4 label.u1 confidence.f4   mỗi cột một file mmap, nới rộng theo khối
+# Process ingest ghi; mọi process (kể cả web khi INGEST_MODE=external) đọc trực tiếp từ file.
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from . import config
+
+COLUMNS = {
+    'timestamp': np.dtype('<f8'),
+    'device': np.dtype('<u2'),
+    'rms': np.dtype('<f4'),
+    'label': np.dtype('<u1'),
+    'confidence': np.dtype('<f4'),
+}
+GROW_ROWS = 1 << 16 # Nới file cột theo khối 64K dòng (file thưa: chưa ghi thì chưa tốn đĩa)
+ERROR_LABEL = 'error' # Nhãn lưu cho chunk dự đoán lỗi (prediction None)
+
+_writer_lock = threading.Lock()
+_partition = None # Partition đang ghi
+_devices = None
+_labels = None
+_last_error_log = float('-inf')
+_retention_thread = None # Luồng xóa partition cũ (chạy ngoài _writer_lock, xem _start_retention)
+
+
+class _Dictionary:
+    """Ánh xạ chuỗi <-> id nhỏ, lưu ở file JSON (danh sách) ghi lại nguyên tử khi có giá trị mới."""
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        self._values = []
+        self._ids = {}
+        self._mtime = None
+        self.reload()
+
+    def reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, encoding='utf-8') as f:
+            self._values = json.load(f)
+        self._ids = {value: i for i, value in enumerate(self._values)}
+        self._mtime = mtime
+
+    def get_id(self, value: str) -> int:
+        value_id = self._ids.get(value)
+        if value_id is None:
+            if len(self._values) >= self.max_size:
+                raise OverflowError(f"{os.path.basename(self.path)}: vượt quá {self.max_size} giá trị")
+            value_id = self._ids[value] = len(self._values)
+            self._values.append(value)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._values, f)
+            os.replace(tmp_path, self.path)
+            self._mtime = os.path.getmtime(self.path)
+        return value_id
+
+    def lookup(self, value: str) -> int | None:
+        self.reload()
+        return self._ids.get(value)
+
+    def values(self) -> list[str]:
+        self.reload()
+        return list(self._values)
+
+
+class Partition:
+    def __init__(self, path: str, writable: bool, start: int | None = None):
+        self.path = path
+        self.start = start
+        self.writable = writable
+        if writable and not os.path.exists(os.path.join(path, 'count')):
+            os.makedirs(path, exist_ok=True)
+            np.zeros(1, dtype='<u8').tofile(os.path.join(path, 'count'))
+        self._count = np.memmap(os.path.join(path, 'count'), dtype='<u8', mode='r+' if writable else 'r', shape=(1,))
+        self._columns = {}
+        self.capacity = 0
+        self._map(max(GROW_ROWS, int(self._count[0])))
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.{COLUMNS[name].kind}{COLUMNS[name].itemsize}")
+
+    def _map(self, capacity: int):
+        if self.writable:
+            for name, dtype in COLUMNS.items():
+                path = self._column_path(name)
+                size = capacity * dtype.itemsize
+                if not os.path.exists(path) or os.path.getsize(path) < size:
+                    with open(path, 'ab') as f:
+                        f.truncate(size)
+        else:
+            # Người đọc chỉ map phần file đã tồn tại
+            capacity = min(os.path.getsize(self._column_path(name)) // dtype.itemsize for name, dtype in COLUMNS.items())
+        self._columns = {name: np.memmap(self._column_path(name), dtype=dtype, mode='r+' if self.writable else 'r',
+                                         shape=(capacity,))
+                         for name, dtype in COLUMNS.items()} if capacity else {}
+        self.capacity = capacity
+
+    def __len__(self) -> int:
+        return int(self._count[0])
+
+    def append(self, values: dict):
+        n = len(self)
+        if n >= self.capacity:
+            self.flush()
+            self._map(self.capacity + GROW_ROWS)
+        for name, value in values.items():
+            self._columns[name][n] = value
+        self._count[0] = n + 1
+
+    def columns(self) -> dict:
+        """View (không sao chép) của các dòng đã ghi xong."""
+        n = len(self)
+        if n > self.capacity:
+            self._map(n) # File đã được process ghi nới thêm
+        n = min(n, self.capacity)
+        return {name: column[:n] for name, column in self._columns.items()} if n else \
+            {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+    def flush(self):
+        for column in self._columns.values():
+            column.flush()
+        self._count.flush()
+
+
+def _partition_start(timestamp: float) -> int:
+    return int(timestamp // config.CHUNK_STORE_PARTITION_S * config.CHUNK_STORE_PARTITION_S)
+
+
+def _partition_path(start: int) -> str:
+    return os.path.join(config.CHUNK_STORE_DIR, f"p_{start}")
+
+
+def _dictionaries() -> tuple[_Dictionary, _Dictionary]:
+    global _devices, _labels
+    if _devices is None:
+        os.makedirs(config.CHUNK_STORE_DIR, exist_ok=True)
+        _devices = _Dictionary(os.path.join(config.CHUNK_STORE_DIR, 'devices.json'), np.iinfo(COLUMNS['device']).max)
+        _labels = _Dictionary(os.path.join(config.CHUNK_STORE_DIR, 'labels.json'), np.iinfo(COLUMNS['label']).max)
+    return _devices, _labels
+
+
+def _apply_retention(now: float):
+    """Xóa partition cũ hơn CHUNK_STORE_RETENTION_DAYS."""
+    cutoff = now - config.CHUNK_STORE_RETENTION_DAYS * 86400
+    for start, path in list_partitions():
+        if start + config.CHUNK_STORE_PARTITION_S < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            logging.info(f"Chunk Store: Đã xóa partition cũ {path}.")
+
+
+def _start_retention(now: float):
+    """
+    Chạy _apply_retention trên luồng riêng (gọi khi chuyển partition, đang giữ _writer_lock): _append chạy trên
+    luồng UDP/inference, có thể đang giữ lock của udp_server, không được chờ rmtree cả một partition.
+    """
+    global _retention_thread
+    if config.CHUNK_STORE_RETENTION_DAYS <= 0:
+        return
+    if _retention_thread is not None and _retention_thread.is_alive():
+        return # Lần trước chưa xóa xong; lần chuyển partition sau sẽ xóa nốt
+    _retention_thread = threading.Thread(target=_apply_retention, args=(now,), name="ChunkStoreRetention",
+                                         daemon=True)
+    _retention_thread.start()
+
+
+def append(device: str, timestamp: float, rms: float, label: str | None, confidence: float):
+    """Ghi kết quả một chunk (gọi từ luồng UDP; chỉ vài phép ghi vào bộ nhớ đã map). Không bao giờ raise."""
+    global _last_error_log
+    try:
+        _append(device, timestamp, rms, label, confidence)
+    except Exception as e:
+        # Lỗi phân tích không được làm hỏng pipeline; log tối đa mỗi phút một lần
+        now = time.monotonic()
+        if now - _last_error_log > 60:
+            _last_error_log = now
+            logging.error(f"Chunk Store: Không ghi được kết quả chunk: {e}", exc_info=True)
+
+
+def _append(device: str, timestamp: float, rms: float, label: str | None, confidence: float):
+    global _partition
+    with _writer_lock:
+        devices, labels = _dictionaries()
+        start = _partition_start(timestamp)
+        if _partition is None or _partition.start != start:
+            if _partition is not None:
+                _partition.flush()
+            _partition = Partition(_partition_path(start), writable=True, start=start)
+            _start_retention(timestamp)
+        _partition.append({
+            'timestamp': timestamp,
+            'device': devices.get_id(device),
+            'rms': rms,
+            'label': labels.get_id(label if label is not None else ERROR_LABEL),
+            'confidence': confidence,
+        })
+
+
+def close():
+    """Flush partition đang ghi (khi dừng process ingest)."""
+    global _partition
+    with _writer_lock:
+        if _partition is not None:
+            _partition.flush()
+            _partition = None
+
+
+def list_partitions() -> list[tuple[int, str]]:
+    if not os.path.isdir(config.CHUNK_STORE_DIR):
+        return []
+    partitions = []
+    for name in os.listdir(config.CHUNK_STORE_DIR):
+        if name.startswith('p_') and name[2:].isdigit():
+            partitions.append((int(name[2:]), os.path.join(config.CHUNK_STORE_DIR, name)))
+    return sorted(partitions)
+
+
+# ==============================================================================
+# Truy vấn (vector hóa bằng numpy)
+# ==============================================================================
+def query(start_time: float, end_time: float, device: str | None = None, label: str | None = None) -> dict:
+    """
+    Các dòng có start_time <= timestamp < end_time (lọc thêm theo device/label nếu có).
+    Trả về dict cột -> mảng numpy (đã sao chép), rỗng nếu không có dữ liệu.
+    """
+    devices, labels = _dictionaries()
+    device_id = devices.lookup(device) if device is not None else None
+    label_id = labels.lookup(label) if label is not None else None
+    empty = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+    if (device is not None and device_id is None) or (label is not None and label_id is None):
+        return empty
+
+    parts = []
+    for start, path in list_partitions():
+        if start + config.CHUNK_STORE_PARTITION_S <= start_time or start >= end_time:
+            continue
+        try:
+            columns = Partition(path, writable=False).columns()
+        except (OSError, ValueError) as e:
+            logging.warning(f"Chunk Store: Bỏ qua partition {path}: {e}")
+            continue
+        timestamps = columns['timestamp']
+        mask = (timestamps >= start_time) & (timestamps < end_time)
+        if device_id is not None:
+            mask &= columns['device'] == device_id
+        if label_id is not None:
+            mask &= columns['label'] == label_id
+        if mask.any():
+            parts.append({name: column[mask] for name, column in columns.items()})
+    if not parts:
+        return empty
+    return {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+
+
+def timeline(device: str, start_time: float, end_time: float, bucket_s: float, scream_label: str) -> dict:
+    """Theo từng bucket thời gian: số chunk, RMS trung bình/lớn nhất, số chunk mỗi nhãn, confidence trung bình."""
+    rows = query(start_time, end_time, device=device)
+    n_buckets = max(1, int(np.ceil((end_time - start_time) / bucket_s)))
+    bucket = np.minimum(((rows['timestamp'] - start_time) // bucket_s).astype(np.int64), n_buckets - 1)
+    counts = np.bincount(bucket, minlength=n_buckets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms_mean = np.bincount(bucket, weights=rows['rms'], minlength=n_buckets) / counts
+        confidence_mean = np.bincount(bucket, weights=rows['confidence'], minlength=n_buckets) / counts
+    rms_max = np.zeros(n_buckets, dtype=np.float64)
+    np.maximum.at(rms_max, bucket, rows['rms'])
+
+    labels = _dictionaries()[1].values()
+    per_label = {}
+    for label_id in np.unique(rows['label']):
+        per_label[labels[label_id]] = np.bincount(bucket[rows['label'] == label_id], minlength=n_buckets).tolist()
+    return {
+        'bucket_start': (start_time + np.arange(n_buckets) * bucket_s).tolist(),
+        'chunks': counts.tolist(),
+        'rms_mean': np.where(counts > 0, rms_mean, 0.0).round(5).tolist(),
+        'rms_max': rms_max.round(5).tolist(),
+        'confidence_mean': np.where(counts > 0, confidence_mean, 0.0).round(4).tolist(),
+        'labels': per_label,
+        'screams': per_label.get(scream_label, [0] * n_buckets),
+    }
+
+
+def histogram(field: str, start_time: float, end_time: float, bins: int,
+              device: str | None = None, label: str | None = None) -> dict:
+    """Histogram của 'rms' hoặc 'confidence' (ví dụ để chọn ngưỡng)."""
+    if field not in ('rms', 'confidence'):
+        raise ValueError(f"Trường không hỗ trợ: {field}")
+    values = query(start_time, end_time, device=device, label=label)[field]
+    value_range = (0.0, 1.0)
+    counts, edges = np.histogram(values, bins=bins, range=value_range)
+    result = {'field': field, 'count': int(values.size), 'edges': edges.round(5).tolist(), 'counts': counts.tolist()}
+    if values.size:
+        result['percentiles'] = dict(zip(('p50', 'p90', 'p99'), np.percentile(values, [50, 90, 99]).round(5).tolist()))
+    return result
+
+
+def summary(start_time: float, end_time: float) -> dict:
+    """Số chunk theo thiết bị và nhãn, kèm tốc độ chunk trung bình (phục vụ lập kế hoạch tải)."""
+    rows = query(start_time, end_time)
+    devices, labels = _dictionaries()
+    device_names, label_names = devices.values(), labels.values()
+    n_devices, n_labels = max(len(device_names), 1), max(len(label_names), 1)
+    matrix = np.bincount(rows['device'].astype(np.int64) * n_labels + rows['label'],
+                         minlength=n_devices * n_labels).reshape(n_devices, n_labels)
+    per_device = {}
+    for device_id in np.flatnonzero(matrix.sum(axis=1)):
+        per_device[device_names[device_id]] = {
+            label_names[label_id]: int(matrix[device_id, label_id]) for label_id in np.flatnonzero(matrix[device_id])
+        }
+    duration = max(end_time - start_time, 1e-9)
+    return {
+        'chunks': int(rows['timestamp'].size),
+        'chunks_per_s': round(rows['timestamp'].size / duration, 3),
+        'devices': per_device,
+        'first_timestamp': float(rows['timestamp'].min()) if rows['timestamp'].size else None,
+        'last_timestamp': float(rows['timestamp'].max()) if rows['timestamp'].size else None,
+    }
+
+
+def get_stats() -> dict:
+    partitions = list_partitions()
+    return {'enabled': config.CHUNK_STORE_ENABLED, 'partitions': len(partitions),
+            'oldest_partition': partitions[0][0] if partitions else None}
@@ -0,0 +1,148 @@
+# app/clip_cache.py
+# Cache trên đĩa cho các clip cảnh báo gần đây (ghi ngay khi mã hóa xong, trước khi upload S3),
+# giới hạn theo tổng dung lượng CLIP_CACHE_MAX_MB, loại bỏ theo LRU (mtime = lần dùng cuối).
+# Process ghi giữ chỉ mục LRU trong bộ nhớ (quét thư mục một lần lúc ghi đầu tiên) và tổng dung lượng
+# chạy; lần dùng ở process khác (process web đọc) chỉ cập nhật mtime, được xét lại lúc loại bỏ.
+# Flask phục vụ file trực tiếp (hỗ trợ Range, sendfile qua wsgi.file_wrapper khi server hỗ trợ);
+# /get_audio_url chỉ tạo pre-signed URL S3 khi clip không có trong cache.
+# Hệ thống file là nguồn dữ liệu chung: process ingest ghi, process web đọc (INGEST_MODE=external).
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from . import config
+from . import metrics
+
+CONTENT_TYPES = {'wav': 'audio/wav', 'flac': 'audio/flac'}
+
+_lock = threading.Lock()
+_index = None # OrderedDict path -> (lần dùng cuối, size), cũ nhất trước (None = chưa quét thư mục)
+_total_bytes = None # Tổng dung lượng các file trong _index
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+
+def _path_for(s3_key: str) -> str:
+    # Tên file là hash của key: không thể thoát khỏi thư mục cache dù key có '..' hay '/'
+    extension = s3_key.rsplit('.', 1)[-1].lower() if '.' in s3_key else 'bin'
+    digest = hashlib.sha1(s3_key.encode('utf-8')).hexdigest()
+    return os.path.join(config.CLIP_CACHE_DIR, digest[:2], f"{digest}.{extension}")
+
+
+def content_type(s3_key: str) -> str:
+    return CONTENT_TYPES.get(s3_key.rsplit('.', 1)[-1].lower(), 'application/octet-stream')
+
+
+def _scan() -> list[tuple[float, int, str]]:
+    """(mtime, size, path) của mọi file trong cache."""
+    entries = []
+    if not os.path.isdir(config.CLIP_CACHE_DIR):
+        return entries
+    for subdir in os.scandir(config.CLIP_CACHE_DIR):
+        if not subdir.is_dir():
+            continue
+        for entry in os.scandir(subdir.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def _load_index_locked():
+    global _index, _total_bytes
+    _index = OrderedDict((path, (mtime, size)) for mtime, size, path in sorted(_scan()))
+    _total_bytes = sum(size for _, size in _index.values())
+
+
+def _touch_locked(path: str, used_at: float, size: int):
+    global _total_bytes
+    previous = _index.pop(path, None)
+    if previous is not None:
+        _total_bytes -= previous[1]
+    _index[path] = (used_at, size)
+    _total_bytes += size
+
+
+def _evict_locked():
+    """Xóa các file dùng lâu nhất cho tới khi tổng dung lượng <= giới hạn (theo chỉ mục, không quét thư mục)."""
+    global _total_bytes
+    limit = config.CLIP_CACHE_MAX_MB * 1024 * 1024
+    while _total_bytes > limit and _index:
+        path, (used_at, size) = _index.popitem(last=False)
+        _total_bytes -= size
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue # Đã bị xóa từ bên ngoài
+        if mtime > used_at:
+            # Được dùng (process khác cập nhật mtime) sau lần ghi nhận cuối: chưa phải cũ nhất
+            _touch_locked(path, mtime, size)
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        _stats['evictions'] += 1
+
+
+def put(s3_key: str, audio_bytes: bytes):
+    """Ghi clip vào cache (ghi file tạm rồi đổi tên để người đọc không thấy file dở dang)."""
+    if not config.CLIP_CACHE_ENABLED or not audio_bytes:
+        return
+    path = _path_for(s3_key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(audio_bytes)
+        os.replace(tmp_path, path)
+        written_at = os.stat(path).st_mtime
+    except OSError as e:
+        logging.error(f"Clip Cache: Không ghi được {s3_key} vào cache: {e}")
+        return
+    with _lock:
+        _stats['stores'] += 1
+        if _index is None:
+            _load_index_locked() # Đã gồm file vừa ghi
+        else:
+            _touch_locked(path, written_at, len(audio_bytes))
+        _evict_locked()
+
+
+def lookup(s3_key: str) -> str | None:
+    """Đường dẫn file của clip nếu có trong cache (và đánh dấu vừa được dùng), ngược lại None."""
+    if not config.CLIP_CACHE_ENABLED:
+        return None
+    path = _path_for(s3_key)
+    try:
+        os.utime(path) # Cập nhật mtime cho LRU; đồng thời kiểm tra file còn tồn tại
+    except FileNotFoundError:
+        with _lock:
+            _stats['misses'] += 1
+        return None
+    except OSError:
+        pass # Không cập nhật được mtime (file chỉ đọc): vẫn phục vụ được
+    with _lock:
+        _stats['hits'] += 1
+        if _index is not None and path in _index:
+            _index.move_to_end(path)
+    return path
+
+
+def get_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats['bytes'] = _total_bytes
+    stats['enabled'] = config.CLIP_CACHE_ENABLED
+    stats['max_bytes'] = config.CLIP_CACHE_MAX_MB * 1024 * 1024
+    return stats
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    stats = get_stats()
+    lines = []
+    for name in ('hits', 'misses', 'stores', 'evictions'):
+        lines += metrics.gauge_lines(f'scream_clip_cache_{name}_total', f'Cache clip trên đĩa: {name}.', stats[name], 'counter')
+    return lines
@@ -0,0 +1,272 @@
+# app/clip_uploads.py
+# Mã hóa đoạn audio cảnh báo (WAV PCM16 hoặc FLAC không mất dữ liệu, ~1/2 dung lượng) và upload
+# lên S3 qua một thread pool có giới hạn, để luồng UDP chỉ chờ upload tối đa S3_UPLOAD_WAIT_S giây.
+# Thời gian mã hóa/upload, số byte và số lần lỗi được ghi vào /metrics.
+import concurrent.futures
+import io
+import logging
+import threading
+import time
+
+import numpy as np
+
+from . import audio_urls
+from . import clip_cache
+from . import config
+from . import metrics
+from . import s3_client
+
+# định dạng -> (format của soundfile, đuôi file, Content-Type)
+CLIP_FORMATS = {
+    'wav': ('WAV', 'wav', 'audio/wav'),
+    'flac': ('FLAC', 'flac', 'audio/flac'),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(config.S3_UPLOAD_MAX_PENDING)
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+_futures = set() # Upload đã gửi vào pool chưa xong (chờ khi drain)
+_active_format = None
+
+
+def active_format() -> str:
+    """Định dạng clip thực sự dùng: AUDIO_CLIP_FORMAT, hoặc 'wav' nếu libsndfile không hỗ trợ."""
+    global _active_format
+    if _active_format is None:
+        clip_format = config.AUDIO_CLIP_FORMAT
+        if clip_format != 'wav':
+            import soundfile as sf
+            if CLIP_FORMATS[clip_format][0] not in sf.available_formats():
+                logging.warning(f"Clip Uploads: libsndfile không hỗ trợ {clip_format.upper()}, dùng WAV.")
+                clip_format = 'wav'
+        _active_format = clip_format
+    return _active_format
+
+
+def encode_clip(audio_tensor, sample_rate: int, clip_format: str | None = None) -> bytes | None:
+    """
+    Chuyển audio thành bytes WAV/FLAC 16-bit. Nhận tensor/numpy float [-1, 1], hoặc một
+    preroll.RingWindow (các đoạn int16 được ghi thẳng từ file ring, không sao chép).
+    """
+    import soundfile as sf
+    if audio_tensor is None or len(audio_tensor) == 0:
+        return None
+    sf_format = CLIP_FORMATS[clip_format or active_format()][0]
+    if hasattr(audio_tensor, 'segments'):
+        return _encode_ring_window(audio_tensor, sf_format)
+    try:
+        audio_np = audio_tensor.detach().cpu().numpy() if hasattr(audio_tensor, 'detach') else np.asarray(audio_tensor)
+        audio_np = audio_np.squeeze()
+        # Clip giá trị để tránh tràn số khi chuyển sang int16
+        audio_int16 = np.clip(audio_np * 32767, -32768, 32767).astype(np.int16)
+        buffer = io.BytesIO()
+        sf.write(buffer, audio_int16, sample_rate, format=sf_format, subtype='PCM_16')
+        return buffer.getvalue()
+    except Exception as e:
+        logging.error(f"Error converting audio to {sf_format} bytes: {e}", exc_info=True)
+        return None
+
+
+def _encode_ring_window(window, sf_format: str) -> bytes | None:
+    import soundfile as sf
+    try:
+        buffer = io.BytesIO()
+        with sf.SoundFile(buffer, 'w', samplerate=window.sample_rate, channels=1,
+                          format=sf_format, subtype='PCM_16') as out:
+            for segment in window.segments():
+                out.write(segment)
+        if not window.consistent():
+            # Ring đã ghi đè phần đầu của clip trong lúc mã hóa (PREROLL_SECONDS quá nhỏ so với clip)
+            logging.error("Clip Uploads: Dữ liệu pre-roll bị ghi đè trong lúc mã hóa clip.")
+            return None
+        return buffer.getvalue()
+    except Exception as e:
+        logging.error(f"Error converting pre-roll window to {sf_format} bytes: {e}", exc_info=True)
+        return None
+
+
+def clip_key(client_ip: str, timestamp: float, clip_format: str | None = None) -> str:
+    extension = CLIP_FORMATS[clip_format or active_format()][1]
+    # Sử dụng timestamp để đảm bảo tên file duy nhất
+    return f"{config.AWS_S3_AUDIO_FOLDER}scream_{client_ip.replace('.', '-')}_{int(timestamp)}.{extension}"
+
+
+def upload_audio_to_s3(audio_bytes: bytes, s3_key: str, content_type: str = 'audio/wav') -> tuple[str | None, str | None]:
+    """Tải dữ liệu audio bytes lên S3 và trả về (s3_key, pre-signed_url)."""
+    from botocore.exceptions import ClientError
+    client = s3_client.get_client()
+    if not client or not config.S3_CONFIGURED:
+        logging.error("S3 client not available or not configured. Cannot upload audio.")
+        return None, None
+    if not audio_bytes:
+        logging.error("No audio bytes provided to upload.")
+        return None, None
+    clip_format = s3_key.rsplit('.', 1)[-1]
+    bucket_name = config.AWS_S3_BUCKET_NAME
+    try:
+        with metrics.stage_timer('s3_upload'):
+            client.put_object(Bucket=bucket_name, Key=s3_key, Body=audio_bytes, ContentType=content_type)
+        metrics.S3_UPLOADS.inc(clip_format, 'ok')
+        metrics.S3_UPLOAD_BYTES.inc(clip_format, amount=len(audio_bytes))
+        logging.info(f"Successfully uploaded audio to s3://{bucket_name}/{s3_key} ({len(audio_bytes)} bytes)")
+
+        # Tạo pre-signed URL để gửi trong thông báo FCM (có thể hết hạn)
+        presign_time = time.time()
+        presigned_url = client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': s3_key},
+            ExpiresIn=config.AWS_S3_URL_EXPIRATION_S # Thời gian hết hạn URL
+        )
+        # Key vừa upload chắc chắn tồn tại: /get_audio_url không cần head_object nữa
+        audio_urls.mark_known(s3_key, presigned_url, presign_time)
+        # Trả về cả key (để lưu vào DB) và URL (để gửi đi)
+        return s3_key, presigned_url
+    except ClientError as e:
+        metrics.S3_UPLOADS.inc(clip_format, 'error')
+        logging.error(f"S3 ClientError during upload/presign URL generation: {e}", exc_info=True)
+        return None, None
+    except Exception as e:
+        metrics.S3_UPLOADS.inc(clip_format, 'error')
+        logging.error(f"Unexpected error during S3 upload: {e}", exc_info=True)
+        return None, None
+
+
+class PendingUpload:
+    """Upload đã gửi vào pool. s3_key chỉ được ghi đi nơi khác (Firestore, FCM) khi upload đã thành công."""
+
+    def __init__(self, future: concurrent.futures.Future, s3_key: str):
+        self.future = future
+        self.s3_key = s3_key
+
+    def wait(self, timeout: float) -> tuple[str | None, str | None]:
+        """
+        Chờ upload tối đa `timeout` giây. Trả về (s3_key, url) nếu đã upload thành công, (None, None) nếu
+        lỗi hoặc vẫn đang upload (is_pending(); dùng when_uploaded để ghi key khi upload xong).
+        """
+        try:
+            return self.future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            logging.warning(f"Clip Uploads: Upload {self.s3_key} chưa xong sau {timeout}s, gửi cảnh báo không kèm audio "
+                            f"(key chỉ được ghi nếu upload thành công).")
+            return None, None
+        except Exception as e:
+            logging.error(f"Clip Uploads: Upload {self.s3_key} thất bại: {e}", exc_info=True)
+            return None, None
+
+    def is_pending(self) -> bool:
+        return not self.future.done()
+
+    def when_uploaded(self, callback):
+        """
+        Gọi callback(s3_key) khi upload thành công (ở luồng upload, hoặc ngay lập tức nếu đã xong).
+        Upload lỗi hoặc bị hủy thì không gọi.
+        """
+        def _done(future: concurrent.futures.Future):
+            try:
+                s3_key, _ = future.result()
+            except Exception:
+                return
+            if not s3_key:
+                return
+            try:
+                callback(s3_key)
+            except Exception as e:
+                logging.error(f"Clip Uploads: Lỗi khi ghi nhận upload {s3_key}: {e}", exc_info=True)
+        self.future.add_done_callback(_done)
+
+
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.S3_UPLOAD_WORKERS, thread_name_prefix="S3Upload")
+        return _executor
+
+
+def _encode_and_upload(audio_tensor, sample_rate: int, s3_key: str, clip_format: str):
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += 1
+    try:
+        with metrics.stage_timer('clip_encode'):
+            audio_bytes = encode_clip(audio_tensor, sample_rate, clip_format)
+        if not audio_bytes:
+            metrics.S3_UPLOADS.inc(clip_format, 'error')
+            logging.error(f"Failed to convert audio tensor to {clip_format.upper()} bytes.")
+            return None, None
+        # Ghi cache cục bộ trước khi upload: clip phát được ngay cả khi upload còn đang chạy
+        clip_cache.put(s3_key, audio_bytes)
+        return upload_audio_to_s3(audio_bytes, s3_key, CLIP_FORMATS[clip_format][2])
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+
+
+def submit_clip(audio_tensor, client_ip: str, timestamp: float) -> PendingUpload | None:
+    """
+    Đưa việc mã hóa + upload một clip vào pool. Trả về None (không chặn) nếu S3 chưa cấu hình
+    hoặc đã có S3_UPLOAD_MAX_PENDING upload đang chờ.
+    """
+    if not config.S3_CONFIGURED:
+        logging.error("S3 client not available or not configured. Cannot upload audio.")
+        return None
+    clip_format = active_format()
+    if not _pending.acquire(blocking=False):
+        metrics.S3_UPLOADS.inc(clip_format, 'rejected')
+        logging.error(f"Clip Uploads: Đã có {config.S3_UPLOAD_MAX_PENDING} upload đang chờ, bỏ qua clip của {client_ip}.")
+        return None
+    s3_key = clip_key(client_ip, timestamp, clip_format)
+    try:
+        future = _get_executor().submit(_encode_and_upload, audio_tensor, config.AUDIO_SAMPLE_RATE, s3_key, clip_format)
+    except RuntimeError as e: # Pool đã shutdown
+        _pending.release()
+        logging.error(f"Clip Uploads: Không thể gửi upload {s3_key}: {e}")
+        return None
+    with _in_flight_lock:
+        _futures.add(future)
+    future.add_done_callback(_upload_done)
+    return PendingUpload(future, s3_key)
+
+
+def _upload_done(future: concurrent.futures.Future):
+    _pending.release()
+    with _in_flight_lock:
+        _futures.discard(future)
+
+
+def shutdown(wait: bool = True):
+    """Dừng pool (chờ các upload đang chạy xong nếu wait=True)."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def drain(timeout_s: float) -> bool:
+    """
+    Dừng nhận upload mới, chờ các upload đã gửi xong tối đa timeout_s giây rồi dừng pool.
+    Trả về False nếu còn upload chưa xong khi hết thời gian (các upload chưa bắt đầu bị hủy).
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is None:
+        return True
+    with _in_flight_lock:
+        futures = list(_futures)
+    _, not_done = concurrent.futures.wait(futures, timeout=max(0.0, timeout_s))
+    executor.shutdown(wait=False, cancel_futures=True)
+    if not_done:
+        logging.warning(f"Clip Uploads: Còn {len(not_done)} upload chưa xong sau {timeout_s:.1f}s, bỏ qua.")
+    return not not_done
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    with _in_flight_lock:
+        in_flight = _in_flight
+    return metrics.gauge_lines('scream_s3_uploads_in_flight', 'Số clip đang được mã hóa/upload.', in_flight)
@@ -0,0 +1,125 @@
+# app/cluster_store.py
+# Trạng thái dùng chung giữa các node ingest (xem app/ingest_cluster.py):
+#   - danh sách node còn sống (heartbeat), để mọi node dựng cùng một vòng consistent hashing;
+#   - thời điểm cảnh báo cuối cùng theo (loại cảnh báo, thiết bị), để cooldown/chống trùng có hiệu lực trên
+#     cả cụm: khi thiết bị chuyển node, node mới không gửi lại cảnh báo mà node cũ vừa gửi.
+# Backend (CLUSTER_STORE):
+#   'sqlite'    : một file SQLite (WAL) - nhiều process trên cùng một máy, và dùng khi kiểm thử
+#   'firestore' : collection trên Firestore, claim cảnh báo bằng transaction - nhiều máy
+import logging
+import os
+import sqlite3
+import threading
+
+from . import config
+
+NODES_COLLECTION = 'ingest_nodes'
+ALERT_CLAIMS_COLLECTION = 'alert_claims'
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _alert_key(kind: str, device: str) -> str:
+    return f"{kind}_{device}".replace('/', '_')
+
+
+class SQLiteStore:
+    """Backend SQLite: mỗi luồng một kết nối, claim cảnh báo trong transaction BEGIN IMMEDIATE."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, address TEXT NOT NULL, last_seen REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS alerts (alert_key TEXT PRIMARY KEY, last_alert REAL NOT NULL, node_id TEXT)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: tự quản lý transaction; timeout chờ khi node khác đang ghi
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def heartbeat(self, node_id: str, address: str, now: float):
+        self._conn().execute("INSERT OR REPLACE INTO nodes (node_id, address, last_seen) VALUES (?, ?, ?)",
+                             (node_id, address, now))
+
+    def remove_node(self, node_id: str):
+        self._conn().execute("DELETE FROM nodes WHERE node_id = ?", (node_id,))
+
+    def live_nodes(self, min_last_seen: float) -> dict:
+        rows = self._conn().execute("SELECT node_id, address FROM nodes WHERE last_seen >= ?", (min_last_seen,))
+        return dict(rows.fetchall())
+
+    def claim_alert(self, kind: str, device: str, now: float, cooldown_s: float, node_id: str) -> tuple[bool, float]:
+        conn = self._conn()
+        key = _alert_key(kind, device)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT last_alert FROM alerts WHERE alert_key = ?", (key,)).fetchone()
+            last_alert = row[0] if row else 0.0
+            if now - last_alert <= cooldown_s:
+                conn.execute("COMMIT")
+                return False, last_alert
+            conn.execute("INSERT OR REPLACE INTO alerts (alert_key, last_alert, node_id) VALUES (?, ?, ?)",
+                         (key, now, node_id))
+            conn.execute("COMMIT")
+            return True, now
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class FirestoreStore:
+    """Backend Firestore: node heartbeat vào NODES_COLLECTION, claim cảnh báo bằng transaction."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def heartbeat(self, node_id: str, address: str, now: float):
+        self.db.collection(NODES_COLLECTION).document(node_id).set({'address': address, 'last_seen': now})
+
+    def remove_node(self, node_id: str):
+        self.db.collection(NODES_COLLECTION).document(node_id).delete()
+
+    def live_nodes(self, min_last_seen: float) -> dict:
+        from firebase_admin import firestore
+        query = self.db.collection(NODES_COLLECTION).where(filter=firestore.FieldFilter('last_seen', '>=', min_last_seen))
+        return {doc.id: doc.to_dict()['address'] for doc in query.stream()}
+
+    def claim_alert(self, kind: str, device: str, now: float, cooldown_s: float, node_id: str) -> tuple[bool, float]:
+        from firebase_admin import firestore
+        doc_ref = self.db.collection(ALERT_CLAIMS_COLLECTION).document(_alert_key(kind, device))
+
+        @firestore.transactional
+        def _claim(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            last_alert = (snapshot.to_dict() or {}).get('last_alert', 0.0) if snapshot.exists else 0.0
+            if now - last_alert <= cooldown_s:
+                return False, last_alert
+            transaction.set(doc_ref, {'last_alert': now, 'node_id': node_id, 'kind': kind, 'device': device})
+            return True, now
+
+        return _claim(self.db.transaction())
+
+
+def get_store():
+    """Backend theo CLUSTER_STORE (tạo ở lần gọi đầu). Ném RuntimeError nếu Firestore chưa sẵn sàng."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if config.CLUSTER_STORE == 'firestore':
+                from . import firebase_client
+                if not firebase_client._firestore_db:
+                    raise RuntimeError("Firestore chưa được khởi tạo, không dùng được CLUSTER_STORE=firestore")
+                _store = FirestoreStore(firebase_client._firestore_db)
+            else:
+                _store = SQLiteStore(config.CLUSTER_STORE_PATH)
+            logging.info(f"Cluster Store: Dùng backend '{config.CLUSTER_STORE}'.")
+        return _store
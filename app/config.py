@@ -1,7 +1,6 @@
 # app/config.py
 import os
 import logging
-import torch
 # Thêm thư viện dotenv để tự động load file .env (tùy chọn nhưng tiện lợi)
 # Cần cài đặt: pip install python-dotenv
 from dotenv import load_dotenv
@@ -49,12 +48,43 @@ else:
 # Đọc từ biến môi trường hoặc dùng giá trị mặc định
 FLASK_HOST = os.getenv("FLASK_HOST", "0.0.0.0")
 FLASK_PORT = int(os.getenv("FLASK_PORT", 5000)) # Chuyển sang int
+# Múi giờ dùng để tính ngày/tuần cho thống kê cảnh báo
+LOCAL_TIMEZONE_NAME = os.getenv("LOCAL_TIMEZONE", "Asia/Ho_Chi_Minh")
 
 # --- Cấu hình UDP Server ---
 UDP_HOST = os.getenv("UDP_HOST", "0.0.0.0")
 UDP_PORT = int(os.getenv("UDP_PORT", 5005)) # Chuyển sang int
 UDP_BUFFER_SIZE = 4096 # Giữ nguyên hoặc thêm vào .env nếu cần
 
+# --- Cấu hình tách process ingest/inference ---
+# 'embedded': UDP listener + model chạy trong process Flask (chỉ được chạy 1 worker).
+# 'external': chạy `python run_ingest.py` riêng; Flask chỉ phục vụ HTTP và có thể chạy nhiều worker,
+#             nhận trạng thái trực tiếp từ process ingest qua IPC cục bộ.
+INGEST_MODE = os.getenv("INGEST_MODE", "embedded").lower()
+INGEST_IPC_HOST = os.getenv("INGEST_IPC_HOST", "127.0.0.1")
+INGEST_IPC_PORT = int(os.getenv("INGEST_IPC_PORT", 5006))
+INGEST_IPC_SOCKET_PATH = os.getenv("INGEST_IPC_SOCKET_PATH") # Nếu đặt: dùng Unix socket thay vì TCP
+# Bắt buộc khi INGEST_MODE=external: process ingest và worker web từ chối chạy nếu trống
+INGEST_IPC_AUTHKEY = os.getenv("INGEST_IPC_AUTHKEY", "")
+
+# --- Nhiều node ingest (app/ingest_cluster.py, app/cluster_store.py) ---
+# Thiết bị được chia cho các node theo consistent hashing; cooldown cảnh báo dùng chung qua CLUSTER_STORE.
+CLUSTER_ENABLED = os.getenv("CLUSTER_ENABLED", "false").lower() in ("1", "true", "yes")
+CLUSTER_NODE_ID = os.getenv("CLUSTER_NODE_ID") # Mặc định '<hostname>-<UDP_PORT>'
+CLUSTER_ADVERTISE_ADDR = os.getenv("CLUSTER_ADVERTISE_ADDR") # "host:port" thiết bị dùng để tới node này
+CLUSTER_STORE = os.getenv("CLUSTER_STORE", "sqlite").lower() # "sqlite" (cùng máy / kiểm thử) hoặc "firestore"
+CLUSTER_STORE_PATH = os.getenv("CLUSTER_STORE_PATH", "cluster_state.db")
+CLUSTER_HEARTBEAT_S = float(os.getenv("CLUSTER_HEARTBEAT_S", 5))
+CLUSTER_NODE_TTL_S = float(os.getenv("CLUSTER_NODE_TTL_S", 15)) # Không heartbeat quá số giây này = đã rời cụm
+CLUSTER_VNODES = int(os.getenv("CLUSTER_VNODES", 64)) # Số điểm ảo mỗi node trên vòng hash
+# Lệnh "REDIRECT:<host>:<port>" cho thiết bị gửi nhầm node; chỉ bật khi firmware ESP32 đã hỗ trợ lệnh này.
+# Tắt: node vẫn xử lý gói của thiết bị không thuộc mình (cooldown chung vẫn chống trùng cảnh báo).
+CLUSTER_REDIRECT_ENABLED = os.getenv("CLUSTER_REDIRECT_ENABLED", "false").lower() in ("1", "true", "yes")
+CLUSTER_REDIRECT_INTERVAL_S = float(os.getenv("CLUSTER_REDIRECT_INTERVAL_S", 5)) # Gửi lại lệnh REDIRECT tối đa mỗi N giây
+if CLUSTER_STORE not in ("sqlite", "firestore"):
+    logging.warning(f"CLUSTER_STORE '{CLUSTER_STORE}' không hợp lệ, dùng 'sqlite'.")
+    CLUSTER_STORE = "sqlite"
+
 # --- Cấu hình Định dạng Âm thanh --- (Giữ nguyên)
 AUDIO_SAMPLE_RATE = 16000
 AUDIO_BYTES_PER_SAMPLE = 4
@@ -71,7 +101,77 @@ MODEL_N_MELS = 64
 MODEL_N_FFT = 1024
 MODEL_IMG_SIZE = (64, 862)
 MODEL_CLASS_MAP = {0: 'Không hét', 1: 'Hét'}
-ML_DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+# 'auto' = dùng 'cuda' nếu có, ngược lại 'cpu'. Được xác định khi tải model (không import torch ở đây
+# để process web khởi động nhanh).
+ML_DEVICE = os.getenv("ML_DEVICE", "auto")
+# Tải model và chạy thử (warm-up) ở luồng nền thay vì chặn create_app()
+ML_BACKGROUND_LOAD = os.getenv("ML_BACKGROUND_LOAD", "true").lower() in ("1", "true", "yes")
+# Số luồng torch và CPU affinity cho inference (app/torch_runtime.py). Chọn giá trị cho máy bằng
+# `python -m tools.thread_calibrate`. 0 = tự tính từ số CPU khả dụng.
+TORCH_THREADS_MANAGED = os.getenv("TORCH_THREADS_MANAGED", "true").lower() in ("1", "true", "yes")
+TORCH_INTRA_OP_THREADS = int(os.getenv("TORCH_INTRA_OP_THREADS", 0))
+TORCH_INTER_OP_THREADS = int(os.getenv("TORCH_INTER_OP_THREADS", 1))
+TORCH_RESERVED_CPUS = int(os.getenv("TORCH_RESERVED_CPUS", 1)) # Core để lại cho luồng UDP/Flask
+INFERENCE_CPU_AFFINITY = os.getenv("INFERENCE_CPU_AFFINITY", "").strip().lower() # "" / "auto" / "0-3,8"
+# Nhiều process inference trên cùng máy (vd. nhiều node ingest): mỗi process một phần CPU riêng
+INFERENCE_PROCESS_SLOTS = int(os.getenv("INFERENCE_PROCESS_SLOTS", 1))
+INFERENCE_PROCESS_INDEX = int(os.getenv("INFERENCE_PROCESS_INDEX", 0))
+# Đường tạo image tensor từ log-mel (app/feature_graph.py):
+#   'auto'  = đồ thị tensor hợp nhất khi kích thước mel (MODEL_N_MELS x frames) đã bằng MODEL_IMG_SIZE VÀ ảnh của
+#             nó khớp đường matplotlib/PIL trên chunk mẫu lúc tải model (sai khác trung bình theo pixel
+#             <= MODEL_FEATURE_PARITY_TOLERANCE), ngược lại 'pil'. Kết quả so ảnh được cache tại
+#             MODEL_FEATURE_PARITY_CACHE_PATH theo cấu hình đặc trưng + device + phiên bản thư viện ("" = không cache);
+#   'fused' = luôn dùng đồ thị hợp nhất (resize bằng F.interpolate nếu khác kích thước, không kiểm tra);
+#   'pil'   = matplotlib -> PNG -> PIL Resize -> ToTensor như khi huấn luyện.
+MODEL_FEATURE_PIPELINE = os.getenv("MODEL_FEATURE_PIPELINE", "auto").strip().lower()
+MODEL_FEATURE_PARITY_TOLERANCE = float(os.getenv("MODEL_FEATURE_PARITY_TOLERANCE", 0.002)) # Ảnh trong [0, 1]
+MODEL_FEATURE_PARITY_CACHE_PATH = os.getenv("MODEL_FEATURE_PARITY_CACHE_PATH", os.path.join("state", "feature_parity.json"))
+# Map file weights vào bộ nhớ (torch.load(mmap=True)) khi chạy trên CPU: các process cùng tải một file
+# (ingest, worker batch_score, nhiều node) dùng chung page cache thay vì mỗi process một bản sao.
+MODEL_MMAP_WEIGHTS = os.getenv("MODEL_MMAP_WEIGHTS", "true").lower() in ("1", "true", "yes")
+
+# --- Lập lịch inference theo mức ưu tiên (app/inference_scheduler.py) ---
+# Thiết bị vừa có dự đoán 'Hét' vào lane 'hot' (chạy gần như ngay), thiết bị im lặng vào lane 'cold'
+# (chờ tối đa INFERENCE_COLD_MAX_WAIT_MS để gom batch lớn). Tắt = dự đoán từng chunk ngay trên luồng UDP.
+INFERENCE_BATCHING_ENABLED = os.getenv("INFERENCE_BATCHING_ENABLED", "false").lower() in ("1", "true", "yes")
+INFERENCE_HOT_MAX_WAIT_MS = float(os.getenv("INFERENCE_HOT_MAX_WAIT_MS", 0))
+INFERENCE_HOT_MAX_BATCH = int(os.getenv("INFERENCE_HOT_MAX_BATCH", 4))
+INFERENCE_COLD_MAX_WAIT_MS = float(os.getenv("INFERENCE_COLD_MAX_WAIT_MS", 500))
+INFERENCE_COLD_MAX_BATCH = int(os.getenv("INFERENCE_COLD_MAX_BATCH", 16))
+INFERENCE_QUEUE_MAX = int(os.getenv("INFERENCE_QUEUE_MAX", 256)) # Đầy thì bỏ chunk cũ nhất của lane cold
+
+# --- Các detector bổ sung ---
+# Mỗi detector là một model chạy trên CÙNG ảnh mel spectrogram với model tiếng hét (đặc trưng chỉ tính
+# một lần cho mỗi chunk), nên phải được huấn luyện với MODEL_N_MELS/MODEL_N_FFT/MODEL_IMG_SIZE như trên.
+# Các detector dùng chung file weights chỉ được tải một lần.
+# Mẫu tiêu đề/nội dung: {count} = số chunk khớp trong cửa sổ, {window} = độ dài cửa sổ (giây), {ip} = thiết bị.
+PRIMARY_MODEL_NAME = 'scream'
+MODEL_CATALOG = {
+    'glass_break': {
+        'filename': 'GlassBreak_Resnet34.pt',
+        'class_map': {0: 'Khác', 1: 'Vỡ kính'},
+        'target_label': 'Vỡ kính',
+        'min_consecutive_chunks': 1,
+        'frequency_count': 1,
+        'frequency_window_s': 5,
+        'cooldown_s': 60,
+        'alert_title': "Cảnh báo Vỡ Kính!",
+        'alert_body_template': "Phát hiện tiếng vỡ kính từ thiết bị tại IP: {ip}",
+    },
+    'baby_cry': {
+        'filename': 'BabyCry_Resnet34.pt',
+        'class_map': {0: 'Khác', 1: 'Trẻ khóc'},
+        'target_label': 'Trẻ khóc',
+        'min_consecutive_chunks': 3,
+        'frequency_count': 5,
+        'frequency_window_s': 15,
+        'cooldown_s': 300,
+        'alert_title': "Cảnh báo Trẻ Khóc!",
+        'alert_body_template': "Phát hiện trẻ khóc {count} lần trong {window} giây từ thiết bị tại IP: {ip}",
+    },
+}
+# Danh sách tên trong MODEL_CATALOG cần bật, cách nhau bởi dấu phẩy (bỏ trống = chỉ model tiếng hét)
+EXTRA_MODELS = [name.strip() for name in os.getenv("EXTRA_MODELS", "").split(",") if name.strip()]
 
 # --- Cấu hình Cảnh báo Tiếng Hét --- (Giữ nguyên)
 SCREAM_ALERT_COOLDOWN_S = 60
@@ -86,15 +186,80 @@ HIGH_FREQUENCY_ALERT_BODY_TEMPLATE = "Phát hiện {} lần hét trong {} giây
 # --- Cấu hình Lưu Âm thanh --- (Giữ nguyên)
 AUDIO_SAVE_DURATION_S = 10
 
+# --- Checkpoint trạng thái phát hiện (app/state_checkpoint.py) ---
+# Lịch sử dự đoán + thời điểm cảnh báo cuối của từng thiết bị được ghi định kỳ và đọc lại khi khởi động,
+# để cooldown không bị reset sau mỗi lần deploy/crash. Mỗi process ingest cần một đường dẫn riêng.
+STATE_CHECKPOINT_ENABLED = os.getenv("STATE_CHECKPOINT_ENABLED", "true").lower() in ("1", "true", "yes")
+STATE_CHECKPOINT_PATH = os.getenv("STATE_CHECKPOINT_PATH", os.path.join("state", "ingest_state.ckpt"))
+STATE_CHECKPOINT_INTERVAL_S = float(os.getenv("STATE_CHECKPOINT_INTERVAL_S", 10))
+STATE_CHECKPOINT_MAX_AGE_S = float(os.getenv("STATE_CHECKPOINT_MAX_AGE_S", 3600)) # 0 = luôn khôi phục
+# Khi dừng: thời gian tối đa chờ các cảnh báo đang gửi (FCM/Firestore/upload clip) trước khi thoát
+SHUTDOWN_DRAIN_TIMEOUT_S = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT_S", 10))
+# Pool gửi cảnh báo (app/alert_dispatch.py): số luồng và số cảnh báo tối đa đang chờ (quá thì bỏ cảnh báo mới)
+ALERT_DISPATCH_WORKERS = int(os.getenv("ALERT_DISPATCH_WORKERS", 2))
+ALERT_DISPATCH_MAX_PENDING = int(os.getenv("ALERT_DISPATCH_MAX_PENDING", 32))
+
+# --- Backend giả lập cục bộ (app/local_backends.py) ---
+# Thay Firestore/RTDB/FCM/S3 bằng bản giả trong bộ nhớ để chạy và kiểm thử tải khi không có cloud
+LOCAL_BACKENDS = os.getenv("LOCAL_BACKENDS", "false").lower() in ("1", "true", "yes")
+LOCAL_BACKENDS_LATENCY_MS = os.getenv("LOCAL_BACKENDS_LATENCY_MS", "") # Ví dụ: "firestore=25,rtdb=10,fcm=60,s3=40"
+LOCAL_BACKENDS_JITTER = float(os.getenv("LOCAL_BACKENDS_JITTER", 0.2)) # Dao động ±20% quanh độ trễ
+LOCAL_BACKENDS_DIR = os.getenv("LOCAL_BACKENDS_DIR") # Lưu object S3 giả trên đĩa thay vì trong bộ nhớ
+LOCAL_S3_PUBLIC_URL = os.getenv("LOCAL_S3_PUBLIC_URL", "http://localhost:9000")
+
+# --- Pre-roll trên đĩa (app/preroll.py) ---
+# Mỗi thiết bị một file ring mmap chứa PREROLL_SECONDS giây audio int16 gần nhất (~32 KB/giây ở 16 kHz).
+# Khi bật, clip cảnh báo dài PREROLL_CLIP_S giây được cắt từ ring thay vì từ deque trong RAM.
+PREROLL_ENABLED = os.getenv("PREROLL_ENABLED", "false").lower() in ("1", "true", "yes")
+PREROLL_DIR = os.getenv("PREROLL_DIR", "preroll")
+PREROLL_SECONDS = int(os.getenv("PREROLL_SECONDS", 300))
+PREROLL_CLIP_S = int(os.getenv("PREROLL_CLIP_S", 30))
+PREROLL_GAP_FILL_S = 0.5 # Khoảng trống lớn hơn số này giữa 2 đoạn audio được ghi bằng im lặng
+if PREROLL_SECONDS < 2 * PREROLL_CLIP_S:
+    logging.warning(f"PREROLL_SECONDS ({PREROLL_SECONDS}) nên >= 2 x PREROLL_CLIP_S ({PREROLL_CLIP_S}) "
+                    "để clip không bị ghi đè trong lúc upload.")
+
+# --- Kho kết quả từng chunk cho phân tích (app/chunk_store.py, GET /analytics/*) ---
+CHUNK_STORE_ENABLED = os.getenv("CHUNK_STORE_ENABLED", "false").lower() in ("1", "true", "yes")
+CHUNK_STORE_DIR = os.getenv("CHUNK_STORE_DIR", "chunk_store")
+CHUNK_STORE_PARTITION_S = int(os.getenv("CHUNK_STORE_PARTITION_S", 86400)) # Mỗi partition một ngày (UTC)
+CHUNK_STORE_RETENTION_DAYS = int(os.getenv("CHUNK_STORE_RETENTION_DAYS", 90)) # 0 = giữ mãi
+
 # --- Cấu hình AWS S3 ---
 # Đọc từ biến môi trường
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-AWS_S3_BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME")
+AWS_S3_BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME", "local-scream-audio" if LOCAL_BACKENDS else None)
 AWS_S3_REGION = os.getenv("AWS_S3_REGION")
 
 AWS_S3_AUDIO_FOLDER = "audio/" # Giữ nguyên hoặc thêm vào .env nếu cần
 AWS_S3_URL_EXPIRATION_S = 3600 # Giữ nguyên hoặc thêm vào .env nếu cần
+# Dùng lại URL đã tạo cho tới khi còn ít hơn số giây này trước khi hết hạn
+AWS_S3_URL_REUSE_MARGIN_S = min(300, AWS_S3_URL_EXPIRATION_S // 2)
+AWS_S3_PRESIGN_WORKERS = int(os.getenv("AWS_S3_PRESIGN_WORKERS", 4)) # Số thread ký URL song song
+
+# Upload clip cảnh báo: định dạng, thread pool và boto3 client (xem app/clip_uploads.py, app/s3_client.py)
+AUDIO_CLIP_FORMAT = os.getenv("AUDIO_CLIP_FORMAT", "wav").lower() # "wav" (PCM16) hoặc "flac" (không mất dữ liệu, nhỏ hơn ~50%)
+if AUDIO_CLIP_FORMAT not in ("wav", "flac"):
+    logging.warning(f"AUDIO_CLIP_FORMAT '{AUDIO_CLIP_FORMAT}' không hợp lệ, dùng 'wav'.")
+    AUDIO_CLIP_FORMAT = "wav"
+S3_UPLOAD_WORKERS = int(os.getenv("S3_UPLOAD_WORKERS", 4))
+S3_UPLOAD_MAX_PENDING = int(os.getenv("S3_UPLOAD_MAX_PENDING", 16)) # Quá số này thì cảnh báo được gửi không kèm clip
+S3_UPLOAD_WAIT_S = float(os.getenv("S3_UPLOAD_WAIT_S", 5.0)) # Thời gian tối đa luồng UDP chờ upload trước khi gửi FCM
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 10)) # Nên >= S3_UPLOAD_WORKERS + AWS_S3_PRESIGN_WORKERS
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 4))
+S3_RETRY_MODE = os.getenv("S3_RETRY_MODE", "adaptive") # "legacy" / "standard" / "adaptive"
+S3_CONNECT_TIMEOUT_S = float(os.getenv("S3_CONNECT_TIMEOUT_S", 3))
+S3_READ_TIMEOUT_S = float(os.getenv("S3_READ_TIMEOUT_S", 10))
+
+# Cache clip cảnh báo trên đĩa (app/clip_cache.py), phục vụ qua GET /audio/<s3_key> thay cho pre-signed URL.
+# Tắt mặc định: khi bật, /get_audio_url (và audio_url trong lịch sử) trả URL /audio/... của server này
+# thay cho pre-signed URL S3 - server phải truy cập được từ app (xem CLIP_CACHE_PUBLIC_BASE_URL).
+CLIP_CACHE_ENABLED = os.getenv("CLIP_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+CLIP_CACHE_DIR = os.getenv("CLIP_CACHE_DIR", "clip_cache")
+CLIP_CACHE_MAX_MB = int(os.getenv("CLIP_CACHE_MAX_MB", 512))
+# URL gốc mà app Android dùng để gọi server (khi chạy sau proxy); bỏ trống thì lấy từ request
+CLIP_CACHE_PUBLIC_BASE_URL = os.getenv("CLIP_CACHE_PUBLIC_BASE_URL", "").rstrip('/')
 
 # Kiểm tra xem tất cả các biến cấu hình S3 cần thiết có giá trị hay không
 S3_CONFIGURED = all([
@@ -102,9 +267,24 @@ S3_CONFIGURED = all([
     AWS_SECRET_ACCESS_KEY,
     AWS_S3_BUCKET_NAME,
     AWS_S3_REGION
-])
+]) or LOCAL_BACKENDS
 # ------------------------------------------
 
+# --- Cấu hình Cache phản hồi API (/alert_history, /statistics/weekly) ---
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL_S = int(os.getenv("RESPONSE_CACHE_TTL_S", 300)) # Giới hạn độ cũ (ví dụ khi sang ngày/tuần mới)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 256))
+
+# --- Cấu hình luồng trực tiếp (SSE /stream/levels) ---
+# Tắt ghi audio level lên RTDB khi app đã chuyển sang dùng SSE để tiết kiệm băng thông RTDB
+RTDB_AUDIO_LEVELS_ENABLED = os.getenv("RTDB_AUDIO_LEVELS_ENABLED", "true").lower() in ("1", "true", "yes")
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", 50))
+SSE_SUBSCRIBER_QUEUE_SIZE = 256 # Số sự kiện tối đa chờ cho mỗi client; client chậm sẽ mất sự kiện cũ nhất
+SSE_KEEPALIVE_S = 15
+
+# --- Cấu hình đo hiệu năng (/metrics) ---
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
 # --- Cấu hình Scheduler --- (Giữ nguyên)
 SCHEDULE_ENABLED = False
 NOTIFICATION_INTERVAL_SECONDS = 60
@@ -115,19 +295,38 @@ LOG_LEVEL_STR = os.getenv("LOG_LEVEL", "INFO").upper()
 LOG_LEVEL = getattr(logging, LOG_LEVEL_STR, logging.INFO) # Chuyển chuỗi thành level của logging
 LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(threadName)s] - %(module)s:%(lineno)d - %(message)s'
 
+# Ghi log qua hàng đợi + luồng nền (xem app/log_setup.py) để luồng UDP không chờ I/O
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000)) # Hàng đợi đầy thì bỏ record thay vì chặn
+# Log từng chunk của udp_server: chỉ giữ 1/N chunk thường (không hét), và tối đa bao nhiêu dòng/giây mỗi thiết bị
+LOG_CHUNK_SAMPLE_EVERY = int(os.getenv("LOG_CHUNK_SAMPLE_EVERY", 10))
+LOG_CHUNK_MAX_PER_S = float(os.getenv("LOG_CHUNK_MAX_PER_S", 2)) # 0 = không giới hạn
+LOG_CHUNK_BURST = int(os.getenv("LOG_CHUNK_BURST", 5))
+
 # --- Khởi tạo Logging ---
-# Xóa các handler cũ để tránh log bị lặp nếu file config được load lại
-root_logger = logging.getLogger()
-if root_logger.hasHandlers():
-    root_logger.handlers.clear()
-logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+from . import log_setup
+log_setup.install(LOG_LEVEL, LOG_FORMAT, async_enabled=LOG_ASYNC, queue_size=LOG_QUEUE_SIZE)
+
+# --- Giới hạn pool OpenMP/MKL (phải trước khi module nào import torch/numpy) ---
+from . import torch_runtime
+torch_runtime.prepare_env()
 
 # --- Log thông tin cấu hình ---
 logging.info(f"--- Cấu hình ứng dụng đã được tải (Log Level: {LOG_LEVEL_STR}) ---")
 logging.info(f"ML Device: {ML_DEVICE}")
 logging.info(f"Flask Server: {FLASK_HOST}:{FLASK_PORT}")
-logging.info(f"UDP Listener: {UDP_HOST}:{UDP_PORT}")
+logging.info(f"UDP Listener: {UDP_HOST}:{UDP_PORT} (Ingest mode: {INGEST_MODE})")
 logging.info(f"Scream Alert: Min Consecutive Chunks = {SCREAM_MIN_CONSECUTIVE_CHUNKS}, Frequency = {SCREAM_FREQUENCY_COUNT} times in {SCREAM_FREQUENCY_WINDOW_S}s, Cooldown = {SCREAM_ALERT_COOLDOWN_S}s")
+if MODEL_FEATURE_PIPELINE not in ('auto', 'fused', 'pil'):
+    logging.error(f"MODEL_FEATURE_PIPELINE='{MODEL_FEATURE_PIPELINE}' không hợp lệ, dùng 'auto'.")
+    MODEL_FEATURE_PIPELINE = 'auto'
+for _unknown_model in [name for name in EXTRA_MODELS if name not in MODEL_CATALOG]:
+    logging.error(f"EXTRA_MODELS: '{_unknown_model}' không có trong MODEL_CATALOG, bỏ qua.")
+EXTRA_MODELS = [name for name in EXTRA_MODELS if name in MODEL_CATALOG]
+if EXTRA_MODELS:
+    logging.info(f"Extra Detectors: {', '.join(EXTRA_MODELS)}")
+if LOCAL_BACKENDS:
+    logging.warning(f"Local Backends: BẬT - Firestore/RTDB/FCM/S3 là bản giả lập cục bộ (độ trễ: '{LOCAL_BACKENDS_LATENCY_MS or 'không'}').")
 if S3_CONFIGURED:
     logging.info(f"AWS S3 Saving: Enabled, Bucket={AWS_S3_BUCKET_NAME}, Region={AWS_S3_REGION}, Folder={AWS_S3_AUDIO_FOLDER}, URL Expires={AWS_S3_URL_EXPIRATION_S}s")
 else:
@@ -0,0 +1,110 @@
+# app/event_bus.py
+# Bus pub/sub trong process: luồng UDP publish kết quả từng chunk (RMS, dự đoán, độ tin cậy)
+# và các sự kiện cảnh báo; các subscriber (ví dụ route SSE /stream/levels) nhận qua hàng đợi riêng.
+# publish() KHÔNG BAO GIỜ chặn luồng ingest: hàng đợi của subscriber chậm bị đầy thì
+# bỏ sự kiện cũ nhất và tăng bộ đếm 'dropped' của subscriber đó.
+import logging
+import threading
+import itertools
+from collections import deque
+
+from . import config
+from . import metrics
+
+_subscribers = {} # id -> Subscriber
+_subscribers_lock = threading.Lock()
+_id_counter = itertools.count(1)
+_stats = {'published': 0, 'delivered': 0, 'dropped': 0}
+
+
+class TooManySubscribersError(RuntimeError):
+    """Đã đạt giới hạn SSE_MAX_SUBSCRIBERS."""
+
+
+class Subscriber:
+    """Hàng đợi có giới hạn cho một consumer, có thể lọc theo thiết bị."""
+
+    def __init__(self, device: str | None, maxlen: int):
+        self.id = next(_id_counter)
+        self.device = device
+        self.dropped = 0
+        self._queue = deque()
+        self._maxlen = maxlen
+        self._cond = threading.Condition()
+
+    def _offer(self, event: dict) -> bool:
+        """Đưa sự kiện vào hàng đợi, bỏ sự kiện cũ nhất nếu đầy. Trả về False nếu có drop."""
+        with self._cond:
+            dropped = False
+            if len(self._queue) >= self._maxlen:
+                self._queue.popleft()
+                self.dropped += 1
+                dropped = True
+            self._queue.append(event)
+            self._cond.notify()
+        return not dropped
+
+    def get(self, timeout: float) -> dict | None:
+        """Lấy sự kiện tiếp theo, chờ tối đa timeout giây. Trả về None nếu hết thời gian."""
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(timeout)
+            if self._queue:
+                return self._queue.popleft()
+            return None
+
+
+def subscribe(device: str | None = None) -> Subscriber:
+    """Đăng ký nhận sự kiện (tất cả thiết bị nếu device=None)."""
+    with _subscribers_lock:
+        if len(_subscribers) >= config.SSE_MAX_SUBSCRIBERS:
+            raise TooManySubscribersError(f"Đã có {len(_subscribers)} subscriber")
+        sub = Subscriber(device, config.SSE_SUBSCRIBER_QUEUE_SIZE)
+        _subscribers[sub.id] = sub
+    logging.info(f"Event Bus: Subscriber #{sub.id} đăng ký (device={device or 'all'}).")
+    return sub
+
+
+def unsubscribe(sub: Subscriber):
+    with _subscribers_lock:
+        _subscribers.pop(sub.id, None)
+    logging.info(f"Event Bus: Subscriber #{sub.id} hủy đăng ký (dropped={sub.dropped}).")
+
+
+def has_subscribers() -> bool:
+    # Đọc len() không cần lock; dùng để bỏ qua việc tạo event khi không ai nghe
+    return bool(_subscribers)
+
+
+def publish(event: dict):
+    """Gửi sự kiện tới các subscriber phù hợp. Sự kiện phải có khóa 'device'."""
+    if not _subscribers:
+        return
+    with _subscribers_lock:
+        targets = [s for s in _subscribers.values() if s.device is None or s.device == event.get('device')]
+    delivered = dropped = 0
+    for sub in targets:
+        delivered += 1
+        if not sub._offer(event):
+            dropped += 1
+    with _subscribers_lock:
+        _stats['published'] += 1
+        _stats['delivered'] += delivered
+        _stats['dropped'] += dropped
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics (đăng ký ở process chạy pipeline ingest)."""
+    stats = get_stats()
+    lines = []
+    for name in ('published', 'delivered', 'dropped'):
+        lines += metrics.gauge_lines(f'scream_event_bus_{name}_total', f'Event bus: số sự kiện {name}.', stats[name], 'counter')
+    lines += metrics.gauge_lines('scream_event_bus_subscribers', 'Số subscriber đang kết nối.', stats['subscribers'])
+    return lines
+
+
+def get_stats() -> dict:
+    with _subscribers_lock:
+        stats = dict(_stats)
+        stats['subscribers'] = len(_subscribers)
+    return stats
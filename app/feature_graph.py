@@ -0,0 +1,58 @@
+# app/feature_graph.py
+# Đồ thị đặc trưng hợp nhất (MODEL_FEATURE_PIPELINE): waveform đã pad -> log-mel -> chuẩn hóa min-max
+# -> colormap viridis -> image tensor (B, 3, H, W), toàn bộ là phép tính tensor theo batch trên device,
+# thay cho matplotlib -> PNG -> PIL Resize -> ToTensor của ml_handler._spectrogram_to_image_tensor.
+# Cho ra cùng ảnh với đường PIL:
+#   - imshow(origin='lower'): hàng mel thấp nhất nằm dưới cùng ảnh -> lật theo trục mel;
+#   - colormap 256 mức của matplotlib, ghi PNG 8-bit -> bảng tra (256, 3) giá trị uint8 / 255;
+#   - chỉ resize (bilinear, antialias như PIL) khi kích thước mel khác MODEL_IMG_SIZE.
+# Là một nn.Module nên ghép được với model rồi torch.jit.trace thành một graph (tools/export_traced.py).
+# Module này import torch ở đầu: ml_handler chỉ import nó sau khi đã import thư viện ML.
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+COLORMAP_LEVELS = 256
+
+
+def colormap_lut(name: str = 'viridis') -> torch.Tensor:
+    """Bảng màu (COLORMAP_LEVELS, 3) float [0, 1] đúng như pixel PNG matplotlib ghi ra."""
+    import matplotlib
+    rgba = matplotlib.colormaps[name](np.arange(COLORMAP_LEVELS), bytes=True)
+    return torch.from_numpy(rgba[:, :3].astype(np.float32) / 255.0)
+
+
+class FeatureGraph(torch.nn.Module):
+    """Waveform (B, MODEL_TARGET_LENGTH_SAMPLES) -> image tensor (B, 3, H, W) cho model."""
+
+    def __init__(self, mel_transform, lut: torch.Tensor, img_size):
+        super().__init__()
+        self.mel_transform = mel_transform
+        self.register_buffer('lut', lut)
+        self.img_size = tuple(img_size)
+
+    def forward(self, waveform):
+        spec = (self.mel_transform(waveform) + 1e-10).log2() # (B, n_mels, frames)
+        # Chuẩn hóa 0-1 theo từng chunk trong batch (một phép tính cho cả batch)
+        flat = spec.flatten(1)
+        spec_min = flat.amin(dim=1).view(-1, 1, 1)
+        span = flat.amax(dim=1).view(-1, 1, 1) - spec_min
+        spec_norm = torch.where(span > 0, (spec - spec_min) / span.clamp_min(1e-12), torch.zeros_like(spec))
+        # Như Colormap của matplotlib: mức = int(x * N), x == 1.0 rơi vào mức cuối
+        levels = (spec_norm * COLORMAP_LEVELS).long().clamp(0, COLORMAP_LEVELS - 1)
+        image = self.lut[levels.flip(1)].permute(0, 3, 1, 2) # (B, 3, n_mels, frames)
+        if tuple(image.shape[-2:]) != self.img_size:
+            image = F.interpolate(image, size=self.img_size, mode='bilinear', align_corners=False, antialias=True)
+        return image.contiguous()
+
+
+def mel_shape(mel_transform, num_samples: int) -> tuple[int, int]:
+    """Kích thước (n_mels, frames) của mel spectrogram cho waveform num_samples mẫu (STFT center=True)."""
+    return mel_transform.n_mels, num_samples // mel_transform.hop_length + 1
+
+
+def build(mel_transform, img_size, device, lut: torch.Tensor | None = None) -> FeatureGraph:
+    """lut: bảng màu đã có (vd. từ cache của ml_handler); None = lấy từ matplotlib."""
+    graph = FeatureGraph(mel_transform, colormap_lut() if lut is None else lut, img_size).to(device)
+    graph.eval()
+    return graph
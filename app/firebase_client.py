@@ -1,6 +1,6 @@
 # app/firebase_client.py
-import firebase_admin
-from firebase_admin import credentials, messaging, db, firestore
+# firebase_admin (kéo theo google-cloud-firestore, grpc) được import trong từng hàm
+# để process web khởi động nhanh; initialize_firebase() thường chạy ở luồng nền.
 # <<< BỎ IMPORT FieldPath >>>
 # from google.cloud.firestore_v1.field_path import FieldPath
 # <<< KẾT THÚC BỎ IMPORT >>>
@@ -12,6 +12,9 @@ import datetime
 # Import cấu hình và quản lý token
 from . import config
 from . import token_storage # Cần truy cập token_storage để lấy danh sách token
+from . import alert_stats # Bộ đếm rollup thống kê cảnh báo theo ngày
+from . import response_cache # Xóa cache API khi có cảnh báo mới
+from . import event_bus # Báo cho worker web (qua IPC) biết có cảnh báo mới
 
 _firebase_initialized = False
 _cred = None
@@ -21,6 +24,14 @@ _firestore_db = None # Biến lưu trữ Firestore client
 def initialize_firebase():
     """Khởi tạo Firebase Admin SDK cho cả FCM, RTDB (nếu cần) và Firestore."""
     global _firebase_initialized, _cred, _db_ref, _firestore_db
+    if config.LOCAL_BACKENDS:
+        from . import local_backends
+        _db_ref = local_backends.get_rtdb_reference()
+        _firestore_db = local_backends.get_firestore()
+        _firebase_initialized = True
+        return True
+    import firebase_admin
+    from firebase_admin import credentials, db, firestore
     if _firebase_initialized:
         logging.info("Firebase Client: Firebase Admin SDK đã được khởi tạo trước đó.")
         return True
@@ -67,6 +78,10 @@ def initialize_firebase():
         logging.error(f"Firebase Client: Lỗi không xác định khi khởi tạo Firebase Admin SDK: {e}", exc_info=True)
         return False
 
+def is_initialized() -> bool:
+    """Firebase Admin SDK đã khởi tạo xong (dùng cho /ready)."""
+    return _firebase_initialized
+
 # --- Hàm send_fcm_notification và send_alert_to_all giữ nguyên như cũ ---
 def send_fcm_notification(token: str, title: str, body: str, data: dict = None) -> bool:
     """
@@ -75,6 +90,10 @@ def send_fcm_notification(token: str, title: str, body: str, data: dict = None)
     if not _firebase_initialized:
         logging.warning("Firebase Client: Bỏ qua gửi FCM do Firebase Admin SDK chưa được khởi tạo.")
         return False
+    if config.LOCAL_BACKENDS:
+        from . import local_backends
+        return local_backends.send_fcm(token, title, body, data)
+    from firebase_admin import messaging
     try:
         message = messaging.Message(
             notification=messaging.Notification(
@@ -149,6 +168,7 @@ def write_audio_level(client_ip: str, amplitude: float, timestamp: float):
     if not _firebase_initialized or _db_ref is None:
         logging.debug("Firebase Client: Firebase RTDB chưa sẵn sàng, không thể ghi audio level.")
         return
+    import firebase_admin.exceptions
 
     try:
         safe_client_ip = client_ip.replace('.', '-')
@@ -168,16 +188,23 @@ def write_audio_level(client_ip: str, amplitude: float, timestamp: float):
         logging.error(f"Firebase Client: Lỗi không xác định khi ghi audio level cho {client_ip} vào RTDB: {e}", exc_info=True)
 
 # --- Hàm ghi lịch sử cảnh báo vào Firestore ---
-def log_alert_to_firestore(client_ip: str, s3_key: str | None):
-    """Ghi lại sự kiện cảnh báo vào collection 'alert_history' trên Firestore."""
+def log_alert_to_firestore(client_ip: str, s3_key: str | None) -> str | None:
+    """
+    Ghi lại sự kiện cảnh báo vào collection 'alert_history' trên Firestore,
+    đồng thời tăng bộ đếm rollup theo ngày/thiết bị (xem alert_stats.py) trong cùng một batch.
+    s3_key: chỉ truyền key của clip ĐÃ upload thành công (clip upload xong sau đó: attach_alert_audio).
+    Trả về ID document, hoặc None nếu không ghi được.
+    """
     if not _firestore_db:
         logging.warning("Firestore client not available. Cannot log alert history.")
-        return
+        return None
 
     try:
-        collection_ref = _firestore_db.collection('alert_history')
+        collection_ref = _firestore_db.collection(alert_stats.ALERT_HISTORY_COLLECTION)
+        # Dùng một thời điểm cho cả document và ngày rollup (SERVER_TIMESTAMP chỉ biết được sau khi commit)
+        alert_time = datetime.datetime.now(datetime.timezone.utc)
         alert_data = {
-            'timestamp': firestore.SERVER_TIMESTAMP,
+            'timestamp': alert_time,
             'client_ip': client_ip,
         }
         if s3_key:
@@ -187,11 +214,55 @@ def log_alert_to_firestore(client_ip: str, s3_key: str | None):
             # alert_data['s3_key'] = s3_key # Nếu đã đổi thành s3_key
 
         doc_ref = collection_ref.document()
-        doc_ref.set(alert_data)
-        logging.info(f"Alert for {client_ip} logged to Firestore collection 'alert_history' with ID: {doc_ref.id}")
+        # Ghi cảnh báo và tăng rollup nguyên tử để số liệu thống kê không bị lệch
+        batch = _firestore_db.batch()
+        batch.set(doc_ref, alert_data)
+        day_key = alert_stats.add_rollup_increment(batch, _firestore_db, client_ip, alert_time)
+        batch.commit()
+        response_cache.invalidate(f"alert logged for {client_ip}")
+        # Worker web chạy ở process khác nhận sự kiện này qua ingest_ipc để xóa cache của chúng
+        event_bus.publish({'type': 'alert_logged', 'device': client_ip, 'alert_id': doc_ref.id,
+                           's3_key': s3_key, 'timestamp': alert_time.timestamp()})
+        logging.info(f"Alert for {client_ip} logged to Firestore collection 'alert_history' with ID: {doc_ref.id} (rollup day: {day_key})")
+        return doc_ref.id
 
     except Exception as e:
         logging.error(f"Error logging alert to Firestore for IP {client_ip}: {e}", exc_info=True)
+        return None
+
+def log_detector_alert_to_firestore(client_ip: str, alert_type: str) -> str | None:
+    """
+    Ghi cảnh báo của một detector bổ sung (config.EXTRA_MODELS) vào collection 'detector_alert_history'.
+    Không tăng rollup và không xuất hiện trong /alert_history: các số liệu đó chỉ dành cho tiếng hét.
+    """
+    if not _firestore_db:
+        logging.warning("Firestore client not available. Cannot log detector alert.")
+        return None
+    try:
+        doc_ref = _firestore_db.collection(alert_stats.DETECTOR_ALERT_HISTORY_COLLECTION).document()
+        doc_ref.set({
+            'timestamp': datetime.datetime.now(datetime.timezone.utc),
+            'client_ip': client_ip,
+            'type': alert_type,
+        })
+        logging.info(f"'{alert_type}' alert for {client_ip} logged to Firestore collection "
+                     f"'{alert_stats.DETECTOR_ALERT_HISTORY_COLLECTION}' with ID: {doc_ref.id}")
+        return doc_ref.id
+    except Exception as e:
+        logging.error(f"Error logging '{alert_type}' alert to Firestore for IP {client_ip}: {e}", exc_info=True)
+        return None
+
+def attach_alert_audio(alert_id: str, client_ip: str, s3_key: str):
+    """Ghi s3_key vào document cảnh báo đã có, khi clip upload xong sau lúc cảnh báo được ghi."""
+    if not _firestore_db:
+        logging.warning("Firestore client not available. Cannot attach alert audio.")
+        return
+    try:
+        _firestore_db.collection(alert_stats.ALERT_HISTORY_COLLECTION).document(alert_id).update({'s3_key': s3_key})
+        response_cache.invalidate(f"alert audio attached for {client_ip}")
+        logging.info(f"Attached audio {s3_key} to alert {alert_id} of {client_ip}.")
+    except Exception as e:
+        logging.error(f"Error attaching audio {s3_key} to alert {alert_id}: {e}", exc_info=True)
 
 # --- Hàm _send_periodic_notifications_job giữ nguyên nếu cần ---
 def _send_periodic_notifications_job():
@@ -217,6 +288,7 @@ def get_default_emergency_contact() -> str | None:
     if not _firestore_db:
         logging.error("Firestore client not available. Cannot get emergency contact.")
         return None
+    from firebase_admin import firestore
 
     try:
         # Tham chiếu đến collection 'emergency_contacts'
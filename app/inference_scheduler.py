@@ -0,0 +1,238 @@
+# app/inference_scheduler.py
+# Lập lịch inference theo mức ưu tiên của thiết bị (INFERENCE_BATCHING_ENABLED):
+#   - lane 'hot' : thiết bị vừa có dự đoán dương tính (đang trong mẫu hình cảnh báo) - chạy gần như ngay,
+#                  batch nhỏ, để thời gian tới cảnh báo không tăng;
+#   - lane 'cold': thiết bị im lặng - chờ gom batch lớn hơn để tăng thông lượng (mel + forward theo batch).
+# Mỗi chunk có hạn chót = lúc vào hàng + ngân sách chờ của lane - thời gian ước tính để chạy batch
+# (trung bình trượt thời gian xử lý mỗi chunk của lane), nên khi model chậm đi thì batch được flush sớm hơn.
+# Một luồng worker chạy batch qua ml_handler.predict_all_batch rồi gọi result_handler cho từng chunk theo thứ tự;
+# result_handler chỉ cập nhật trạng thái phát hiện (cảnh báo được gửi ở app/alert_dispatch.py).
+# Khi dừng: hàng đợi được chạy hết, is_running() vẫn True cho tới khi worker xong và submit() từ chối chunk
+# mới, để nơi gọi không chạy inference inline vượt lên trước các chunk còn chờ của cùng thiết bị.
+import logging
+import threading
+import time
+from collections import deque
+
+import torch
+
+from . import config
+from . import metrics
+from . import ml_handler
+from . import torch_runtime
+
+LANES = ('hot', 'cold')
+
+
+class _Item:
+    __slots__ = ('device', 'chunk', 'timestamp', 'rms', 'address', 'enqueued_at', 'deadline')
+
+    def __init__(self, device, chunk, timestamp, rms, address, enqueued_at, deadline):
+        self.device = device
+        self.chunk = chunk
+        self.timestamp = timestamp
+        self.rms = rms
+        self.address = address
+        self.enqueued_at = enqueued_at
+        self.deadline = deadline
+
+
+class _Lane:
+    def __init__(self, name: str, max_wait_s: float, max_batch: int):
+        self.name = name
+        self.max_wait_s = max_wait_s
+        self.max_batch = max(1, max_batch)
+        self.items = deque()
+        self.seconds_per_chunk = 0.0 # Trung bình trượt thời gian inference mỗi chunk (theo batch)
+        self.batches = 0
+        self.chunks = 0
+
+    def deadline(self, now: float) -> float:
+        expected_batch = min(len(self.items) + 1, self.max_batch)
+        return now + max(0.0, self.max_wait_s - self.seconds_per_chunk * expected_batch)
+
+
+_cond = threading.Condition()
+_lanes = {}
+_stopping = False
+_generation = 0 # Tăng mỗi lần start(): worker của lần chạy trước (bị kẹt khi dừng) tự thoát
+_worker = None
+_result_handler = None # fn(item, predictions: dict) gọi ở luồng worker
+_dropped = 0
+
+
+def _make_lanes() -> dict:
+    return {
+        'hot': _Lane('hot', config.INFERENCE_HOT_MAX_WAIT_MS / 1000.0, config.INFERENCE_HOT_MAX_BATCH),
+        'cold': _Lane('cold', config.INFERENCE_COLD_MAX_WAIT_MS / 1000.0, config.INFERENCE_COLD_MAX_BATCH),
+    }
+
+
+def start(result_handler):
+    """
+    Khởi động luồng worker. result_handler(item, predictions) xử lý kết quả của từng chunk.
+    Gọi sau stop() (kể cả khi worker cũ còn đang chạy nốt hàng đợi) sẽ chờ worker cũ rồi chạy lại từ đầu.
+    """
+    global _worker, _result_handler, _stopping, _lanes, _generation
+    old_worker = _worker
+    if old_worker is not None and old_worker.is_alive():
+        with _cond:
+            stopping = _stopping
+        if not stopping:
+            return
+        # stop() chưa xong: chờ worker cũ chạy hết hàng đợi để kết quả không bị đảo thứ tự
+        old_worker.join(timeout=config.SHUTDOWN_DRAIN_TIMEOUT_S)
+        if old_worker.is_alive():
+            logging.warning(f"Inference Scheduler: Worker cũ chưa dừng, bỏ {queue_depth()} chunk còn chờ.")
+    with _cond:
+        _generation += 1
+        _lanes = _make_lanes()
+        _stopping = False
+        generation = _generation
+    _result_handler = result_handler
+    _worker = threading.Thread(target=_worker_loop, args=(generation,), name="InferenceScheduler", daemon=True)
+    _worker.start()
+    logging.info(f"Inference Scheduler: hot (chờ {config.INFERENCE_HOT_MAX_WAIT_MS}ms, batch {config.INFERENCE_HOT_MAX_BATCH}), "
+                 f"cold (chờ {config.INFERENCE_COLD_MAX_WAIT_MS}ms, batch {config.INFERENCE_COLD_MAX_BATCH}).")
+
+
+def stop(timeout_s: float) -> bool:
+    """
+    Ngừng nhận chunk mới, chạy hết hàng đợi (không chờ hạn chót) tối đa timeout_s giây. True nếu xong.
+    Trong lúc chạy hết hàng đợi is_running() vẫn True và submit() trả về False.
+    """
+    global _stopping
+    worker = _worker
+    if worker is None:
+        return True
+    with _cond:
+        _stopping = True
+        _cond.notify_all()
+    worker.join(timeout=max(0.0, timeout_s))
+    if worker.is_alive():
+        logging.warning(f"Inference Scheduler: Còn {queue_depth()} chunk chưa xử lý khi dừng.")
+        return False
+    return True
+
+
+def is_running() -> bool:
+    """True từ start() cho tới khi worker chạy hết hàng đợi sau stop()."""
+    worker = _worker
+    return worker is not None and worker.is_alive()
+
+
+def submit(device: str, chunk, timestamp: float, rms: float, lane_name: str, address=None) -> bool:
+    """
+    Đưa một chunk vào lane. Chunk của thiết bị chuyển sang 'hot' kéo theo các chunk còn chờ ở 'cold', và
+    thiết bị còn chunk chờ ở 'hot' thì chunk mới cũng vào 'hot' (dù đã nguội), để kết quả của thiết bị
+    vẫn theo đúng thứ tự. Trả về False nếu chunk bị bỏ (đang dừng).
+    """
+    global _dropped
+    now = time.monotonic()
+    with _cond:
+        if _stopping or not _lanes:
+            return False
+        if lane_name == 'cold' and any(item.device == device for item in _lanes['hot'].items):
+            lane_name = 'hot'
+        lane = _lanes[lane_name]
+        if lane_name == 'hot':
+            cold = _lanes['cold']
+            if any(item.device == device for item in cold.items):
+                promoted = [item for item in cold.items if item.device == device]
+                cold.items = deque(item for item in cold.items if item.device != device)
+                for item in promoted:
+                    item.deadline = now
+                lane.items.extend(promoted)
+        if sum(len(l.items) for l in _lanes.values()) >= config.INFERENCE_QUEUE_MAX:
+            # Quá tải: bỏ chunk cũ nhất của lane cold trước, hot chỉ khi cold trống
+            victim_lane = _lanes['cold'] if _lanes['cold'].items else _lanes['hot']
+            victim = victim_lane.items.popleft()
+            _dropped += 1
+            metrics.DROPS.inc(victim.device, 'inference_queue_full')
+        lane.items.append(_Item(device, chunk, timestamp, rms, address, now, lane.deadline(now)))
+        _cond.notify()
+    return True
+
+
+def _ready_lane(now: float):
+    for name in LANES:
+        lane = _lanes[name]
+        if lane.items and (_stopping or len(lane.items) >= lane.max_batch or lane.items[0].deadline <= now):
+            return lane
+    return None
+
+
+def _worker_loop(generation: int):
+    torch_runtime.pin_current_thread()
+    while True:
+        with _cond:
+            while True:
+                if generation != _generation:
+                    return # start() đã thay worker này
+                now = time.monotonic()
+                lane = _ready_lane(now)
+                if lane is not None:
+                    batch = [lane.items.popleft() for _ in range(min(len(lane.items), lane.max_batch))]
+                    break
+                if _stopping:
+                    return
+                deadlines = [l.items[0].deadline for l in _lanes.values() if l.items]
+                _cond.wait(timeout=max(0.0, min(deadlines) - now) if deadlines else None)
+        _run_batch(lane, batch)
+
+
+def _run_batch(lane: _Lane, batch: list):
+    try:
+        start = time.perf_counter()
+        results = ml_handler.predict_all_batch(torch.stack([item.chunk for item in batch]))
+        elapsed = time.perf_counter() - start
+    except Exception as e:
+        logging.error(f"Inference Scheduler: Lỗi khi chạy batch {len(batch)} chunk ({lane.name}): {e}", exc_info=True)
+        results = [{config.PRIMARY_MODEL_NAME: (None, 0.0)} for _ in batch]
+        elapsed = 0.0
+    with _cond:
+        per_chunk = elapsed / len(batch)
+        lane.seconds_per_chunk = per_chunk if lane.batches == 0 else 0.8 * lane.seconds_per_chunk + 0.2 * per_chunk
+        lane.batches += 1
+        lane.chunks += len(batch)
+    metrics.INFERENCE_BATCH_SIZE.observe(len(batch), lane.name)
+    for item, predictions in zip(batch, results):
+        try:
+            _result_handler(item, predictions)
+        except Exception as e:
+            logging.error(f"Inference Scheduler: Lỗi khi xử lý kết quả của {item.device}: {e}", exc_info=True)
+        metrics.INFERENCE_LANE_SECONDS.observe(time.monotonic() - item.enqueued_at, lane.name)
+
+
+def queue_depth() -> int:
+    with _cond:
+        return sum(len(lane.items) for lane in _lanes.values())
+
+
+def get_stats() -> dict:
+    with _cond:
+        return {
+            'enabled': config.INFERENCE_BATCHING_ENABLED,
+            'dropped': _dropped,
+            'lanes': {
+                name: {
+                    'queued': len(lane.items),
+                    'batches': lane.batches,
+                    'chunks': lane.chunks,
+                    'avg_batch': round(lane.chunks / lane.batches, 2) if lane.batches else None,
+                    'seconds_per_chunk': round(lane.seconds_per_chunk, 5),
+                }
+                for name, lane in _lanes.items()
+            },
+        }
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics (độ trễ theo lane nằm ở scream_inference_lane_latency_seconds)."""
+    if not config.INFERENCE_BATCHING_ENABLED:
+        return []
+    stats = get_stats()
+    lines = []
+    for name, lane in stats['lanes'].items():
+        lines += metrics.gauge_lines(f'scream_inference_{name}_queue_depth', f'Số chunk đang chờ ở lane {name}.', lane['queued'])
+    return lines
@@ -0,0 +1,229 @@
+# app/ingest_cluster.py
+# Chạy nhiều node ingest song song (CLUSTER_ENABLED): mỗi node sở hữu một phần thiết bị theo
+# consistent hashing (CLUSTER_VNODES điểm ảo mỗi node trên vòng hash), nên khi thêm/bớt node chỉ
+# khoảng 1/N thiết bị đổi chủ.
+#
+# Giao thức:
+#   - Announce: mỗi node ghi heartbeat (node_id, địa chỉ UDP) vào cluster_store mỗi CLUSTER_HEARTBEAT_S giây;
+#     node không heartbeat trong CLUSTER_NODE_TTL_S giây bị coi là đã rời cụm. Dừng node thì xóa ngay.
+#   - Redirect (CLUSTER_REDIRECT_ENABLED, cần firmware hỗ trợ): gói audio đến node không phải chủ của thiết bị
+#     bị bỏ qua; node gửi về địa chỉ nguồn của gói một datagram UTF-8 "REDIRECT:<host>:<port>" (cùng kênh với
+#     lệnh "CALL:<số>"), tối đa mỗi CLUSTER_REDIRECT_INTERVAL_S giây, để ESP32 chuyển sang node chủ.
+#     Mặc định tắt: node vẫn xử lý thiết bị không thuộc mình (chỉ ghi log/đếm).
+#   - Cooldown/chống trùng cảnh báo nằm trong cluster_store (claim_alert), nên thiết bị vừa chuyển node
+#     không bị cảnh báo lại trong thời gian cooldown.
+import bisect
+import hashlib
+import logging
+import socket
+import threading
+import time
+
+from . import cluster_store
+from . import config
+from . import metrics
+
+_lock = threading.Lock()
+_ring = None # HashRing hiện tại (None = chưa tham gia cụm)
+_members = {} # node_id -> địa chỉ UDP "host:port"
+_node_id = None
+_address = None
+_last_redirects = {} # thiết bị -> thời điểm gửi REDIRECT / ghi log gói sai node gần nhất (dọn ở mỗi heartbeat)
+_stats = {'redirects': 0, 'foreign_packets': 0, 'rebalances': 0, 'claims_won': 0, 'claims_lost': 0, 'store_errors': 0}
+_stop_heartbeat = threading.Event()
+_heartbeat_thread = None
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Vòng consistent hashing: thiết bị thuộc node có điểm ảo đầu tiên >= hash(thiết bị)."""
+
+    def __init__(self, node_ids, vnodes: int):
+        points = sorted((_hash(f"{node_id}#{i}"), node_id) for node_id in node_ids for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node_id for _, node_id in points]
+
+    def owner(self, device: str) -> str | None:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(device)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def node_id() -> str:
+    """ID của node này: CLUSTER_NODE_ID, hoặc '<hostname>-<UDP_PORT>'."""
+    global _node_id
+    if _node_id is None:
+        _node_id = config.CLUSTER_NODE_ID or f"{socket.gethostname()}-{config.UDP_PORT}"
+    return _node_id
+
+
+def _advertise_address() -> str:
+    """Địa chỉ UDP mà thiết bị dùng để gửi tới node này."""
+    if config.CLUSTER_ADVERTISE_ADDR:
+        return config.CLUSTER_ADVERTISE_ADDR
+    host = config.UDP_HOST
+    if host in ('0.0.0.0', ''):
+        try:
+            host = socket.gethostbyname(socket.gethostname())
+        except OSError:
+            host = '127.0.0.1'
+    return f"{host}:{config.UDP_PORT}"
+
+
+def _refresh():
+    """Heartbeat rồi dựng lại vòng hash nếu danh sách node thay đổi."""
+    global _ring, _members
+    now = time.time()
+    store = cluster_store.get_store()
+    store.heartbeat(node_id(), _address, now)
+    members = store.live_nodes(now - config.CLUSTER_NODE_TTL_S)
+    members[node_id()] = _address # Luôn có chính mình, kể cả khi store trả về chậm
+    with _lock:
+        if members == _members and _ring is not None:
+            return
+        joined = sorted(set(members) - set(_members))
+        left = sorted(set(_members) - set(members))
+        _members = members
+        _ring = HashRing(sorted(members), config.CLUSTER_VNODES)
+        _stats['rebalances'] += 1
+    logging.info(f"Ingest Cluster: {len(members)} node trong cụm (tham gia: {joined or '-'}, rời: {left or '-'}).")
+
+
+def _prune_redirects(now: float):
+    """Bỏ các mục _last_redirects đã quá CLUSTER_REDIRECT_INTERVAL_S (thiết bị đã chuyển đi hoặc ngừng gửi)."""
+    with _lock:
+        for device in [d for d, ts in _last_redirects.items() if now - ts >= config.CLUSTER_REDIRECT_INTERVAL_S]:
+            del _last_redirects[device]
+
+
+def _heartbeat_loop():
+    while not _stop_heartbeat.wait(config.CLUSTER_HEARTBEAT_S):
+        _prune_redirects(time.time())
+        try:
+            _refresh()
+        except Exception as e:
+            # Giữ vòng hash cũ: tốt hơn là đột ngột coi mình là node duy nhất
+            with _lock:
+                _stats['store_errors'] += 1
+            logging.error(f"Ingest Cluster: Lỗi heartbeat/cập nhật danh sách node: {e}")
+
+
+def start():
+    """Tham gia cụm (gọi khi khởi động UDP listener). Không làm gì nếu CLUSTER_ENABLED=false."""
+    global _address, _heartbeat_thread
+    if not config.CLUSTER_ENABLED:
+        return
+    _address = _advertise_address()
+    try:
+        _refresh()
+    except Exception as e:
+        logging.error(f"Ingest Cluster: Không thể tham gia cụm qua cluster store: {e}. Tạm xử lý mọi thiết bị.")
+    _stop_heartbeat.clear()
+    _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name="ClusterHeartbeat", daemon=True)
+    _heartbeat_thread.start()
+    logging.info(f"Ingest Cluster: Node '{node_id()}' ({_address}) đã tham gia cụm.")
+
+
+def stop():
+    """Rời cụm: xóa heartbeat để các node khác nhận thiết bị của node này ngay ở lần cập nhật tới."""
+    global _ring
+    if not config.CLUSTER_ENABLED or _heartbeat_thread is None:
+        return
+    _stop_heartbeat.set()
+    _heartbeat_thread.join(timeout=config.CLUSTER_HEARTBEAT_S + 1)
+    try:
+        cluster_store.get_store().remove_node(node_id())
+    except Exception as e:
+        logging.error(f"Ingest Cluster: Không xóa được node '{node_id()}' khỏi cluster store: {e}")
+    with _lock:
+        _ring = None
+        _last_redirects.clear()
+    logging.info(f"Ingest Cluster: Node '{node_id()}' đã rời cụm.")
+
+
+def owns(device: str) -> bool:
+    """Node này có xử lý thiết bị không (luôn True khi không chạy cụm hoặc chưa có vòng hash)."""
+    with _lock:
+        ring = _ring
+    if ring is None:
+        return True
+    return ring.owner(device) == node_id()
+
+
+def redirect_command(device: str) -> str | None:
+    """
+    Lệnh "REDIRECT:<host>:<port>" báo thiết bị chuyển sang node chủ, tối đa một lần mỗi
+    CLUSTER_REDIRECT_INTERVAL_S giây cho mỗi thiết bị (None nếu vừa gửi).
+    """
+    now = time.time()
+    with _lock:
+        owner = _ring.owner(device) if _ring is not None else None
+        address = _members.get(owner)
+        if address is None or now - _last_redirects.get(device, 0.0) < config.CLUSTER_REDIRECT_INTERVAL_S:
+            return None
+        _last_redirects[device] = now
+        _stats['redirects'] += 1
+    logging.info(f"Ingest Cluster: Thiết bị {device} thuộc node '{owner}', chuyển hướng tới {address}.")
+    return f"REDIRECT:{address}"
+
+
+def note_foreign_packet(device: str):
+    """Gói của thiết bị thuộc node khác được xử lý tại chỗ (CLUSTER_REDIRECT_ENABLED=false): đếm + log có giới hạn."""
+    now = time.time()
+    with _lock:
+        _stats['foreign_packets'] += 1
+        owner = _ring.owner(device) if _ring is not None else None
+        if now - _last_redirects.get(device, 0.0) < config.CLUSTER_REDIRECT_INTERVAL_S:
+            return
+        _last_redirects[device] = now
+    logging.info(f"Ingest Cluster: Thiết bị {device} thuộc node '{owner}' nhưng gửi tới node này; vẫn xử lý "
+                 f"(CLUSTER_REDIRECT_ENABLED=false).")
+
+
+def claim_alert(kind: str, device: str, now: float, cooldown_s: float) -> tuple[bool, float]:
+    """
+    Giành quyền gửi cảnh báo `kind` cho thiết bị trên cả cụm. Trả về (True, now) nếu được gửi,
+    (False, thời điểm cảnh báo trước) nếu node khác đã cảnh báo trong cooldown.
+    Khi store lỗi thì vẫn cho gửi: trùng cảnh báo còn hơn bỏ lỡ cảnh báo.
+    Có thể chặn tới vài giây (transaction SQLite/Firestore): không gọi khi đang giữ lock của udp_server.
+    """
+    if not config.CLUSTER_ENABLED:
+        return True, now
+    try:
+        claimed, last_alert = cluster_store.get_store().claim_alert(kind, device, now, cooldown_s, node_id())
+    except Exception as e:
+        with _lock:
+            _stats['store_errors'] += 1
+        logging.error(f"Ingest Cluster: Lỗi claim cảnh báo '{kind}' của {device}, vẫn gửi: {e}")
+        return True, now
+    with _lock:
+        _stats['claims_won' if claimed else 'claims_lost'] += 1
+    if not claimed:
+        logging.info(f"Ingest Cluster: Cảnh báo '{kind}' của {device} đã được gửi lúc {last_alert:.0f} (node khác), bỏ qua.")
+    return claimed, last_alert
+
+
+def get_status() -> dict:
+    with _lock:
+        return {
+            'enabled': config.CLUSTER_ENABLED,
+            'node_id': node_id() if config.CLUSTER_ENABLED else None,
+            'address': _address,
+            'members': dict(_members),
+            'stats': dict(_stats),
+        }
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    if not config.CLUSTER_ENABLED:
+        return []
+    status = get_status()
+    lines = metrics.gauge_lines('scream_cluster_members', 'Số node ingest còn sống trong cụm.', len(status['members']))
+    for name, value in status['stats'].items():
+        lines += metrics.gauge_lines(f'scream_cluster_{name}_total', f'Cụm ingest: {name}.', value, 'counter')
+    return lines
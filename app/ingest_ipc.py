@@ -0,0 +1,360 @@
+# app/ingest_ipc.py
+# Kênh IPC cục bộ giữa process ingest/inference (run_ingest.py) và các worker web Flask.
+# Dùng multiprocessing.connection (TCP localhost hoặc Unix socket, có xác thực authkey).
+#
+# Giao thức: mỗi kết nối gửi một message đầu tiên dạng {'op': ...}
+#   {'op': 'subscribe'}     -> server đẩy liên tục các sự kiện của event_bus (level, detection, alert_logged);
+#                              hàng đợi có giới hạn, bỏ sự kiện cũ nhất khi worker chậm (chỉ dùng cho SSE)
+#   {'op': 'invalidations'} -> server gửi thế hệ dữ liệu hiện tại (response_cache) mỗi khi nó đổi và định kỳ,
+#                              kèm các key S3 vừa upload; chỉ gửi trạng thái mới nhất nên không bao giờ mất
+#                              một lần invalidate
+#   {'op': 'status'}    -> server trả về một dict trạng thái rồi đóng kết nối
+#   {'op': 'metrics'}   -> server trả về text Prometheus của process ingest rồi đóng kết nối
+#
+# Phía web: start_event_relay() giữ kênh 'invalidations' (xóa response cache khi có cảnh báo mới) và mở kênh
+# 'subscribe' khi có client SSE /stream/levels để phát lại sự kiện vào event_bus cục bộ.
+#
+# multiprocessing.connection unpickle mọi message đã qua xác thực: INGEST_IPC_AUTHKEY phải là chuỗi bí mật
+# riêng (check_authkey từ chối chạy với giá trị trống hoặc giá trị mẫu).
+#
+# Bắt tay authkey đọc chặn trên socket: cả hai phía tự bắt tay (không dùng Listener.accept()/Client()) với
+# timeout đọc/ghi trên socket, để một peer im lặng không chặn luồng accept hay request của worker web.
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Connection, answer_challenge, deliver_challenge
+
+from . import config
+from . import event_bus
+from . import metrics
+
+_stop_ipc = threading.Event()
+_relay_connected = threading.Event()
+_seen_generation = None # Thế hệ dữ liệu của process ingest mà worker này đã áp dụng
+# Giá trị mẫu (trong code cũ và .env.example) không được dùng làm authkey
+_PLACEHOLDER_AUTHKEYS = ('', 'change-me-ingest-ipc', 'doi-thanh-chuoi-bi-mat')
+
+
+def check_authkey():
+    """Raise RuntimeError nếu INGEST_IPC_AUTHKEY chưa đặt hoặc còn là giá trị mẫu."""
+    if config.INGEST_IPC_AUTHKEY.strip() in _PLACEHOLDER_AUTHKEYS:
+        raise RuntimeError("INGEST_IPC_AUTHKEY chưa được đặt (hoặc vẫn là giá trị mẫu): đặt một chuỗi bí mật "
+                           "ngẫu nhiên, giống nhau cho process ingest và các worker web.")
+
+
+def _address():
+    """Địa chỉ IPC: đường dẫn Unix socket nếu cấu hình, ngược lại (host, port) TCP."""
+    if config.INGEST_IPC_SOCKET_PATH:
+        return config.INGEST_IPC_SOCKET_PATH
+    return (config.INGEST_IPC_HOST, config.INGEST_IPC_PORT)
+
+
+def _authkey() -> bytes:
+    return config.INGEST_IPC_AUTHKEY.encode('utf-8')
+
+
+_HANDSHAKE_TIMEOUT_S = 5.0
+
+
+def _set_io_timeout(conn: Connection, timeout_s: float):
+    """Đặt SO_RCVTIMEO/SO_SNDTIMEO cho socket của conn: đọc/ghi chặn quá timeout_s giây -> OSError."""
+    timeout_s = max(timeout_s, 0.001) # 0 nghĩa là không giới hạn
+    if sys.platform == 'win32':
+        value = struct.pack('L', int(timeout_s * 1000))
+    else:
+        value = struct.pack('ll', int(timeout_s), int((timeout_s % 1) * 1_000_000))
+    sock = socket.socket(fileno=conn.fileno())
+    try:
+        sock.setblocking(True) # Connection đọc/ghi thẳng trên fd, không dùng được timeout của socket Python
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+    finally:
+        sock.detach()
+
+
+def _open_socket(timeout_s: float) -> socket.socket:
+    address = _address()
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout_s)
+        sock.connect(address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _connect(timeout_s: float) -> Connection:
+    """Như multiprocessing.connection.Client() nhưng kết nối và bắt tay authkey xong trong khoảng timeout_s giây."""
+    deadline = time.monotonic() + timeout_s
+    conn = Connection(_open_socket(timeout_s).detach())
+    try:
+        _set_io_timeout(conn, deadline - time.monotonic())
+        answer_challenge(conn, _authkey())
+        _set_io_timeout(conn, deadline - time.monotonic())
+        deliver_challenge(conn, _authkey())
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+# ==============================================================================
+# Phía process ingest
+# ==============================================================================
+def _serve_subscriber(conn, peer):
+    """Đẩy sự kiện của event_bus tới một worker web. Worker chậm chỉ mất sự kiện của chính nó."""
+    try:
+        subscriber = event_bus.subscribe(None)
+    except event_bus.TooManySubscribersError:
+        logging.warning(f"Ingest IPC: Từ chối subscriber {peer}: quá nhiều subscriber.")
+        conn.close()
+        return
+    try:
+        while not _stop_ipc.is_set():
+            event = subscriber.get(timeout=config.SSE_KEEPALIVE_S)
+            conn.send(event if event is not None else {'type': 'keepalive'})
+    except (OSError, EOFError, BrokenPipeError) as e:
+        logging.info(f"Ingest IPC: Subscriber {peer} ngắt kết nối: {e}")
+    finally:
+        event_bus.unsubscribe(subscriber)
+        conn.close()
+
+
+def _serve_invalidations(conn, peer):
+    """Gửi thế hệ dữ liệu mới nhất mỗi khi nó đổi (và mỗi SSE_KEEPALIVE_S giây để phát hiện mất kết nối)."""
+    from . import response_cache
+    from . import audio_urls
+    sent_generation = None
+    known_seq = 0
+    try:
+        while not _stop_ipc.is_set():
+            if sent_generation is None:
+                generation, last_modified = response_cache.current_generation()
+            else:
+                generation, last_modified = response_cache.wait_for_change(sent_generation, config.SSE_KEEPALIVE_S)
+            known_seq, known_keys = audio_urls.recent_known_keys(known_seq)
+            conn.send({'generation': generation, 'last_modified': last_modified, 'known_keys': known_keys})
+            sent_generation = generation
+    except (OSError, EOFError, BrokenPipeError) as e:
+        logging.info(f"Ingest IPC: Kênh invalidations của {peer} ngắt kết nối: {e}")
+    finally:
+        conn.close()
+
+
+def _handle_connection(conn, peer, status_provider):
+    try:
+        # Bắt tay ở luồng của kết nối (không ở luồng accept); sai authkey -> AuthenticationError
+        _set_io_timeout(conn, _HANDSHAKE_TIMEOUT_S)
+        deliver_challenge(conn, _authkey())
+        answer_challenge(conn, _authkey())
+        # Sau bắt tay: worker web không đọc trong SSE_KEEPALIVE_S * 3 giây thì send() lỗi và kết nối bị đóng
+        _set_io_timeout(conn, max(_HANDSHAKE_TIMEOUT_S, config.SSE_KEEPALIVE_S * 3))
+        if not conn.poll(5.0):
+            conn.close()
+            return
+        request = conn.recv()
+        op = request.get('op') if isinstance(request, dict) else None
+        if op == 'subscribe':
+            _serve_subscriber(conn, peer)
+        elif op == 'invalidations':
+            _serve_invalidations(conn, peer)
+        elif op == 'status':
+            conn.send(status_provider())
+            conn.close()
+        elif op == 'metrics':
+            conn.send(metrics.render())
+            conn.close()
+        else:
+            logging.warning(f"Ingest IPC: Yêu cầu không hợp lệ từ {peer}: {request!r}")
+            conn.close()
+    except (OSError, EOFError) as e:
+        logging.debug(f"Ingest IPC: Lỗi kết nối với {peer}: {e}")
+        conn.close()
+    except AuthenticationError as e:
+        logging.warning(f"Ingest IPC: Từ chối kết nối từ {peer}: {e}")
+        conn.close()
+    except Exception as e:
+        logging.error(f"Ingest IPC: Lỗi không xác định khi xử lý {peer}: {e}", exc_info=True)
+        conn.close()
+
+
+def _ipc_server_loop(status_provider):
+    address = _address()
+    try:
+        listener = Listener(address) # Bắt tay authkey trong _handle_connection
+    except OSError as e:
+        logging.error(f"Ingest IPC: Không thể mở listener tại {address}: {e}")
+        return
+    logging.info(f"Ingest IPC: Đang lắng nghe tại {address}...")
+    try:
+        while not _stop_ipc.is_set():
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # Client ngắt giữa chừng: bỏ qua kết nối này
+                if _stop_ipc.is_set():
+                    break
+                logging.warning(f"Ingest IPC: Lỗi khi chấp nhận kết nối: {e}")
+                continue
+            peer = listener.last_accepted
+            if _stop_ipc.is_set():
+                conn.close()
+                break
+            threading.Thread(target=_handle_connection, args=(conn, peer, status_provider),
+                             name="IngestIPCConn", daemon=True).start()
+    finally:
+        listener.close()
+        logging.info("Ingest IPC: Listener đã đóng.")
+
+
+def start_ipc_server(status_provider) -> threading.Thread:
+    """
+    Khởi chạy server IPC trong process ingest.
+    status_provider: hàm không tham số trả về dict trạng thái (cho op 'status').
+    Raise RuntimeError nếu INGEST_IPC_AUTHKEY chưa được đặt.
+    """
+    check_authkey()
+    _stop_ipc.clear()
+    thread = threading.Thread(target=_ipc_server_loop, args=(status_provider,),
+                              name="IngestIPCServer", daemon=True)
+    thread.start()
+    return thread
+
+
+def stop_ipc_server():
+    _stop_ipc.set()
+    # Kết nối giả (không bắt tay) để accept() thoát ra
+    try:
+        _open_socket(_HANDSHAKE_TIMEOUT_S).close()
+    except OSError:
+        pass
+
+
+# ==============================================================================
+# Phía worker web
+# ==============================================================================
+def _apply_invalidation(message: dict, first: bool):
+    """Message của kênh 'invalidations': xóa response cache khi thế hệ dữ liệu đổi, ghi nhận key S3 đã upload."""
+    from . import response_cache
+    from . import audio_urls
+    global _seen_generation
+    for s3_key in message.get('known_keys') or ():
+        audio_urls.mark_known(s3_key)
+    generation = message['generation']
+    # Vừa (kết nối lại): có thể đã lỡ các lần ghi trong lúc mất kết nối, luôn xóa cache
+    if first or generation != _seen_generation:
+        response_cache.invalidate(f"data generation {generation} (ingest process)",
+                                  generation=generation, last_modified=message['last_modified'])
+        _seen_generation = generation
+
+
+def _relay_event(event: dict, first: bool):
+    if event.get('type') != 'keepalive':
+        event_bus.publish(event)
+
+
+def _subscription_loop(op: str, on_message, wanted=None, connected: threading.Event | None = None):
+    """
+    Giữ một kết nối `op` tới process ingest (kết nối lại với backoff) và gọi on_message(message, first)
+    cho từng message nhận được. wanted: hàm không tham số, trả về False thì đóng kết nối và chờ.
+    """
+    backoff = 1.0
+    while not _stop_ipc.is_set():
+        if wanted is not None and not wanted():
+            _stop_ipc.wait(1.0)
+            continue
+        try:
+            conn = _connect(_HANDSHAKE_TIMEOUT_S)
+        except (OSError, EOFError) as e:
+            logging.warning(f"Ingest IPC Relay: Không kết nối được kênh '{op}' tới process ingest ({e}). Thử lại sau {backoff:.0f}s.")
+            _stop_ipc.wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        except Exception as e:
+            logging.error(f"Ingest IPC Relay: Lỗi xác thực/kết nối kênh '{op}': {e}")
+            _stop_ipc.wait(30.0)
+            continue
+
+        backoff = 1.0
+        first = True
+        logging.info(f"Ingest IPC Relay: Đã kết nối kênh '{op}' tới process ingest.")
+        try:
+            # Server gửi ít nhất mỗi SSE_KEEPALIVE_S giây; recv() kẹt giữa message quá lâu -> coi như mất kết nối
+            _set_io_timeout(conn, max(_HANDSHAKE_TIMEOUT_S, config.SSE_KEEPALIVE_S * 3))
+            conn.send({'op': op})
+            while not _stop_ipc.is_set() and (wanted is None or wanted()):
+                if not conn.poll(1.0):
+                    continue
+                on_message(conn.recv(), first)
+                first = False
+                if connected is not None:
+                    connected.set()
+        except (OSError, EOFError) as e:
+            logging.warning(f"Ingest IPC Relay: Mất kết nối kênh '{op}' tới process ingest: {e}")
+        finally:
+            if connected is not None:
+                connected.clear()
+            conn.close()
+
+
+def start_event_relay() -> list[threading.Thread]:
+    """
+    Khởi chạy các luồng nhận dữ liệu từ process ingest (dùng khi INGEST_MODE='external'):
+      - kênh 'invalidations' luôn kết nối (xóa cache, known keys);
+      - kênh 'subscribe' chỉ mở khi worker có client SSE, để process ingest không tạo sự kiện không ai nghe.
+    """
+    check_authkey()
+    _stop_ipc.clear()
+    threads = [
+        threading.Thread(target=_subscription_loop, args=('invalidations', _apply_invalidation),
+                         kwargs={'connected': _relay_connected}, name="IngestIPCInvalidations", daemon=True),
+        threading.Thread(target=_subscription_loop, args=('subscribe', _relay_event),
+                         kwargs={'wanted': event_bus.has_subscribers}, name="IngestIPCRelay", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def is_relay_connected() -> bool:
+    return _relay_connected.is_set()
+
+
+def _request(op: str, timeout: float):
+    """
+    Gửi một yêu cầu một-lần tới process ingest, cả kết nối, bắt tay lẫn chờ phản hồi không quá khoảng timeout
+    giây. Trả về None nếu không liên lạc được.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        conn = _connect(timeout)
+    except Exception as e:
+        logging.debug(f"Ingest IPC: Không gửi được yêu cầu '{op}' tới ingest: {e}")
+        return None
+    try:
+        conn.send({'op': op})
+        if not conn.poll(max(0.0, deadline - time.monotonic())):
+            return None
+        _set_io_timeout(conn, deadline - time.monotonic())
+        return conn.recv()
+    except (OSError, EOFError) as e:
+        logging.debug(f"Ingest IPC: Lỗi khi đọc phản hồi '{op}' từ ingest: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def request_status(timeout: float = 2.0) -> dict | None:
+    """Hỏi trạng thái trực tiếp của process ingest. Trả về None nếu không liên lạc được."""
+    return _request('status', timeout)
+
+
+def request_metrics(timeout: float = 2.0) -> str | None:
+    """Lấy text Prometheus của process ingest. Trả về None nếu không liên lạc được."""
+    return _request('metrics', timeout)
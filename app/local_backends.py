@@ -0,0 +1,577 @@
+# app/local_backends.py
+# Stand-in cục bộ cho Firestore, Realtime Database, FCM và S3 (bật bằng LOCAL_BACKENDS=true).
+# Dùng để chạy server / kiểm thử tải các route (/alert_history, /statistics/weekly, /get_audio_url)
+# khi không có Firebase/AWS. Chỉ cài đặt phần API mà code trong app/ thực sự dùng:
+#   - Firestore: collection/document/get/set(merge)/batch/get_all/where/order_by/limit/start_after/
+#     stream/count, hiểu Increment và SERVER_TIMESTAMP của google-cloud-firestore.
+#   - RTDB: reference().child(path).set/get.
+#   - FCM: send_fcm() thay cho messaging.send (ghi lại tin nhắn gần nhất).
+#   - S3: put_object/head_object/get_object/delete_object/generate_presigned_url/download_file/
+#     list_objects_v2 paginator; object lưu trong bộ nhớ hoặc trên đĩa (LOCAL_BACKENDS_DIR).
+# Mỗi thao tác có thể bị làm chậm theo LOCAL_BACKENDS_LATENCY_MS (ví dụ "firestore=25,rtdb=10,fcm=60,s3=40")
+# để mô phỏng round-trip mạng.
+# Vẫn cần thư viện google-cloud-firestore (FieldFilter, SERVER_TIMESTAMP) và botocore (ClientError),
+# nhưng không cần Service Account Key, credentials AWS hay kết nối mạng.
+import copy
+import datetime
+import io
+import logging
+import os
+import random
+import secrets
+import string
+import threading
+import time
+from collections import deque
+
+from . import config
+
+
+def _parse_latency(spec: str) -> dict:
+    latency = {}
+    for part in (spec or '').split(','):
+        name, _, value = part.partition('=')
+        if not name.strip():
+            continue
+        try:
+            latency[name.strip()] = float(value) / 1000
+        except ValueError:
+            logging.warning(f"Local Backends: Bỏ qua độ trễ không hợp lệ '{part}'.")
+    return latency
+
+
+_latency_s = _parse_latency(config.LOCAL_BACKENDS_LATENCY_MS)
+
+
+def set_latency(service: str, ms: float):
+    """Đổi độ trễ giả lập của một dịch vụ ('firestore', 'rtdb', 'fcm', 's3') lúc chạy."""
+    _latency_s[service] = ms / 1000
+
+
+def _delay(service: str):
+    seconds = _latency_s.get(service)
+    if seconds:
+        jitter = config.LOCAL_BACKENDS_JITTER
+        time.sleep(seconds * random.uniform(1 - jitter, 1 + jitter))
+
+
+# ==============================================================================
+# Firestore
+# ==============================================================================
+_AUTO_ID_CHARS = string.ascii_letters + string.digits
+
+
+def _is_server_timestamp(value) -> bool:
+    # google.cloud.firestore.SERVER_TIMESTAMP là một transforms.Sentinel
+    return type(value).__name__ == 'Sentinel' and 'server timestamp' in repr(value).lower()
+
+
+def _is_increment(value) -> bool:
+    return type(value).__name__ == 'Increment' and hasattr(value, 'value')
+
+
+def _resolve_write(existing, value):
+    """Áp dụng một giá trị ghi (có thể chứa Increment/SERVER_TIMESTAMP) lên giá trị cũ."""
+    if _is_server_timestamp(value):
+        return datetime.datetime.now(datetime.timezone.utc)
+    if _is_increment(value):
+        base = existing if isinstance(existing, (int, float)) else 0
+        return base + value.value
+    if isinstance(value, dict):
+        return {k: _resolve_write(None, v) for k, v in value.items()}
+    return copy.deepcopy(value)
+
+
+def _merge_into(target: dict, data: dict):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_into(target[key], value)
+        else:
+            target[key] = _resolve_write(target.get(key), value)
+
+
+def _get_field(doc_id: str, data: dict, field_path: str):
+    if field_path == '__name__':
+        return doc_id
+    value = data
+    for part in field_path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(field_path)
+        value = value[part]
+    return value
+
+
+_OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str):
+        return _get_field(self.id, self._data or {}, field_path)
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection_name: str, doc_id: str):
+        self._db = db
+        self._collection_name = collection_name
+        self.id = doc_id
+        self.path = f"{collection_name}/{doc_id}"
+
+    def get(self) -> FakeDocumentSnapshot:
+        _delay('firestore')
+        return self._db._snapshot(self)
+
+    def set(self, data: dict, merge: bool = False):
+        _delay('firestore')
+        with self._db._lock:
+            self._db._apply_set(self, data, merge)
+
+    def update(self, data: dict):
+        self.set(data, merge=True)
+
+    def delete(self):
+        _delay('firestore')
+        with self._db._lock:
+            self._db._collections.get(self._collection_name, {}).pop(self.id, None)
+
+
+class _AggregationResult:
+    def __init__(self, alias: str, value):
+        self.alias = alias
+        self.value = value
+
+
+class _FakeCountQuery:
+    def __init__(self, query, alias: str):
+        self._query = query
+        self._alias = alias
+
+    def get(self):
+        _delay('firestore')
+        return [[_AggregationResult(self._alias, len(self._query._run()))]]
+
+
+class FakeQuery:
+    """Query bất biến: mỗi phương thức trả về query mới như SDK thật."""
+
+    def __init__(self, db, collection_name: str, filters=(), orders=(), limit_count=None, cursor=None):
+        self._db = db
+        self._collection_name = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_count
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, limit_count=self._limit, cursor=self._cursor)
+        state.update(changes)
+        return FakeQuery(self._db, self._collection_name, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f"Local Firestore: toán tử không hỗ trợ: {op_string}")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((str(field_path), direction == 'DESCENDING'),))
+
+    def limit(self, count: int):
+        return self._copy(limit_count=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def count(self, alias: str = 'count'):
+        return _FakeCountQuery(self, alias)
+
+    def _effective_orders(self):
+        orders = list(self._orders)
+        if not any(field == '__name__' for field, _ in orders):
+            # Firestore luôn sắp xếp ngầm theo document ID cùng chiều với trường cuối
+            orders.append(('__name__', orders[-1][1] if orders else False))
+        return orders
+
+    def _cursor_values(self, orders):
+        cursor = self._cursor
+        if isinstance(cursor, FakeDocumentSnapshot):
+            return [cursor.get(field) for field, _ in orders]
+        values = [v.id if isinstance(v, FakeDocumentReference) else v for v in cursor]
+        if len(values) < len(orders):
+            raise ValueError("Local Firestore: cursor thiếu giá trị cho các trường order_by")
+        return values
+
+    def _run(self) -> list:
+        with self._db._lock:
+            docs = list(self._db._collections.get(self._collection_name, {}).items())
+        rows = []
+        for doc_id, data in docs:
+            try:
+                if all(_OPERATORS[op](_get_field(doc_id, data, field), value) for field, op, value in self._filters):
+                    rows.append((doc_id, data))
+            except (KeyError, TypeError):
+                continue # Thiếu trường hoặc không so sánh được: Firestore cũng loại document này
+
+        orders = self._effective_orders()
+        try:
+            rows = [r for r in rows if all(f == '__name__' or _has_field(r[1], f) for f, _ in orders)]
+            # Sắp xếp ổn định theo từng trường, từ trường cuối lên trường đầu
+            for field, descending in reversed(orders):
+                rows.sort(key=lambda r, f=field: _get_field(r[0], r[1], f), reverse=descending)
+        except TypeError as e:
+            raise ValueError(f"Local Firestore: không sắp xếp được: {e}") from e
+
+        if self._cursor is not None:
+            cursor_values = self._cursor_values(orders)
+            rows = [r for r in rows if _is_after(r, orders, cursor_values)]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows
+
+    def stream(self):
+        _delay('firestore')
+        for doc_id, data in self._run():
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._db, self._collection_name, doc_id), copy.deepcopy(data))
+
+    def get(self) -> list:
+        return list(self.stream())
+
+
+def _has_field(data: dict, field_path: str) -> bool:
+    try:
+        _get_field('', data, field_path)
+        return True
+    except KeyError:
+        return False
+
+
+def _is_after(row, orders, cursor_values) -> bool:
+    for (field, descending), cursor_value in zip(orders, cursor_values):
+        value = _get_field(row[0], row[1], field)
+        if value == cursor_value:
+            continue
+        return value < cursor_value if descending else value > cursor_value
+    return False # Trùng hoàn toàn với cursor: start_after bỏ qua chính nó
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db, name: str):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, document_id: str | None = None) -> FakeDocumentReference:
+        if document_id is None:
+            document_id = ''.join(secrets.choice(_AUTO_ID_CHARS) for _ in range(20))
+        return FakeDocumentReference(self._db, self._collection_name, document_id)
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class FakeWriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data: dict, merge: bool = False):
+        self._writes.append(('set', reference, data, merge))
+
+    def update(self, reference, data: dict):
+        self._writes.append(('set', reference, data, True))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False))
+
+    def commit(self):
+        _delay('firestore')
+        # Áp dụng nguyên tử: giữ lock trong suốt batch
+        with self._db._lock:
+            for op, reference, data, merge in self._writes:
+                if op == 'delete':
+                    self._db._collections.get(reference._collection_name, {}).pop(reference.id, None)
+                else:
+                    self._db._apply_set(reference, data, merge)
+        self._writes = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._collections = {} # name -> {doc_id: data}
+        self._lock = threading.RLock()
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def get_all(self, references):
+        _delay('firestore')
+        for reference in references:
+            yield self._snapshot(reference)
+
+    def _snapshot(self, reference) -> FakeDocumentSnapshot:
+        with self._lock:
+            data = self._collections.get(reference._collection_name, {}).get(reference.id)
+            return FakeDocumentSnapshot(reference, copy.deepcopy(data))
+
+    def _apply_set(self, reference, data: dict, merge: bool):
+        docs = self._collections.setdefault(reference._collection_name, {})
+        if merge and reference.id in docs:
+            _merge_into(docs[reference.id], data)
+        else:
+            new_doc = {}
+            _merge_into(new_doc, data)
+            docs[reference.id] = new_doc
+
+
+# ==============================================================================
+# Realtime Database
+# ==============================================================================
+class FakeRTDBReference:
+    def __init__(self, store: dict, lock, path: str = ''):
+        self._store = store
+        self._lock = lock
+        self.path = path.strip('/')
+
+    def child(self, path: str) -> 'FakeRTDBReference':
+        return FakeRTDBReference(self._store, self._lock, f"{self.path}/{path.strip('/')}")
+
+    def set(self, value):
+        _delay('rtdb')
+        with self._lock:
+            self._store[self.path] = copy.deepcopy(value)
+
+    def get(self):
+        _delay('rtdb')
+        with self._lock:
+            return copy.deepcopy(self._store.get(self.path))
+
+
+# ==============================================================================
+# FCM
+# ==============================================================================
+_sent_messages = deque(maxlen=1000)
+
+
+def send_fcm(token: str, title: str, body: str, data: dict | None = None) -> bool:
+    """Thay cho messaging.send: ghi lại tin nhắn (xem get_sent_messages) và luôn thành công."""
+    _delay('fcm')
+    _sent_messages.append({'token': token, 'title': title, 'body': body, 'data': data, 'sent_at': time.time()})
+    return True
+
+
+def get_sent_messages() -> list[dict]:
+    return list(_sent_messages)
+
+
+# ==============================================================================
+# S3
+# ==============================================================================
+class _FakePaginator:
+    def __init__(self, client):
+        self._client = client
+
+    def paginate(self, Bucket: str, Prefix: str = '', PageSize: int = 1000, **kwargs):
+        keys = self._client._list_keys(Bucket, Prefix)
+        for start in range(0, len(keys), PageSize):
+            _delay('s3')
+            yield {'Contents': [{'Key': key, 'Size': size} for key, size in keys[start:start + PageSize]],
+                   'KeyCount': min(PageSize, len(keys) - start)}
+        if not keys:
+            yield {'KeyCount': 0}
+
+
+class FakeS3Client:
+    """Chỉ các phương thức boto3 mà app/ và tools/ dùng; lỗi được báo bằng botocore ClientError thật."""
+
+    def __init__(self, root_dir: str | None = None):
+        self._root_dir = root_dir
+        self._objects = {} # (bucket, key) -> (bytes, content_type)
+        self._lock = threading.Lock()
+
+    def _path(self, bucket: str, key: str) -> str:
+        path = os.path.abspath(os.path.join(self._root_dir, bucket, key))
+        if not path.startswith(os.path.abspath(self._root_dir) + os.sep):
+            raise ValueError(f"Key không hợp lệ: {key}")
+        return path
+
+    def _not_found(self, operation: str, key: str):
+        from botocore.exceptions import ClientError
+        return ClientError({'Error': {'Code': '404', 'Message': f'Not Found: {key}'}}, operation)
+
+    def _read(self, bucket: str, key: str, operation: str) -> bytes:
+        if self._root_dir:
+            try:
+                with open(self._path(bucket, key), 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                raise self._not_found(operation, key)
+        with self._lock:
+            if (bucket, key) not in self._objects:
+                raise self._not_found(operation, key)
+            return self._objects[(bucket, key)][0]
+
+    def _list_keys(self, bucket: str, prefix: str) -> list[tuple[str, int]]:
+        if self._root_dir:
+            base = os.path.join(self._root_dir, bucket)
+            keys = []
+            for dirpath, _, filenames in os.walk(base):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    key = os.path.relpath(path, base).replace(os.sep, '/')
+                    if key.startswith(prefix):
+                        keys.append((key, os.path.getsize(path)))
+            return sorted(keys)
+        with self._lock:
+            return sorted((k, len(v[0])) for (b, k), v in self._objects.items() if b == bucket and k.startswith(prefix))
+
+    def put_object(self, Bucket: str, Key: str, Body, ContentType: str = 'binary/octet-stream', **kwargs):
+        _delay('s3')
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        if self._root_dir:
+            path = self._path(Bucket, Key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        else:
+            with self._lock:
+                self._objects[(Bucket, Key)] = (data, ContentType)
+        return {'ETag': f'"{secrets.token_hex(16)}"'}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        _delay('s3')
+        data = self._read(Bucket, Key, 'HeadObject')
+        return {'ContentLength': len(data)}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        _delay('s3')
+        data = self._read(Bucket, Key, 'GetObject')
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        _delay('s3')
+        if self._root_dir:
+            try:
+                os.remove(self._path(Bucket, Key))
+            except FileNotFoundError:
+                pass
+        else:
+            with self._lock:
+                self._objects.pop((Bucket, Key), None)
+        return {}
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, **kwargs):
+        _delay('s3')
+        data = self._read(Bucket, Key, 'GetObject')
+        with open(Filename, 'wb') as f:
+            f.write(data)
+
+    def generate_presigned_url(self, ClientMethod: str, Params: dict, ExpiresIn: int = 3600, **kwargs) -> str:
+        # Ký URL là tính toán cục bộ trong boto3 thật: không thêm độ trễ mạng
+        return (f"{config.LOCAL_S3_PUBLIC_URL.rstrip('/')}/{Params['Bucket']}/{Params['Key']}"
+                f"?X-Amz-Expires={ExpiresIn}&X-Amz-Date={int(time.time())}")
+
+    def get_paginator(self, operation_name: str):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(f"Local S3: paginator '{operation_name}' chưa được hỗ trợ")
+        return _FakePaginator(self)
+
+
+# ==============================================================================
+# Singletons
+# ==============================================================================
+_firestore = None
+_rtdb_store = {}
+_rtdb_lock = threading.Lock()
+_s3 = None
+_init_lock = threading.Lock()
+
+
+def get_firestore() -> FakeFirestore:
+    global _firestore
+    with _init_lock:
+        if _firestore is None:
+            _firestore = FakeFirestore()
+            logging.warning("Local Backends: Đang dùng Firestore GIẢ trong bộ nhớ (LOCAL_BACKENDS=true).")
+        return _firestore
+
+
+def get_rtdb_reference() -> FakeRTDBReference:
+    return FakeRTDBReference(_rtdb_store, _rtdb_lock)
+
+
+def get_s3_client() -> FakeS3Client:
+    global _s3
+    with _init_lock:
+        if _s3 is None:
+            _s3 = FakeS3Client(config.LOCAL_BACKENDS_DIR)
+            where = config.LOCAL_BACKENDS_DIR or 'bộ nhớ'
+            logging.warning(f"Local Backends: Đang dùng S3 GIẢ ({where}) (LOCAL_BACKENDS=true).")
+        return _s3
+
+
+def seed_alerts(count: int, devices: int = 5, days: int = 14, with_audio: bool = True, seed: int = 1) -> dict:
+    """
+    Tạo dữ liệu mẫu: count cảnh báo rải đều trong `days` ngày gần nhất cho `devices` thiết bị,
+    kèm object audio trên S3 giả và rollup theo ngày (tính bằng alert_stats.rebuild_daily_rollups).
+    Trả về {'alert_ids', 's3_keys', 'devices'} để bộ kiểm thử tải chọn tham số request.
+    """
+    from . import alert_stats
+    rng = random.Random(seed)
+    db = get_firestore()
+    s3 = get_s3_client()
+    device_ips = [f"192.168.1.{100 + i}" for i in range(devices)]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # WAV rỗng 44 byte header + 0.1s im lặng: đủ để head_object/get_object hoạt động
+    silent_wav = b'RIFF' + (36 + 3200).to_bytes(4, 'little') + b'WAVEfmt ' + (16).to_bytes(4, 'little') \
+        + (1).to_bytes(2, 'little') + (1).to_bytes(2, 'little') + (16000).to_bytes(4, 'little') \
+        + (32000).to_bytes(4, 'little') + (2).to_bytes(2, 'little') + (16).to_bytes(2, 'little') \
+        + b'data' + (3200).to_bytes(4, 'little') + bytes(3200)
+
+    alert_ids, s3_keys = [], []
+    collection = db.collection(alert_stats.ALERT_HISTORY_COLLECTION)
+    batch = db.batch()
+    for i in range(count):
+        client_ip = rng.choice(device_ips)
+        timestamp = now - datetime.timedelta(seconds=rng.uniform(0, days * 86400))
+        doc = {'timestamp': timestamp, 'client_ip': client_ip}
+        if with_audio:
+            s3_key = f"{config.AWS_S3_AUDIO_FOLDER}scream_{client_ip.replace('.', '-')}_{int(timestamp.timestamp())}_{i}.wav"
+            s3.put_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=s3_key, Body=silent_wav, ContentType='audio/wav')
+            doc['s3_key'] = s3_key
+            s3_keys.append(s3_key)
+        ref = collection.document()
+        batch.set(ref, doc)
+        alert_ids.append(ref.id)
+        if (i + 1) % 450 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    alert_stats.rebuild_daily_rollups(db)
+    logging.info(f"Local Backends: Đã tạo {count} cảnh báo mẫu cho {devices} thiết bị trong {days} ngày.")
+    return {'alert_ids': alert_ids, 's3_keys': s3_keys, 'devices': device_ips}
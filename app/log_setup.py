@@ -0,0 +1,140 @@
+# app/log_setup.py
+# Logging bất đồng bộ: mọi luồng chỉ đẩy LogRecord vào hàng đợi (QueueHandler), một luồng nền
+# (QueueListener) mới định dạng và ghi ra stderr. Luồng UDP vì thế không bao giờ chờ I/O của log.
+# Kèm DeviceLogSampler để lấy mẫu / giới hạn tốc độ log từng chunk theo thiết bị.
+# Module này không import config (config.py gọi install() trong lúc đang được import).
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Kiểu tham số an toàn để định dạng muộn ở luồng listener (bất biến)
+_LAZY_ARG_TYPES = (str, int, float, bool, type(None))
+
+_listener = None
+_queue_handler = None
+_samplers = [] # DeviceLogSampler đã tạo, để báo số dòng bị bỏ qua trên /metrics
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler gốc định dạng message ngay trong luồng gọi (prepare()). Ở đây giữ nguyên
+    msg/args để luồng listener định dạng, trừ khi args chứa đối tượng có thể thay đổi sau đó.
+    Khi hàng đợi đầy thì bỏ record (đếm vào dropped) thay vì chặn luồng gọi.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock() # enqueue() chạy đồng thời trên nhiều luồng
+
+    def prepare(self, record):
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(a, _LAZY_ARG_TYPES) for a in args)):
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+def install(level: int, log_format: str, async_enabled: bool = True, queue_size: int = 10000):
+    """Cấu hình root logger (thay cho logging.basicConfig). Gọi lại được: handler cũ bị gỡ."""
+    global _listener, _queue_handler
+    stop()
+    root_logger = logging.getLogger()
+    # Xóa các handler cũ để tránh log bị lặp nếu file config được load lại
+    if root_logger.hasHandlers():
+        root_logger.handlers.clear()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(log_format))
+    root_logger.setLevel(level)
+    if not async_enabled:
+        root_logger.addHandler(stream_handler)
+        return
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    _queue_handler = _LazyQueueHandler(log_queue)
+    root_logger.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """Dừng luồng listener sau khi ghi hết các record còn trong hàng đợi."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    _queue_handler = None
+
+
+atexit.register(stop)
+
+
+class DeviceLogSampler:
+    """
+    Quyết định có ghi log của một chunk hay không, theo từng thiết bị:
+      - record thường (không quan trọng): chỉ giữ 1 trong mỗi `sample_every` record,
+      - mọi record được giữ sau đó còn qua token bucket `rate_per_s` (dung lượng `burst`).
+    allow() trả về (có ghi không, số record đã bỏ qua kể từ lần ghi trước) để dòng log kế tiếp
+    cho biết đã mất bao nhiêu dòng. Chi phí: một lần lấy lock và vài phép tính.
+    """
+
+    def __init__(self, rate_per_s: float, burst: int, sample_every: int):
+        self.rate_per_s = rate_per_s
+        self.burst = max(1, burst)
+        self.sample_every = max(1, sample_every)
+        self.suppressed_total = 0
+        self._state = {} # device -> [tokens, last_refill, seen, suppressed]
+        self._lock = threading.Lock()
+        _samplers.append(self)
+
+    def allow(self, device: str, important: bool = False) -> tuple[bool, int]:
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(device)
+            if state is None:
+                state = self._state[device] = [float(self.burst), now, 0, 0]
+            if not important:
+                state[2] += 1
+                if state[2] % self.sample_every:
+                    state[3] += 1
+                    self.suppressed_total += 1
+                    return False, 0
+            if self.rate_per_s > 0:
+                state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate_per_s)
+                state[1] = now
+                if state[0] < 1:
+                    state[3] += 1
+                    self.suppressed_total += 1
+                    return False, 0
+                state[0] -= 1
+            suppressed, state[3] = state[3], 0
+            return True, suppressed
+
+
+def get_stats() -> dict:
+    return {
+        'async': _listener is not None,
+        'queue_size': _queue_handler.queue.qsize() if _queue_handler is not None else 0,
+        'dropped': _queue_handler.dropped if _queue_handler is not None else 0,
+        'sampled_out': sum(sampler.suppressed_total for sampler in _samplers),
+    }
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    from . import metrics # Import muộn: metrics import config, config import module này
+    stats = get_stats()
+    return (metrics.gauge_lines('scream_log_queue_size', 'Số log record đang chờ ghi.', stats['queue_size'])
+            + metrics.gauge_lines('scream_log_dropped_total', 'Số log record bị bỏ do hàng đợi log đầy.',
+                                  stats['dropped'], 'counter')
+            + metrics.gauge_lines('scream_log_sampled_out_total', 'Số log chunk bị bỏ do lấy mẫu / giới hạn tốc độ.',
+                                  stats['sampled_out'], 'counter'))
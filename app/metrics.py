@@ -0,0 +1,186 @@
+# app/metrics.py
+# Bộ đo đơn giản (không phụ thuộc prometheus_client) cho pipeline xử lý audio:
+# - Histogram thời gian từng giai đoạn (giải mã gói, nối buffer, RMS, mel, tạo ảnh, forward, ...).
+# - Counter số gói/chunk/gói bị bỏ/cảnh báo theo thiết bị.
+# render() xuất theo định dạng text của Prometheus cho route /metrics.
+# Chi phí mỗi lần ghi chỉ là perf_counter() + bisect + một lock ngắn, đủ nhẹ để bật ở production.
+import bisect
+import threading
+import time
+
+from . import config
+
+_DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = [] # Các metric theo thứ tự đăng ký
+_collectors = [] # Hàm trả về các dòng text bổ sung (ví dụ thống kê cache)
+
+
+def _format_labels(labelnames, labelvalues, extra=None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Bộ đếm tăng dần, có thể có nhãn."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labelvalues, amount: float = 1):
+        if not config.METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues) -> float:
+        """Giá trị hiện tại của một chuỗi nhãn; không truyền nhãn thì trả về tổng mọi chuỗi."""
+        with self._lock:
+            if labelvalues:
+                return self._values.get(labelvalues, 0)
+            return sum(self._values.values())
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items:
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_labelvalues', '_start')
+
+    def __init__(self, histogram, labelvalues):
+        self._histogram = histogram
+        self._labelvalues = labelvalues
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labelvalues)
+        return False
+
+
+class Histogram:
+    """Histogram với bucket cố định (giây), có thể có nhãn."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = _DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # labelvalues -> [counts theo bucket (không cộng dồn) + bucket +Inf, sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        if not config.METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labelvalues) -> _Timer:
+        """Context manager đo thời gian một đoạn code: `with HIST.time('mel'): ...`."""
+        return _Timer(self, labelvalues)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        if not items:
+            return []
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (counts, total, count) in items:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = ('le', _format_value(upper) if upper != float('inf') else '+Inf')
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}")
+            label_str = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{label_str} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+def register_collector(func):
+    """Đăng ký hàm trả về list các dòng text Prometheus (được gọi mỗi lần render)."""
+    _collectors.append(func)
+
+
+def gauge_lines(name: str, documentation: str, value: float, metric_type: str = 'gauge') -> list[str]:
+    """Tạo các dòng cho một metric không nhãn (dùng trong collector)."""
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}", f"{name} {_format_value(value)}"]
+
+
+def render() -> str:
+    """Xuất toàn bộ metric của process hiện tại theo định dạng text Prometheus 0.0.4."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            lines.extend(collector())
+        except Exception:
+            # Collector lỗi không được làm hỏng /metrics
+            continue
+    return '\n'.join(lines) + '\n'
+
+
+# --- Các metric của pipeline ---
+STAGE_SECONDS = Histogram(
+    'scream_stage_duration_seconds',
+    'Thời gian xử lý từng giai đoạn của pipeline audio.',
+    ('stage',)
+)
+UDP_PACKETS = Counter('scream_udp_packets_total', 'Số gói UDP audio nhận được.', ('device',))
+UDP_BYTES = Counter('scream_udp_bytes_total', 'Số byte audio nhận được qua UDP.', ('device',))
+CHUNKS = Counter('scream_chunks_total', 'Số chunk audio đã được xử lý (RMS + dự đoán).', ('device',))
+DROPS = Counter('scream_packets_dropped_total', 'Số gói/chunk bị bỏ qua.', ('device', 'reason'))
+PREDICTIONS = Counter('scream_predictions_total', 'Số dự đoán theo nhãn.', ('device', 'label'))
+ALERTS = Counter('scream_alerts_total', 'Số cảnh báo tiếng hét đã gửi.', ('device',))
+INFERENCE_LANE_SECONDS = Histogram(
+    'scream_inference_lane_latency_seconds',
+    'Thời gian từ lúc chunk vào hàng đợi inference tới khi xử lý xong kết quả, theo lane.',
+    ('lane',)
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    'scream_inference_batch_size',
+    'Số chunk trong mỗi batch inference, theo lane.',
+    ('lane',),
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+DETECTOR_ALERTS = Counter('scream_detector_alerts_total', 'Số cảnh báo của các detector bổ sung (EXTRA_MODELS).', ('model', 'device'))
+S3_UPLOADS = Counter('scream_s3_uploads_total', 'Số clip cảnh báo upload lên S3 theo kết quả.', ('format', 'result'))
+S3_UPLOAD_BYTES = Counter('scream_s3_upload_bytes_total', 'Số byte clip đã upload lên S3.', ('format',))
+
+
+def stage_timer(stage: str) -> _Timer:
+    """Rút gọn cho STAGE_SECONDS.time(stage)."""
+    return _Timer(STAGE_SECONDS, (stage,))
@@ -1,37 +1,262 @@
+import json
 import logging
+import math
 import os
 import io
 import time # Thêm import time
+import threading
 
-# --- THÊM VÀO ĐÂY ---
-# Chỉ định backend không tương tác cho Matplotlib TRƯỚC khi import pyplot
-import matplotlib
-matplotlib.use('Agg') # Sử dụng backend 'Agg' để tránh lỗi GUI trong thread phụ
-# --------------------
-
-import torch
-import torchaudio
-import torchvision # Cần import torchvision để load model ResNet
-from torchvision import transforms
-from torchvision.models import resnet34 # Import cụ thể ResNet nếu cần khi load
 import numpy as np
-from PIL import Image
-import matplotlib.pyplot as plt # Sử dụng matplotlib để tạo ảnh spectrogram
 
 from . import config # Import config của app
+from . import metrics
+from . import torch_runtime
+
+# Các thư viện nặng được import ở lần dùng đầu tiên để import module này (và khởi động web tier) không tốn
+# vài giây: torch/torchaudio trong _import_ml_libs(), matplotlib/PIL/torchvision.transforms trong
+# _ensure_pil_pipeline() (chỉ khi dùng đường ảnh PIL, xem MODEL_FEATURE_PIPELINE).
+torch = None
+torchaudio = None
+transforms = None
+plt = None
+Image = None
+_ml_libs_lock = threading.Lock()
 
 # Biến toàn cục cho model và các thành phần xử lý (tránh load lại liên tục)
 _model = None
 _mel_transform = None
 _transform_pipeline = None
+_feature_graph = None # feature_graph.FeatureGraph khi dùng đường đặc trưng hợp nhất (MODEL_FEATURE_PIPELINE)
+_feature_parity_diff = None # Lệch ảnh hợp nhất so với đường PIL đo lúc tải model (MODEL_FEATURE_PIPELINE=auto)
 _is_model_loaded = False
+_device = None # Thiết bị thực tế ('cpu'/'cuda'), xác định khi tải model
+_load_lock = threading.Lock()
+_load_state = 'not_started' # 'not_started' | 'loading' | 'ready' | 'failed'
+_load_error = None
+_is_warmed_up = False
+# Registry các model cùng nhận image tensor của chunk: tên -> RegisteredModel, model tiếng hét luôn đứng đầu
+_registry = {}
+
+
+class RegisteredModel:
+    """Một model trong registry: dùng chung đặc trưng (mel + ảnh) với các model khác, class map riêng."""
+
+    def __init__(self, name: str, path: str, model, class_map: dict):
+        self.name = name
+        self.path = path
+        self.model = model
+        self.class_map = class_map
+
+def _import_ml_libs():
+    """Import torch và torchaudio (chỉ lần đầu)."""
+    global torch, torchaudio
+    if torch is not None:
+        return
+    with _ml_libs_lock:
+        if torch is not None:
+            return
+        t0 = time.perf_counter()
+        # torchvision không import ở đây: torch.load tự import torchvision.models khi unpickle model ResNet
+        import torchaudio as _torchaudio
+        import torch as _torch
+        torchaudio = _torchaudio
+        torch_runtime.configure(_torch) # Số luồng intra/inter-op trước công việc song song đầu tiên
+        torch = _torch # Gán cuối cùng: torch khác None nghĩa là mọi thư viện đã sẵn sàng
+        logging.info(f"ML Handler: Đã import thư viện ML trong {time.perf_counter() - t0:.2f}s.")
+
+def _ensure_pil_pipeline():
+    """
+    Import matplotlib/PIL/torchvision.transforms và tạo pipeline Resize + ToTensor (chỉ lần đầu).
+    Chỉ đường matplotlib -> PNG -> PIL cần các thư viện này; đồ thị đặc trưng hợp nhất thì không.
+    """
+    global transforms, plt, Image, _transform_pipeline
+    if _transform_pipeline is not None:
+        return
+    with _ml_libs_lock:
+        if _transform_pipeline is not None:
+            return
+        t0 = time.perf_counter()
+        # Chỉ định backend không tương tác cho Matplotlib TRƯỚC khi import pyplot
+        import matplotlib
+        matplotlib.use('Agg') # Sử dụng backend 'Agg' để tránh lỗi GUI trong thread phụ
+        import matplotlib.pyplot as _plt # Sử dụng matplotlib để tạo ảnh spectrogram
+        from torchvision import transforms as _transforms
+        from PIL import Image as _Image
+        transforms, plt, Image = _transforms, _plt, _Image
+        _transform_pipeline = transforms.Compose([
+            transforms.Resize(config.MODEL_IMG_SIZE),
+            transforms.ToTensor(),
+            # Bỏ comment nếu model của bạn cần chuẩn hóa ImageNet
+            # transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ])
+        logging.info(f"ML Handler: Đã import matplotlib/PIL cho đường ảnh PIL trong {time.perf_counter() - t0:.2f}s.")
+
+def _resolve_device() -> str:
+    if config.ML_DEVICE == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    return config.ML_DEVICE
+
+def _load_weights(path: str):
+    """torch.load một model đầy đủ; trên CPU thử map file vào bộ nhớ để các process dùng chung page cache."""
+    # Quan trọng: Chỉ sử dụng weights_only=False nếu bạn tin tưởng nguồn gốc của tệp .pt
+    if config.MODEL_MMAP_WEIGHTS and _device == 'cpu':
+        try:
+            return torch.load(path, map_location=_device, weights_only=False, mmap=True)
+        except (TypeError, RuntimeError) as e:
+            # torch < 2.1 (không có tham số mmap) hoặc file lưu theo định dạng cũ (không phải zip)
+            logging.info(f"ML Handler: Không map được {os.path.basename(path)} vào bộ nhớ ({e}), tải bình thường.")
+    return torch.load(path, map_location=_device, weights_only=False)
+
+def _load_extra_models():
+    """Tải các detector trong config.EXTRA_MODELS; lỗi của một detector không ảnh hưởng model tiếng hét."""
+    loaded_by_path = {os.path.realpath(config.MODEL_PATH): _model}
+    for name in config.EXTRA_MODELS:
+        spec = config.MODEL_CATALOG[name]
+        path = os.path.realpath(os.path.join(config.PROJECT_ROOT, 'model', spec['filename']))
+        model = loaded_by_path.get(path)
+        if model is not None:
+            logging.info(f"ML Handler: Detector '{name}' dùng chung weights đã tải từ {path}.")
+        elif not os.path.exists(path):
+            logging.error(f"ML Handler: Không tìm thấy tệp model của detector '{name}' tại '{path}', bỏ qua.")
+            continue
+        else:
+            try:
+                model = _load_weights(path)
+                model.to(_device)
+                model.eval()
+            except Exception as e:
+                logging.error(f"ML Handler: Lỗi khi tải detector '{name}' từ {path}: {e}", exc_info=True)
+                continue
+            loaded_by_path[path] = model
+            logging.info(f"ML Handler: Detector '{name}' đã tải thành công.")
+        _registry[name] = RegisteredModel(name, path, model, spec['class_map'])
+
+def list_models() -> list[str]:
+    """Tên các model đang chạy trên mỗi chunk (model tiếng hét đứng đầu)."""
+    return list(_registry)
+
+def is_model_loaded() -> bool:
+    return _is_model_loaded
+
+def get_device() -> str | None:
+    """Thiết bị đang chạy model (None nếu chưa tải)."""
+    return _device
 
 def load_model():
     """
     Tải model PyTorch và khởi tạo các thành phần xử lý.
     Trả về True nếu thành công, False nếu thất bại.
     """
-    global _model, _mel_transform, _transform_pipeline, _is_model_loaded
+    with _load_lock:
+        return _load_model_locked()
+
+def parity_chunks(batch_size: int = 2, seed: int = 1234):
+    """Chunk mẫu cố định (sóng sin quét tần số + nhiễu, nhiễu thuần) để so đồ thị hợp nhất với đường PIL."""
+    _import_ml_libs()
+    generator = torch.Generator().manual_seed(seed)
+    t = torch.arange(config.AUDIO_CHUNK_SAMPLES, dtype=torch.float32) / config.AUDIO_SAMPLE_RATE
+    freqs = 300 + 1200 * torch.rand(batch_size, 1, generator=generator)
+    chunks = 0.3 * torch.sin(2 * math.pi * (freqs + 1500 * t) * t) * (torch.arange(batch_size) % 2 == 0).unsqueeze(1)
+    chunks = chunks + 0.05 * torch.randn(batch_size, config.AUDIO_CHUNK_SAMPLES, generator=generator)
+    return chunks.clamp(-1.0, 1.0)
+
+def feature_parity_diff(graph, chunks) -> float | None:
+    """
+    Sai khác trung bình theo pixel (ảnh trong [0, 1]) lớn nhất giữa ảnh của `graph` và ảnh matplotlib -> PNG ->
+    PIL cho từng chunk. None nếu không so được (đường PIL lỗi hoặc kích thước ảnh khác nhau).
+    """
+    with torch.no_grad():
+        fused = graph(_pad_waveform(chunks.to(_device), config.MODEL_TARGET_LENGTH_SAMPLES))
+    worst = 0.0
+    for index, spec_np in enumerate(_log_mel_batch(chunks)):
+        pil_image = _spectrogram_to_image_tensor(spec_np)
+        if pil_image is None or tuple(pil_image.shape[1:]) != tuple(fused.shape[1:]):
+            return None
+        worst = max(worst, (pil_image[0] - fused[index]).abs().mean().item())
+    return worst
+
+def _feature_parity_key(shape) -> dict:
+    """Những gì quyết định ảnh của hai đường (không phụ thuộc weights): cấu hình đặc trưng, device, phiên bản thư viện."""
+    from importlib import metadata
+    versions = {}
+    for package in ('torch', 'torchaudio', 'torchvision', 'matplotlib', 'Pillow', 'numpy'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {'sample_rate': config.AUDIO_SAMPLE_RATE, 'chunk_samples': config.AUDIO_CHUNK_SAMPLES,
+            'target_samples': config.MODEL_TARGET_LENGTH_SAMPLES, 'n_mels': config.MODEL_N_MELS,
+            'n_fft': config.MODEL_N_FFT, 'mel_shape': list(shape), 'img_size': list(config.MODEL_IMG_SIZE),
+            'device': str(_device), 'versions': versions}
+
+def _cached_feature_parity(key: dict) -> dict | None:
+    """Kết quả so ảnh đã lưu ({'diff', 'lut'}) tại MODEL_FEATURE_PARITY_CACHE_PATH nếu khớp key, ngược lại None."""
+    if not config.MODEL_FEATURE_PARITY_CACHE_PATH:
+        return None
+    try:
+        with open(config.MODEL_FEATURE_PARITY_CACHE_PATH, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"ML Handler: Không đọc được cache kiểm tra ảnh hợp nhất: {e}")
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != key or not isinstance(cached.get('lut'), list):
+        return None
+    return cached
+
+def _save_feature_parity(key: dict, diff, lut):
+    if not config.MODEL_FEATURE_PARITY_CACHE_PATH:
+        return
+    try:
+        directory = os.path.dirname(config.MODEL_FEATURE_PARITY_CACHE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{config.MODEL_FEATURE_PARITY_CACHE_PATH}.{os.getpid()}.tmp" # Nhiều process có thể cùng ghi
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            # LUT lưu dạng uint8 như pixel PNG: lần tải sau dựng đồ thị không cần import matplotlib
+            json.dump({'key': key, 'diff': diff, 'lut': (lut * 255).round().int().tolist()}, f)
+        os.replace(tmp_path, config.MODEL_FEATURE_PARITY_CACHE_PATH)
+    except OSError as e:
+        logging.warning(f"ML Handler: Không ghi được cache kiểm tra ảnh hợp nhất: {e}")
+
+def _build_feature_graph():
+    """Đồ thị đặc trưng hợp nhất theo MODEL_FEATURE_PIPELINE, hoặc None nếu dùng đường matplotlib/PIL."""
+    global _feature_parity_diff
+    mode = config.MODEL_FEATURE_PIPELINE
+    if mode == 'pil':
+        return None
+    from . import feature_graph
+    shape = feature_graph.mel_shape(_mel_transform, config.MODEL_TARGET_LENGTH_SAMPLES)
+    if mode == 'fused':
+        graph = feature_graph.build(_mel_transform, config.MODEL_IMG_SIZE, _device)
+    elif shape != tuple(config.MODEL_IMG_SIZE):
+        logging.info(f"ML Handler: Mel {shape} khác MODEL_IMG_SIZE {config.MODEL_IMG_SIZE}, dùng đường PIL để resize.")
+        return None
+    else:
+        # Model được huấn luyện trên ảnh PNG của matplotlib: chỉ thay khi ảnh khớp (bbox_inches='tight' có thể
+        # làm PNG lệch một pixel và kéo theo resample). Kết quả (và bảng màu) được cache để các lần tải sau
+        # không phải import matplotlib/PIL/torchvision chỉ để so ảnh.
+        key = _feature_parity_key(shape)
+        cached = _cached_feature_parity(key)
+        if cached is not None:
+            _feature_parity_diff = cached['diff']
+            lut = torch.tensor(cached['lut'], dtype=torch.float32) / 255.0
+            graph = feature_graph.build(_mel_transform, config.MODEL_IMG_SIZE, _device, lut=lut)
+        else:
+            graph = feature_graph.build(_mel_transform, config.MODEL_IMG_SIZE, _device)
+            _feature_parity_diff = feature_parity_diff(graph, parity_chunks())
+            _save_feature_parity(key, _feature_parity_diff, graph.lut.cpu())
+        if _feature_parity_diff is None or _feature_parity_diff > config.MODEL_FEATURE_PARITY_TOLERANCE:
+            logging.warning(f"ML Handler: Ảnh của đồ thị hợp nhất lệch đường PIL ({_feature_parity_diff} > "
+                            f"{config.MODEL_FEATURE_PARITY_TOLERANCE}), dùng đường PIL.")
+            return None
+    logging.info(f"ML Handler: Dùng đồ thị đặc trưng hợp nhất (mel {shape} -> ảnh {config.MODEL_IMG_SIZE}, "
+                 f"lệch PIL: {_feature_parity_diff}).")
+    return graph
+
+def _load_model_locked():
+    global _model, _mel_transform, _feature_graph, _is_model_loaded, _device, _load_state, _load_error
 
     if _is_model_loaded:
         logging.info("ML Handler: Model đã được tải trước đó.")
@@ -39,26 +264,29 @@ def load_model():
 
     if not os.path.exists(config.MODEL_PATH):
         logging.error(f"ML Handler: Không tìm thấy tệp model tại '{config.MODEL_PATH}'")
+        _load_state, _load_error = 'failed', f"Model file not found: {config.MODEL_PATH}"
         return False
 
+    _load_state = 'loading'
     try:
+        _import_ml_libs()
+        _device = _resolve_device()
         logging.info(f"ML Handler: Đang tải model từ {config.MODEL_PATH}...")
-        # Quan trọng: Chỉ sử dụng weights_only=False nếu bạn tin tưởng nguồn gốc của tệp .pt
         # Nếu model được lưu bằng torch.save(model.state_dict(), ...), bạn cần tạo instance model trước rồi load state_dict
         # Nếu model được lưu bằng torch.save(model, ...), bạn có thể load trực tiếp như dưới đây
         # Giả sử model được lưu toàn bộ:
-        _model = torch.load(config.MODEL_PATH, map_location=config.ML_DEVICE, weights_only=False) # weights_only=False có thể không an toàn
+        _model = _load_weights(config.MODEL_PATH) # weights_only=False có thể không an toàn
 
         # Nếu bạn lưu state_dict, hãy làm như sau:
         # _model = resnet34(weights=None) # Tạo instance ResNet, weights=None vì bạn sẽ load weights của mình
         # # Điều chỉnh lớp cuối cùng của ResNet nếu cần (ví dụ: nếu số lớp output khác ImageNet)
         # num_ftrs = _model.fc.in_features
         # _model.fc = torch.nn.Linear(num_ftrs, len(config.MODEL_CLASS_MAP)) # Số lớp output = số lớp trong map
-        # _model.load_state_dict(torch.load(config.MODEL_PATH, map_location=config.ML_DEVICE))
+        # _model.load_state_dict(torch.load(config.MODEL_PATH, map_location=_device))
 
-        _model.to(config.ML_DEVICE) # Chuyển model đến thiết bị (CPU/GPU)
+        _model.to(_device) # Chuyển model đến thiết bị (CPU/GPU)
         _model.eval() # Chuyển model sang chế độ đánh giá (quan trọng!)
-        logging.info(f"ML Handler: Model '{config.MODEL_FILENAME}' đã tải thành công và chuyển đến {config.ML_DEVICE}.")
+        logging.info(f"ML Handler: Model '{config.MODEL_FILENAME}' đã tải thành công và chuyển đến {_device}.")
 
         # Khởi tạo các thành phần transform một lần
         logging.info("ML Handler: Khởi tạo các phép biến đổi...")
@@ -66,32 +294,85 @@ def load_model():
             sample_rate=config.AUDIO_SAMPLE_RATE,
             n_mels=config.MODEL_N_MELS,
             n_fft=config.MODEL_N_FFT
-        ).to(config.ML_DEVICE)
+        ).to(_device)
 
-        _transform_pipeline = transforms.Compose([
-            transforms.Resize(config.MODEL_IMG_SIZE),
-            transforms.ToTensor(),
-            # Bỏ comment nếu model của bạn cần chuẩn hóa ImageNet
-            # transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+        _feature_graph = _build_feature_graph()
+        if _feature_graph is None:
+            _ensure_pil_pipeline()
         logging.info("ML Handler: Các phép biến đổi đã được khởi tạo.")
 
+        _registry.clear()
+        _registry[config.PRIMARY_MODEL_NAME] = RegisteredModel(
+            config.PRIMARY_MODEL_NAME, config.MODEL_PATH, _model, config.MODEL_CLASS_MAP)
+        _load_extra_models()
+
         _is_model_loaded = True
+        _load_state, _load_error = 'ready', None
         return True
 
     except ImportError as e:
          logging.error(f"ML Handler: Lỗi import khi tải model. Đảm bảo torchvision đã được cài đặt đúng cách. Lỗi: {e}", exc_info=True)
          _model = None
          _is_model_loaded = False
+         _load_state, _load_error = 'failed', f"ImportError: {e}"
          return False
     except Exception as e:
         logging.error(f"ML Handler: Lỗi không xác định khi tải model hoặc khởi tạo transform: {e}", exc_info=True)
         _model = None
         _is_model_loaded = False
+        _load_state, _load_error = 'failed', str(e)
+        return False
+
+def warmup(iterations: int = 2) -> bool:
+    """
+    Chạy thử vài lần dự đoán trên chunk im lặng để khởi tạo bộ nhớ/kernels,
+    tránh chunk thật đầu tiên bị chậm. Trả về False nếu model chưa tải.
+    """
+    global _is_warmed_up
+    if not _is_model_loaded:
         return False
+    silent_chunk = torch.zeros(config.AUDIO_CHUNK_SAMPLES, dtype=torch.float32)
+    t0 = time.perf_counter()
+    for _ in range(max(1, iterations)):
+        predict_all(silent_chunk)
+    _is_warmed_up = True
+    logging.info(f"ML Handler: Warm-up {iterations} lần dự đoán mất {time.perf_counter() - t0:.2f}s.")
+    return True
+
+def load_and_warmup() -> bool:
+    """Tải model rồi warm-up (dùng cho luồng nền và run_ingest.py)."""
+    # Warm-up tạo pool OpenMP của luồng này: ghim trước để pool dùng đúng CPU set inference,
+    # xong thì trả luồng về CPU set cũ (luồng main của run_ingest còn tạo luồng UDP/IPC sau đó)
+    previous_cpus = torch_runtime.pin_current_thread()
+    try:
+        if not load_model():
+            return False
+        try:
+            warmup()
+        except Exception as e:
+            # Warm-up lỗi không làm hỏng model đã tải
+            logging.warning(f"ML Handler: Warm-up thất bại: {e}", exc_info=True)
+        return True
+    finally:
+        torch_runtime.restore_thread_affinity(previous_cpus)
+
+def get_readiness() -> dict:
+    """Trạng thái tải model cho /ready."""
+    return {
+        'state': _load_state,
+        'loaded': _is_model_loaded,
+        'warmed_up': _is_warmed_up,
+        'device': _device,
+        'models': list_models(),
+        'feature_pipeline': 'fused' if _feature_graph is not None else 'pil',
+        'feature_parity_diff': _feature_parity_diff,
+        'threads': torch_runtime.get_layout(),
+        'error': _load_error,
+    }
 
 def _pad_waveform(waveform, target_length):
     """Pads hoặc cắt bớt tensor waveform đến target_length."""
+    _import_ml_libs()
     # Đảm bảo waveform là 2D (channels, time)
     if waveform.ndim == 1:
         waveform = waveform.unsqueeze(0)
@@ -104,132 +385,235 @@ def _pad_waveform(waveform, target_length):
         waveform = waveform[:, :target_length] # Cắt từ cuối
     return waveform
 
-def _audio_chunk_to_image_tensor(audio_chunk_tensor):
-    """Biến đổi một đoạn audio tensor thành image tensor cho model."""
-    global _mel_transform, _transform_pipeline
-
-    if not _is_model_loaded or _mel_transform is None or _transform_pipeline is None:
-        logging.error("ML Handler: Model hoặc transforms chưa được tải, không thể xử lý audio.")
-        return None # Trả về None nếu chưa sẵn sàng
-
+def _log_mel_batch(audio_batch):
+    """
+    Tính log-mel spectrogram cho một batch audio.
+    audio_batch: tensor (T,) hoặc (B, T) float [-1.0, 1.0]. Trả về numpy (B, n_mels, frames) trên CPU.
+    Mỗi hàng được pad/cắt và biến đổi độc lập nên kết quả giống hệt khi xử lý từng chunk.
+    """
+    # 1. Đảm bảo tensor audio ở đúng định dạng và thiết bị
+    if audio_batch.ndim == 1:
+        audio_batch = audio_batch.unsqueeze(0) # Thêm chiều batch nếu thiếu
+    audio_batch = audio_batch.to(_device) # Chuyển lên device
+
+    # 2. Pad/Truncate waveform đến độ dài mong đợi khi huấn luyện
+    audio_padded = _pad_waveform(audio_batch, config.MODEL_TARGET_LENGTH_SAMPLES)
+
+    # 3. Tạo Mel Spectrogram
+    spectrogram = _mel_transform(audio_padded) # audio_padded đã ở trên device
+    spectrogram = spectrogram + 1e-10 # Thêm epsilon nhỏ tránh log(0)
+
+    # 4. Chuyển sang thang Log, về CPU để xử lý numpy và matplotlib
+    return spectrogram.log2().cpu().numpy()
+
+def _spectrogram_to_image_tensor(spec_np):
+    """Biến đổi một log-mel spectrogram 2D (numpy) thành image tensor (1, 3, H, W) trên device."""
+    _ensure_pil_pipeline()
+    # 5. Chuẩn hóa và chuyển đổi sang ảnh PIL dùng matplotlib (theo code mẫu)
+    # Chuẩn hóa 0-1 (tùy chọn nhưng thường tốt)
+    spec_min, spec_max = spec_np.min(), spec_np.max()
+    if spec_max > spec_min:
+        spec_norm = (spec_np - spec_min) / (spec_max - spec_min)
+    else:
+        spec_norm = np.zeros_like(spec_np)
+
+    # Tạo ảnh từ matplotlib để có colormap 'viridis'
+    # Tạo figure và axes mới mỗi lần để tránh vấn đề thread-safety của matplotlib
+    # Dòng này sẽ không còn gây warning vì đã set backend 'Agg'
+    fig, ax = plt.subplots(1, figsize=(config.MODEL_IMG_SIZE[1]/100, config.MODEL_IMG_SIZE[0]/100), dpi=100)
+    fig.subplots_adjust(left=0, right=1, bottom=0, top=1) # Bỏ viền trắng
+    ax.axis('off') # Tắt trục
+    ax.imshow(spec_norm, cmap='viridis', aspect='auto', origin='lower')
+
+    buf = io.BytesIO()
     try:
-        # 1. Đảm bảo tensor audio ở đúng định dạng và thiết bị
-        if audio_chunk_tensor.ndim == 1:
-            audio_chunk_tensor = audio_chunk_tensor.unsqueeze(0) # Thêm chiều channel nếu thiếu
-        audio_chunk_device = audio_chunk_tensor.to(config.ML_DEVICE) # Chuyển lên device
-
-        # 2. Pad/Truncate waveform đến độ dài mong đợi khi huấn luyện
-        audio_padded = _pad_waveform(audio_chunk_device, config.MODEL_TARGET_LENGTH_SAMPLES)
-
-        # 3. Tạo Mel Spectrogram
-        spectrogram = _mel_transform(audio_padded) # audio_padded đã ở trên device
-        spectrogram = spectrogram + 1e-10 # Thêm epsilon nhỏ tránh log(0)
-
-        # 4. Chuyển sang thang Log
-        log_spectrogram = spectrogram.log2()
-
-        # 5. Chuẩn hóa và chuyển đổi sang ảnh PIL dùng matplotlib (theo code mẫu)
-        # Chuyển về CPU để xử lý numpy và matplotlib
-        spec_np = log_spectrogram.squeeze().cpu().numpy()
-
-        # Chuẩn hóa 0-1 (tùy chọn nhưng thường tốt)
-        spec_min, spec_max = spec_np.min(), spec_np.max()
-        if spec_max > spec_min:
-            spec_norm = (spec_np - spec_min) / (spec_max - spec_min)
-        else:
-            spec_norm = np.zeros_like(spec_np)
+        # Lưu ảnh vào buffer trong bộ nhớ
+        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0, dpi=100)
+    except Exception as save_err:
+        logging.error(f"ML Handler: Lỗi khi lưu ảnh matplotlib: {save_err}", exc_info=True)
+        return None # Trả về None nếu lỗi
+    finally:
+        plt.close(fig) # Luôn đóng figure để giải phóng bộ nhớ
+    buf.seek(0)
+
+    # Mở ảnh từ buffer bằng PIL và chuyển sang RGB
+    try:
+        img = Image.open(buf).convert('RGB')
+    except Exception as img_err:
+        logging.error(f"ML Handler: Lỗi khi mở ảnh từ buffer: {img_err}", exc_info=True)
+        return None
 
-        # Tạo ảnh từ matplotlib để có colormap 'viridis'
-        # Tạo figure và axes mới mỗi lần để tránh vấn đề thread-safety của matplotlib
-        # Dòng này sẽ không còn gây warning vì đã set backend 'Agg'
-        fig, ax = plt.subplots(1, figsize=(config.MODEL_IMG_SIZE[1]/100, config.MODEL_IMG_SIZE[0]/100), dpi=100)
-        fig.subplots_adjust(left=0, right=1, bottom=0, top=1) # Bỏ viền trắng
-        ax.axis('off') # Tắt trục
-        ax.imshow(spec_norm, cmap='viridis', aspect='auto', origin='lower')
+    # 6. Áp dụng pipeline transform (Resize, ToTensor, Normalize nếu cần)
+    img_tensor = _transform_pipeline(img)
 
-        buf = io.BytesIO()
-        try:
-            # Lưu ảnh vào buffer trong bộ nhớ
-            plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0, dpi=100)
-        except Exception as save_err:
-            logging.error(f"ML Handler: Lỗi khi lưu ảnh matplotlib: {save_err}", exc_info=True)
-            return None # Trả về None nếu lỗi
-        finally:
-            plt.close(fig) # Luôn đóng figure để giải phóng bộ nhớ
-        buf.seek(0)
-
-        # Mở ảnh từ buffer bằng PIL và chuyển sang RGB
-        try:
-            img = Image.open(buf).convert('RGB')
-        except Exception as img_err:
-            logging.error(f"ML Handler: Lỗi khi mở ảnh từ buffer: {img_err}", exc_info=True)
-            return None
+    # 7. Thêm chiều batch (batch size = 1)
+    img_tensor = img_tensor.unsqueeze(0)
 
-        # 6. Áp dụng pipeline transform (Resize, ToTensor, Normalize nếu cần)
-        img_tensor = _transform_pipeline(img)
+    # 8. Đảm bảo tensor cuối cùng ở đúng device
+    return img_tensor.to(_device)
 
-        # 7. Thêm chiều batch (batch size = 1)
-        img_tensor = img_tensor.unsqueeze(0)
+def _fused_image_batch(audio_batch):
+    """Audio (T,) hoặc (B, T) -> image tensor (B, 3, H, W) trên device qua đồ thị đặc trưng hợp nhất."""
+    if audio_batch.ndim == 1:
+        audio_batch = audio_batch.unsqueeze(0)
+    audio_padded = _pad_waveform(audio_batch.to(_device), config.MODEL_TARGET_LENGTH_SAMPLES)
+    with torch.no_grad():
+        return _feature_graph(audio_padded)
 
-        # 8. Đảm bảo tensor cuối cùng ở đúng device
-        return img_tensor.to(config.ML_DEVICE)
+def _audio_chunk_to_image_tensor(audio_chunk_tensor):
+    """Biến đổi một đoạn audio tensor thành image tensor cho model."""
+    if not _is_model_loaded or _mel_transform is None or (_feature_graph is None and _transform_pipeline is None):
+        logging.error("ML Handler: Model hoặc transforms chưa được tải, không thể xử lý audio.")
+        return None # Trả về None nếu chưa sẵn sàng
 
+    try:
+        if _feature_graph is not None:
+            with metrics.stage_timer('feature_graph'):
+                return _fused_image_batch(audio_chunk_tensor)
+        with metrics.stage_timer('mel'):
+            spec_np = _log_mel_batch(audio_chunk_tensor)[0]
+        with metrics.stage_timer('image_conversion'):
+            return _spectrogram_to_image_tensor(spec_np)
     except Exception as e:
         logging.error(f"ML Handler: Lỗi trong quá trình chuyển đổi audio sang ảnh: {e}", exc_info=True)
         return None # Trả về None nếu có lỗi
 
-def predict_scream(audio_chunk_tensor):
+def _outputs_to_predictions(outputs, class_map: dict | None = None) -> list[tuple]:
+    """Logits (B, num_classes) -> [(prediction_label, confidence), ...]."""
+    class_map = config.MODEL_CLASS_MAP if class_map is None else class_map
+    probabilities = torch.softmax(outputs, dim=1)
+    confidence_tensor, predicted_idx_tensor = torch.max(probabilities, 1)
+    results = []
+    for predicted_idx, confidence in zip(predicted_idx_tensor.cpu().tolist(), confidence_tensor.cpu().tolist()):
+        prediction_label = class_map.get(predicted_idx, "Unknown")
+        if prediction_label not in class_map.values():
+            logging.warning(f"ML Handler: Lớp dự đoán không xác định: index {predicted_idx}")
+        results.append((prediction_label, confidence))
+    return results
+
+def _forward_registry(image_batch, include_extra: bool) -> dict:
     """
-    Thực hiện dự đoán tiếng hét từ một đoạn audio tensor.
+    Forward một batch ảnh qua các model trong registry: {tên model: [(label, confidence), ...]}.
+    Các detector dùng chung một model chỉ forward một lần. Model bị lỗi nhận (None, 0.0) cho cả batch.
+    """
+    batch_size = image_batch.shape[0]
+    results = {}
+    outputs_by_model = {}
+    with torch.no_grad(): # Quan trọng: không tính gradient khi inference
+        for name, entry in _registry.items():
+            is_primary = name == config.PRIMARY_MODEL_NAME
+            if not is_primary and not include_extra:
+                continue
+            try:
+                outputs = outputs_by_model.get(id(entry.model))
+                if outputs is None:
+                    with metrics.stage_timer('forward_pass' if is_primary else f'forward_pass_{name}'):
+                        outputs = outputs_by_model[id(entry.model)] = entry.model(image_batch)
+                results[name] = _outputs_to_predictions(outputs, entry.class_map)
+            except Exception as e:
+                logging.error(f"ML Handler: Lỗi khi forward model '{name}': {e}", exc_info=True)
+                results[name] = [(None, 0.0)] * batch_size
+    return results
+
+def _empty_predictions(include_extra: bool) -> dict:
+    names = list_models() if include_extra else [config.PRIMARY_MODEL_NAME]
+    return {name: (None, 0.0) for name in names or [config.PRIMARY_MODEL_NAME]}
+
+def predict_all_batch(audio_batch, include_extra: bool = True) -> list[dict]:
+    """
+    Dự đoán cho nhiều chunk cùng lúc: mel spectrogram tính theo batch, ảnh tính một lần cho mỗi chunk
+    (cả batch một lần với đồ thị đặc trưng hợp nhất), rồi mỗi model trong registry forward một lần cho cả batch.
     Args:
-        audio_chunk_tensor (torch.Tensor): Tensor chứa dữ liệu audio float [-1.0, 1.0].
+        audio_batch (torch.Tensor): (B, T) float [-1.0, 1.0].
+        include_extra (bool): False = chỉ chạy model tiếng hét.
     Returns:
-        tuple: (prediction_label, confidence) hoặc (None, 0.0) nếu lỗi hoặc không phát hiện.
-               prediction_label (str): Tên lớp dự đoán ('Hét', 'Không hét', 'Unknown').
-               confidence (float): Độ tin cậy của dự đoán (0.0 đến 1.0).
+        list[dict]: B phần tử {tên model: (prediction_label, confidence)}; (None, 0.0) cho chunk bị lỗi.
     """
-    global _model
+    batch_size = audio_batch.shape[0] if audio_batch.ndim > 1 else 1
+    if not _is_model_loaded or _model is None:
+        logging.warning("ML Handler: Model chưa được tải, không thể dự đoán.")
+        return [_empty_predictions(include_extra) for _ in range(batch_size)]
 
+    results = [_empty_predictions(include_extra) for _ in range(batch_size)]
+    try:
+        if _feature_graph is not None:
+            with metrics.stage_timer('feature_graph'):
+                images = _fused_image_batch(audio_batch)
+            predictions = _forward_registry(images, include_extra)
+            for name, model_predictions in predictions.items():
+                for result, prediction in zip(results, model_predictions):
+                    result[name] = prediction
+            return results
+        with metrics.stage_timer('mel'):
+            specs = _log_mel_batch(audio_batch)
+        with metrics.stage_timer('image_conversion'):
+            images = [_spectrogram_to_image_tensor(spec) for spec in specs]
+        valid = [i for i, img in enumerate(images) if img is not None]
+        if not valid:
+            return results
+        predictions = _forward_registry(torch.cat([images[i] for i in valid]), include_extra)
+        for name, model_predictions in predictions.items():
+            for i, prediction in zip(valid, model_predictions):
+                results[i][name] = prediction
+        return results
+    except Exception as e:
+        logging.error(f"ML Handler: Lỗi trong quá trình dự đoán theo batch: {e}", exc_info=True)
+        return [_empty_predictions(include_extra) for _ in range(batch_size)]
+
+def predict_scream_batch(audio_batch) -> list[tuple]:
+    """
+    Dự đoán tiếng hét cho nhiều chunk cùng lúc (chỉ model tiếng hét, xem predict_all_batch).
+    Dùng cho chấm điểm offline (tools/batch_score.py); kết quả giống predict_scream từng chunk.
+    Returns:
+        list[tuple]: B phần tử (prediction_label, confidence); (None, 0.0) cho chunk bị lỗi.
+    """
+    return [result[config.PRIMARY_MODEL_NAME] for result in predict_all_batch(audio_batch, include_extra=False)]
+
+def predict_all(audio_chunk_tensor, include_extra: bool = True) -> dict:
+    """
+    Chạy mọi model trong registry trên một đoạn audio: mel spectrogram và ảnh chỉ tính một lần.
+    Args:
+        audio_chunk_tensor (torch.Tensor): Tensor chứa dữ liệu audio float [-1.0, 1.0].
+        include_extra (bool): False = chỉ chạy model tiếng hét.
+    Returns:
+        dict: {tên model: (prediction_label, confidence)}, (None, 0.0) cho model bị lỗi.
+              Kết quả của model tiếng hét nằm ở khóa config.PRIMARY_MODEL_NAME.
+    """
     if not _is_model_loaded or _model is None:
         logging.warning("ML Handler: Model chưa được tải, không thể dự đoán.")
-        return None, 0.0
+        return _empty_predictions(include_extra)
 
     start_time = time.time()
 
-    # 1. Chuyển đổi audio thành image tensor
+    # 1. Chuyển đổi audio thành image tensor (dùng chung cho mọi model)
     image_tensor = _audio_chunk_to_image_tensor(audio_chunk_tensor)
     if image_tensor is None or image_tensor.nelement() == 0:
         logging.error("ML Handler: Không thể tạo image tensor từ audio chunk.")
-        return None, 0.0
+        return _empty_predictions(include_extra)
 
     # 2. Thực hiện dự đoán
     try:
-        with torch.no_grad(): # Quan trọng: không tính gradient khi inference
-            outputs = _model(image_tensor) # image_tensor đã ở trên device
-            probabilities = torch.softmax(outputs, dim=1)
-            confidence_tensor, predicted_idx_tensor = torch.max(probabilities, 1)
-
-            # Chuyển kết quả về CPU để lấy giá trị
-            predicted_idx = predicted_idx_tensor.cpu().item()
-            confidence = confidence_tensor.cpu().item()
-
-            prediction_label = config.MODEL_CLASS_MAP.get(predicted_idx, "Unknown")
-
-        end_time = time.time()
-        processing_time = end_time - start_time
-        # Log này vẫn giữ nguyên, bạn có thể điều chỉnh nếu muốn
-        logging.debug(f"ML Handler: Dự đoán hoàn tất trong {processing_time:.4f}s - Kết quả: {prediction_label} ({confidence*100:.1f}%)")
-
-        # Chỉ trả về kết quả nếu là 'Hét' hoặc 'Không hét' (có thể tùy chỉnh)
-        if prediction_label in config.MODEL_CLASS_MAP.values():
-             return prediction_label, confidence
-        else:
-             logging.warning(f"ML Handler: Lớp dự đoán không xác định: index {predicted_idx}")
-             return "Unknown", confidence # Hoặc trả về None, 0.0 tùy logic mong muốn
-
+        results = {name: predictions[0] for name, predictions in _forward_registry(image_tensor, include_extra).items()}
     except Exception as e:
         logging.error(f"ML Handler: Lỗi trong quá trình dự đoán: {e}", exc_info=True)
-        return None, 0.0
+        return _empty_predictions(include_extra)
+
+    processing_time = time.time() - start_time
+    metrics.STAGE_SECONDS.observe(processing_time, 'predict_total')
+    logging.debug(f"ML Handler: Dự đoán hoàn tất trong {processing_time:.4f}s - Kết quả: {results}")
+    return results
+
+def predict_scream(audio_chunk_tensor):
+    """
+    Thực hiện dự đoán tiếng hét từ một đoạn audio tensor.
+    Args:
+        audio_chunk_tensor (torch.Tensor): Tensor chứa dữ liệu audio float [-1.0, 1.0].
+    Returns:
+        tuple: (prediction_label, confidence) hoặc (None, 0.0) nếu lỗi hoặc không phát hiện.
+               prediction_label (str): Tên lớp dự đoán ('Hét', 'Không hét', 'Unknown').
+               confidence (float): Độ tin cậy của dự đoán (0.0 đến 1.0).
+    """
+    return predict_all(audio_chunk_tensor, include_extra=False)[config.PRIMARY_MODEL_NAME]
 
 # Tùy chọn: Gọi load_model() ngay khi import module này?
 # Điều này có thể làm chậm quá trình khởi động server ban đầu.
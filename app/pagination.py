@@ -0,0 +1,71 @@
+# app/pagination.py
+# Cursor "mờ" (opaque) cho phân trang keyset của /alert_history.
+# Cursor mã hóa (timestamp, document id) của phần tử cuối trang, nên có thể truyền thẳng
+# vào Query.start_after() mà KHÔNG cần đọc lại document (không tốn thêm read / round-trip).
+# Cursor còn gắn với bộ lọc đã dùng để tạo ra nó; đổi bộ lọc thì cursor cũ bị từ chối.
+import base64
+import hashlib
+import json
+import datetime
+
+CURSOR_VERSION = 1
+
+
+class InvalidCursorError(ValueError):
+    """Cursor không giải mã được, sai phiên bản hoặc không khớp bộ lọc hiện tại."""
+
+
+def filters_fingerprint(filters: dict) -> str:
+    """Tạo dấu vân tay ngắn cho bộ lọc (client_ip, since, until...) để gắn vào cursor."""
+    canonical = json.dumps({k: v for k, v in sorted(filters.items()) if v is not None},
+                           separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:12]
+
+
+def _timestamp_to_str(timestamp: datetime.datetime) -> str:
+    """Chuỗi RFC 3339 giữ nguyên độ chính xác nano giây của Firestore."""
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+    if isinstance(timestamp, DatetimeWithNanoseconds):
+        return timestamp.rfc3339()
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def encode_cursor(timestamp: datetime.datetime, doc_id: str, filters: dict) -> str:
+    """Mã hóa vị trí (timestamp, doc_id) thành token base64 an toàn cho URL."""
+    payload = {
+        'v': CURSOR_VERSION,
+        't': _timestamp_to_str(timestamp),
+        'i': doc_id,
+        'f': filters_fingerprint(filters),
+    }
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token: str, filters: dict) -> tuple[datetime.datetime, str]:
+    """
+    Giải mã token thành (timestamp, doc_id).
+    Raises:
+        InvalidCursorError: nếu token hỏng hoặc được tạo với bộ lọc khác.
+    """
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if payload.get('v') != CURSOR_VERSION:
+            raise InvalidCursorError("Unsupported cursor version")
+        timestamp = DatetimeWithNanoseconds.from_rfc3339(payload['t'])
+        doc_id = payload['i']
+        fingerprint = payload['f']
+    except InvalidCursorError:
+        raise
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise InvalidCursorError(f"Malformed cursor: {e}") from e
+
+    if not isinstance(doc_id, str) or not doc_id or '/' in doc_id:
+        raise InvalidCursorError("Malformed cursor: bad document id")
+    if fingerprint != filters_fingerprint(filters):
+        raise InvalidCursorError("Cursor does not match the current filters")
+    return timestamp, doc_id
@@ -0,0 +1,268 @@
+# app/preroll.py
+# Bộ ghi pre-roll trên đĩa: mỗi thiết bị một file vòng (ring) kích thước cố định, map vào bộ nhớ (mmap),
+# chứa PREROLL_SECONDS giây audio int16 gần nhất. RAM không tăng theo độ dài clip hay số thiết bị
+# (page cache của OS lo phần đệm), dữ liệu còn nguyên sau khi process khởi động lại, và clip cảnh báo
+# được cắt ra dưới dạng view numpy trỏ thẳng vào file (không sao chép).
+#
+# Bố cục file '<PREROLL_DIR>/<device>.ring':
+#   [0, HEADER_SIZE)  header: magic, version, sample_rate, capacity (mẫu), written (tổng số mẫu đã ghi),
+#                     end_time (epoch giây của mẫu cuối cùng), sequence (số lẻ = đang ghi; người đọc ở process
+#                     khác dùng để lấy header nhất quán và phát hiện lần ghi chen vào lúc đang đọc)
+#   [HEADER_SIZE, ..) capacity mẫu int16; mẫu thứ n (tính từ lúc tạo file) nằm ở vị trí n % capacity
+# Khoảng mất kết nối dài hơn PREROLL_GAP_FILL_S được ghi bằng im lặng để trục thời gian luôn đúng.
+import logging
+import contextlib
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+
+from . import config
+
+MAGIC = b'SCRMRING'
+VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('sample_rate', '<u4'),
+    ('capacity', '<u8'),
+    ('written', '<u8'),
+    ('end_time', '<f8'),
+    ('sequence', '<u8'), # File cũ có 0 ở đây (phần đệm của header) nên không cần đổi VERSION
+])
+_SNAPSHOT_RETRIES = 1000
+
+_rings = {} # device -> DeviceRing
+_rings_lock = threading.Lock()
+
+
+def to_int16(audio) -> np.ndarray:
+    """Audio float [-1, 1] (tensor hoặc numpy) -> int16."""
+    audio_np = audio.detach().cpu().numpy() if hasattr(audio, 'detach') else np.asarray(audio)
+    if audio_np.dtype == np.int16:
+        return audio_np
+    return np.clip(audio_np * 32767, -32768, 32767).astype(np.int16)
+
+
+class RingWindow:
+    """
+    Một khoảng mẫu [start, stop) của ring, dưới dạng tối đa 2 view (khi khoảng vắt qua cuối file).
+    Ring vẫn tiếp tục được ghi: dùng consistent() sau khi đọc xong để chắc dữ liệu chưa bị ghi đè.
+    """
+
+    def __init__(self, ring: 'DeviceRing', start: int, stop: int, start_time: float, sequence: int):
+        self.ring = ring
+        self.start = start
+        self.stop = stop
+        self.start_time = start_time
+        self.sample_rate = ring.sample_rate
+        self.sequence = sequence
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def segments(self) -> list[np.ndarray]:
+        capacity = self.ring.capacity
+        first, last = self.start % capacity, self.stop % capacity
+        if len(self) == 0:
+            return []
+        if first < last or last == 0:
+            return [self.ring.data[first:last or capacity]]
+        return [self.ring.data[first:], self.ring.data[:last]]
+
+    def to_array(self) -> np.ndarray:
+        """Một mảng liền: view nếu không vắt qua cuối ring, ngược lại là bản sao."""
+        segments = self.segments()
+        if len(segments) == 1:
+            return segments[0]
+        return np.concatenate(segments) if segments else np.empty(0, dtype=np.int16)
+
+    def intact(self) -> bool:
+        return int(self.ring.header['written']) - self.ring.capacity <= self.start
+
+    def consistent(self) -> bool:
+        """
+        True nếu dữ liệu đọc từ window (kể từ lúc tạo window) còn đúng: không có lần ghi nào chen vào, hoặc
+        các lần ghi chen vào đã xong và chưa chạm tới đầu window. Gọi SAU khi đọc xong.
+        """
+        sequence, written, _ = self.ring.header_snapshot()
+        if sequence == self.sequence:
+            return True
+        return sequence % 2 == 0 and written - self.ring.capacity <= self.start
+
+
+class DeviceRing:
+    def __init__(self, path: str, sample_rate: int, capacity: int, writable: bool = True):
+        self.path = path
+        self.writable = writable
+        self._lock = threading.Lock()
+        file_size = HEADER_SIZE + capacity * 2
+        if writable:
+            self._ensure_file(path, sample_rate, capacity, file_size)
+        with open(path, 'r+b' if writable else 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self._mmap, offset=0)
+        if self.header['magic'] != MAGIC or int(self.header['version']) != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} không phải file pre-roll hợp lệ")
+        self.sample_rate = int(self.header['sample_rate'])
+        self.capacity = int(self.header['capacity'])
+        self.data = np.ndarray((self.capacity,), dtype=np.int16, buffer=self._mmap, offset=HEADER_SIZE)
+
+    @staticmethod
+    def _ensure_file(path: str, sample_rate: int, capacity: int, file_size: int):
+        if os.path.exists(path) and os.path.getsize(path) == file_size:
+            header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+            if header['magic'] == MAGIC and int(header['version']) == VERSION \
+                    and int(header['sample_rate']) == sample_rate and int(header['capacity']) == capacity:
+                return # Dùng lại dữ liệu từ lần chạy trước
+            logging.warning(f"Pre-roll: {path} có cấu hình khác (sample rate/dung lượng), tạo lại.")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.truncate(file_size) # File thưa: chưa tốn dung lượng đĩa cho tới khi được ghi
+            header = np.zeros((), dtype=HEADER_DTYPE)
+            header['magic'], header['version'] = MAGIC, VERSION
+            header['sample_rate'], header['capacity'] = sample_rate, capacity
+            f.write(header.tobytes())
+        os.replace(tmp_path, path)
+
+    def _write(self, samples: np.ndarray):
+        """Ghi mẫu vào vị trí hiện tại (gọi trong lock, không cập nhật end_time)."""
+        written = int(self.header['written'])
+        if len(samples) > self.capacity:
+            written += len(samples) - self.capacity
+            samples = samples[-self.capacity:]
+        position = written % self.capacity
+        first = min(len(samples), self.capacity - position)
+        self.data[position:position + first] = samples[:first]
+        self.data[:len(samples) - first] = samples[first:]
+        # Cập nhật header SAU khi ghi dữ liệu để người đọc không thấy mẫu chưa ghi xong
+        self.header['written'] = written + len(samples)
+
+    def header_snapshot(self) -> tuple[int, int, float]:
+        """
+        (sequence, written, end_time) đọc nhất quán, kể cả khi process khác đang ghi. sequence lẻ nghĩa là
+        không lấy được bản nhất quán (ghi liên tục quá lâu); consistent() khi đó trả về False.
+        """
+        for _ in range(_SNAPSHOT_RETRIES):
+            sequence = int(self.header['sequence'])
+            if sequence % 2 == 0:
+                written, end_time = int(self.header['written']), float(self.header['end_time'])
+                if int(self.header['sequence']) == sequence:
+                    return sequence, written, end_time
+            time.sleep(0)
+        return sequence | 1, int(self.header['written']), float(self.header['end_time'])
+
+    def append(self, audio, end_time: float):
+        """Ghi một đoạn audio kết thúc tại end_time (epoch giây)."""
+        samples = to_int16(audio)
+        if samples.ndim != 1:
+            samples = samples.reshape(-1)
+        with self._lock:
+            self.header['sequence'] = int(self.header['sequence']) + 1 # Lẻ: đang ghi
+            try:
+                last_end = float(self.header['end_time'])
+                if last_end > 0:
+                    gap_s = end_time - len(samples) / self.sample_rate - last_end
+                    if gap_s > config.PREROLL_GAP_FILL_S:
+                        # Thiết bị mất kết nối / process vừa khởi động lại: lấp im lặng để giữ trục thời gian
+                        self._write(np.zeros(min(int(gap_s * self.sample_rate), self.capacity), dtype=np.int16))
+                self._write(samples)
+                self.header['end_time'] = end_time
+            finally:
+                self.header['sequence'] = int(self.header['sequence']) + 1
+
+    def window(self, start_time: float, end_time: float) -> RingWindow:
+        """Khoảng [start_time, end_time] (epoch giây), bị cắt theo phần dữ liệu còn trong ring."""
+        with self._lock:
+            sequence, written, last_end = self.header_snapshot()
+        oldest = max(0, written - self.capacity)
+        stop = written - int(round(max(0.0, last_end - end_time) * self.sample_rate))
+        start = written - int(round(max(0.0, last_end - start_time) * self.sample_rate))
+        start, stop = max(oldest, start), max(oldest, min(stop, written))
+        start = min(start, stop)
+        return RingWindow(self, start, stop, last_end - (written - start) / self.sample_rate, sequence)
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        with self._lock:
+            if self._mmap.closed:
+                return
+            if self.writable:
+                self._mmap.flush()
+            self._mmap.close()
+
+    def __enter__(self) -> 'DeviceRing':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _ring_path(device: str) -> str:
+    return os.path.join(config.PREROLL_DIR, f"{device.replace('.', '-').replace(':', '_')}.ring")
+
+
+def get_ring(device: str) -> DeviceRing:
+    """Ring của thiết bị (tạo file ở lần đầu, mở lại file cũ nếu có)."""
+    ring = _rings.get(device)
+    if ring is not None:
+        return ring
+    with _rings_lock:
+        ring = _rings.get(device)
+        if ring is None:
+            os.makedirs(config.PREROLL_DIR, exist_ok=True)
+            capacity = int(config.PREROLL_SECONDS * config.AUDIO_SAMPLE_RATE)
+            ring = _rings[device] = DeviceRing(_ring_path(device), config.AUDIO_SAMPLE_RATE, capacity)
+            logging.info(f"Pre-roll: Mở ring {ring.path} ({config.PREROLL_SECONDS}s, {ring.capacity * 2 / 1e6:.1f} MB).")
+        return ring
+
+
+def append(device: str, audio, end_time: float):
+    get_ring(device).append(audio, end_time)
+
+
+def get_window(device: str, start_time: float, end_time: float) -> RingWindow | None:
+    """Khoảng audio của thiết bị trong process ingest (None nếu thiết bị chưa có ring)."""
+    if device not in _rings and not os.path.exists(_ring_path(device)):
+        return None
+    return get_ring(device).window(start_time, end_time)
+
+
+@contextlib.contextmanager
+def read_window(device: str, start_time: float, end_time: float):
+    """
+    Context manager: khoảng audio từ file ring ở chế độ chỉ đọc (dùng được từ process web khi
+    INGEST_MODE=external), hoặc None nếu thiết bị không có file pre-roll. Ring mở riêng cho lần đọc được
+    đóng (unmap) khi ra khỏi khối with; chỉ dùng window bên trong khối và kiểm tra consistent() sau khi đọc.
+    """
+    ring = _rings.get(device)
+    if ring is not None:
+        yield ring.window(start_time, end_time)
+        return
+    path = _ring_path(device)
+    if not os.path.exists(path):
+        yield None
+        return
+    with DeviceRing(path, 0, 0, writable=False) as ring:
+        yield ring.window(start_time, end_time)
+
+
+def list_devices() -> list[str]:
+    """Các thiết bị có file pre-roll (tên file đã chuẩn hóa: '.' -> '-')."""
+    if not os.path.isdir(config.PREROLL_DIR):
+        return []
+    return sorted(name[:-len('.ring')].replace('-', '.') for name in os.listdir(config.PREROLL_DIR) if name.endswith('.ring'))
+
+
+def close_all():
+    """Flush và đóng mọi ring (khi dừng process ingest)."""
+    with _rings_lock:
+        for ring in _rings.values():
+            ring.close()
+        _rings.clear()
@@ -0,0 +1,180 @@
+# app/response_cache.py
+# Cache phản hồi phía server cho các route chỉ thay đổi khi có cảnh báo mới
+# (/alert_history, /statistics/weekly).
+# - Key = path + toàn bộ query params (đã sắp xếp).
+# - Bị vô hiệu hóa (invalidate) mỗi khi firebase_client.log_alert_to_firestore ghi cảnh báo mới.
+# - Gửi ETag và Last-Modified; client gửi lại If-None-Match / If-Modified-Since sẽ nhận 304 không có body.
+#   ETag = "<thế hệ dữ liệu>-<hash nội dung>": thế hệ tăng ở mỗi lần ghi cảnh báo (process ingest gửi thế hệ
+#   của nó cho worker web qua ingest_ipc), nên hai lần ghi trong cùng một giây không bao giờ dùng chung ETag.
+#   Last-Modified tăng ngặt theo thế hệ (ít nhất 1 giây mỗi lần ghi) để If-Modified-Since cũng không trả 304 sai.
+import logging
+import threading
+import time
+import hashlib
+import datetime
+import functools
+from collections import OrderedDict
+
+from flask import request, Response
+
+from . import config
+from . import metrics
+
+_cache = OrderedDict() # key -> _CacheEntry (thứ tự LRU)
+_cache_lock = threading.Lock()
+_generation_changed = threading.Condition(_cache_lock)
+# Thời điểm dữ liệu thay đổi lần cuối (dùng cho Last-Modified), khởi tạo bằng lúc server khởi động
+_last_modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+_generation = 0 # Thế hệ dữ liệu: tăng mỗi lần ghi cảnh báo
+_stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'invalidations': 0, 'evictions': 0}
+
+
+class _CacheEntry:
+    __slots__ = ('body', 'status', 'mimetype', 'etag', 'last_modified', 'created_at')
+
+    def __init__(self, body: bytes, status: int, mimetype: str, etag: str, last_modified: datetime.datetime):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+        self.created_at = time.monotonic()
+
+
+def _make_key() -> str:
+    """Tạo cache key từ path và query params của request hiện tại."""
+    params = sorted((k, v) for k in request.args for v in request.args.getlist(k))
+    return request.path + '?' + '&'.join(f"{k}={v}" for k, v in params)
+
+
+def invalidate(reason: str = "new alert", generation: int | None = None,
+               last_modified: datetime.datetime | None = None) -> tuple[int, datetime.datetime]:
+    """
+    Xóa toàn bộ cache. Không truyền generation = dữ liệu vừa được ghi trong process này (tăng thế hệ);
+    worker web truyền thế hệ và Last-Modified nhận từ process ingest.
+    Trả về (thế hệ, Last-Modified) hiện tại.
+    """
+    global _last_modified, _generation
+    with _cache_lock:
+        _cache.clear()
+        if generation is None:
+            _generation += 1
+            now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+            # Last-Modified chỉ chính xác tới giây: hai lần ghi trong cùng một giây vẫn phải khác nhau
+            _last_modified = max(now, _last_modified + datetime.timedelta(seconds=1))
+        else:
+            _generation, _last_modified = generation, last_modified
+        _stats['invalidations'] += 1
+        _generation_changed.notify_all()
+        current = (_generation, _last_modified)
+    logging.debug(f"Response Cache: Đã xóa cache ({reason}), thế hệ {current[0]}.")
+    return current
+
+
+def current_generation() -> tuple[int, datetime.datetime]:
+    with _cache_lock:
+        return _generation, _last_modified
+
+
+def wait_for_change(generation: int, timeout: float) -> tuple[int, datetime.datetime]:
+    """Chờ tối đa timeout giây tới khi thế hệ khác `generation`. Trả về (thế hệ, Last-Modified) hiện tại."""
+    with _generation_changed:
+        _generation_changed.wait_for(lambda: _generation != generation, timeout)
+        return _generation, _last_modified
+
+
+def get_stats() -> dict:
+    """Trả về bộ đếm hit/miss/304 của cache."""
+    with _cache_lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_cache)
+        stats['last_modified'] = _last_modified.isoformat()
+        stats['generation'] = _generation
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+    return stats
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    stats = get_stats()
+    lines = []
+    for name in ('hits', 'misses', 'not_modified', 'invalidations', 'evictions'):
+        lines += metrics.gauge_lines(f'scream_response_cache_{name}_total', f'Response cache: {name}.', stats[name], 'counter')
+    lines += metrics.gauge_lines('scream_response_cache_entries', 'Số phản hồi đang được cache.', stats['entries'])
+    return lines
+
+
+def _is_not_modified(entry: _CacheEntry) -> bool:
+    """Kiểm tra các header điều kiện của request so với entry trong cache."""
+    if request.if_none_match:
+        # If-None-Match được ưu tiên hơn If-Modified-Since (RFC 7232)
+        return request.if_none_match.contains(entry.etag)
+    if request.if_modified_since:
+        return request.if_modified_since >= entry.last_modified
+    return False
+
+
+def _build_response(entry: _CacheEntry) -> Response:
+    if _is_not_modified(entry):
+        with _cache_lock:
+            _stats['not_modified'] += 1
+        response = Response(status=304)
+    else:
+        response = Response(entry.body, status=entry.status, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    # Buộc client luôn xác thực lại (gửi request có điều kiện) thay vì dùng bản cũ
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def cached(view_func):
+    """
+    Decorator cache phản hồi 200 của một view Flask.
+    View có thể trả về Response hoặc tuple (Response, status) như các route hiện có.
+    """
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        if not config.RESPONSE_CACHE_ENABLED:
+            return view_func(*args, **kwargs)
+
+        key = _make_key()
+        now = time.monotonic()
+        with _cache_lock:
+            entry = _cache.get(key)
+            if entry is not None and now - entry.created_at <= config.RESPONSE_CACHE_TTL_S:
+                _cache.move_to_end(key)
+                _stats['hits'] += 1
+            else:
+                entry = None
+                _stats['misses'] += 1
+            last_modified = _last_modified
+            generation = _generation
+
+        if entry is not None:
+            return _build_response(entry)
+
+        result = view_func(*args, **kwargs)
+        response, status = (result if isinstance(result, tuple) else (result, None))
+        if not isinstance(response, Response):
+            return result
+        status = status or response.status_code
+        if status != 200:
+            # Không cache lỗi
+            return result
+
+        body = response.get_data()
+        etag = f"{generation}-{hashlib.sha1(body).hexdigest()[:20]}"
+        entry = _CacheEntry(body, status, response.mimetype, etag, last_modified)
+        with _cache_lock:
+            # Chỉ lưu nếu không có invalidate xảy ra trong lúc đang truy vấn Firestore
+            if generation == _generation:
+                _cache[key] = entry
+                _cache.move_to_end(key)
+                while len(_cache) > config.RESPONSE_CACHE_MAX_ENTRIES:
+                    _cache.popitem(last=False)
+                    _stats['evictions'] += 1
+        return _build_response(entry)
+
+    return wrapper
@@ -1,22 +1,46 @@
 # app/routes.py
-from flask import request, jsonify, current_app, abort
+from flask import request, jsonify, current_app, abort, Response, stream_with_context, send_file, redirect, url_for
+import json
 import logging
 import datetime # <<< THÊM DÒNG NÀY
 from datetime import timedelta # <<< THÊM DÒNG NÀY
-from google.cloud import firestore
 import pytz # <<< THÊM DÒNG NÀY (Cần cài đặt: pip install pytz)
 
 from . import token_storage
 from . import firebase_client
-# Import S3 client và config từ udp_server (cân nhắc refactor nếu cần)
-from .udp_server import _s3_client, config as udp_config
+from . import alert_stats
+from . import response_cache
+from . import pagination
+from . import audio_urls
+from . import clip_cache
+from . import event_bus
+from . import ingest_ipc
+from . import ml_handler
+from . import s3_client
+from . import metrics
+from . import config
 
 # Định nghĩa múi giờ cho Việt Nam (hoặc múi giờ server của bạn)
 # Điều này quan trọng để tính toán ngày bắt đầu/kết thúc tuần chính xác
-LOCAL_TIMEZONE = pytz.timezone('Asia/Ho_Chi_Minh')
+LOCAL_TIMEZONE = alert_stats.LOCAL_TIMEZONE
+MAX_HISTORY_PAGE_SIZE = 100
+MAX_BATCH_AUDIO_KEYS = 100
+
+def _parse_query_datetime(value: str | None) -> datetime.datetime | None:
+    """Parse tham số thời gian ISO 8601 ('Z' hoặc offset); không có múi giờ thì hiểu là giờ local."""
+    if not value:
+        return None
+    dt = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = LOCAL_TIMEZONE.localize(dt)
+    return dt.astimezone(pytz.utc)
 
 def register_routes(app):
     """Đăng ký các route cho Flask app."""
+    # Thống kê cache của web tier cho /metrics
+    metrics.register_collector(response_cache.metric_lines)
+    metrics.register_collector(audio_urls.metric_lines)
+    metrics.register_collector(clip_cache.metric_lines)
 
     # --- Route đăng ký token (giữ nguyên) ---
     @app.route('/register_token', methods=['POST'])
@@ -40,44 +64,182 @@ def register_routes(app):
         """Endpoint kiểm tra sức khỏe đơn giản."""
         return jsonify({"status": "ok"}), 200
 
-    # --- Route lấy lịch sử cảnh báo (giữ nguyên) ---
+    # --- Route kiểm tra sẵn sàng (khác /health: /health chỉ cho biết process còn sống) ---
+    @app.route('/ready', methods=['GET'])
+    def readiness_check():
+        """
+        Trả về 200 khi model (hoặc process ingest), Firebase và S3 (nếu được cấu hình) đã sẵn sàng,
+        ngược lại 503 kèm chi tiết từng thành phần.
+        """
+        if config.INGEST_MODE == 'external':
+            ingest_status = ingest_ipc.request_status(timeout=1.0)
+            model = {'loaded': bool(ingest_status and ingest_status.get('model_loaded')),
+                     'source': 'ingest_process', 'reachable': ingest_status is not None}
+        else:
+            model = ml_handler.get_readiness()
+        components = {
+            "model": model,
+            "firebase": {"ready": firebase_client.is_initialized()},
+            "s3": {"configured": config.S3_CONFIGURED, "ready": s3_client.is_ready()},
+        }
+        ready = (model['loaded']
+                 and components['firebase']['ready']
+                 and (components['s3']['ready'] or not config.S3_CONFIGURED))
+        return jsonify({"status": "ready" if ready else "not_ready", "components": components}), (200 if ready else 503)
+
+    # --- Route Prometheus ---
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        """Metric theo định dạng text của Prometheus (pipeline audio + cache của web tier)."""
+        body = metrics.render()
+        if config.INGEST_MODE == 'external':
+            # Pipeline chạy ở process ingest: lấy metric của nó qua IPC
+            ingest_text = ingest_ipc.request_metrics(timeout=1.0)
+            if ingest_text is None:
+                logging.warning("/metrics: Không lấy được metric từ process ingest.")
+                ingest_text = "# ingest process unreachable\n"
+            body = ingest_text + body
+        return Response(body, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    # --- Route trạng thái pipeline ingest (UDP + inference) ---
+    @app.route('/ingest/status', methods=['GET'])
+    def ingest_status():
+        """Trạng thái trực tiếp của pipeline ingest: trong process hoặc hỏi process ingest qua IPC."""
+        if config.INGEST_MODE == 'external':
+            status = ingest_ipc.request_status()
+            if status is None:
+                return jsonify({"status": "error", "message": "Ingest service unreachable"}), 503
+            status['relay_connected'] = ingest_ipc.is_relay_connected()
+        else:
+            from . import udp_server # Chỉ import khi chạy embedded (kéo theo torch)
+            status = udp_server.get_status()
+        return jsonify({"status": "ok", "mode": config.INGEST_MODE, "ingest": status}), 200
+
+    # --- Route xem bộ đếm cache phản hồi ---
+    @app.route('/cache/stats', methods=['GET'])
+    def cache_stats():
+        """Trả về bộ đếm hit/miss của cache phản hồi và cache URL audio."""
+        return jsonify({
+            "status": "ok",
+            "response_cache": response_cache.get_stats(),
+            "audio_url_cache": audio_urls.get_stats(),
+            "clip_cache": clip_cache.get_stats()
+        }), 200
+
+    # --- Route SSE: mức âm thanh và kết quả nhận diện trực tiếp ---
+    @app.route('/stream/levels', methods=['GET'])
+    def stream_levels():
+        """
+        Server-Sent Events: đẩy RMS, dự đoán và độ tin cậy của từng chunk ('event: level')
+        và sự kiện phát hiện tiếng hét ('event: detection').
+        Tham số query 'device' (IP thiết bị) để chỉ nhận sự kiện của một thiết bị.
+        """
+        device = request.args.get('device', default=None, type=str)
+        try:
+            subscriber = event_bus.subscribe(device)
+        except event_bus.TooManySubscribersError:
+            logging.warning("/stream/levels: Đã đạt giới hạn số client SSE.")
+            return jsonify({"status": "error", "message": "Too many stream subscribers"}), 503
+
+        def generate():
+            try:
+                # Gợi ý thời gian kết nối lại cho EventSource phía client
+                yield "retry: 3000\n\n"
+                while True:
+                    event = subscriber.get(timeout=config.SSE_KEEPALIVE_S)
+                    if event is None:
+                        yield ": keepalive\n\n" # Giữ kết nối qua proxy
+                        continue
+                    yield f"event: {event.get('type', 'message')}\ndata: {json.dumps(event)}\n\n"
+            finally:
+                # Client ngắt kết nối (GeneratorExit) hoặc server dừng
+                event_bus.unsubscribe(subscriber)
+
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no' # Tắt buffering của nginx
+        return response
+
+    # --- Route lấy lịch sử cảnh báo ---
     @app.route('/alert_history', methods=['GET'])
+    @response_cache.cached
     def get_alert_history():
         """
-        Lấy danh sách lịch sử cảnh báo từ Firestore.
-        Hỗ trợ phân trang cơ bản bằng 'limit' và 'last_doc_id'.
+        Lấy danh sách lịch sử cảnh báo từ Firestore (mới nhất trước).
+        Tham số query:
+            limit (int): số phần tử mỗi trang (1..MAX_HISTORY_PAGE_SIZE, mặc định 20).
+            cursor (str): token 'next_cursor' của trang trước (keyset, không tốn thêm read).
+            last_doc_id (str): cách phân trang cũ, vẫn hỗ trợ cho app phiên bản cũ (tốn thêm 1 read).
+            client_ip (str): chỉ lấy cảnh báo của một thiết bị.
+            since, until (ISO 8601): khoảng thời gian; không có múi giờ thì hiểu là giờ local.
+            include_audio_urls (bool): thêm 'audio_url' (pre-signed) cho mỗi dòng có 's3_key',
+                tránh việc app phải gọi /get_audio_url cho từng dòng.
         """
         if not firebase_client._firestore_db:
             logging.error("Firestore client not available in /alert_history route.")
             return jsonify({"status": "error", "message": "Firestore not configured on server"}), 500
 
+        from google.cloud import firestore # Import khi cần để web tier khởi động nhanh
+
         try:
             limit = request.args.get('limit', default=20, type=int)
+            limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+            cursor_token = request.args.get('cursor', default=None, type=str)
             last_doc_id = request.args.get('last_doc_id', default=None, type=str)
+            client_ip_filter = request.args.get('client_ip', default=None, type=str)
+            include_audio_urls = request.args.get('include_audio_urls', default='false').lower() in ('1', 'true', 'yes')
 
-            collection_ref = firebase_client._firestore_db.collection('alert_history')
-            query = collection_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+            try:
+                since_dt = _parse_query_datetime(request.args.get('since'))
+                until_dt = _parse_query_datetime(request.args.get('until'))
+            except ValueError as e:
+                return jsonify({"status": "error", "message": f"Invalid since/until: {e}"}), 400
+
+            filters = {
+                'client_ip': client_ip_filter,
+                'since': since_dt.isoformat() if since_dt else None,
+                'until': until_dt.isoformat() if until_dt else None,
+            }
 
-            if last_doc_id:
+            collection_ref = firebase_client._firestore_db.collection('alert_history')
+            query = collection_ref
+            # Các bộ lọc này cần composite index (xem firestore.indexes.json)
+            if client_ip_filter:
+                query = query.where(filter=firestore.FieldFilter('client_ip', '==', client_ip_filter))
+            if since_dt:
+                query = query.where(filter=firestore.FieldFilter('timestamp', '>=', since_dt))
+            if until_dt:
+                query = query.where(filter=firestore.FieldFilter('timestamp', '<=', until_dt))
+            # Sắp xếp thêm theo document ID để thứ tự ổn định khi trùng timestamp
+            query = query.order_by('timestamp', direction=firestore.Query.DESCENDING) \
+                         .order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+
+            if cursor_token:
+                try:
+                    cursor_ts, cursor_id = pagination.decode_cursor(cursor_token, filters)
+                except pagination.InvalidCursorError as e:
+                    logging.warning(f"/alert_history: cursor không hợp lệ: {e}")
+                    return jsonify({"status": "error", "message": f"Invalid cursor: {e}"}), 400
+                # Dùng trực tiếp giá trị trong cursor, không cần get() document
+                query = query.start_after([cursor_ts, collection_ref.document(cursor_id)])
+            elif last_doc_id:
                 last_doc_snapshot = collection_ref.document(last_doc_id).get()
-                if last_doc_snapshot.exists:
-                    query = query.start_after(last_doc_snapshot)
-                else:
+                if not last_doc_snapshot.exists:
                     logging.warning(f"/alert_history: last_doc_id '{last_doc_id}' not found.")
-                    # Trả về trang đầu tiên thay vì lỗi 404
-                    # return jsonify({"status": "error", "message": "Invalid last document ID"}), 404
-                    logging.info(f"/alert_history: last_doc_id '{last_doc_id}' not found. Returning first page.")
-
+                    return jsonify({"status": "error", "message": "Invalid last document ID"}), 404
+                query = query.start_after(last_doc_snapshot)
 
             query = query.limit(limit)
             results = query.stream()
 
             history_list = []
             last_id_in_page = None
+            last_ts_in_page = None
             for doc in results:
                 doc_data = doc.to_dict()
                 # Chuyển đổi Timestamp của Firestore thành chuỗi ISO 8601 UTC
                 if 'timestamp' in doc_data and isinstance(doc_data['timestamp'], datetime.datetime):
+                    last_ts_in_page = doc_data['timestamp'] # Giữ giá trị gốc (nano giây) cho cursor
                     # Đảm bảo timestamp là timezone-aware (UTC) trước khi format
                     if doc_data['timestamp'].tzinfo is None:
                         doc_data['timestamp'] = doc_data['timestamp'].replace(tzinfo=pytz.utc)
@@ -89,10 +251,19 @@ def register_routes(app):
                 history_list.append(doc_data)
                 last_id_in_page = doc.id # Lưu ID của document cuối cùng trong trang này
 
+            if include_audio_urls:
+                _attach_audio_urls(history_list)
+
+            # Chỉ trả cursor khi trang đầy (có thể còn trang sau)
+            next_cursor = None
+            if len(history_list) == limit and last_id_in_page and last_ts_in_page is not None:
+                next_cursor = pagination.encode_cursor(last_ts_in_page, last_id_in_page, filters)
+
             response_data = {
                 "status": "success",
                 "history": history_list,
-                # Trả về ID cuối cùng để client có thể dùng cho lần gọi tiếp theo
+                "next_cursor": next_cursor,
+                # Giữ lại cho app phiên bản cũ
                 "last_doc_id": last_id_in_page
             }
             return jsonify(response_data), 200
@@ -101,63 +272,245 @@ def register_routes(app):
             logging.error(f"Lỗi khi xử lý route /alert_history: {e}", exc_info=True)
             return jsonify({"status": "error", "message": "Internal server error fetching history"}), 500
 
-    # --- Route lấy URL S3 tạm thời (giữ nguyên) ---
+    def _attach_audio_urls(history_list: list):
+        """
+        Gắn 'audio_url' vào các dòng lịch sử có 's3_key': URL /audio/... nếu clip có trong cache trên đĩa
+        (như /get_audio_url), ngược lại pre-signed URL. Không head_object (chỉ ký URL cục bộ) và không
+        đánh dấu key là đã tồn tại: dòng lịch sử có thể trỏ tới clip đã bị xóa, nên /get_audio_url vẫn
+        head_object như bình thường. URL phải còn hạn lâu hơn thời gian phản hồi này có thể nằm trong response cache
+        (URL /audio/... không hết hạn: clip bị loại khỏi cache thì chuyển hướng sang S3).
+        """
+        s3_keys = [row['s3_key'] for row in history_list if row.get('s3_key')]
+        if not s3_keys:
+            return
+        urls = {key: url for key in dict.fromkeys(s3_keys) if (url := _local_audio_url(key))}
+        remaining = [key for key in s3_keys if key not in urls]
+        if remaining and not audio_urls.is_configured():
+            logging.warning("/alert_history: include_audio_urls được yêu cầu nhưng S3 chưa cấu hình.")
+            remaining = []
+        if remaining:
+            min_remaining_s = config.AWS_S3_URL_REUSE_MARGIN_S + config.RESPONSE_CACHE_TTL_S
+            try:
+                presigned, _ = audio_urls.get_presigned_urls(remaining, check_exists=False,
+                                                             min_remaining_s=min_remaining_s)
+                urls.update(presigned)
+            except Exception as e:
+                # Không làm hỏng cả trang lịch sử chỉ vì lỗi tạo URL
+                logging.error(f"/alert_history: Lỗi khi tạo audio URL: {e}", exc_info=True)
+        for row in history_list:
+            url = urls.get(row.get('s3_key'))
+            if url:
+                row['audio_url'] = url
+
+    # --- Route lấy audio pre-roll (ring trên đĩa, xem preroll.py) ---
+    @app.route('/preroll/<device>', methods=['GET'])
+    def get_preroll_audio(device):
+        """
+        Trả về WAV của một khoảng audio đã qua từ ring pre-roll của thiết bị.
+        Tham số: 'start'/'end' (ISO 8601) hoặc 'seconds' (N giây gần nhất, mặc định PREROLL_CLIP_S).
+        """
+        from . import clip_uploads, preroll
+        try:
+            end_dt = _parse_query_datetime(request.args.get('end'))
+            start_dt = _parse_query_datetime(request.args.get('start'))
+            seconds = request.args.get('seconds', default=config.PREROLL_CLIP_S, type=float)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid 'start'/'end' (ISO 8601 expected)"}), 400
+        end_time = end_dt.timestamp() if end_dt else datetime.datetime.now(pytz.utc).timestamp()
+        start_time = start_dt.timestamp() if start_dt else end_time - seconds
+        if start_time >= end_time or end_time - start_time > config.PREROLL_SECONDS:
+            return jsonify({"status": "error", "message": f"Window must be between 0 and {config.PREROLL_SECONDS}s"}), 400
+
+        try:
+            with preroll.read_window(device, start_time, end_time) as window:
+                if window is None:
+                    return jsonify({"status": "error", "message": f"No pre-roll audio for device {device}"}), 404
+                if len(window) == 0 or not window.intact():
+                    return jsonify({"status": "error", "message": "Requested window is no longer in the pre-roll buffer"}), 404
+                # encode_clip kiểm tra window.consistent() sau khi đọc: None nếu ring bị ghi đè trong lúc đọc
+                audio_bytes = clip_uploads.encode_clip(window, window.sample_rate, 'wav')
+                audio_start = window.start_time
+        except ValueError as e:
+            logging.error(f"/preroll: {e}")
+            return jsonify({"status": "error", "message": "Pre-roll file is corrupted"}), 500
+        if audio_bytes is None:
+            return jsonify({"status": "error", "message": "Error encoding pre-roll audio"}), 500
+        response = Response(audio_bytes, mimetype='audio/wav')
+        # Thời điểm thực của mẫu đầu tiên (có thể muộn hơn 'start' nếu dữ liệu cũ đã bị ghi đè)
+        response.headers['X-Audio-Start'] = f"{audio_start:.3f}"
+        return response
+
+    def _local_audio_url(s3_key: str) -> str | None:
+        """URL phục vụ clip từ cache trên đĩa, hoặc None nếu clip không có trong cache."""
+        if not clip_cache.lookup(s3_key):
+            return None
+        if config.CLIP_CACHE_PUBLIC_BASE_URL:
+            return config.CLIP_CACHE_PUBLIC_BASE_URL + url_for('get_cached_audio', s3_key=s3_key)
+        return url_for('get_cached_audio', s3_key=s3_key, _external=True)
+
+    # --- Route phục vụ clip từ cache trên đĩa (hỗ trợ Range) ---
+    @app.route('/audio/<path:s3_key>', methods=['GET'])
+    def get_cached_audio(s3_key):
+        """
+        Phục vụ clip trong cache cục bộ; send_file(conditional=True) trả 206 cho request Range và
+        dùng wsgi.file_wrapper (sendfile) nếu WSGI server hỗ trợ. Clip đã bị loại khỏi cache thì
+        chuyển hướng sang pre-signed URL của S3.
+        """
+        path = clip_cache.lookup(s3_key)
+        if path:
+            try:
+                return send_file(path, mimetype=clip_cache.content_type(s3_key), conditional=True,
+                                 max_age=config.AWS_S3_URL_EXPIRATION_S)
+            except FileNotFoundError:
+                pass # Vừa bị loại khỏi cache giữa lookup và mở file
+        if not audio_urls.is_configured():
+            return jsonify({"status": "error", "message": "Audio file not found"}), 404
+        try:
+            return redirect(audio_urls.get_presigned_url(s3_key), code=302)
+        except audio_urls.AudioNotFoundError:
+            return jsonify({"status": "error", "message": "Audio file not found"}), 404
+        except audio_urls.AudioStorageError as e:
+            return _s3_client_error_response(e, s3_key)
+
+    # --- Route lấy URL S3 tạm thời ---
     @app.route('/get_audio_url', methods=['GET'])
     def get_s3_audio_url():
         """
         Tạo và trả về một pre-signed URL cho một S3 key cụ thể.
-        Yêu cầu tham số query 's3_key'.
+        Yêu cầu tham số query 's3_key'. URL được cache và dùng lại cho tới gần lúc hết hạn.
         """
         s3_key = request.args.get('s3_key', default=None, type=str)
 
         if not s3_key:
             return jsonify({"status": "error", "message": "Missing 's3_key' query parameter"}), 400
 
-        if not _s3_client or not udp_config.S3_CONFIGURED:
+        local_url = _local_audio_url(s3_key)
+        if local_url:
+            return jsonify({"status": "success", "url": local_url, "source": "local"}), 200
+
+        if not audio_urls.is_configured():
              logging.error("S3 client not available or not configured in /get_audio_url route.")
              return jsonify({"status": "error", "message": "S3 storage not configured on server"}), 501 # 501 Not Implemented
 
         try:
-            # Kiểm tra xem key có tồn tại không trước khi tạo URL (tùy chọn nhưng tốt hơn)
-            try:
-                 _s3_client.head_object(Bucket=udp_config.AWS_S3_BUCKET_NAME, Key=s3_key)
-            except ClientError as e:
-                 if e.response['Error']['Code'] == '404':
-                      logging.warning(f"S3 key not found when generating URL: {s3_key}")
-                      return jsonify({"status": "error", "message": "Audio file not found"}), 404
-                 else:
-                      # Lỗi khác khi kiểm tra key
-                      raise e # Ném lại lỗi để block catch bên ngoài xử lý
-
-            # Nếu key tồn tại, tạo URL
-            presigned_url = _s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': udp_config.AWS_S3_BUCKET_NAME, 'Key': s3_key},
-                ExpiresIn=udp_config.AWS_S3_URL_EXPIRATION_S
-            )
-
-            if presigned_url:
-                return jsonify({"status": "success", "url": presigned_url}), 200
-            else:
-                # Trường hợp này ít xảy ra nếu head_object thành công
-                logging.error(f"Failed to generate presigned URL for key: {s3_key} even though key exists.")
-                return jsonify({"status": "error", "message": "Failed to generate audio URL"}), 500
-
-        except ClientError as e: # Bắt lỗi ClientError cụ thể từ boto3
-            error_code = e.response.get('Error', {}).get('Code')
-            # Lỗi 404 đã được xử lý ở trên bằng head_object
-            if error_code == 'NoSuchBucket':
-                 logging.error(f"S3 bucket '{udp_config.AWS_S3_BUCKET_NAME}' not found.")
-                 return jsonify({"status": "error", "message": "Server storage configuration error"}), 500
-            else:
-                logging.error(f"S3 ClientError generating URL for key {s3_key}: {e}", exc_info=True)
-                return jsonify({"status": "error", "message": "Error accessing storage"}), 500
+            presigned_url = audio_urls.get_presigned_url(s3_key)
+            return jsonify({"status": "success", "url": presigned_url}), 200
+
+        except audio_urls.AudioNotFoundError:
+            logging.warning(f"S3 key not found when generating URL: {s3_key}")
+            return jsonify({"status": "error", "message": "Audio file not found"}), 404
+        except audio_urls.AudioStorageError as e: # Lỗi ClientError từ boto3 (đã được bọc)
+            return _s3_client_error_response(e, s3_key)
         except Exception as e:
             logging.error(f"Lỗi không xác định khi tạo URL S3 cho key {s3_key}: {e}", exc_info=True)
             return jsonify({"status": "error", "message": "Internal server error generating URL"}), 500
 
+    # --- Route lấy nhiều URL S3 trong một lần gọi ---
+    @app.route('/get_audio_urls', methods=['POST'])
+    def get_s3_audio_urls():
+        """
+        Tạo pre-signed URL cho nhiều S3 key.
+        Body JSON: {"s3_keys": ["audio/...", ...]} (tối đa MAX_BATCH_AUDIO_KEYS key).
+        Trả về {"urls": {s3_key: url}, "missing": [key không tồn tại]}.
+        """
+        data = request.get_json(silent=True)
+        s3_keys = data.get('s3_keys') if isinstance(data, dict) else None
+        if not isinstance(s3_keys, list) or not s3_keys or not all(isinstance(k, str) and k for k in s3_keys):
+            return jsonify({"status": "error", "message": "Body must be JSON with a non-empty string list 's3_keys'"}), 400
+        if len(s3_keys) > MAX_BATCH_AUDIO_KEYS:
+            return jsonify({"status": "error", "message": f"At most {MAX_BATCH_AUDIO_KEYS} keys per request"}), 400
+
+        # Clip có trong cache trên đĩa không cần S3
+        local_urls = {key: url for key in dict.fromkeys(s3_keys) if (url := _local_audio_url(key))}
+        remaining = [key for key in s3_keys if key not in local_urls]
+        if remaining and not audio_urls.is_configured():
+             logging.error("S3 client not available or not configured in /get_audio_urls route.")
+             return jsonify({"status": "error", "message": "S3 storage not configured on server"}), 501
+
+        try:
+            urls, missing = audio_urls.get_presigned_urls(remaining) if remaining else ({}, [])
+            urls.update(local_urls)
+            if missing:
+                logging.warning(f"/get_audio_urls: {len(missing)} S3 key không tồn tại.")
+            return jsonify({
+                "status": "success",
+                "urls": urls,
+                "missing": missing,
+                "expires_in": config.AWS_S3_URL_EXPIRATION_S
+            }), 200
+        except audio_urls.AudioStorageError as e:
+            return _s3_client_error_response(e, f"{len(s3_keys)} keys")
+        except Exception as e:
+            logging.error(f"Lỗi không xác định khi tạo nhiều URL S3: {e}", exc_info=True)
+            return jsonify({"status": "error", "message": "Internal server error generating URLs"}), 500
+
+    def _s3_client_error_response(e: audio_urls.AudioStorageError, context: str):
+        """Chuyển lỗi S3 thành phản hồi JSON (dùng chung cho các route S3)."""
+        if e.code == 'NoSuchBucket':
+             logging.error(f"S3 bucket '{config.AWS_S3_BUCKET_NAME}' not found.")
+             return jsonify({"status": "error", "message": "Server storage configuration error"}), 500
+        logging.error(f"S3 ClientError generating URL for {context}: {e}", exc_info=True)
+        return jsonify({"status": "error", "message": "Error accessing storage"}), 500
+
+    # --- Route phân tích kết quả từng chunk (kho cột trên đĩa, xem chunk_store.py) ---
+    MAX_ANALYTICS_BUCKETS = 10000
+
+    def _analytics_window():
+        """(start, end) epoch giây từ 'start'/'end' ISO 8601; mặc định 24 giờ gần nhất."""
+        end_dt = _parse_query_datetime(request.args.get('end'))
+        start_dt = _parse_query_datetime(request.args.get('start'))
+        end_time = end_dt.timestamp() if end_dt else datetime.datetime.now(pytz.utc).timestamp()
+        start_time = start_dt.timestamp() if start_dt else end_time - 86400
+        if start_time >= end_time:
+            raise ValueError("'start' must be before 'end'")
+        return start_time, end_time
+
+    @app.route('/analytics/timeline', methods=['GET'])
+    def analytics_timeline():
+        """Dòng thời gian của một thiết bị: số chunk, RMS, số chunk theo nhãn mỗi 'bucket_s' giây."""
+        from . import chunk_store
+        device = request.args.get('device', default=None, type=str)
+        bucket_s = request.args.get('bucket_s', default=60.0, type=float)
+        if not device:
+            return jsonify({"status": "error", "message": "Missing 'device' query parameter"}), 400
+        try:
+            start_time, end_time = _analytics_window()
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if bucket_s <= 0 or (end_time - start_time) / bucket_s > MAX_ANALYTICS_BUCKETS:
+            return jsonify({"status": "error", "message": f"'bucket_s' must give at most {MAX_ANALYTICS_BUCKETS} buckets"}), 400
+        result = chunk_store.timeline(device, start_time, end_time, bucket_s, config.MODEL_CLASS_MAP[1])
+        return jsonify({"status": "success", "device": device, "bucket_s": bucket_s, **result}), 200
+
+    @app.route('/analytics/histogram', methods=['GET'])
+    def analytics_histogram():
+        """Histogram 'rms' hoặc 'confidence' (lọc theo 'device', 'label' nếu có) để chỉnh ngưỡng."""
+        from . import chunk_store
+        field = request.args.get('field', default='confidence', type=str)
+        bins = request.args.get('bins', default=20, type=int)
+        if field not in ('rms', 'confidence') or not 1 <= bins <= 1000:
+            return jsonify({"status": "error", "message": "'field' must be rms|confidence and 'bins' in 1..1000"}), 400
+        try:
+            start_time, end_time = _analytics_window()
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        result = chunk_store.histogram(field, start_time, end_time, bins,
+                                       device=request.args.get('device'), label=request.args.get('label'))
+        return jsonify({"status": "success", **result}), 200
+
+    @app.route('/analytics/summary', methods=['GET'])
+    def analytics_summary():
+        """Số chunk theo thiết bị và nhãn trong khoảng thời gian (lập kế hoạch tải)."""
+        from . import chunk_store
+        try:
+            start_time, end_time = _analytics_window()
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        return jsonify({"status": "success", **chunk_store.summary(start_time, end_time)}), 200
+
     # --- THÊM ROUTE MỚI CHO THỐNG KÊ TUẦN ---
     @app.route('/statistics/weekly', methods=['GET'])
+    @response_cache.cached
     def get_weekly_statistics():
         """
         Lấy thống kê số lượng cảnh báo theo tuần.
@@ -196,54 +549,20 @@ def register_routes(app):
             start_dt_local = LOCAL_TIMEZONE.localize(datetime.datetime.combine(week_start_date, datetime.time.min))
             end_dt_local = LOCAL_TIMEZONE.localize(datetime.datetime.combine(week_end_date, datetime.time.max))
 
-            # Chuyển sang UTC để query Firestore
+            # Chuyển sang UTC (chỉ dùng để log, dữ liệu được đọc từ rollup theo ngày local)
             start_dt_utc = start_dt_local.astimezone(pytz.utc)
             end_dt_utc = end_dt_local.astimezone(pytz.utc)
 
-            logging.info(f"Querying Firestore for week: {week_start_date.isoformat()} to {week_end_date.isoformat()} "
+            logging.info(f"Reading alert rollups for week: {week_start_date.isoformat()} to {week_end_date.isoformat()} "
                          f"(UTC range: {start_dt_utc.isoformat()} to {end_dt_utc.isoformat()})")
 
-            # --- Truy vấn Firestore ---
-            collection_ref = firebase_client._firestore_db.collection('alert_history')
-            query = collection_ref.where(
-                filter=firestore.FieldFilter('timestamp', '>=', start_dt_utc)
-            ).where(
-                filter=firestore.FieldFilter('timestamp', '<=', end_dt_utc)
-            )
-            # Không cần order_by ở đây vì chúng ta sẽ duyệt qua tất cả kết quả trong tuần
-
-            results = query.stream()
-
-            # --- Tổng hợp dữ liệu ---
-            total_alerts = 0
-            alerts_per_day = {
-                "monday": 0, "tuesday": 0, "wednesday": 0, "thursday": 0,
-                "friday": 0, "saturday": 0, "sunday": 0
-            }
-            # Mapping từ weekday() (0-6) sang key của dict
-            weekday_map = {0: "monday", 1: "tuesday", 2: "wednesday", 3: "thursday",
-                           4: "friday", 5: "saturday", 6: "sunday"}
-
-            for doc in results:
-                total_alerts += 1
-                doc_data = doc.to_dict()
-                timestamp = doc_data.get('timestamp')
-
-                if isinstance(timestamp, datetime.datetime):
-                    # Chuyển timestamp (được trả về từ Firestore, thường là UTC) sang múi giờ LOCAL
-                    # để xác định đúng ngày trong tuần theo giờ địa phương
-                    timestamp_local = timestamp.astimezone(LOCAL_TIMEZONE)
-                    day_index = timestamp_local.weekday() # 0 = Thứ Hai, ..., 6 = Chủ Nhật
-                    day_key = weekday_map.get(day_index)
-                    if day_key:
-                        alerts_per_day[day_key] += 1
-                    else:
-                         logging.warning(f"Invalid weekday index {day_index} for timestamp {timestamp}")
-                else:
-                     logging.warning(f"Document {doc.id} has missing or invalid timestamp: {timestamp}")
-
+            # --- Đọc tối đa 7 document rollup (xem alert_stats.py) ---
+            week_counts = alert_stats.get_week_counts(firebase_client._firestore_db, week_start_date)
+            total_alerts = week_counts['total_alerts']
+            alerts_per_day = week_counts['alerts_per_day']
 
-            logging.info(f"Query completed. Total alerts: {total_alerts}. Daily counts: {alerts_per_day}")
+            logging.info(f"Query completed. Total alerts: {total_alerts}. Daily counts: {alerts_per_day}"
+                         + (f" (fallback count cho: {week_counts['fallback_days']})" if week_counts['fallback_days'] else ""))
 
             # --- Định dạng và trả về kết quả ---
             response_data = {
@@ -251,7 +570,8 @@ def register_routes(app):
                 "week_start_date": week_start_date.isoformat(),
                 "week_end_date": week_end_date.isoformat(),
                 "total_alerts": total_alerts,
-                "alerts_per_day": alerts_per_day
+                "alerts_per_day": alerts_per_day,
+                "alerts_per_device": week_counts['alerts_per_device']
             }
             return jsonify(response_data), 200
 
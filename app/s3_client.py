@@ -0,0 +1,67 @@
+# app/s3_client.py
+# Khởi tạo boto3 S3 client khi cần lần đầu (boto3/botocore import khá chậm),
+# dùng chung cho upload (udp_server) và tạo pre-signed URL (audio_urls, routes).
+import logging
+import threading
+
+from . import config
+
+_s3_client = None
+_init_attempted = False
+_init_lock = threading.Lock()
+
+
+def get_client():
+    """Trả về S3 client (tạo ở lần gọi đầu tiên), hoặc None nếu S3 chưa cấu hình / lỗi khởi tạo."""
+    global _s3_client, _init_attempted
+    if _init_attempted:
+        return _s3_client
+    with _init_lock:
+        if _init_attempted:
+            return _s3_client
+        if not config.S3_CONFIGURED:
+            logging.warning("S3 Client not initialized because S3 configuration is incomplete in config.")
+            _init_attempted = True
+            return None
+        if config.LOCAL_BACKENDS:
+            from . import local_backends
+            _s3_client = local_backends.get_s3_client()
+            _init_attempted = True
+            return _s3_client
+        try:
+            import boto3 # Để tương tác với AWS S3
+            from botocore.config import Config
+            from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+        except ImportError as e:
+            logging.error(f"S3 Initialization Error: boto3 chưa được cài đặt. {e}")
+            _init_attempted = True
+            return None
+        try:
+            _s3_client = boto3.client(
+                's3',
+                aws_access_key_id=config.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
+                region_name=config.AWS_S3_REGION,
+                # Pool kết nối đủ cho các luồng upload + ký URL song song, retry có backoff
+                config=Config(
+                    max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': config.S3_MAX_ATTEMPTS, 'mode': config.S3_RETRY_MODE},
+                    connect_timeout=config.S3_CONNECT_TIMEOUT_S,
+                    read_timeout=config.S3_READ_TIMEOUT_S,
+                    tcp_keepalive=True,
+                )
+            )
+            logging.info("S3 Client initialized successfully.")
+        except (NoCredentialsError, PartialCredentialsError) as e:
+            logging.error(f"S3 Initialization Error: AWS credentials not found or incomplete. {e}")
+            _s3_client = None
+        except Exception as e:
+            logging.error(f"S3 Initialization Error: An unexpected error occurred. {e}", exc_info=True)
+            _s3_client = None
+        _init_attempted = True
+        return _s3_client
+
+
+def is_ready() -> bool:
+    """S3 client đã được khởi tạo thành công (không tự khởi tạo)."""
+    return _s3_client is not None
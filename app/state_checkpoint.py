@@ -0,0 +1,112 @@
+# app/state_checkpoint.py
+# Checkpoint định kỳ trạng thái phát hiện theo thiết bị của udp_server (lịch sử dự đoán, thời điểm cảnh báo
+# cuối) để khởi động lại (deploy/crash) không làm mất cooldown - tránh cảnh báo trùng - và cửa sổ đánh giá
+# không bắt đầu lạnh. Audio không nằm trong checkpoint (vài KB thay vì ~480 KB mỗi thiết bị): audio qua được
+# lần khởi động lại nằm trong ring pre-roll trên đĩa (PREROLL_ENABLED).
+# Định dạng: pickle (protocol cao nhất), ghi file tạm rồi đổi tên.
+# File chỉ do chính process ingest ghi và đọc: không trỏ STATE_CHECKPOINT_PATH tới thư mục người khác ghi được.
+import logging
+import os
+import pickle
+import threading
+import time
+
+from . import config
+from . import metrics
+
+FORMAT_VERSION = 2
+_READABLE_VERSIONS = (1, 2) # Phiên bản 1 có thêm audio từng thiết bị, được bỏ qua khi khôi phục
+
+_stop_checkpoint = threading.Event()
+_checkpoint_thread = None
+_export_state = None # Hàm không tham số trả về dict trạng thái (udp_server.export_state)
+_save_lock = threading.Lock()
+_stats = {'saves': 0, 'errors': 0, 'bytes': 0, 'last_saved_at': None}
+
+
+def save(state: dict) -> bool:
+    """Ghi một checkpoint (nguyên tử: người đọc chỉ thấy file cũ hoặc file mới hoàn chỉnh)."""
+    try:
+        with metrics.stage_timer('checkpoint_write'):
+            payload = pickle.dumps({'version': FORMAT_VERSION, 'saved_at': time.time(), 'state': state},
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            directory = os.path.dirname(config.STATE_CHECKPOINT_PATH)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with _save_lock:
+                tmp_path = config.STATE_CHECKPOINT_PATH + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(payload)
+                os.replace(tmp_path, config.STATE_CHECKPOINT_PATH)
+    except Exception as e:
+        _stats['errors'] += 1
+        logging.error(f"State Checkpoint: Không ghi được checkpoint: {e}", exc_info=True)
+        return False
+    _stats['saves'] += 1
+    _stats['bytes'] = len(payload)
+    _stats['last_saved_at'] = time.time()
+    return True
+
+
+def load() -> dict | None:
+    """Trạng thái trong checkpoint, hoặc None nếu không có / hỏng / cũ hơn STATE_CHECKPOINT_MAX_AGE_S."""
+    path = config.STATE_CHECKPOINT_PATH
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+    except Exception as e:
+        logging.error(f"State Checkpoint: File {path} bị hỏng, bỏ qua: {e}")
+        return None
+    if not isinstance(checkpoint, dict) or checkpoint.get('version') not in _READABLE_VERSIONS:
+        logging.warning(f"State Checkpoint: {path} có định dạng khác (phiên bản {checkpoint.get('version') if isinstance(checkpoint, dict) else '?'}), bỏ qua.")
+        return None
+    age_s = time.time() - checkpoint['saved_at']
+    if config.STATE_CHECKPOINT_MAX_AGE_S and age_s > config.STATE_CHECKPOINT_MAX_AGE_S:
+        logging.info(f"State Checkpoint: Checkpoint đã cũ {age_s:.0f}s (> {config.STATE_CHECKPOINT_MAX_AGE_S}s), bỏ qua.")
+        return None
+    logging.info(f"State Checkpoint: Đọc checkpoint ghi cách đây {age_s:.1f}s từ {path}.")
+    return checkpoint['state']
+
+
+def _checkpoint_loop():
+    while not _stop_checkpoint.wait(config.STATE_CHECKPOINT_INTERVAL_S):
+        try:
+            save(_export_state())
+        except Exception as e:
+            _stats['errors'] += 1
+            logging.error(f"State Checkpoint: Lỗi khi lấy trạng thái để checkpoint: {e}", exc_info=True)
+
+
+def start(export_state):
+    """Bắt đầu ghi checkpoint mỗi STATE_CHECKPOINT_INTERVAL_S giây (no-op nếu đã chạy)."""
+    global _checkpoint_thread, _export_state
+    if _checkpoint_thread is not None and _checkpoint_thread.is_alive():
+        return
+    _export_state = export_state
+    _stop_checkpoint.clear()
+    _checkpoint_thread = threading.Thread(target=_checkpoint_loop, name="StateCheckpoint", daemon=True)
+    _checkpoint_thread.start()
+    logging.info(f"State Checkpoint: Ghi {config.STATE_CHECKPOINT_PATH} mỗi {config.STATE_CHECKPOINT_INTERVAL_S}s.")
+
+
+def stop(final_save: bool = True):
+    """Dừng luồng checkpoint và (mặc định) ghi một checkpoint cuối cùng."""
+    global _checkpoint_thread
+    if _checkpoint_thread is None:
+        return
+    _stop_checkpoint.set()
+    _checkpoint_thread.join(timeout=5.0)
+    _checkpoint_thread = None
+    if final_save and _export_state is not None:
+        save(_export_state())
+
+
+def metric_lines() -> list[str]:
+    """Collector cho /metrics."""
+    lines = []
+    lines += metrics.gauge_lines('scream_checkpoint_saves_total', 'Số checkpoint trạng thái đã ghi.', _stats['saves'], 'counter')
+    lines += metrics.gauge_lines('scream_checkpoint_errors_total', 'Số lần ghi checkpoint lỗi.', _stats['errors'], 'counter')
+    lines += metrics.gauge_lines('scream_checkpoint_bytes', 'Kích thước checkpoint gần nhất.', _stats['bytes'])
+    return lines
@@ -0,0 +1,130 @@
+# app/torch_runtime.py
+# Số luồng torch và CPU affinity cho inference, để pool OpenMP/MKL của torch, luồng UDP và luồng Flask
+# không tranh nhau cùng các core (oversubscription):
+#   - CPU khả dụng = CPU set của process (sched_getaffinity), bỏ TORCH_RESERVED_CPUS core đầu cho luồng
+#     UDP/Flask, rồi chia đều cho INFERENCE_PROCESS_SLOTS process inference trên cùng máy (nhiều node
+#     ingest, ...); process này dùng phần thứ INFERENCE_PROCESS_INDEX.
+#   - intra-op = số CPU của phần đó (TORCH_INTRA_OP_THREADS ghi đè); inter-op = TORCH_INTER_OP_THREADS.
+#   - INFERENCE_CPU_AFFINITY: "" = không ghim, "auto" = ghim vào phần CPU ở trên, hoặc danh sách "0-3,8".
+#     Chỉ các luồng chạy inference được ghim; pool OpenMP mà luồng đó tạo ra thừa hưởng cùng CPU set.
+# Chọn bộ tham số cho máy bằng: python -m tools.thread_calibrate
+import logging
+import os
+
+from . import config
+
+_configured = False
+_process_cpus = None # CPU set của process lúc khởi động (trước khi có luồng nào bị ghim)
+
+
+def parse_cpu_list(spec: str) -> list[int]:
+    """Danh sách CPU dạng "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]."""
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def available_cpus() -> list[int]:
+    global _process_cpus
+    if _process_cpus is None:
+        if hasattr(os, 'sched_getaffinity'):
+            _process_cpus = sorted(os.sched_getaffinity(0))
+        else:
+            _process_cpus = list(range(os.cpu_count() or 1))
+    return list(_process_cpus)
+
+
+def _slot_cpus() -> list[int]:
+    """Phần CPU dành cho process inference này (sau khi trừ core dự trữ)."""
+    cpus = available_cpus()
+    if len(cpus) > config.TORCH_RESERVED_CPUS:
+        cpus = cpus[config.TORCH_RESERVED_CPUS:]
+    slots = max(1, config.INFERENCE_PROCESS_SLOTS)
+    size = max(1, len(cpus) // slots)
+    start = (config.INFERENCE_PROCESS_INDEX % slots) * size
+    return cpus[start:start + size] or cpus[-size:]
+
+
+def inference_cpus() -> list[int] | None:
+    """CPU set để ghim các luồng inference, None nếu không ghim."""
+    spec = config.INFERENCE_CPU_AFFINITY
+    if not spec:
+        return None
+    if spec == 'auto':
+        return _slot_cpus()
+    cpus = [cpu for cpu in parse_cpu_list(spec) if cpu in set(available_cpus())]
+    if not cpus:
+        logging.warning(f"Torch Runtime: INFERENCE_CPU_AFFINITY='{spec}' không có CPU khả dụng nào, bỏ qua.")
+        return None
+    return cpus
+
+
+def get_layout() -> dict:
+    """Bộ tham số luồng sẽ dùng: {'intra_op', 'inter_op', 'cpus'}."""
+    cpus = inference_cpus()
+    intra_op = config.TORCH_INTRA_OP_THREADS or len(cpus if cpus is not None else _slot_cpus())
+    return {'intra_op': max(1, intra_op), 'inter_op': max(1, config.TORCH_INTER_OP_THREADS), 'cpus': cpus}
+
+
+def prepare_env():
+    """
+    Đặt OMP_NUM_THREADS/MKL_NUM_THREADS theo intra-op (nếu chưa đặt) - phải chạy trước khi import torch/numpy
+    để pool OpenMP/MKL không mặc định lấy toàn bộ core của máy.
+    """
+    if not config.TORCH_THREADS_MANAGED:
+        return
+    threads = str(get_layout()['intra_op'])
+    os.environ.setdefault('OMP_NUM_THREADS', threads)
+    os.environ.setdefault('MKL_NUM_THREADS', threads)
+
+
+def configure(torch):
+    """Áp dụng số luồng intra/inter-op cho torch (gọi ngay sau khi import torch, một lần)."""
+    global _configured
+    if _configured or not config.TORCH_THREADS_MANAGED:
+        return
+    layout = get_layout()
+    torch.set_num_threads(layout['intra_op'])
+    try:
+        torch.set_num_interop_threads(layout['inter_op'])
+    except RuntimeError as e:
+        # Chỉ đặt được trước khi có công việc inter-op đầu tiên
+        logging.warning(f"Torch Runtime: Không đặt được số luồng inter-op: {e}")
+    _configured = True
+    logging.info(f"Torch Runtime: intra-op={layout['intra_op']}, inter-op={layout['inter_op']}, "
+                 f"CPU={layout['cpus'] if layout['cpus'] is not None else 'không ghim'}.")
+
+
+def pin_current_thread() -> set | None:
+    """
+    Ghim luồng hiện tại (và pool OpenMP nó sẽ tạo) vào CPU set inference.
+    Trả về CPU set cũ của luồng (để restore_thread_affinity), None nếu không ghim.
+    """
+    cpus = inference_cpus()
+    if cpus is None or not hasattr(os, 'sched_setaffinity'):
+        return None
+    try:
+        previous = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, cpus) # pid 0 trên Linux = luồng đang gọi
+    except OSError as e:
+        logging.warning(f"Torch Runtime: Không ghim được luồng vào CPU {cpus}: {e}")
+        return None
+    return previous
+
+
+def restore_thread_affinity(previous: set | None):
+    """Trả luồng hiện tại về CPU set cũ (luồng tạo sau đó từ luồng này không bị ghim theo)."""
+    if previous is None:
+        return
+    try:
+        os.sched_setaffinity(0, previous)
+    except OSError as e:
+        logging.warning(f"Torch Runtime: Không khôi phục được CPU set của luồng: {e}")
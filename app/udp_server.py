@@ -4,18 +4,39 @@ import logging
 import torch
 import threading
 import time
-import io # Để xử lý byte stream trong bộ nhớ
 from collections import defaultdict, deque
 import numpy as np
-import soundfile as sf # Để lưu tensor thành file WAV
-import boto3 # Để tương tác với AWS S3
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError, ClientError
 
 from . import config
 from . import ml_handler # Import module xử lý ML
 from . import firebase_client # Import module Firebase để gửi thông báo VÀ ghi DB VÀ LẤY SỐ ĐT
+from . import event_bus # Pub/sub trong process cho SSE /stream/levels
+from . import s3_client
+from . import clip_uploads # Mã hóa WAV/FLAC + upload S3 qua thread pool
+from . import alert_dispatch # Gửi cảnh báo qua thread pool có giới hạn
+from . import preroll # Ring audio trên đĩa cho clip cảnh báo dài (PREROLL_ENABLED)
+from . import chunk_store # Lưu kết quả từng chunk cho phân tích (CHUNK_STORE_ENABLED)
+from . import ingest_cluster # Chia thiết bị giữa nhiều node ingest (CLUSTER_ENABLED)
+from . import state_checkpoint # Lưu/khôi phục trạng thái từng thiết bị qua các lần khởi động lại
+from . import torch_runtime # Ghim luồng inference vào CPU set riêng
+from . import inference_scheduler # Lane ưu tiên + gom batch inference (INFERENCE_BATCHING_ENABLED)
+from . import metrics # Histogram thời gian từng giai đoạn + counter cho /metrics
+from . import log_setup # Lấy mẫu / giới hạn tốc độ log từng chunk
 
 _stop_udp = threading.Event()
+metrics.register_collector(event_bus.metric_lines)
+metrics.register_collector(log_setup.metric_lines)
+metrics.register_collector(clip_uploads.metric_lines)
+metrics.register_collector(alert_dispatch.metric_lines)
+metrics.register_collector(ingest_cluster.metric_lines)
+metrics.register_collector(state_checkpoint.metric_lines)
+metrics.register_collector(inference_scheduler.metric_lines)
+# Log từng chunk đi qua logger riêng để có thể chỉnh level độc lập (logging.getLogger('app.udp_server.chunks'))
+_chunk_logger = logging.getLogger('app.udp_server.chunks')
+_chunk_log_sampler = log_setup.DeviceLogSampler(config.LOG_CHUNK_MAX_PER_S, config.LOG_CHUNK_BURST,
+                                                config.LOG_CHUNK_SAMPLE_EVERY)
+_udp_thread = None
+_sock = None # Socket UDP đang lắng nghe (luồng inference dùng để gửi lệnh về thiết bị)
 
 # --- Cấu trúc dữ liệu mới để lưu trữ lịch sử ---
 _prediction_history = defaultdict(lambda: deque(maxlen=int(config.SCREAM_FREQUENCY_WINDOW_S / config.AUDIO_CHUNK_DURATION_S) * 2))
@@ -23,76 +44,9 @@ _audio_chunk_history = defaultdict(lambda: deque(maxlen=int(config.AUDIO_SAVE_DU
 _last_alert_times = defaultdict(float)
 _audio_buffers = defaultdict(lambda: torch.tensor([], dtype=torch.float32))
 _buffer_lock = threading.Lock()
-
-# --- Hàm trợ giúp S3 ---
-_s3_client = None
-if config.S3_CONFIGURED:
-    try:
-        _s3_client = boto3.client(
-            's3',
-            aws_access_key_id=config.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
-            region_name=config.AWS_S3_REGION
-        )
-        logging.info("S3 Client initialized successfully.")
-    except (NoCredentialsError, PartialCredentialsError) as e:
-        logging.error(f"S3 Initialization Error: AWS credentials not found or incomplete. {e}")
-        _s3_client = None
-    except Exception as e:
-        logging.error(f"S3 Initialization Error: An unexpected error occurred. {e}", exc_info=True)
-        _s3_client = None
-else:
-    logging.warning("S3 Client not initialized because S3 configuration is incomplete in config.")
-
-def save_tensor_to_wav_bytes(audio_tensor: torch.Tensor, sample_rate: int) -> bytes | None:
-    """Chuyển đổi tensor audio float [-1, 1] thành bytes WAV."""
-    if audio_tensor is None or audio_tensor.nelement() == 0:
-        return None
-    try:
-        if audio_tensor.ndim > 1:
-            audio_tensor = audio_tensor.squeeze()
-        # Chuyển đổi tensor float [-1, 1] sang int16
-        # Đảm bảo clip giá trị để tránh lỗi tràn số khi nhân
-        audio_np = torch.clamp(audio_tensor * 32767, -32768, 32767).cpu().numpy().astype(np.int16)
-        buffer = io.BytesIO()
-        sf.write(buffer, audio_np, sample_rate, format='WAV', subtype='PCM_16')
-        buffer.seek(0)
-        return buffer.getvalue()
-    except Exception as e:
-        logging.error(f"Error converting tensor to WAV bytes: {e}", exc_info=True)
-        return None
-
-def upload_audio_to_s3(audio_bytes: bytes, client_ip: str, timestamp: float) -> tuple[str | None, str | None]:
-    """Tải dữ liệu audio bytes lên S3 và trả về (s3_key, pre-signed_url)."""
-    if not _s3_client or not config.S3_CONFIGURED:
-        logging.error("S3 client not available or not configured. Cannot upload audio.")
-        return None, None
-    if not audio_bytes:
-        logging.error("No audio bytes provided to upload.")
-        return None, None
-    try:
-        # Sử dụng timestamp để đảm bảo tên file duy nhất
-        s3_key = f"{config.AWS_S3_AUDIO_FOLDER}scream_{client_ip.replace('.', '-')}_{int(timestamp)}.wav"
-        bucket_name = config.AWS_S3_BUCKET_NAME
-
-        # Tải file lên S3
-        _s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=audio_bytes, ContentType='audio/wav')
-        logging.info(f"Successfully uploaded audio to s3://{bucket_name}/{s3_key}")
-
-        # Tạo pre-signed URL để gửi trong thông báo FCM (có thể hết hạn)
-        presigned_url = _s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': bucket_name, 'Key': s3_key},
-            ExpiresIn=config.AWS_S3_URL_EXPIRATION_S # Thời gian hết hạn URL
-        )
-        # Trả về cả key (để lưu vào DB) và URL (để gửi đi)
-        return s3_key, presigned_url
-    except ClientError as e:
-        logging.error(f"S3 ClientError during upload/presign URL generation: {e}", exc_info=True)
-        return None, None
-    except Exception as e:
-        logging.error(f"Unexpected error during S3 upload: {e}", exc_info=True)
-        return None, None
+# Lịch sử/cooldown của các detector bổ sung (config.EXTRA_MODELS), khóa (tên detector, ip), dùng trong _buffer_lock
+_detector_history = defaultdict(deque)
+_detector_last_alert_times = defaultdict(float)
 
 def calculate_rms(audio_chunk_tensor: torch.Tensor) -> float:
     """Tính giá trị Root Mean Square (RMS) cho một chunk audio tensor."""
@@ -108,41 +62,354 @@ def calculate_rms(audio_chunk_tensor: torch.Tensor) -> float:
         logging.error(f"Error calculating RMS: {e}", exc_info=True)
         return 0.0
 
+def scream_pattern_status(predictions, target_label: str = 'Hét') -> tuple[int, int]:
+    """
+    Đánh giá lịch sử dự đoán trong cửa sổ: trả về (số chunk target_label liên tiếp dài nhất, tổng số chunk target_label).
+    predictions: iterable các cặp (timestamp, label). Dùng chung với tools/batch_score.py và các detector bổ sung.
+    """
+    max_consecutive = 0
+    current_consecutive = 0
+    total = 0
+    for _, pred_label in predictions:
+        if pred_label == target_label:
+            current_consecutive += 1
+            total += 1
+        else:
+            max_consecutive = max(max_consecutive, current_consecutive)
+            current_consecutive = 0
+    return max(max_consecutive, current_consecutive), total
+
+def _forget_device(client_ip: str):
+    """Xóa buffer và lịch sử của một thiết bị (khi lỗi xử lý, hoặc thiết bị đã chuyển sang node khác)."""
+    with _buffer_lock:
+        if client_ip in _audio_buffers: del _audio_buffers[client_ip]
+        if client_ip in _prediction_history: del _prediction_history[client_ip]
+        if client_ip in _audio_chunk_history: del _audio_chunk_history[client_ip]
+        if client_ip in _last_alert_times: del _last_alert_times[client_ip]
+        for key in [key for key in _detector_history if key[1] == client_ip]:
+            del _detector_history[key]
+
+def _send_detector_alert(name: str, client_ip: str, consecutive: int, total_in_window: int, timestamp: float):
+    """
+    Gửi FCM + ghi Firestore cho cảnh báo của một detector bổ sung (chạy trong pool alert_dispatch).
+    Khi chạy cụm, claim cooldown chung trước (ngoài _buffer_lock); node khác đã cảnh báo thì bỏ qua.
+    """
+    spec = config.MODEL_CATALOG[name]
+    if config.CLUSTER_ENABLED:
+        claimed, last_alert = ingest_cluster.claim_alert(name, client_ip, timestamp, spec['cooldown_s'])
+        if not claimed:
+            with _buffer_lock:
+                _detector_last_alert_times[(name, client_ip)] = last_alert
+            return
+    event_bus.publish({
+        'type': 'detection',
+        'model': name,
+        'device': client_ip,
+        'timestamp': timestamp,
+        'consecutive': consecutive,
+        'total_in_window': total_in_window,
+    })
+    try:
+        alert_body = spec['alert_body_template'].format(count=total_in_window, window=spec['frequency_window_s'], ip=client_ip)
+        with metrics.stage_timer('fcm_fanout'):
+            success_fcm = firebase_client.send_alert_to_all(spec['alert_title'], alert_body, data={"type": name, "ip": client_ip})
+        with metrics.stage_timer('firestore_write'):
+            firebase_client.log_detector_alert_to_firestore(client_ip, name)
+        metrics.DETECTOR_ALERTS.inc(name, client_ip)
+        if success_fcm:
+            logging.info(f"Sent '{name}' alert for {client_ip} to devices.")
+        else:
+            logging.error(f"Failed to send '{name}' alert for {client_ip}.")
+    except Exception as e:
+        logging.error(f"Error sending '{name}' alert for {client_ip}: {e}", exc_info=True)
+
+def _check_detectors(client_ip: str, current_time: float, predictions: dict):
+    """
+    Áp dụng luật (liên tiếp, tần suất, cooldown) riêng của từng detector bổ sung; gọi trong _buffer_lock.
+    Cảnh báo được gửi qua pool alert_dispatch để không giữ lock/chặn luồng UDP.
+    """
+    for name, (label, confidence) in predictions.items():
+        spec = config.MODEL_CATALOG.get(name)
+        if spec is None:
+            continue
+        history = _detector_history[(name, client_ip)]
+        history.append((current_time, label))
+        window_start_time = current_time - spec['frequency_window_s']
+        while history and history[0][0] < window_start_time:
+            history.popleft()
+        max_consecutive, total = scream_pattern_status(history, spec['target_label'])
+        if max_consecutive < spec['min_consecutive_chunks'] or total < spec['frequency_count']:
+            continue
+        last_alert_time = _detector_last_alert_times[(name, client_ip)]
+        cooldown_passed = current_time - last_alert_time > spec['cooldown_s']
+        if not cooldown_passed:
+            logging.info(f"'{name}' pattern conditions met for {client_ip}, but within cooldown period. Alert not sent.")
+            continue
+        logging.warning(f"--- !!! '{name}' Pattern Detected from {client_ip} ({label}, {confidence * 100:.1f}%) !!! ---")
+        # Giữ chỗ cooldown cục bộ; claim cooldown chung của cụm chạy trong pool gửi cảnh báo (ngoài lock)
+        _detector_last_alert_times[(name, client_ip)] = current_time
+        if not alert_dispatch.submit(f"'{name}' alert for {client_ip}", _send_detector_alert,
+                                     name, client_ip, max_consecutive, total, current_time):
+            # Hàng đợi gửi cảnh báo đầy: trả lại cooldown để chunk kế tiếp thử lại
+            _detector_last_alert_times[(name, client_ip)] = last_alert_time
+
+def _device_lane(client_ip: str) -> str:
+    """
+    Lane inference của thiết bị (gọi trong _buffer_lock): 'hot' nếu trong cửa sổ gần đây có dự đoán
+    'Hét' (hoặc nhãn mục tiêu của detector bổ sung), ngược lại 'cold'.
+    """
+    if any(label == 'Hét' for _, label in _prediction_history.get(client_ip, ())):
+        return 'hot'
+    for name in config.EXTRA_MODELS:
+        target_label = config.MODEL_CATALOG[name]['target_label']
+        if any(label == target_label for _, label in _detector_history.get((name, client_ip), ())):
+            return 'hot'
+    return 'cold'
+
+def _handle_scheduled_result(item, predictions: dict):
+    """Xử lý kết quả từ inference_scheduler (luồng inference): chỉ cập nhật trạng thái, cảnh báo chạy ở alert_dispatch."""
+    try:
+        with _buffer_lock:
+            _handle_prediction(item.device, item.address, item.chunk, item.timestamp, item.rms, dict(predictions))
+    except Exception as e:
+        metrics.DROPS.inc(item.device, 'processing_error')
+        logging.error(f"UDP Server: Critical error processing prediction for {item.device}: {e}", exc_info=True)
+        _forget_device(item.device)
+
+def _send_command(command: str, addr):
+    """Gửi lệnh (CALL:/REDIRECT:) về thiết bị qua socket UDP đang lắng nghe."""
+    sock = _sock
+    if sock is None:
+        logging.error(f"UDP Server: Socket đã đóng, không gửi được lệnh '{command}' tới {addr}.")
+        return
+    try:
+        logging.info(f"Sending command '{command}' back to {addr}")
+        sock.sendto(command.encode('utf-8'), addr)
+    except OSError as send_err:
+        logging.error(f"UDP Server: Socket OSError sending command to {addr}: {send_err}")
+    except Exception as send_exc:
+        logging.error(f"UDP Server: Unknown error sending command to {addr}: {send_exc}", exc_info=True)
+
+def _send_scream_alert(client_ip: str, address, audio_to_save_list: list, current_time: float,
+                       max_consecutive_in_window: int, total_screams_in_window: int):
+    """
+    Gửi cảnh báo tiếng hét (chạy trong pool alert_dispatch, ngoài _buffer_lock và ngoài luồng inference):
+    claim cooldown của cụm, upload clip S3, FCM, ghi Firestore, rồi gửi lệnh "CALL:<số>" về thiết bị.
+    """
+    if config.CLUSTER_ENABLED:
+        # Cooldown dùng chung cả cụm: chủ cũ của thiết bị có thể vừa gửi cảnh báo
+        claimed, last_alert = ingest_cluster.claim_alert('scream', client_ip, current_time, config.SCREAM_ALERT_COOLDOWN_S)
+        if not claimed:
+            with _buffer_lock:
+                _last_alert_times[client_ip] = last_alert
+            return
+    event_bus.publish({
+        'type': 'detection',
+        'device': client_ip,
+        'timestamp': current_time,
+        'consecutive': max_consecutive_in_window,
+        'total_in_window': total_screams_in_window,
+    })
+
+    # --- Xử lý S3, Gửi Thông báo FCM, Log Firestore ---
+    audio_s3_key = None
+    audio_presigned_url = None
+    pending_upload = None
+    try:
+        if audio_to_save_list:
+            full_audio_tensor = audio_to_save_list[0] if config.PREROLL_ENABLED else torch.cat(audio_to_save_list)
+            # Mã hóa + upload chạy trong pool; chỉ chờ tối đa S3_UPLOAD_WAIT_S để cảnh báo không bị trễ
+            pending_upload = clip_uploads.submit_clip(full_audio_tensor, client_ip, current_time)
+            if pending_upload:
+                 with metrics.stage_timer('s3_upload_wait'):
+                     audio_s3_key, audio_presigned_url = pending_upload.wait(config.S3_UPLOAD_WAIT_S)
+                 if audio_s3_key: logging.info(f"Uploaded audio segment to S3 key: {audio_s3_key}")
+                 elif pending_upload.is_pending(): logging.info(f"Audio segment upload to {pending_upload.s3_key} still pending.")
+                 else: logging.error("Failed to upload audio segment to S3.")
+        else: logging.warning("No audio data found in the save window to upload.")
+
+        alert_title = config.HIGH_FREQUENCY_ALERT_TITLE
+        alert_body = config.HIGH_FREQUENCY_ALERT_BODY_TEMPLATE.format(total_screams_in_window, config.SCREAM_FREQUENCY_WINDOW_S, client_ip)
+        payload = {"type": "complex_scream", "ip": client_ip}
+        if audio_presigned_url:
+            payload["audio_url"] = audio_presigned_url
+        if audio_s3_key:
+            payload["s3_key"] = audio_s3_key
+
+        with metrics.stage_timer('fcm_fanout'):
+            success_fcm = firebase_client.send_alert_to_all(alert_title, alert_body, data=payload)
+        with metrics.stage_timer('firestore_write'):
+            alert_id = firebase_client.log_alert_to_firestore(client_ip, audio_s3_key)
+        if alert_id and pending_upload and not audio_s3_key:
+            # Upload chưa xong: chỉ ghi key vào cảnh báo khi upload thành công
+            pending_upload.when_uploaded(lambda s3_key: firebase_client.attach_alert_audio(alert_id, client_ip, s3_key))
+        metrics.ALERTS.inc(client_ip)
+
+        if success_fcm:
+            logging.info(f"Sent complex scream alert for {client_ip} to devices.")
+        else:
+            logging.error(f"Failed to send complex scream alert for {client_ip}.")
+
+        # --- LẤY SỐ ĐIỆN THOẠI VÀ GỬI LỆNH VỀ ESP32 ---
+        logging.info(f"Attempting to get default emergency phone number for {client_ip}...")
+        default_phone_number = firebase_client.get_default_emergency_contact()
+
+        if default_phone_number and address:
+            _send_command(f"CALL:{default_phone_number}", address)
+        elif not default_phone_number:
+            logging.error(f"Could not retrieve default phone number. No CALL command will be sent to {client_ip}.")
+
+    except Exception as alert_err:
+        logging.error(f"Error during S3 upload, sending alert, or getting phone number for {client_ip}: {alert_err}", exc_info=True)
+
+def _handle_prediction(client_ip: str, address, process_chunk, current_time_for_rms: float, rms_value: float,
+                       detector_predictions: dict):
+    """
+    Xử lý kết quả dự đoán của một chunk: lịch sử, mẫu hình cảnh báo. Gọi khi đang giữ _buffer_lock.
+    Khi đủ điều kiện cảnh báo, chỉ giữ chỗ cooldown + lấy audio rồi đưa việc gửi (S3/FCM/Firestore/lệnh CALL
+    về `address`) vào pool alert_dispatch: luồng inference/UDP không bao giờ chờ mạng.
+    """
+    current_time = time.time() # Lấy lại thời gian sau khi dự đoán
+    prediction, confidence = detector_predictions.pop(config.PRIMARY_MODEL_NAME, (None, 0.0))
+    metrics.PREDICTIONS.inc(client_ip, prediction if prediction is not None else 'error')
+    if config.CHUNK_STORE_ENABLED:
+        chunk_store.append(client_ip, current_time_for_rms, rms_value, prediction, confidence)
+
+    # Đẩy kết quả chunk cho các client SSE (không chặn, bỏ qua nếu không ai nghe)
+    if event_bus.has_subscribers():
+        event_bus.publish({
+            'type': 'level',
+            'device': client_ip,
+            'timestamp': current_time_for_rms,
+            'rms': rms_value,
+            'prediction': prediction,
+            'confidence': confidence,
+        })
+
+    # --- Cập nhật lịch sử và kiểm tra điều kiện (trong lock) ---
+    # Lưu chunk audio (trên CPU để tiết kiệm bộ nhớ GPU nếu có) và kết quả dự đoán
+    if config.PREROLL_ENABLED:
+        # Audio được giữ trong ring trên đĩa; deque trong RAM không cần nữa
+        with metrics.stage_timer('preroll_write'):
+            preroll.append(client_ip, process_chunk, current_time_for_rms)
+    else:
+        _audio_chunk_history[client_ip].append((current_time, process_chunk.cpu()))
+    _prediction_history[client_ip].append((current_time, prediction))
+    if detector_predictions:
+        _check_detectors(client_ip, current_time, detector_predictions)
+
+    # Xóa dữ liệu cũ trong history để giới hạn bộ nhớ
+    prediction_window_start_time = current_time - config.SCREAM_FREQUENCY_WINDOW_S
+    while _prediction_history[client_ip] and _prediction_history[client_ip][0][0] < prediction_window_start_time:
+         _prediction_history[client_ip].popleft()
+    audio_save_window_start_time = current_time - config.AUDIO_SAVE_DURATION_S - 5 # Giữ thêm buffer
+    while _audio_chunk_history[client_ip] and _audio_chunk_history[client_ip][0][0] < audio_save_window_start_time:
+         _audio_chunk_history[client_ip].popleft()
+
+    # Kiểm tra điều kiện cảnh báo phức tạp
+    stage_start = time.perf_counter()
+    max_consecutive_in_window, total_screams_in_window = scream_pattern_status(_prediction_history[client_ip])
+    condition1_met = max_consecutive_in_window >= config.SCREAM_MIN_CONSECUTIVE_CHUNKS
+    condition2_met = total_screams_in_window >= config.SCREAM_FREQUENCY_COUNT
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - stage_start, 'pattern_check')
+
+    # Log chi tiết trạng thái (hữu ích cho debug)
+    # Chỉ log INFO nếu là hét hoặc lỗi, còn lại là DEBUG để tránh spam log.
+    # Kiểm tra level + lấy mẫu trước, message chỉ được định dạng ở luồng ghi log.
+    important = prediction == 'Hét' or prediction is None
+    log_level = logging.INFO if important else logging.DEBUG
+    if _chunk_logger.isEnabledFor(log_level):
+        log_allowed, log_suppressed = _chunk_log_sampler.allow(client_ip, important)
+        if log_allowed:
+            _chunk_logger.log(
+                log_level,
+                "UDP Server: Chunk from %s - RMS: %.3f, Prediction: %s (%.1f%%). "
+                "Status in %ss window: Consecutive: %d/%d, Total: %d/%d.%s",
+                client_ip, rms_value, prediction, confidence * 100, config.SCREAM_FREQUENCY_WINDOW_S,
+                max_consecutive_in_window, config.SCREAM_MIN_CONSECUTIVE_CHUNKS,
+                total_screams_in_window, config.SCREAM_FREQUENCY_COUNT,
+                f" ({log_suppressed} dòng trước đó đã bị bỏ qua)" if log_suppressed else "",
+            )
+
+    # --- Logic Xử lý Cảnh báo ---
+    last_alert_time = _last_alert_times.get(client_ip, 0.0)
+    cooldown_passed = current_time - last_alert_time > config.SCREAM_ALERT_COOLDOWN_S
+    # Kiểm tra cả 2 điều kiện và thời gian cooldown (cooldown chung của cụm được claim trong _send_scream_alert)
+    if condition1_met and condition2_met and cooldown_passed:
+        logging.warning(f"--- !!! Complex Scream Pattern Detected from {client_ip} !!! ---")
+
+        # Lấy audio chunks cần lưu TRONG LOCK
+        if config.PREROLL_ENABLED:
+            # View vào file ring (không sao chép), mã hóa trong pool upload
+            preroll_window = preroll.get_window(client_ip, current_time_for_rms - config.PREROLL_CLIP_S, current_time_for_rms)
+            audio_to_save_list = [preroll_window] if preroll_window is not None and len(preroll_window) else []
+        else:
+            save_window_start_time = current_time - config.AUDIO_SAVE_DURATION_S
+            audio_to_save_list = [chunk for ts, chunk in list(_audio_chunk_history[client_ip]) if ts >= save_window_start_time]
+
+        # Gán last_alert_time NGAY LẬP TỨC trong lock để tránh gửi nhiều lần khi xử lý S3/FCM chậm
+        _last_alert_times[client_ip] = current_time
+        if not alert_dispatch.submit(f"scream alert for {client_ip}", _send_scream_alert, client_ip, address,
+                                     audio_to_save_list, current_time, max_consecutive_in_window, total_screams_in_window):
+            # Hàng đợi gửi cảnh báo đầy: trả lại cooldown để chunk kế tiếp thử lại
+            _last_alert_times[client_ip] = last_alert_time
+
+    # Trường hợp đủ điều kiện nhưng đang trong thời gian cooldown
+    elif condition1_met and condition2_met:
+         logging.info(f"Complex scream pattern conditions met for {client_ip}, but within cooldown period. Alert not sent.")
+    # --- Kết thúc cập nhật lịch sử và kiểm tra ---
+
 # ==============================================================================
 # <<< SỬA ĐỔI HÀM _process_audio_data >>>
 # ==============================================================================
 def _process_audio_data(data_bytes, client_address) -> str | None:
     """
     Xử lý dữ liệu audio nhận được từ một client (ESP32).
-    Tính RMS, gửi lên Firebase DB, áp dụng logic phát hiện phức tạp,
-    gửi cảnh báo FCM/log Firestore, VÀ trả về lệnh gọi điện nếu cần.
+    Tính RMS, gửi lên Firebase DB, áp dụng logic phát hiện phức tạp. Cảnh báo FCM/Firestore và lệnh
+    "CALL:<phone_number>" được gửi từ pool alert_dispatch (_send_scream_alert).
 
     Returns:
-        str | None: Chuỗi lệnh "CALL:<phone_number>" nếu cần gửi lệnh gọi,
+        str | None: Lệnh "REDIRECT:<host>:<port>" nếu thiết bị cần chuyển node (CLUSTER_REDIRECT_ENABLED),
                     None nếu không cần gửi lệnh.
     """
     global _audio_buffers, _prediction_history, _audio_chunk_history, _last_alert_times, _buffer_lock
 
     client_ip = client_address[0]
     num_bytes_received = len(data_bytes)
-    command_to_send_back = None # <<< Biến để lưu lệnh trả về
 
+    metrics.UDP_PACKETS.inc(client_ip)
+    metrics.UDP_BYTES.inc(client_ip, amount=num_bytes_received)
     if num_bytes_received == 0: return None
     if num_bytes_received % config.AUDIO_BYTES_PER_SAMPLE != 0:
         logging.warning(f"UDP Server: From {client_ip}, received {num_bytes_received} bytes, "
                         f"not a multiple of {config.AUDIO_BYTES_PER_SAMPLE} bytes/sample. Skipping packet.")
+        metrics.DROPS.inc(client_ip, 'bad_size')
         return None
+    if config.CLUSTER_ENABLED and not ingest_cluster.owns(client_ip):
+        # Thiết bị thuộc node khác (vừa rebalance / gửi nhầm node)
+        if config.CLUSTER_REDIRECT_ENABLED:
+            # Firmware hỗ trợ REDIRECT: bỏ gói, báo thiết bị chuyển node
+            metrics.DROPS.inc(client_ip, 'not_owner')
+            if client_ip in _audio_buffers:
+                _forget_device(client_ip)
+            return ingest_cluster.redirect_command(client_ip)
+        # Firmware chưa hỗ trợ: vẫn xử lý, claim_alert chống trùng cảnh báo với node chủ
+        ingest_cluster.note_foreign_packet(client_ip)
 
     try:
         # Chuyển đổi bytes thành numpy array rồi thành tensor float
+        stage_start = time.perf_counter()
         samples_np = np.frombuffer(data_bytes, dtype=config.AUDIO_NUMPY_DTYPE)
         # Chuẩn hóa về khoảng [-1.0, 1.0] dựa trên kiểu dữ liệu int32 (2**31)
         audio_tensor_float = torch.from_numpy(samples_np.astype(np.float32) / (2**31)).float()
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - stage_start, 'packet_decode')
 
         with _buffer_lock:
             # Nối dữ liệu mới vào buffer của client tương ứng
+            stage_start = time.perf_counter()
             _audio_buffers[client_ip] = torch.cat((_audio_buffers[client_ip], audio_tensor_float))
             current_buffer = _audio_buffers[client_ip]
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - stage_start, 'buffer_append')
 
             # Xử lý từng chunk hoàn chỉnh trong buffer
             while len(current_buffer) >= config.AUDIO_CHUNK_SAMPLES:
@@ -152,146 +419,48 @@ def _process_audio_data(data_bytes, client_address) -> str | None:
 
                 # --- Tính RMS và gửi lên Firebase DB (ngoài lock) ---
                 current_time_for_rms = time.time()
-                rms_value = calculate_rms(process_chunk)
-                # Gọi hàm ghi lên Firebase (có thể là RTDB hoặc Firestore tùy cấu hình)
-                firebase_client.write_audio_level(client_ip, rms_value, current_time_for_rms)
+                metrics.CHUNKS.inc(client_ip)
+                with metrics.stage_timer('rms'):
+                    rms_value = calculate_rms(process_chunk)
+                # Gọi hàm ghi lên Firebase RTDB (có thể tắt nếu app đã dùng SSE /stream/levels)
+                if config.RTDB_AUDIO_LEVELS_ENABLED:
+                    firebase_client.write_audio_level(client_ip, rms_value, current_time_for_rms)
                 # --- Kết thúc tính RMS và gửi DB ---
 
+                if config.INFERENCE_BATCHING_ENABLED and inference_scheduler.is_running():
+                    # Chunk vào lane theo mức ưu tiên của thiết bị; kết quả được xử lý ở luồng inference.
+                    # Scheduler đang dừng thì bỏ chunk: chạy inline sẽ vượt lên trước các chunk còn trong hàng đợi
+                    if not inference_scheduler.submit(client_ip, process_chunk, current_time_for_rms, rms_value,
+                                                      _device_lane(client_ip), client_address):
+                        metrics.DROPS.inc(client_ip, 'scheduler_stopping')
+                    continue
+
                 # --- Thực hiện dự đoán (ngoài lock) ---
                 _buffer_lock.release() # Tạm thời nhả lock khi chạy ML
                 try:
-                    prediction, confidence = ml_handler.predict_scream(process_chunk)
+                    # Mọi model trong registry chạy trên cùng một ảnh mel của chunk
+                    detector_predictions = ml_handler.predict_all(process_chunk)
                 finally:
                     _buffer_lock.acquire() # Lấy lại lock sau khi dự đoán xong
                 # --- Kết thúc dự đoán ---
 
-                current_time = time.time() # Lấy lại thời gian sau khi dự đoán
-
-                # --- Cập nhật lịch sử và kiểm tra điều kiện (trong lock) ---
-                # Lưu chunk audio (trên CPU để tiết kiệm bộ nhớ GPU nếu có) và kết quả dự đoán
-                _audio_chunk_history[client_ip].append((current_time, process_chunk.cpu()))
-                _prediction_history[client_ip].append((current_time, prediction))
-
-                # Xóa dữ liệu cũ trong history để giới hạn bộ nhớ
-                prediction_window_start_time = current_time - config.SCREAM_FREQUENCY_WINDOW_S
-                while _prediction_history[client_ip] and _prediction_history[client_ip][0][0] < prediction_window_start_time:
-                     _prediction_history[client_ip].popleft()
-                audio_save_window_start_time = current_time - config.AUDIO_SAVE_DURATION_S - 5 # Giữ thêm buffer
-                while _audio_chunk_history[client_ip] and _audio_chunk_history[client_ip][0][0] < audio_save_window_start_time:
-                     _audio_chunk_history[client_ip].popleft()
-
-                # Kiểm tra điều kiện cảnh báo phức tạp
-                recent_predictions_in_window = list(_prediction_history[client_ip])
-                max_consecutive_in_window = 0
-                current_consecutive = 0
-                for _, pred_label in recent_predictions_in_window:
-                    if pred_label == 'Hét': current_consecutive += 1
-                    else:
-                        max_consecutive_in_window = max(max_consecutive_in_window, current_consecutive)
-                        current_consecutive = 0
-                max_consecutive_in_window = max(max_consecutive_in_window, current_consecutive)
-                condition1_met = max_consecutive_in_window >= config.SCREAM_MIN_CONSECUTIVE_CHUNKS
-
-                total_screams_in_window = sum(1 for _, pred_label in recent_predictions_in_window if pred_label == 'Hét')
-                condition2_met = total_screams_in_window >= config.SCREAM_FREQUENCY_COUNT
-
-                # Log chi tiết trạng thái (hữu ích cho debug)
-                log_message = (
-                    f"UDP Server: Chunk from {client_ip} - RMS: {rms_value:.3f}, Prediction: {prediction} ({confidence*100:.1f}%). "
-                    f"Status in {config.SCREAM_FREQUENCY_WINDOW_S}s window: "
-                    f"Consecutive: {max_consecutive_in_window}/{config.SCREAM_MIN_CONSECUTIVE_CHUNKS}, "
-                    f"Total: {total_screams_in_window}/{config.SCREAM_FREQUENCY_COUNT}."
-                )
-                # Chỉ log INFO nếu là hét hoặc lỗi, còn lại là DEBUG để tránh spam log
-                if prediction == 'Hét' or prediction is None: logging.info(log_message)
-                else: logging.debug(log_message)
-
-                # --- Logic Xử lý Cảnh báo ---
-                last_alert_time = _last_alert_times.get(client_ip, 0.0)
-                # Kiểm tra cả 2 điều kiện và thời gian cooldown
-                if condition1_met and condition2_met and (current_time - last_alert_time > config.SCREAM_ALERT_COOLDOWN_S):
-                    logging.warning(f"--- !!! Complex Scream Pattern Detected from {client_ip} !!! ---")
-
-                    # Lấy audio chunks cần lưu TRONG LOCK
-                    save_window_start_time = current_time - config.AUDIO_SAVE_DURATION_S
-                    audio_to_save_list = [chunk for ts, chunk in list(_audio_chunk_history[client_ip]) if ts >= save_window_start_time]
-
-                    # Gán last_alert_time NGAY LẬP TỨC trong lock để tránh gửi nhiều lần khi xử lý S3/FCM chậm
-                    _last_alert_times[client_ip] = current_time
-
-                    # Nhả lock SAU KHI lấy dữ liệu cần thiết và cập nhật last_alert_time
-                    _buffer_lock.release()
-
-                    # --- Xử lý S3, Gửi Thông báo FCM, Log Firestore (ngoài lock) ---
-                    audio_s3_key = None
-                    audio_presigned_url = None
-                    try:
-                        # <<< LOGIC S3, FCM, FIRESTORE LOG GIỮ NGUYÊN >>>
-                        if audio_to_save_list:
-                            full_audio_tensor = torch.cat(audio_to_save_list)
-                            audio_bytes = save_tensor_to_wav_bytes(full_audio_tensor, config.AUDIO_SAMPLE_RATE)
-                            if audio_bytes:
-                                 audio_s3_key, audio_presigned_url = upload_audio_to_s3(audio_bytes, client_ip, current_time)
-                                 if audio_s3_key: logging.info(f"Uploaded audio segment to S3 key: {audio_s3_key}")
-                                 else: logging.error("Failed to upload audio segment to S3.")
-                            else: logging.error("Failed to convert audio tensor to WAV bytes.")
-                        else: logging.warning("No audio data found in the save window to upload.")
-
-                        alert_title = config.HIGH_FREQUENCY_ALERT_TITLE
-                        alert_body = config.HIGH_FREQUENCY_ALERT_BODY_TEMPLATE.format(total_screams_in_window, config.SCREAM_FREQUENCY_WINDOW_S, client_ip)
-                        payload = {"type": "complex_scream", "ip": client_ip}
-                        if audio_presigned_url:
-                            payload["audio_url"] = audio_presigned_url
-                        if audio_s3_key:
-                            payload["s3_key"] = audio_s3_key
-
-                        success_fcm = firebase_client.send_alert_to_all(alert_title, alert_body, data=payload)
-                        firebase_client.log_alert_to_firestore(client_ip, audio_s3_key)
-
-                        if success_fcm:
-                            logging.info(f"Sent complex scream alert for {client_ip} to devices.")
-                        else:
-                            logging.error(f"Failed to send complex scream alert for {client_ip}.")
-                        # <<< KẾT THÚC LOGIC S3, FCM, FIRESTORE LOG >>>
-
-                        # --- THÊM LOGIC LẤY SỐ ĐIỆN THOẠI VÀ TẠO LỆNH GỬI VỀ ESP32 ---
-                        logging.info(f"Attempting to get default emergency phone number for {client_ip}...")
-                        default_phone_number = firebase_client.get_default_emergency_contact()
-
-                        if default_phone_number:
-                            command_to_send_back = f"CALL:{default_phone_number}"
-                            logging.info(f"Prepared command to send back to {client_ip}: {command_to_send_back}")
-                        else:
-                            logging.error(f"Could not retrieve default phone number. No CALL command will be sent to {client_ip}.")
-                        # --- KẾT THÚC LOGIC LẤY SỐ ĐT VÀ TẠO LỆNH ---
-
-                    except Exception as alert_err:
-                        logging.error(f"Error during S3 upload, sending alert, or getting phone number for {client_ip}: {alert_err}", exc_info=True)
-                    finally:
-                        _buffer_lock.acquire() # Lấy lại lock sau khi xử lý xong
-
-                # Trường hợp đủ điều kiện nhưng đang trong thời gian cooldown
-                elif condition1_met and condition2_met:
-                     logging.info(f"Complex scream pattern conditions met for {client_ip}, but within cooldown period. Alert not sent.")
-                # --- Kết thúc cập nhật lịch sử và kiểm tra ---
+                _handle_prediction(client_ip, client_address, process_chunk, current_time_for_rms, rms_value,
+                                   detector_predictions)
 
     except ValueError as e:
+         metrics.DROPS.inc(client_ip, 'decode_error')
          # Lỗi khi chuyển đổi bytes sang numpy (ví dụ: sai dtype)
          logging.error(f"UDP Server: ValueError processing data from {client_ip}. Corrupted data or wrong dtype? {e}", exc_info=True)
          return None # Trả về None khi có lỗi
     except Exception as e:
+        metrics.DROPS.inc(client_ip, 'processing_error')
         # Các lỗi nghiêm trọng khác trong quá trình xử lý
         logging.error(f"UDP Server: Critical error processing data from {client_ip}: {e}", exc_info=True)
         # Xóa buffer và lịch sử của client này để tránh lỗi lặp lại
-        with _buffer_lock:
-            if client_ip in _audio_buffers: del _audio_buffers[client_ip]
-            if client_ip in _prediction_history: del _prediction_history[client_ip]
-            if client_ip in _audio_chunk_history: del _audio_chunk_history[client_ip]
-            if client_ip in _last_alert_times: del _last_alert_times[client_ip]
+        _forget_device(client_ip)
         return None # Trả về None khi có lỗi
 
-    # Trả về lệnh cần gửi (có thể là None)
-    return command_to_send_back
+    return None
 # ==============================================================================
 # <<< KẾT THÚC SỬA ĐỔI HÀM _process_audio_data >>>
 # ==============================================================================
@@ -302,6 +471,7 @@ def _process_audio_data(data_bytes, client_address) -> str | None:
 # ==============================================================================
 def udp_listener():
     """Lắng nghe dữ liệu UDP từ các ESP32, xử lý và gửi lại lệnh nếu cần."""
+    global _sock
     sock = None
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -309,6 +479,10 @@ def udp_listener():
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((config.UDP_HOST, config.UDP_PORT))
         sock.settimeout(1.0) # Chờ tối đa 1 giây để nhận dữ liệu
+        _sock = sock
+        if not config.INFERENCE_BATCHING_ENABLED:
+            # Luồng UDP chạy inference trực tiếp: ghim vào CPU set inference
+            torch_runtime.pin_current_thread()
         logging.info(f"UDP Server: Listening on {config.UDP_HOST}:{config.UDP_PORT}...")
 
         while not _stop_udp.is_set():
@@ -316,18 +490,12 @@ def udp_listener():
                 # Nhận dữ liệu và địa chỉ client
                 data, addr = sock.recvfrom(config.UDP_BUFFER_SIZE)
                 if data:
-                    # Gọi hàm xử lý, hàm này giờ trả về lệnh cần gửi lại (hoặc None)
+                    # Gọi hàm xử lý, hàm này trả về lệnh REDIRECT cần gửi lại (hoặc None)
                     command_to_send = _process_audio_data(data, addr)
 
                     # <<< THÊM LOGIC GỬI LỆNH TRẢ VỀ ESP32 >>>
                     if command_to_send:
-                        try:
-                            logging.info(f"Sending command '{command_to_send}' back to {addr}")
-                            sock.sendto(command_to_send.encode('utf-8'), addr)
-                        except OSError as send_err:
-                            logging.error(f"UDP Server: Socket OSError sending command to {addr}: {send_err}")
-                        except Exception as send_exc:
-                            logging.error(f"UDP Server: Unknown error sending command to {addr}: {send_exc}", exc_info=True)
+                        _send_command(command_to_send, addr)
                     # <<< KẾT THÚC LOGIC GỬI LỆNH >>>
 
             except socket.timeout:
@@ -348,6 +516,12 @@ def udp_listener():
         # Các lỗi không mong muốn khác trong vòng lặp chính
         logging.error(f"UDP Server: Unknown error in main listener loop: {e}", exc_info=True)
     finally:
+        # Chạy nốt các chunk đang chờ inference và các cảnh báo đang gửi trước khi đóng socket
+        # (cảnh báo có thể cần gửi lệnh CALL về thiết bị)
+        if inference_scheduler.is_running():
+            inference_scheduler.stop(config.SHUTDOWN_DRAIN_TIMEOUT_S)
+        alert_dispatch.drain(config.SHUTDOWN_DRAIN_TIMEOUT_S)
+        _sock = None
         # Đảm bảo socket được đóng khi luồng kết thúc
         if sock:
             sock.close()
@@ -359,7 +533,7 @@ def udp_listener():
 
 def start_udp_thread() -> threading.Thread:
     """Khởi tạo và bắt đầu luồng chạy UDP listener."""
-    if not ml_handler._is_model_loaded:
+    if not ml_handler.is_model_loaded():
          logging.warning("UDP Server: ML Model not loaded. UDP listener starting but predictions will fail.")
 
     _stop_udp.clear() # Đảm bảo cờ stop được reset
@@ -369,16 +543,117 @@ def start_udp_thread() -> threading.Thread:
         _prediction_history.clear()
         _audio_chunk_history.clear()
         _last_alert_times.clear()
+        _detector_history.clear()
+        _detector_last_alert_times.clear()
+    if config.STATE_CHECKPOINT_ENABLED:
+        state = state_checkpoint.load()
+        if state:
+            _restore_state(state)
+        state_checkpoint.start(export_state)
+    if config.INFERENCE_BATCHING_ENABLED:
+        inference_scheduler.start(_handle_scheduled_result)
 
     # Tạo và bắt đầu luồng listener
+    global _udp_thread
     udp_thread = threading.Thread(target=udp_listener, name="UDPListenerThread", daemon=True) # daemon=True để luồng tự thoát khi chương trình chính thoát
     udp_thread.start()
+    _udp_thread = udp_thread
     logging.info("UDP Server: Listener thread initialized and started.")
+    ingest_cluster.start()
     return udp_thread
 
 def stop_udp_listener():
     """Dừng UDP listener một cách an toàn."""
     logging.info("UDP Server: Requesting listener thread stop...")
     _stop_udp.set() # Đặt cờ yêu cầu dừng
+    ingest_cluster.stop() # Rời cụm để node khác nhận thiết bị ngay
     # Không cần join() ở đây vì luồng là daemon và sẽ tự thoát,
     # hoặc join() trong hàm shutdown của run.py nếu cần đợi
+
+def export_state() -> dict:
+    """
+    Ảnh chụp trạng thái phát hiện theo thiết bị cho state_checkpoint: lịch sử dự đoán và thời điểm cảnh báo
+    cuối (cooldown) của cảnh báo tiếng hét và detector bổ sung. Không lưu audio: với PREROLL_ENABLED clip được
+    cắt từ ring trên đĩa (còn nguyên sau khi khởi động lại); không có pre-roll thì clip của cảnh báo ngay sau
+    khi khởi động lại chỉ gồm audio nhận từ lúc đó. Buffer dở dang (< 1 chunk) cũng không được lưu.
+    """
+    with _buffer_lock:
+        # Chỉ sao chép các list nhỏ (timestamp, nhãn) trong lock; pickle/ghi file ở luồng checkpoint, ngoài lock
+        devices = {
+            ip: (list(_prediction_history.get(ip, ())), _last_alert_times.get(ip, 0.0))
+            for ip in set(_prediction_history) | set(_last_alert_times)
+        }
+        detectors = {
+            key: (list(_detector_history.get(key, ())), _detector_last_alert_times.get(key, 0.0))
+            for key in set(_detector_history) | set(_detector_last_alert_times)
+        }
+    return {
+        'devices': {
+            ip: {'predictions': predictions, 'last_alert_time': last_alert_time}
+            for ip, (predictions, last_alert_time) in devices.items()
+        },
+        'detectors': {
+            key: {'predictions': predictions, 'last_alert_time': last_alert_time}
+            for key, (predictions, last_alert_time) in detectors.items()
+        },
+    }
+
+def _restore_state(state: dict):
+    """Nạp lại trạng thái từ checkpoint (dữ liệu quá cũ sẽ tự bị loại khỏi cửa sổ ở chunk kế tiếp)."""
+    with _buffer_lock:
+        for ip, device in state.get('devices', {}).items():
+            _prediction_history[ip].extend(device['predictions'])
+            if device['last_alert_time']:
+                _last_alert_times[ip] = device['last_alert_time']
+        for key, detector in state.get('detectors', {}).items():
+            _detector_history[key].extend(detector['predictions'])
+            if detector['last_alert_time']:
+                _detector_last_alert_times[key] = detector['last_alert_time']
+    logging.info(f"UDP Server: Khôi phục trạng thái của {len(state.get('devices', {}))} thiết bị từ checkpoint.")
+
+def drain(timeout_s: float) -> bool:
+    """
+    Dừng an toàn: ngừng nhận gói, chờ chunk đang chờ inference, cảnh báo đang gửi (alert_dispatch) và upload clip
+    tối đa timeout_s giây, rồi ghi checkpoint cuối, flush ring pre-roll và kho kết quả chunk. Dùng chung cho
+    process ingest (run_ingest.py) và UDP chạy trong process web (run.py). Trả về False nếu hết thời gian khi
+    còn việc dở.
+    """
+    deadline = time.monotonic() + timeout_s
+    stop_udp_listener()
+    if _udp_thread is not None:
+        # Luồng UDP dừng scheduler inference và chờ alert_dispatch trước khi đóng socket (lệnh CALL)
+        _udp_thread.join(timeout=max(0.0, deadline - time.monotonic()))
+    drained = alert_dispatch.drain(deadline - time.monotonic())
+    drained = clip_uploads.drain(deadline - time.monotonic()) and drained
+    drained = drained and not (_udp_thread and _udp_thread.is_alive())
+    if config.STATE_CHECKPOINT_ENABLED:
+        state_checkpoint.stop(final_save=True)
+    # Sau khi upload clip xong (clip đọc audio từ ring pre-roll)
+    preroll.close_all()
+    chunk_store.close()
+    if drained:
+        logging.info("UDP Server: Đã xử lý xong các cảnh báo đang gửi.")
+    else:
+        logging.warning(f"UDP Server: Hết {timeout_s}s chờ, vẫn còn cảnh báo/upload chưa xong khi dừng.")
+    return drained
+
+def get_status() -> dict:
+    """Trạng thái trực tiếp của pipeline ingest (dùng cho /ingest/status và IPC)."""
+    with _buffer_lock:
+        devices = {
+            ip: {
+                'buffered_samples': int(len(buf)),
+                'last_alert_time': _last_alert_times.get(ip) or None,
+                'recent_predictions': len(_prediction_history.get(ip, ())),
+            }
+            for ip, buf in _audio_buffers.items()
+        }
+    return {
+        'udp_listening': bool(_udp_thread and _udp_thread.is_alive()),
+        'model_loaded': ml_handler.is_model_loaded(),
+        's3_configured': bool(s3_client.is_ready() and config.S3_CONFIGURED),
+        'devices': devices,
+        'event_bus': event_bus.get_stats(),
+        'cluster': ingest_cluster.get_status(),
+        'inference': inference_scheduler.get_stats(),
+    }
@@ -1,4 +1,4 @@
-from app import create_app, config,  udp_server # Import các thành phần cần thiết
+from app import create_app, config # Import các thành phần cần thiết
 import logging
 # import scheduler
 import signal
@@ -13,7 +13,10 @@ def shutdown_server(signum, frame):
     logging.info("Nhận tín hiệu dừng (Ctrl+C)... Đang dọn dẹp.")
     # Dừng các luồng nền
     # scheduler.stop_scheduler()
-    udp_server.stop_udp_listener()
+    if 'app.udp_server' in sys.modules: # Chỉ có khi UDP listener chạy trong process này
+        # Ngừng nhận gói, chờ cảnh báo đang gửi xong (tối đa SHUTDOWN_DRAIN_TIMEOUT_S), ghi checkpoint trạng thái,
+        # flush ring pre-roll và kho kết quả chunk
+        sys.modules['app.udp_server'].drain(config.SHUTDOWN_DRAIN_TIMEOUT_S)
     # Đợi các luồng kết thúc (tùy chọn, có thể cần join)
     logging.info("Đã yêu cầu dừng các luồng nền.")
     # Có thể thêm các thao tác dọn dẹp khác ở đây (ví dụ: đóng kết nối DB)
@@ -0,0 +1,53 @@
+# run_ingest.py
+# Process ingest/inference độc lập với web tier:
+#   - Nhận audio UDP từ ESP32, chạy model, gửi cảnh báo FCM / ghi Firestore / upload S3.
+#   - Mở kênh IPC cục bộ (app/ingest_ipc.py) để các worker Flask nhận trạng thái và sự kiện trực tiếp.
+# Cách chạy (Flask đặt INGEST_MODE=external trong .env):
+#   python run_ingest.py
+#   gunicorn --workers 4 run:app
+from app import config, firebase_client, ml_handler, udp_server, ingest_ipc
+import logging
+import signal
+import sys
+import threading
+
+_shutdown = threading.Event()
+
+def shutdown_ingest(signum, frame):
+    """Xử lý tín hiệu dừng (Ctrl+C / SIGTERM)."""
+    logging.info("Ingest: Nhận tín hiệu dừng... Đang dọn dẹp.")
+    _shutdown.set()
+
+def main() -> int:
+    logging.info("--- Khởi động process ingest/inference ---")
+    try:
+        ingest_ipc.check_authkey()
+    except RuntimeError as e:
+        logging.error(f"Ingest: {e}")
+        return 1
+    if not firebase_client.initialize_firebase():
+        logging.error("Ingest: KHÔNG THỂ KHỞI TẠO FIREBASE ADMIN SDK. Cảnh báo sẽ không được gửi.")
+
+    if not ml_handler.load_and_warmup():
+        logging.warning("Ingest: Không thể tải model ML. Chức năng dự đoán sẽ không hoạt động.")
+
+    udp_thread = udp_server.start_udp_thread()
+    ingest_ipc.start_ipc_server(udp_server.get_status)
+
+    signal.signal(signal.SIGINT, shutdown_ingest)
+    signal.signal(signal.SIGTERM, shutdown_ingest)
+
+    # Chờ tín hiệu dừng (kiểm tra định kỳ để signal handler được gọi)
+    while not _shutdown.wait(1.0):
+        if not udp_thread.is_alive():
+            logging.error("Ingest: Luồng UDP listener đã dừng bất ngờ. Thoát.")
+            break
+
+    # Chờ các cảnh báo đang gửi / clip đang upload (có giới hạn thời gian), ghi checkpoint cuối, flush pre-roll/chunk store
+    udp_server.drain(config.SHUTDOWN_DRAIN_TIMEOUT_S)
+    ingest_ipc.stop_ipc_server()
+    logging.info("Ingest: Process ingest đã dừng.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
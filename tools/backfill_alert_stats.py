@@ -0,0 +1,45 @@
+# tools/backfill_alert_stats.py
+# Tính lại (backfill/sửa chữa) các document rollup 'alert_stats_daily' từ 'alert_history'.
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.backfill_alert_stats                       # toàn bộ lịch sử
+#   python -m tools.backfill_alert_stats --start 2025-04-01 --end 2025-04-30
+#   python -m tools.backfill_alert_stats --dry-run
+import argparse
+import datetime
+import logging
+import sys
+
+from app import firebase_client, alert_stats
+
+
+def _parse_date(value: str) -> datetime.date:
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Ngày không hợp lệ (cần YYYY-MM-DD): {value}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Backfill/sửa chữa rollup thống kê cảnh báo theo ngày.")
+    parser.add_argument('--start', type=_parse_date, default=None, help="Ngày bắt đầu (local, YYYY-MM-DD)")
+    parser.add_argument('--end', type=_parse_date, default=None, help="Ngày kết thúc (local, YYYY-MM-DD)")
+    parser.add_argument('--dry-run', action='store_true', help="Chỉ tính toán và in kết quả, không ghi Firestore")
+    args = parser.parse_args(argv)
+
+    if args.start and args.end and args.start > args.end:
+        parser.error("--start phải nhỏ hơn hoặc bằng --end")
+
+    if not firebase_client.initialize_firebase() or not firebase_client._firestore_db:
+        logging.error("Backfill: Không thể khởi tạo Firestore. Dừng.")
+        return 1
+
+    rollups = alert_stats.rebuild_daily_rollups(
+        firebase_client._firestore_db, start_date=args.start, end_date=args.end, dry_run=args.dry_run
+    )
+    for day_key, data in sorted(rollups.items()):
+        print(f"{day_key}\ttotal={data['total']}\tdevices={data['devices']}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,282 @@
+# tools/batch_score.py
+# Chấm điểm offline các file WAV (ví dụ clip cảnh báo đã lưu trên S3 dưới AWS_S3_AUDIO_FOLDER) bằng đúng
+# model và tiền xử lý của ml_handler, để kiểm tra lại cảnh báo cũ hoặc tinh chỉnh ngưỡng.
+# Pipeline: đọc WAV bằng memory-map (không nạp cả file vào RAM) -> cắt chunk 1 giây -> mel theo batch
+# -> forward theo batch (ml_handler.predict_scream_batch) trên một pool process.
+# Mỗi chunk được ghi (file, chunk, nhãn, độ tin cậy, có cảnh báo hay không) vào một file .npz nén;
+# quyết định cảnh báo được mô phỏng bằng đúng luật của udp_server (liên tiếp + tần suất + cooldown).
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.batch_score recordings/ --output scores.npz
+#   python -m tools.batch_score --s3-prefix audio/ --cache-dir s3_cache/ --workers 4 --output scores.npz
+import argparse
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app import config
+
+# Mã nhãn trong file kết quả: chỉ số lớp của MODEL_CLASS_MAP, cộng thêm hai mã đặc biệt
+LABEL_UNKNOWN = 254
+LABEL_ERROR = 255
+_LABEL_TO_INDEX = {label: idx for idx, label in config.MODEL_CLASS_MAP.items()}
+
+# (format tag, bits per sample) -> dtype numpy và hệ số chuẩn hóa về [-1, 1]
+_WAV_DTYPES = {
+    (1, 16): ('<i2', 2**15),
+    (1, 32): ('<i4', 2**31), # Giống cách udp_server chuẩn hóa dữ liệu '<i4' từ ESP32
+    (3, 32): ('<f4', 1.0),
+}
+
+
+class WavFormatError(ValueError):
+    """File không phải WAV PCM/float mà bộ đọc memory-map hỗ trợ."""
+
+
+def open_wav_memmap(path: str) -> tuple[np.memmap, int, float]:
+    """
+    Mở phần dữ liệu của file WAV dưới dạng memory-map.
+    Returns:
+        (samples (frames, channels), sample_rate, scale) - chia samples cho scale để được float [-1, 1].
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise WavFormatError(f"{path}: không phải file RIFF/WAVE")
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise WavFormatError(f"{path}: không tìm thấy chunk 'data'")
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                fmt_bytes = f.read(chunk_size + (chunk_size & 1))
+                format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt_bytes[:16])
+                if format_tag == 0xFFFE and chunk_size >= 26: # WAVE_FORMAT_EXTENSIBLE: lấy sub-format
+                    format_tag = struct.unpack('<H', fmt_bytes[24:26])[0]
+                fmt = (format_tag, channels, sample_rate, block_align, bits)
+            elif chunk_id == b'data':
+                data_offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+    if fmt is None:
+        raise WavFormatError(f"{path}: thiếu chunk 'fmt '")
+    format_tag, channels, sample_rate, block_align, bits = fmt
+    if (format_tag, bits) not in _WAV_DTYPES:
+        raise WavFormatError(f"{path}: định dạng không hỗ trợ (format={format_tag}, bits={bits})")
+    dtype, scale = _WAV_DTYPES[(format_tag, bits)]
+    # Một số bộ ghi dạng stream để chunk_size = 0/0xFFFFFFFF: lấy theo kích thước file
+    available = os.path.getsize(path) - data_offset
+    data_size = min(chunk_size, available) if chunk_size else available
+    frames = data_size // block_align
+    if frames == 0:
+        return np.zeros((0, channels), dtype=dtype), sample_rate, scale
+    samples = np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=(frames, channels))
+    return samples, sample_rate, scale
+
+
+def simulate_alerts(labels: list) -> list[int]:
+    """
+    Áp dụng luật cảnh báo của udp_server lên chuỗi nhãn của một file (chunk i kết thúc tại (i+1) giây chunk).
+    Trả về danh sách chỉ số chunk mà server sẽ gửi cảnh báo.
+    """
+    from app.udp_server import scream_pattern_status
+    history = deque()
+    last_alert_time = float('-inf')
+    alert_chunks = []
+    for i, label in enumerate(labels):
+        current_time = (i + 1) * config.AUDIO_CHUNK_DURATION_S
+        history.append((current_time, label))
+        while history and history[0][0] < current_time - config.SCREAM_FREQUENCY_WINDOW_S:
+            history.popleft()
+        max_consecutive, total = scream_pattern_status(history)
+        if (max_consecutive >= config.SCREAM_MIN_CONSECUTIVE_CHUNKS and total >= config.SCREAM_FREQUENCY_COUNT
+                and current_time - last_alert_time > config.SCREAM_ALERT_COOLDOWN_S):
+            alert_chunks.append(i)
+            last_alert_time = current_time
+    return alert_chunks
+
+
+# --- Phía process con ---
+_worker_batch_size = 16
+
+
+def _init_worker(threads: int, batch_size: int):
+    global _worker_batch_size
+    from app import ml_handler
+    _worker_batch_size = batch_size
+    if not ml_handler.load_model():
+        raise RuntimeError("Không tải được model trong process con")
+    ml_handler.torch.set_num_threads(threads)
+
+
+def _score_file(path: str) -> dict:
+    from app import ml_handler
+    torch = ml_handler.torch
+    result = {'path': path, 'error': None, 'duration_s': 0.0,
+              'labels': np.zeros(0, dtype=np.uint8), 'confidence': np.zeros(0, dtype=np.float16), 'alerts': []}
+    try:
+        samples, sample_rate, scale = open_wav_memmap(path)
+        result['duration_s'] = len(samples) / sample_rate if sample_rate else 0.0
+        if sample_rate != config.AUDIO_SAMPLE_RATE:
+            # Hiếm gặp (clip của server luôn 16 kHz): resample cả file, không dùng memory-map được
+            import torchaudio
+            audio = torch.from_numpy(np.asarray(samples, dtype=np.float32).mean(axis=1) / scale)
+            audio = torchaudio.functional.resample(audio, sample_rate, config.AUDIO_SAMPLE_RATE).numpy()
+            samples, scale = audio[:, None], 1.0
+
+        chunk = config.AUDIO_CHUNK_SAMPLES
+        num_chunks = len(samples) // chunk # Chunk cuối chưa đủ 1 giây bị bỏ qua như trên server
+        labels = np.full(num_chunks, LABEL_ERROR, dtype=np.uint8)
+        confidence = np.zeros(num_chunks, dtype=np.float16)
+        label_names = [None] * num_chunks
+        for start in range(0, num_chunks, _worker_batch_size):
+            stop = min(num_chunks, start + _worker_batch_size)
+            # Chỉ phần memory-map của batch này được đọc từ đĩa
+            block = np.asarray(samples[start * chunk:stop * chunk], dtype=np.float32)
+            block = (block.mean(axis=1) / scale).reshape(stop - start, chunk)
+            predictions = ml_handler.predict_scream_batch(torch.from_numpy(block))
+            for offset, (label, conf) in enumerate(predictions):
+                i = start + offset
+                label_names[i] = label
+                if label is not None:
+                    labels[i] = _LABEL_TO_INDEX.get(label, LABEL_UNKNOWN)
+                    confidence[i] = conf
+        result.update(labels=labels, confidence=confidence, alerts=simulate_alerts(label_names))
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+# --- Phía process chính ---
+def collect_wav_files(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, '**', '*.wav'), recursive=True))
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            logging.warning(f"Batch Score: Bỏ qua đường dẫn không tồn tại: {path}")
+    return sorted(set(files))
+
+
+def download_s3_prefix(prefix: str, cache_dir: str, workers: int = 8) -> list[str]:
+    """Tải các file .wav dưới prefix về cache_dir (bỏ qua file đã có cùng kích thước)."""
+    from app import s3_client
+    client = s3_client.get_client()
+    if client is None:
+        raise SystemExit("S3 chưa được cấu hình (xem AWS_* trong .env).")
+    objects = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=config.AWS_S3_BUCKET_NAME, Prefix=prefix):
+        objects.extend(obj for obj in page.get('Contents', []) if obj['Key'].endswith('.wav'))
+
+    def fetch(obj) -> str:
+        local_path = os.path.join(cache_dir, obj['Key'])
+        if not (os.path.exists(local_path) and os.path.getsize(local_path) == obj['Size']):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            client.download_file(config.AWS_S3_BUCKET_NAME, obj['Key'], local_path)
+        return local_path
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        local_files = list(pool.map(fetch, objects))
+    logging.info(f"Batch Score: {len(local_files)} file từ s3://{config.AWS_S3_BUCKET_NAME}/{prefix} đã có trong {cache_dir}.")
+    return local_files
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Chấm điểm offline các file WAV bằng model phát hiện tiếng hét.")
+    parser.add_argument('paths', nargs='*', help="File WAV hoặc thư mục (quét đệ quy *.wav)")
+    parser.add_argument('--s3-prefix', default=None, help=f"Tải và chấm các clip trên S3 dưới prefix này (ví dụ {config.AWS_S3_AUDIO_FOLDER})")
+    parser.add_argument('--cache-dir', default='s3_cache', help="Thư mục lưu clip tải từ S3")
+    parser.add_argument('--output', default='scores.npz', help="File kết quả (.npz nén)")
+    parser.add_argument('--workers', type=int, default=None, help="Số process con (mặc định: số CPU / --threads)")
+    parser.add_argument('--threads', type=int, default=1, help="Số luồng torch mỗi process con")
+    parser.add_argument('--batch-size', type=int, default=16, help="Số chunk 1 giây mỗi lần forward")
+    args = parser.parse_args(argv)
+
+    files = collect_wav_files(args.paths)
+    if args.s3_prefix is not None:
+        files = sorted(set(files) | set(download_s3_prefix(args.s3_prefix, args.cache_dir)))
+    if not files:
+        parser.error("Không có file WAV nào để chấm")
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+
+    file_index, chunk_index, labels, confidence, alert_flags = [], [], [], [], []
+    file_alerts = {}
+    errors = {}
+    total_audio_s = 0.0
+    t0 = time.perf_counter()
+    # 'spawn' an toàn với torch/CUDA hơn 'fork'
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(args.threads, args.batch_size)) as pool:
+        index_of = {path: i for i, path in enumerate(files)}
+        for done, result in enumerate(pool.imap_unordered(_score_file, files, chunksize=4), start=1):
+            i = index_of[result['path']]
+            if result['error']:
+                errors[result['path']] = result['error']
+                logging.warning(f"Batch Score: Lỗi {result['path']}: {result['error']}")
+                continue
+            n = len(result['labels'])
+            total_audio_s += result['duration_s']
+            file_index.append(np.full(n, i, dtype=np.uint32))
+            chunk_index.append(np.arange(n, dtype=np.uint32))
+            labels.append(result['labels'])
+            confidence.append(result['confidence'])
+            flags = np.zeros(n, dtype=bool)
+            flags[result['alerts']] = True
+            alert_flags.append(flags)
+            if result['alerts']:
+                file_alerts[result['path']] = result['alerts']
+            if done % 100 == 0:
+                elapsed = time.perf_counter() - t0
+                logging.info(f"Batch Score: {done}/{len(files)} file, {total_audio_s / elapsed:.1f}x thời gian thực.")
+    elapsed = time.perf_counter() - t0
+
+    def concat(parts, dtype):
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+    labels_all = concat(labels, np.uint8)
+    summary = {
+        'files': len(files),
+        'files_failed': len(errors),
+        'chunks': int(len(labels_all)),
+        'scream_chunks': int(np.count_nonzero(labels_all == _LABEL_TO_INDEX.get('Hét', LABEL_UNKNOWN))),
+        'error_chunks': int(np.count_nonzero(labels_all == LABEL_ERROR)),
+        'alerts': sum(len(v) for v in file_alerts.values()),
+        'files_with_alerts': len(file_alerts),
+        'audio_hours': round(total_audio_s / 3600, 3),
+        'wall_s': round(elapsed, 2),
+        'realtime_factor': round(total_audio_s / elapsed, 1) if elapsed else None,
+        'workers': workers,
+        'threads_per_worker': args.threads,
+        'batch_size': args.batch_size,
+    }
+    np.savez_compressed(
+        args.output,
+        files=np.array(files),
+        file_index=concat(file_index, np.uint32),
+        chunk_index=concat(chunk_index, np.uint32),
+        label=labels_all,
+        confidence=concat(confidence, np.float16),
+        alert=concat(alert_flags, bool),
+        class_names=np.array([config.MODEL_CLASS_MAP[k] for k in sorted(config.MODEL_CLASS_MAP)]),
+        summary=np.array(json.dumps({**summary, 'errors': errors}, ensure_ascii=False)),
+    )
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    logging.info(f"Batch Score: Đã ghi kết quả vào {args.output}")
+    return 1 if errors and len(errors) == len(files) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# tools/export_traced.py
+# Xuất đồ thị đặc trưng hợp nhất (app/feature_graph.py) + model tiếng hét thành MỘT module TorchScript
+# (torch.jit.trace, tùy chọn freeze/optimize_for_inference) để tiền xử lý và model chạy chung một graph
+# đã tối ưu - vd. trên máy inference không có matplotlib/PIL/torchaudio.
+# Module xuất ra nhận waveform đã pad (B, MODEL_TARGET_LENGTH_SAMPLES) float [-1.0, 1.0] trên cùng device lúc
+# xuất, trả về logits (B, số lớp); batch size tùy ý.
+# Trước khi ghi, công cụ kiểm tra (không ghi file nếu vượt --tolerance): module trace khớp module gốc trên batch
+# khác kích thước, và ảnh của đồ thị hợp nhất khớp đường matplotlib/PIL mà model được huấn luyện (sai khác
+# trung bình theo pixel, ảnh trong [0, 1]).
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.export_traced
+#   python -m tools.export_traced --optimize --output model/scream_fused.ts.pt
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+
+def _synthetic_batch(torch, batch_size: int, seed: int):
+    """Batch chunk 1 giây: sóng sin + nhiễu, pad tới độ dài model như trong ml_handler."""
+    from app import config, ml_handler
+    generator = torch.Generator().manual_seed(seed)
+    t = torch.arange(config.AUDIO_CHUNK_SAMPLES, dtype=torch.float32) / config.AUDIO_SAMPLE_RATE
+    freqs = 300 + 1200 * torch.rand(batch_size, 1, generator=generator)
+    chunks = (0.3 * torch.sin(2 * math.pi * freqs * t)
+              + 0.05 * torch.randn(batch_size, config.AUDIO_CHUNK_SAMPLES, generator=generator)).clamp(-1.0, 1.0)
+    return chunks, ml_handler._pad_waveform(chunks, config.MODEL_TARGET_LENGTH_SAMPLES).to(ml_handler.get_device())
+
+
+def _mean_ms(fn, iterations: int) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return round(1000 * (time.perf_counter() - t0) / iterations, 3)
+
+
+def main(argv=None) -> int:
+    from app import config
+    default_output = os.path.splitext(config.MODEL_PATH)[0] + '.traced.pt'
+    parser = argparse.ArgumentParser(description="Xuất đồ thị đặc trưng + model tiếng hét thành một module TorchScript.")
+    parser.add_argument('--output', default=default_output, help=f"File TorchScript (mặc định {default_output})")
+    parser.add_argument('--batch-size', type=int, default=4, help="Batch dùng để trace")
+    parser.add_argument('--optimize', action='store_true', help="torch.jit.freeze + optimize_for_inference sau khi trace")
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help="Sai khác tối đa cho phép: logits (trace so với gốc) và pixel trung bình (so với đường PIL)")
+    parser.add_argument('--iterations', type=int, default=10, help="Số lần chạy khi so thời gian eager/traced")
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args(argv)
+
+    from app import feature_graph, ml_handler
+    if not ml_handler.load_model():
+        print("Không tải được model (kiểm tra MODEL_PATH).", file=sys.stderr)
+        return 1
+    torch = ml_handler.torch
+
+    graph = feature_graph.build(ml_handler._mel_transform, config.MODEL_IMG_SIZE, ml_handler.get_device())
+    combined = torch.nn.Sequential(graph, ml_handler._model).eval()
+    chunks, example = _synthetic_batch(torch, args.batch_size, args.seed)
+    _, check = _synthetic_batch(torch, args.batch_size + 3, args.seed + 1)
+
+    with torch.no_grad():
+        traced = torch.jit.trace(combined, example)
+        if args.optimize:
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+        max_diff = (traced(check) - combined(check)).abs().max().item()
+        # Ảnh hợp nhất so với đường matplotlib/PIL cho cùng các chunk (None = không so được)
+        image_diff = ml_handler.feature_parity_diff(graph, chunks)
+        timings = {
+            'eager_ms': _mean_ms(lambda: combined(example), args.iterations),
+            'traced_ms': _mean_ms(lambda: traced(example), args.iterations),
+        }
+
+    summary = {
+        'output': args.output,
+        'device': ml_handler.get_device(),
+        'input_shape': ['B', config.MODEL_TARGET_LENGTH_SAMPLES],
+        'optimized': args.optimize,
+        'max_logit_diff': max_diff,
+        'pil_vs_fused_mean_pixel_diff': image_diff,
+        'batch_size': args.batch_size,
+        **timings,
+    }
+    print(json.dumps(summary, indent=2))
+    if max_diff > args.tolerance:
+        print(f"Module trace lệch {max_diff:.3g} > {args.tolerance} so với module gốc, không ghi file.", file=sys.stderr)
+        return 1
+    if image_diff is None or image_diff > args.tolerance:
+        reason = "không so được (đường PIL lỗi hoặc khác kích thước)" if image_diff is None else f"lệch {image_diff:.3g} > {args.tolerance}"
+        print(f"Ảnh của đồ thị hợp nhất {reason} so với đường matplotlib/PIL, không ghi file.", file=sys.stderr)
+        return 1
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    torch.jit.save(traced, args.output)
+    print(f"Đã ghi {args.output}.", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
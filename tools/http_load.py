@@ -0,0 +1,327 @@
+# tools/http_load.py
+# Kiểm thử tải các route đọc của Flask (/alert_history, /statistics/weekly, /get_audio_url(s)).
+# Mặc định chạy app trong process này với backend giả lập cục bộ (LOCAL_BACKENDS=true, xem
+# app/local_backends.py): tạo dữ liệu mẫu, phục vụ bằng werkzeug đa luồng rồi bắn request song song
+# từ nhiều luồng (mỗi luồng một kết nối keep-alive) theo trộn kịch bản có trọng số.
+# Báo cáo req/s và độ trễ p50/p90/p99 theo từng kịch bản, cùng thống kê cache của server.
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.http_load
+#   python -m tools.http_load --concurrency 32 --duration 30 --latency firestore=25,s3=40 --output bench/http.json
+#   python -m tools.http_load --no-cache --output bench/http_nocache.json
+#   python -m tools.http_load --url http://127.0.0.1:5000 --scenarios history_first,weekly
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+# Trọng số mặc định gần với cách app Android dùng API: chủ yếu mở lịch sử và thống kê
+SCENARIO_WEIGHTS = {
+    'history_first': 30,    # Trang đầu /alert_history
+    'history_page': 15,     # Trang tiếp theo bằng next_cursor
+    'history_device': 10,   # Lọc theo client_ip
+    'history_audio': 10,    # include_audio_urls=true
+    'weekly': 15,           # /statistics/weekly (tuần hiện tại hoặc tuần trước)
+    'audio_url': 10,        # /get_audio_url
+    'audio_urls': 5,        # POST /get_audio_urls
+    'conditional': 5,       # /alert_history với If-None-Match (304 nếu cache còn hiệu lực)
+}
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def start_local_server(args) -> tuple[str, dict]:
+    """Khởi động app với backend giả lập, tạo dữ liệu mẫu; trả về (base_url, dữ liệu đã seed)."""
+    # Phải đặt trước khi import app.config
+    os.environ['LOCAL_BACKENDS'] = 'true'
+    os.environ['INGEST_MODE'] = 'external' # Không tải model / UDP listener trong process này
+    if args.latency is not None:
+        os.environ['LOCAL_BACKENDS_LATENCY_MS'] = args.latency
+    if args.no_cache:
+        os.environ['RESPONSE_CACHE_ENABLED'] = 'false'
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import flask
+    from werkzeug.serving import make_server
+    from app import firebase_client, local_backends, routes, s3_client
+
+    firebase_client.initialize_firebase()
+    s3_client.get_client()
+    # Seed không tính độ trễ giả lập
+    saved_latency = dict(local_backends._latency_s)
+    local_backends._latency_s.clear()
+    seeded = local_backends.seed_alerts(args.alerts, devices=args.devices, days=args.days, seed=args.seed)
+    local_backends._latency_s.update(saved_latency)
+
+    # Chỉ đăng ký route, không gọi create_app(): không cần relay IPC tới process ingest
+    app = flask.Flask('app')
+    routes.register_routes(app)
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="HttpLoadServer", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", seeded
+
+
+class _Client:
+    """Một kết nối HTTP keep-alive (mỗi luồng worker một client)."""
+
+    def __init__(self, base_url: str, timeout: float):
+        parsed = urllib.parse.urlsplit(base_url)
+        self._host, self._port = parsed.hostname, parsed.port or 80
+        self._timeout = timeout
+        self._conn = None
+
+    def request(self, method: str, path: str, body: dict | None = None, headers: dict | None = None):
+        headers = dict(headers or {})
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self._host, self._port, timeout=self._timeout)
+            try:
+                self._conn.request(method, path, body=payload, headers=headers)
+                response = self._conn.getresponse()
+                data = response.read()
+                return response.status, response.getheader('ETag'), data
+            except (http.client.HTTPException, ConnectionError):
+                # Server đóng kết nối keep-alive: mở lại một lần
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+
+
+class LoadRunner:
+    def __init__(self, base_url: str, seeded: dict, weights: dict, timeout: float, seed: int):
+        self.base_url = base_url
+        self.seeded = seeded
+        self.scenarios = list(weights)
+        self.weights = [weights[name] for name in self.scenarios]
+        self.timeout = timeout
+        self.seed = seed
+        self._lock = threading.Lock()
+        self.samples = {name: [] for name in self.scenarios} # name -> [latency_s]
+        self.statuses = {name: {} for name in self.scenarios}
+        self.errors = {name: 0 for name in self.scenarios}
+        self._cursors = [] # next_cursor thu được từ trang đầu, dùng cho history_page
+        self._etags = {}
+
+    def _record(self, name: str, latency: float, status):
+        with self._lock:
+            self.samples[name].append(latency)
+            self.statuses[name][str(status)] = self.statuses[name].get(str(status), 0) + 1
+
+    def _run_one(self, client: _Client, rng: random.Random, name: str):
+        devices = self.seeded.get('devices') or []
+        s3_keys = self.seeded.get('s3_keys') or []
+        method, body, headers = 'GET', None, None
+        if name == 'history_first':
+            path = '/alert_history?limit=20'
+        elif name == 'history_page':
+            with self._lock:
+                cursor = rng.choice(self._cursors) if self._cursors else None
+            path = '/alert_history?limit=20' + (f"&cursor={urllib.parse.quote(cursor)}" if cursor else '')
+        elif name == 'history_device':
+            path = f"/alert_history?limit=20&client_ip={rng.choice(devices)}" if devices else '/alert_history?limit=20'
+        elif name == 'history_audio':
+            path = '/alert_history?limit=20&include_audio_urls=true'
+        elif name == 'weekly':
+            day = time.strftime('%Y-%m-%d', time.localtime(time.time() - rng.choice((0, 7)) * 86400))
+            path = f"/statistics/weekly?start_date={day}"
+        elif name == 'audio_url':
+            if not s3_keys:
+                return
+            path = f"/get_audio_url?s3_key={urllib.parse.quote(rng.choice(s3_keys))}"
+        elif name == 'audio_urls':
+            if not s3_keys:
+                return
+            method, path = 'POST', '/get_audio_urls'
+            body = {'s3_keys': rng.sample(s3_keys, min(20, len(s3_keys)))}
+        elif name == 'conditional':
+            path = '/alert_history?limit=20'
+            with self._lock:
+                etag = self._etags.get(path)
+            headers = {'If-None-Match': etag} if etag else None
+        else:
+            raise ValueError(f"Kịch bản không hợp lệ: {name}")
+
+        t0 = time.perf_counter()
+        try:
+            status, etag, data = client.request(method, path, body=body, headers=headers)
+        except Exception as e:
+            with self._lock:
+                self.errors[name] += 1
+            logging.debug(f"{name}: {e}")
+            return
+        self._record(name, time.perf_counter() - t0, status)
+
+        if status == 200 and name in ('history_first', 'conditional') and etag:
+            with self._lock:
+                self._etags[path] = etag
+        if status == 200 and name in ('history_first', 'history_page'):
+            cursor = json.loads(data).get('next_cursor')
+            if cursor:
+                with self._lock:
+                    if len(self._cursors) < 1000:
+                        self._cursors.append(cursor)
+
+    def _worker(self, index: int, deadline: float):
+        rng = random.Random(self.seed + index)
+        client = _Client(self.base_url, self.timeout)
+        try:
+            while time.monotonic() < deadline:
+                self._run_one(client, rng, rng.choices(self.scenarios, weights=self.weights)[0])
+        finally:
+            client.close()
+
+    def run(self, concurrency: int, duration: float) -> float:
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=self._worker, args=(i, deadline), name=f"HttpLoad-{i}", daemon=True)
+                   for i in range(concurrency)]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - t0
+
+    def summary(self, elapsed: float) -> dict:
+        scenarios = {}
+        for name in self.scenarios:
+            latencies = sorted(self.samples[name])
+            entry = {'requests': len(latencies), 'errors': self.errors[name], 'statuses': self.statuses[name],
+                     'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0}
+            if latencies:
+                entry.update({
+                    'mean_ms': round(1000 * sum(latencies) / len(latencies), 2),
+                    'p50_ms': round(1000 * _percentile(latencies, 50), 2),
+                    'p90_ms': round(1000 * _percentile(latencies, 90), 2),
+                    'p99_ms': round(1000 * _percentile(latencies, 99), 2),
+                    'max_ms': round(1000 * latencies[-1], 2),
+                })
+            scenarios[name] = entry
+        total = sum(len(v) for v in self.samples.values())
+        return {'elapsed_s': round(elapsed, 2), 'total_requests': total,
+                'total_rps': round(total / elapsed, 1) if elapsed else 0.0, 'scenarios': scenarios}
+
+
+def _discover(base_url: str, timeout: float, max_pages: int = 10) -> dict:
+    """Với --url: lấy danh sách thiết bị và s3_key từ vài trang /alert_history đầu tiên."""
+    client = _Client(base_url, timeout)
+    devices, s3_keys = set(), []
+    cursor = None
+    try:
+        for _ in range(max_pages):
+            path = '/alert_history?limit=100' + (f"&cursor={urllib.parse.quote(cursor)}" if cursor else '')
+            status, _, data = client.request('GET', path)
+            if status != 200:
+                break
+            page = json.loads(data)
+            for row in page.get('history', []):
+                if row.get('client_ip'):
+                    devices.add(row['client_ip'])
+                if row.get('s3_key'):
+                    s3_keys.append(row['s3_key'])
+            cursor = page.get('next_cursor')
+            if not cursor:
+                break
+    finally:
+        client.close()
+    return {'devices': sorted(devices), 's3_keys': s3_keys}
+
+
+def _fetch_json(base_url: str, path: str, timeout: float):
+    client = _Client(base_url, timeout)
+    try:
+        status, _, data = client.request('GET', path)
+        return json.loads(data) if status == 200 else None
+    except Exception:
+        return None
+    finally:
+        client.close()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Kiểm thử tải các route đọc của Flask (backend giả lập hoặc server có sẵn).")
+    parser.add_argument('--url', default=None, help="Server có sẵn (bỏ qua thì chạy app cục bộ với LOCAL_BACKENDS)")
+    parser.add_argument('--concurrency', type=int, default=16, help="Số luồng gửi request song song")
+    parser.add_argument('--duration', type=float, default=15.0, help="Thời gian đo (giây)")
+    parser.add_argument('--warmup', type=float, default=2.0, help="Thời gian chạy trước khi đo (giây)")
+    parser.add_argument('--scenarios', default=None,
+                        help=f"Danh sách kịch bản, có thể kèm trọng số 'ten=w' (mặc định: {','.join(SCENARIO_WEIGHTS)})")
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', default=None, help="Ghi kết quả ra file JSON")
+    local = parser.add_argument_group("Server cục bộ (khi không có --url)")
+    local.add_argument('--port', type=int, default=0, help="Cổng HTTP (0 = tự chọn)")
+    local.add_argument('--alerts', type=int, default=5000, help="Số cảnh báo mẫu")
+    local.add_argument('--devices', type=int, default=8)
+    local.add_argument('--days', type=int, default=28)
+    local.add_argument('--latency', default=None,
+                       help="Độ trễ giả lập, ví dụ 'firestore=25,rtdb=10,fcm=60,s3=40' (mặc định: LOCAL_BACKENDS_LATENCY_MS)")
+    local.add_argument('--no-cache', action='store_true', help="Tắt response cache để đo đường đi không cache")
+    args = parser.parse_args(argv)
+
+    weights = dict(SCENARIO_WEIGHTS)
+    if args.scenarios:
+        weights = {}
+        for item in args.scenarios.split(','):
+            name, _, weight = item.strip().partition('=')
+            if name not in SCENARIO_WEIGHTS:
+                parser.error(f"Kịch bản không hợp lệ: {name}")
+            weights[name] = float(weight) if weight else SCENARIO_WEIGHTS[name]
+
+    if args.url:
+        base_url = args.url.rstrip('/')
+        seeded = _discover(base_url, args.timeout)
+    else:
+        base_url, seeded = start_local_server(args)
+    print(f"Target {base_url}: {len(seeded['devices'])} thiết bị, {len(seeded['s3_keys'])} s3_key", file=sys.stderr)
+
+    if args.warmup > 0:
+        LoadRunner(base_url, seeded, weights, args.timeout, args.seed).run(args.concurrency, args.warmup)
+    runner = LoadRunner(base_url, seeded, weights, args.timeout, args.seed)
+    elapsed = runner.run(args.concurrency, args.duration)
+
+    results = {
+        'target': base_url if args.url else 'local',
+        'args': vars(args),
+        'summary': runner.summary(elapsed),
+        'cache_stats': _fetch_json(base_url, '/cache/stats', args.timeout),
+    }
+    summary = results['summary']
+    print(f"Tổng: {summary['total_requests']} request trong {summary['elapsed_s']}s = {summary['total_rps']} req/s",
+          file=sys.stderr)
+    for name, entry in summary['scenarios'].items():
+        if not entry['requests']:
+            print(f"  {name:<15} (không có request, lỗi={entry['errors']})", file=sys.stderr)
+            continue
+        print(f"  {name:<15} {entry['rps']:>8} req/s  mean={entry['mean_ms']:>8}ms p50={entry['p50_ms']:>8}ms "
+              f"p90={entry['p90_ms']:>8}ms p99={entry['p99_ms']:>8}ms  status={entry['statuses']} lỗi={entry['errors']}",
+              file=sys.stderr)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    failed = sum(entry['errors'] for entry in summary['scenarios'].values())
+    return 1 if failed and failed == sum(entry['requests'] + entry['errors'] for entry in summary['scenarios'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# tools/import_timing.py
+# Đo thời gian khởi động của web tier:
+#   1. Phân tích `python -X importtime -c "import app"`: thời gian import cộng dồn theo package gốc.
+#   2. Đo riêng từng thư viện nặng trong một process mới (torch, torchaudio, ...).
+#   3. Thời gian từ lúc process bắt đầu tới khi /health trả lời (create_app + test client).
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.import_timing
+#   python -m tools.import_timing --json import_timing.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['torch', 'torchaudio', 'torchvision', 'matplotlib.pyplot', 'PIL.Image',
+                 'numpy', 'soundfile', 'boto3', 'firebase_admin.firestore', 'firebase_admin.messaging',
+                 'google.cloud.firestore', 'flask', 'pytz']
+
+_TIME_TO_HEALTH_SNIPPET = """
+import time
+t0 = time.perf_counter()
+import app
+t_import = time.perf_counter()
+flask_app = app.create_app()
+t_create = time.perf_counter()
+response = flask_app.test_client().get('/health')
+t_health = time.perf_counter()
+import json, sys
+sys.stdout.write(json.dumps({
+    'import_app_s': t_import - t0,
+    'create_app_s': t_create - t_import,
+    'first_health_s': t_health - t_create,
+    'total_s': t_health - t0,
+    'health_status': response.status_code,
+}))
+"""
+
+
+def _run(args, env=None):
+    return subprocess.run([sys.executable] + args, cwd=PROJECT_ROOT, capture_output=True, text=True, env=env)
+
+
+def import_breakdown(target: str = 'app') -> dict:
+    """
+    Thời gian import cộng dồn (giây) theo package gốc khi `import <target>`.
+    Mỗi package được tính tại điểm nó được import bởi một package KHÁC, nên thời gian của
+    package con (ví dụ numpy do torch import) cũng nằm trong số của package cha.
+    """
+    result = _run(['-X', 'importtime', '-c', f'import {target}'])
+    if result.returncode != 0:
+        raise RuntimeError(f"`import {target}` thất bại:\n{result.stderr[-2000:]}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        # Định dạng: "import time:   <self us> | <cumulative us> | <thụt lề><module>"
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue # Dòng tiêu đề
+        name_field = parts[2][1:] # Bỏ một dấu cách sau '|'
+        indent = len(name_field) - len(name_field.lstrip(' '))
+        entries.append((indent, name_field.strip().split('.')[0], int(parts[1]) / 1e6))
+
+    per_package = defaultdict(float)
+    stack = [] # (indent, package gốc) của các import cha; dòng được in theo thứ tự post-order
+    for indent, root, cumulative_s in reversed(entries):
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        parent_root = stack[-1][1] if stack else None
+        if root != parent_root:
+            per_package[root] += cumulative_s
+        stack.append((indent, root))
+    return dict(sorted(per_package.items(), key=lambda kv: kv[1], reverse=True))
+
+
+def module_import_times(modules: list[str]) -> dict:
+    """Thời gian import từng module trong một process mới (giây); None nếu không cài."""
+    times = {}
+    for module in modules:
+        result = _run(['-c', f"import time; t=time.perf_counter(); import {module}; print(time.perf_counter()-t)"])
+        times[module] = round(float(result.stdout.strip()), 4) if result.returncode == 0 else None
+    return times
+
+
+def time_to_health() -> dict:
+    env = dict(os.environ, ML_BACKGROUND_LOAD='true')
+    result = _run(['-c', _TIME_TO_HEALTH_SNIPPET], env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f"create_app()/health thất bại:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Đo thời gian import/khởi động của web tier.")
+    parser.add_argument('--json', dest='json_path', default=None, help="Ghi kết quả ra file JSON")
+    parser.add_argument('--skip-modules', action='store_true', help="Không đo riêng từng thư viện nặng")
+    args = parser.parse_args(argv)
+
+    report = {'python': sys.version.split()[0]}
+    report['import_app_by_package_s'] = {k: round(v, 4) for k, v in import_breakdown('app').items()}
+    if not args.skip_modules:
+        report['heavy_module_import_s'] = module_import_times(HEAVY_MODULES)
+    report['time_to_health'] = time_to_health()
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
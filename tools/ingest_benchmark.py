@@ -0,0 +1,269 @@
+# tools/ingest_benchmark.py
+# Benchmark pipeline ingest (UDP -> buffer -> RMS -> model) với tải giả lập từ tools/udp_load.py.
+# Chạy UDP server + model ngay trong process này (không khởi tạo Firebase/S3: cảnh báo chỉ được ghi log),
+# bộ phát tải chạy ở process con để không tranh CPU/GIL với pipeline.
+# Với mỗi số thiết bị, báo cáo:
+#   - packets/s server xử lý được, tỉ lệ gói bị mất (gửi - nhận)
+#   - độ trễ chunk p50/p90/p99/max: từ lúc gói hoàn tất chunk được gửi tới lúc server có kết quả dự đoán
+#   - CPU của process ingest (%, và % trên mỗi thiết bị)
+# Kết quả được lưu JSON để so sánh giữa các bản phát hành (--baseline).
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.ingest_benchmark --devices 1,5,10,20 --duration 30
+#   python -m tools.ingest_benchmark --devices 10 --output bench/v1.4.json --baseline bench/v1.3.json
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from app import config
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Chỉ số dùng khi so sánh với baseline: (khóa, True nếu giá trị lớn hơn là tốt hơn)
+COMPARED_METRICS = [
+    ('packets_per_s', True),
+    ('drop_rate', False),
+    ('latency_p50_ms', False),
+    ('latency_p99_ms', False),
+    ('cpu_percent_per_device', False),
+]
+
+
+def _percentile(sorted_values: list[float], q: float) -> float | None:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _LevelCollector:
+    """Ghi lại thời điểm nhận từng kết quả chunk ('level' event) theo thiết bị."""
+
+    def __init__(self, event_bus):
+        self._event_bus = event_bus
+        self._subscriber = event_bus.subscribe(None)
+        self._stop = threading.Event()
+        self.arrivals = {} # device -> [time.time(), ...]
+        self.last_event_at = 0.0
+        self._thread = threading.Thread(target=self._run, name="BenchLevelCollector", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            event = self._subscriber.get(timeout=0.5)
+            if event is None or event.get('type') != 'level':
+                continue
+            now = time.time()
+            self.arrivals.setdefault(event['device'], []).append(now)
+            self.last_event_at = now
+
+    def wait_idle(self, idle_s: float, timeout_s: float):
+        """Chờ tới khi không còn kết quả mới trong idle_s giây (pipeline đã xử lý hết hàng đợi)."""
+        deadline = time.time() + timeout_s
+        while time.time() < deadline:
+            if time.time() - max(self.last_event_at, 0.0) >= idle_s:
+                return
+            time.sleep(0.1)
+
+    @property
+    def dropped(self) -> int:
+        return self._subscriber.dropped
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2.0)
+        self._event_bus.unsubscribe(self._subscriber)
+
+
+def _run_generator(args, devices: int, source_prefix: str, report_path: str):
+    cmd = [sys.executable, '-m', 'tools.udp_load',
+           '--host', '127.0.0.1', '--port', str(args.port),
+           '--devices', str(devices), '--duration', str(args.duration),
+           '--speed', str(args.speed), '--packet-samples', str(args.packet_samples),
+           '--mix', args.mix, '--source-prefix', source_prefix,
+           '--seed', str(args.seed), '--report', report_path]
+    if args.scream_dir:
+        cmd += ['--scream-dir', args.scream_dir]
+    subprocess.run(cmd, cwd=PROJECT_ROOT, check=True)
+
+
+def run_case(args, devices: int, run_index: int, metrics, event_bus) -> dict:
+    """Chạy một mức tải. Mỗi lần chạy dùng dải địa chỉ nguồn riêng để không dính buffer/cooldown của lần trước."""
+    source_prefix = f"127.{run_index + 1}"
+    collector = _LevelCollector(event_bus)
+    packets_before = metrics.UDP_PACKETS.value()
+    drops_before = metrics.DROPS.value()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, 'load.json')
+        cpu_start, wall_start = _cpu_seconds(), time.perf_counter()
+        _run_generator(args, devices, source_prefix, report_path)
+        collector.wait_idle(idle_s=2.0, timeout_s=max(30.0, args.duration))
+        # Không tính thời gian chờ rỗi ở cuối vào CPU trung bình
+        wall_s = max(time.perf_counter() - wall_start - 2.0, 1e-6)
+        cpu_s = _cpu_seconds() - cpu_start
+        with open(report_path, encoding='utf-8') as f:
+            load = json.load(f)
+    collector.close()
+
+    packets_received = metrics.UDP_PACKETS.value() - packets_before
+    latencies = []
+    chunks_expected = chunks_processed = 0
+    for device in load['per_device']:
+        sent_at = device['chunk_sent_at']
+        arrivals = collector.arrivals.get(device['device'], [])
+        chunks_expected += len(sent_at)
+        chunks_processed += len(arrivals)
+        # Kết quả của một thiết bị đến theo đúng thứ tự chunk: ghép theo vị trí.
+        # Nếu có gói bị mất, chunk hoàn tất muộn hơn dự kiến nên độ trễ bị đánh giá cao hơn thực tế.
+        latencies.extend(a - s for s, a in zip(sent_at, arrivals))
+    latencies.sort()
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    cpu_percent = 100.0 * cpu_s / wall_s
+    return {
+        'devices': devices,
+        'generator_elapsed_s': round(load['elapsed_s'], 3),
+        'generator_late_sends': load['late_sends'],
+        'packets_sent': load['packets_sent'],
+        'packets_received': int(packets_received),
+        'packets_per_s': round(packets_received / load['elapsed_s'], 1) if load['elapsed_s'] else 0.0,
+        'drop_rate': round(1 - packets_received / load['packets_sent'], 5) if load['packets_sent'] else 0.0,
+        'pipeline_drops': int(metrics.DROPS.value() - drops_before),
+        'chunks_expected': chunks_expected,
+        'chunks_processed': chunks_processed,
+        'latency_p50_ms': ms(_percentile(latencies, 50)),
+        'latency_p90_ms': ms(_percentile(latencies, 90)),
+        'latency_p99_ms': ms(_percentile(latencies, 99)),
+        'latency_max_ms': ms(latencies[-1] if latencies else None),
+        'cpu_percent': round(cpu_percent, 1),
+        'cpu_percent_per_device': round(cpu_percent / devices, 2),
+        'collector_dropped_events': collector.dropped,
+        'commands_received': sum(d['commands_received'] for d in load['per_device']),
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Trả về danh sách các chỉ số kém hơn baseline quá tolerance (tỉ lệ, ví dụ 0.1 = 10%)."""
+    baseline_runs = {run['devices']: run for run in baseline.get('runs', [])}
+    regressions = []
+    for run in results['runs']:
+        base = baseline_runs.get(run['devices'])
+        if base is None:
+            continue
+        for key, higher_is_better in COMPARED_METRICS:
+            new, old = run.get(key), base.get(key)
+            if new is None or old is None:
+                continue
+            if key == 'drop_rate':
+                # Tỉ lệ mất gói gần 0: so sánh tuyệt đối thay vì tương đối
+                worse = new - old > tolerance / 10
+            elif higher_is_better:
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance)
+            marker = 'REGRESSION' if worse else 'ok'
+            print(f"  devices={run['devices']:<4} {key:<24} baseline={old!s:<10} now={new!s:<10} {marker}")
+            if worse:
+                regressions.append(f"devices={run['devices']} {key}: {old} -> {new}")
+    return regressions
+
+
+def _environment_info(ml_handler) -> dict:
+    info = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'ml_device': str(ml_handler.get_device()),
+        'model_loaded': ml_handler.is_model_loaded(),
+    }
+    try:
+        info['git_commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT,
+                                            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['git_commit'] = None
+    if ml_handler.torch is not None:
+        info['torch'] = ml_handler.torch.__version__
+        info['torch_threads'] = ml_handler.torch.get_num_threads()
+    return info
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark pipeline ingest UDP + inference với nhiều thiết bị giả lập.")
+    parser.add_argument('--devices', default='1,5,10', help="Danh sách số thiết bị cần đo, ví dụ 1,5,10,20")
+    parser.add_argument('--duration', type=float, default=20.0, help="Số giây audio mỗi thiết bị gửi trong một lần đo")
+    parser.add_argument('--speed', type=float, default=1.0, help="Hệ số tốc độ gửi (1 = thời gian thực)")
+    parser.add_argument('--packet-samples', type=int, default=512)
+    parser.add_argument('--mix', default='silence=0.6,noise=0.3,scream=0.1')
+    parser.add_argument('--scream-dir', default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--port', type=int, default=15005, help="Cổng UDP dùng cho benchmark (tránh đụng server thật)")
+    parser.add_argument('--output', default=None, help="Ghi kết quả ra file JSON")
+    parser.add_argument('--baseline', default=None, help="File JSON kết quả cũ để so sánh")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="Mức kém hơn baseline cho phép (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    try:
+        device_counts = [int(x) for x in args.devices.split(',') if x.strip()]
+    except ValueError:
+        parser.error(f"--devices không hợp lệ: {args.devices}")
+
+    # Cấu hình riêng cho benchmark: chỉ nghe trên loopback, không ghi RTDB, luôn bật metric
+    config.UDP_HOST = '127.0.0.1'
+    config.UDP_PORT = args.port
+    config.RTDB_AUDIO_LEVELS_ENABLED = False
+    config.METRICS_ENABLED = True
+    config.SSE_SUBSCRIBER_QUEUE_SIZE = 1_000_000 # Bộ thu kết quả không được làm mất sự kiện
+
+    from app import ml_handler, udp_server, metrics, event_bus
+    if not ml_handler.load_and_warmup():
+        logging.warning("Benchmark: Model chưa tải được, độ trễ đo được không bao gồm inference.")
+    udp_thread = udp_server.start_udp_thread()
+    time.sleep(0.5) # Chờ socket bind xong
+
+    results = {'environment': _environment_info(ml_handler), 'args': vars(args), 'runs': []}
+    try:
+        for run_index, devices in enumerate(device_counts):
+            logging.info(f"Benchmark: Đo với {devices} thiết bị...")
+            run = run_case(args, devices, run_index, metrics, event_bus)
+            results['runs'].append(run)
+            print(json.dumps(run, ensure_ascii=False))
+    finally:
+        udp_server.stop_udp_listener()
+        udp_thread.join(timeout=5.0)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        logging.info(f"Benchmark: Đã lưu kết quả vào {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"So sánh với baseline {args.baseline} (commit {baseline.get('environment', {}).get('git_commit')}):")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Phát hiện suy giảm hiệu năng:\n  " + "\n  ".join(regressions))
+            return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
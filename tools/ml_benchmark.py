@@ -0,0 +1,243 @@
+# tools/ml_benchmark.py
+# Micro-benchmark các giai đoạn tiền xử lý và inference trong app/ml_handler.py trên input tổng hợp cố định:
+#   pad        : _pad_waveform (chunk 1s -> MODEL_TARGET_LENGTH_SAMPLES)
+#   mel        : _mel_transform + log2 trên batch đã pad
+#   image      : _audio_chunk_to_image_tensor (matplotlib -> PNG -> PIL -> tensor, hoặc đồ thị đặc trưng hợp nhất
+#                theo MODEL_FEATURE_PIPELINE), từng chunk trong batch
+#   forward    : model(batch ảnh) trong torch.no_grad()
+#   predict    : predict_scream, từng chunk trong batch (đường đi thực tế của udp_server)
+# Mỗi tổ hợp (stage, batch size, số luồng torch) chạy trong một process con riêng để đỉnh bộ nhớ
+# (ru_maxrss / CUDA max_memory_allocated) chỉ phản ánh tổ hợp đó.
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.ml_benchmark
+#   python -m tools.ml_benchmark --stages mel,forward --batch-sizes 1,8 --threads 1,4 --output bench/ml.json
+#   python -m tools.ml_benchmark --output bench/ml_new.json --baseline bench/ml.json
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ('pad', 'mel', 'image', 'forward', 'predict')
+# Chỉ số dùng khi so sánh với baseline (đều là "nhỏ hơn là tốt hơn")
+COMPARED_METRICS = ('mean_ms', 'p99_ms', 'peak_mem_delta_mb')
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def _max_rss_mb() -> float:
+    # Linux trả về KB, macOS trả về byte
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def _synthetic_batch(torch, batch_size: int, seed: int):
+    """Batch chunk 1 giây cố định: sóng sin + nhiễu, biên độ giống audio thật đã chuẩn hóa."""
+    from app import config
+    generator = torch.Generator().manual_seed(seed)
+    t = torch.arange(config.AUDIO_CHUNK_SAMPLES, dtype=torch.float32) / config.AUDIO_SAMPLE_RATE
+    freqs = 300 + 1200 * torch.rand(batch_size, 1, generator=generator)
+    tone = 0.3 * torch.sin(2 * math.pi * freqs * t)
+    noise = 0.05 * torch.randn(batch_size, config.AUDIO_CHUNK_SAMPLES, generator=generator)
+    return (tone + noise).clamp(-1.0, 1.0)
+
+
+def _build_stage(stage: str, batch):
+    """Trả về hàm không tham số chạy một lần stage trên batch."""
+    from app import config, ml_handler
+    torch = ml_handler.torch
+    device = ml_handler.get_device()
+    target = config.MODEL_TARGET_LENGTH_SAMPLES
+
+    if stage == 'pad':
+        return lambda: ml_handler._pad_waveform(batch, target)
+    if stage == 'mel':
+        padded = ml_handler._pad_waveform(batch, target).to(device)
+
+        def run_mel():
+            spectrogram = ml_handler._mel_transform(padded) + 1e-10
+            return spectrogram.log2().cpu()
+        return run_mel
+    if stage == 'image':
+        return lambda: [ml_handler._audio_chunk_to_image_tensor(chunk) for chunk in batch]
+    if stage == 'forward':
+        images = torch.cat([ml_handler._audio_chunk_to_image_tensor(chunk) for chunk in batch])
+
+        def run_forward():
+            with torch.no_grad():
+                outputs = ml_handler._model(images)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            return outputs
+        return run_forward
+    if stage == 'predict':
+        return lambda: [ml_handler.predict_scream(chunk) for chunk in batch]
+    raise ValueError(f"Stage không hợp lệ: {stage}")
+
+
+def run_case(stage: str, batch_size: int, threads: int, warmup: int, iterations: int, seed: int) -> dict:
+    """Đo một tổ hợp trong process hiện tại (được gọi trong process con)."""
+    from app import ml_handler
+    if not ml_handler.load_model():
+        raise SystemExit("Không tải được model (kiểm tra MODEL_PATH).")
+    torch = ml_handler.torch
+    torch.set_num_threads(threads)
+    batch = _synthetic_batch(torch, batch_size, seed)
+    fn = _build_stage(stage, batch)
+
+    for _ in range(warmup):
+        fn()
+    if ml_handler.get_device() == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    rss_before = _max_rss_mb()
+
+    timings = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+
+    result = {
+        'stage': stage,
+        'batch_size': batch_size,
+        'threads': threads,
+        'iterations': iterations,
+        'mean_ms': round(1000 * sum(timings) / len(timings), 3),
+        'p50_ms': round(1000 * _percentile(timings, 50), 3),
+        'p99_ms': round(1000 * _percentile(timings, 99), 3),
+        'per_item_mean_ms': round(1000 * sum(timings) / len(timings) / batch_size, 3),
+        'peak_rss_mb': round(_max_rss_mb(), 1),
+        # Phần đỉnh RSS tăng thêm trong lúc đo (sau warm-up); 0 nghĩa là không vượt đỉnh của warm-up
+        'peak_mem_delta_mb': round(_max_rss_mb() - rss_before, 1),
+    }
+    if ml_handler.get_device() == 'cuda':
+        result['cuda_peak_mb'] = round(torch.cuda.max_memory_allocated() / (1024 * 1024), 1)
+    return result
+
+
+def _run_case_subprocess(args, stage: str, batch_size: int, threads: int) -> dict:
+    cmd = [sys.executable, '-m', 'tools.ml_benchmark', '--case', f"{stage},{batch_size},{threads}",
+           '--warmup', str(args.warmup), '--iterations', str(args.iterations), '--seed', str(args.seed)]
+    # Giới hạn cả luồng OpenMP/MKL để số luồng không bị thư viện bên dưới bỏ qua
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+    completed = subprocess.run(cmd, cwd=PROJECT_ROOT, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Case {stage}/b{batch_size}/t{threads} thất bại:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Trả về các tổ hợp chậm/tốn bộ nhớ hơn baseline quá tolerance."""
+    def key(case):
+        return case['stage'], case['batch_size'], case['threads']
+    baseline_cases = {key(case): case for case in baseline.get('cases', [])}
+    regressions = []
+    for case in results['cases']:
+        base = baseline_cases.get(key(case))
+        if base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            new, old = case.get(metric), base.get(metric)
+            if new is None or old is None:
+                continue
+            # Bộ nhớ dao động vài MB giữa các lần chạy: bỏ qua thay đổi nhỏ hơn 5 MB
+            slack = 5.0 if metric == 'peak_mem_delta_mb' else 0.0
+            worse = new > old * (1 + tolerance) + slack
+            marker = 'REGRESSION' if worse else 'ok'
+            print(f"  {case['stage']:<8} b={case['batch_size']:<3} t={case['threads']:<3} {metric:<18} "
+                  f"baseline={old!s:<10} now={new!s:<10} {marker}", file=sys.stderr)
+            if worse:
+                regressions.append(f"{case['stage']}/b{case['batch_size']}/t{case['threads']} {metric}: {old} -> {new}")
+    return regressions
+
+
+def _int_list(value: str) -> list[int]:
+    try:
+        return [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Danh sách số nguyên không hợp lệ: {value}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmark tiền xử lý và inference của ml_handler.")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"Các stage cần đo ({', '.join(STAGES)})")
+    parser.add_argument('--batch-sizes', type=_int_list, default=[1, 4, 16])
+    parser.add_argument('--threads', type=_int_list, default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', default=None, help="Ghi kết quả ra file JSON (mặc định in ra stdout)")
+    parser.add_argument('--baseline', default=None, help="File JSON kết quả cũ để so sánh")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="Mức kém hơn baseline cho phép (0.10 = 10%%)")
+    parser.add_argument('--case', default=None, help=argparse.SUPPRESS) # Dùng nội bộ: chạy một tổ hợp trong process con
+    args = parser.parse_args(argv)
+
+    if args.case:
+        logging.disable(logging.INFO) # Log INFO của app không cần thiết cho từng process con
+        stage, batch_size, threads = args.case.split(',')
+        result = run_case(stage, int(batch_size), int(threads), args.warmup, args.iterations, args.seed)
+        print(json.dumps(result))
+        return 0
+
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Stage không hợp lệ: {', '.join(sorted(unknown))}")
+
+    results = {
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ml_device': os.getenv('ML_DEVICE', 'auto'),
+        },
+        'args': {k: v for k, v in vars(args).items() if k != 'case'},
+        'cases': [],
+    }
+    try:
+        results['environment']['git_commit'] = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        results['environment']['git_commit'] = None
+
+    for stage in stages:
+        for batch_size in args.batch_sizes:
+            for threads in args.threads:
+                case = _run_case_subprocess(args, stage, batch_size, threads)
+                results['cases'].append(case)
+                print(f"{stage:<8} b={batch_size:<3} t={threads:<3} mean={case['mean_ms']:>9.2f}ms "
+                      f"p50={case['p50_ms']:>9.2f}ms p99={case['p99_ms']:>9.2f}ms "
+                      f"per-item={case['per_item_mean_ms']:>8.2f}ms peak_rss={case['peak_rss_mb']}MB", file=sys.stderr)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"So sánh với baseline {args.baseline}:", file=sys.stderr)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Phát hiện suy giảm hiệu năng:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
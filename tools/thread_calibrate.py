@@ -0,0 +1,182 @@
+# tools/thread_calibrate.py
+# Chọn bộ tham số luồng torch cho máy hiện tại bằng cách đo thông lượng predict_scream (đường đi của udp_server):
+#   với mỗi tổ hợp (số process inference, intra-op, inter-op), chạy đồng thời N process con, mỗi process ghim
+#   vào phần CPU riêng (INFERENCE_CPU_AFFINITY=auto, INFERENCE_PROCESS_SLOTS=N), đo tổng số chunk/giây và
+#   độ trễ p99 mỗi chunk. Tổ hợp tốt nhất = thông lượng cao nhất với p99 <= --max-p99-ms (mặc định bằng độ
+#   dài một chunk, tức vẫn theo kịp thời gian thực), in ra các biến môi trường cần đặt trong .env.
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.thread_calibrate
+#   python -m tools.thread_calibrate --processes 1,2 --intra 1,2,4 --seconds 20 --output bench/threads.json
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_worker(seconds: float, start_at: float, seed: int) -> dict:
+    """Đo trong process hiện tại (process con): predict_scream liên tục trong `seconds` giây."""
+    from app import config, ml_handler, torch_runtime
+    if not ml_handler.load_and_warmup():
+        raise SystemExit("Không tải được model (kiểm tra MODEL_PATH).")
+    torch = ml_handler.torch
+    generator = torch.Generator().manual_seed(seed)
+    chunks = (0.3 * torch.randn(8, config.AUDIO_CHUNK_SAMPLES, generator=generator)).clamp(-1.0, 1.0)
+    # Ghim luồng đo như luồng inference của server (load_and_warmup đã trả CPU set về như cũ sau warm-up)
+    torch_runtime.pin_current_thread()
+    # Các process con bắt đầu cùng lúc để đo khi tất cả đang tranh CPU
+    time.sleep(max(0.0, start_at - time.time()))
+    timings = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        ml_handler.predict_scream(chunks[len(timings) % len(chunks)])
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+    layout = torch_runtime.get_layout()
+    return {
+        'chunks': len(timings),
+        'seconds': seconds,
+        'p50_ms': round(1000 * _percentile(timings, 50), 2),
+        'p99_ms': round(1000 * _percentile(timings, 99), 2),
+        'intra_op': torch.get_num_threads(),
+        'inter_op': torch.get_num_interop_threads(),
+        'cpus': layout['cpus'],
+    }
+
+
+def _layout_env(processes: int, intra: int, inter: int, reserved: int, index: int | None = None) -> dict:
+    env = {
+        'TORCH_INTRA_OP_THREADS': str(intra),
+        'TORCH_INTER_OP_THREADS': str(inter),
+        'TORCH_RESERVED_CPUS': str(reserved),
+        'INFERENCE_CPU_AFFINITY': 'auto',
+        'INFERENCE_PROCESS_SLOTS': str(processes),
+        'OMP_NUM_THREADS': str(intra),
+        'MKL_NUM_THREADS': str(intra),
+    }
+    if index is not None:
+        env['INFERENCE_PROCESS_INDEX'] = str(index)
+    return env
+
+
+def run_layout(args, processes: int, intra: int, inter: int) -> dict:
+    """Chạy `processes` process con đồng thời với một bộ tham số, gộp kết quả."""
+    start_at = time.time() + args.startup_s
+    workers = []
+    for index in range(processes):
+        cmd = [sys.executable, '-m', 'tools.thread_calibrate', '--worker',
+               '--seconds', str(args.seconds), '--start-at', str(start_at), '--seed', str(args.seed + index)]
+        env = dict(os.environ, **_layout_env(processes, intra, inter, args.reserved, index))
+        workers.append(subprocess.Popen(cmd, cwd=PROJECT_ROOT, env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, text=True))
+    results = []
+    for worker in workers:
+        stdout, stderr = worker.communicate()
+        if worker.returncode != 0:
+            raise RuntimeError(f"Layout p={processes}/intra={intra}/inter={inter} thất bại:\n{stderr[-2000:]}")
+        results.append(json.loads(stdout.strip().splitlines()[-1]))
+    return {
+        'processes': processes,
+        'intra_op': intra,
+        'inter_op': inter,
+        'chunks_per_s': round(sum(r['chunks'] / r['seconds'] for r in results), 2),
+        'p50_ms': max(r['p50_ms'] for r in results),
+        'p99_ms': max(r['p99_ms'] for r in results),
+        'workers': results,
+    }
+
+
+def candidate_layouts(cpus: int, processes_list: list[int], intra_list: list[int] | None, inter_list: list[int]):
+    for processes in processes_list:
+        per_process = max(1, cpus // processes)
+        if intra_list:
+            intras = [n for n in intra_list if n <= per_process]
+        else:
+            intras = sorted({n for n in (1, 2, 4, 8, 16) if n <= per_process} | {per_process})
+        for intra in intras:
+            for inter in inter_list:
+                yield processes, intra, inter
+
+
+def _int_list(value: str) -> list[int]:
+    try:
+        return [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Danh sách số nguyên không hợp lệ: {value}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Chọn số luồng torch / CPU affinity bằng cách đo thông lượng predict_scream.")
+    parser.add_argument('--processes', type=_int_list, default=None,
+                        help="Số process inference cần thử (mặc định 1,2,4 trong giới hạn số CPU)")
+    parser.add_argument('--intra', type=_int_list, default=None, help="Số luồng intra-op cần thử (mặc định lũy thừa của 2)")
+    parser.add_argument('--inter', type=_int_list, default=[1, 2], help="Số luồng inter-op cần thử")
+    parser.add_argument('--reserved', type=int, default=1, help="Số CPU để lại cho luồng UDP/Flask")
+    parser.add_argument('--seconds', type=float, default=10.0, help="Thời gian đo mỗi tổ hợp")
+    parser.add_argument('--startup-s', type=float, default=15.0, help="Thời gian chờ các process con tải model")
+    parser.add_argument('--max-p99-ms', type=float, default=None,
+                        help="Giới hạn p99 mỗi chunk (mặc định = độ dài chunk, để theo kịp thời gian thực)")
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', default=None, help="Ghi toàn bộ kết quả ra file JSON")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS) # Dùng nội bộ: process con
+    parser.add_argument('--start-at', type=float, default=0.0, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        logging.disable(logging.INFO) # Log INFO của app không cần thiết cho từng process con
+        print(json.dumps(run_worker(args.seconds, args.start_at, args.seed)))
+        return 0
+
+    from app import config, torch_runtime
+    cpus = max(1, len(torch_runtime.available_cpus()) - args.reserved)
+    processes_list = args.processes or [p for p in (1, 2, 4) if p <= cpus]
+    max_p99_ms = args.max_p99_ms if args.max_p99_ms is not None else 1000 * config.AUDIO_CHUNK_DURATION_S
+
+    results = {
+        'environment': {'python': sys.version.split()[0], 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(), 'usable_cpus': cpus},
+        'max_p99_ms': max_p99_ms,
+        'layouts': [],
+    }
+    for processes, intra, inter in candidate_layouts(cpus, processes_list, args.intra, args.inter):
+        layout = run_layout(args, processes, intra, inter)
+        results['layouts'].append(layout)
+        print(f"processes={processes:<2} intra={intra:<3} inter={inter:<2} {layout['chunks_per_s']:>8.2f} chunk/s "
+              f"p50={layout['p50_ms']:>8.2f}ms p99={layout['p99_ms']:>8.2f}ms", file=sys.stderr)
+
+    eligible = [l for l in results['layouts'] if l['p99_ms'] <= max_p99_ms] or results['layouts']
+    if not eligible:
+        print("Không có tổ hợp nào để đo.", file=sys.stderr)
+        return 1
+    best = max(eligible, key=lambda l: l['chunks_per_s'])
+    results['best'] = {k: v for k, v in best.items() if k != 'workers'}
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    print(f"\nTốt nhất: {best['processes']} process x intra-op {best['intra_op']} / inter-op {best['inter_op']} "
+          f"-> {best['chunks_per_s']} chunk/s (p99 {best['p99_ms']}ms). Đặt trong .env:", file=sys.stderr)
+    env = _layout_env(best['processes'], best['intra_op'], best['inter_op'], args.reserved)
+    for name in ('TORCH_INTRA_OP_THREADS', 'TORCH_INTER_OP_THREADS', 'TORCH_RESERVED_CPUS',
+                 'INFERENCE_CPU_AFFINITY', 'INFERENCE_PROCESS_SLOTS'):
+        print(f"{name}={env[name]}")
+    if best['processes'] > 1:
+        print(f"# mỗi process ingest đặt INFERENCE_PROCESS_INDEX riêng: 0..{best['processes'] - 1}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+# tools/time_to_alert.py
+# Đo thời gian từ lúc mẫu tiếng hét đầu tiên được gửi qua UDP tới lúc server:
+#   - phát hiện (sự kiện 'detection' trên event_bus),
+#   - gửi FCM (lần gọi send_fcm_notification đầu tiên của cảnh báo),
+#   - trả lệnh 'CALL:<số>' về thiết bị (thời điểm socket của thiết bị nhận được lệnh).
+# Các bản ghi có gán nhãn được phát lại theo thời gian thực tới UDP server chạy trong process này;
+# Firebase (FCM, Firestore) và S3 được thay bằng stand-in cục bộ có độ trễ cấu hình được, nên đoạn code
+# thật của udp_server/firebase_client.send_alert_to_all/clip_uploads vẫn được chạy và đo.
+#
+# Manifest JSON: danh sách bản ghi, mỗi bản ghi có các khoảng tiếng hét (giây, tính từ đầu file):
+#   [{"path": "recordings/a.wav", "events": [[12.0, 16.5], [80.2, 83.0]]},
+#    {"path": "recordings/quiet.wav", "events": []}]
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.time_to_alert manifest.json --output tta.json
+#   python -m tools.time_to_alert manifest.json --parallel 4 --fcm-latency-ms 120 --tokens 5
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+from app import config
+from tools.batch_score import open_wav_memmap
+
+PACKET_SAMPLES = 512
+
+
+class _Recorder:
+    """Ghi lại thời điểm các mốc cảnh báo theo thiết bị (thread-safe)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.detections = {} # device -> [time.time()]
+        self.fcm_sends = {}  # device -> [time.time()] (chỉ lần gửi token đầu tiên của mỗi cảnh báo)
+        self.calls = {}      # device -> [time.time()]
+
+    def add(self, kind: dict, device: str, when: float):
+        with self._lock:
+            kind.setdefault(device, []).append(when)
+
+
+def install_stand_ins(recorder: _Recorder, args):
+    """
+    Thay Firebase/S3 bằng stand-in cục bộ. Chỉ thay ở mức thấp nhất (gửi từng token FCM, ghi Firestore,
+    lấy số khẩn cấp, S3 put/presign) để logic thật bên trên vẫn được đo.
+    """
+    from app import firebase_client, s3_client, token_storage
+
+    fcm_delay = args.fcm_latency_ms / 1000
+    firestore_delay = args.firestore_latency_ms / 1000
+    s3_delay = args.s3_latency_ms / 1000
+    tokens = [f"fake-token-{i:03d}" for i in range(args.tokens)]
+    first_token = tokens[0] if tokens else None
+
+    def fake_send_fcm_notification(token, title, body, data=None):
+        device = (data or {}).get('ip')
+        now = time.time()
+        # Token đầu tiên của mỗi lần send_alert_to_all: coi là mốc "đã gửi FCM"
+        if token == first_token and device:
+            recorder.add(recorder.fcm_sends, device, now)
+        time.sleep(fcm_delay)
+        return True
+
+    def fake_log_alert_to_firestore(client_ip, s3_key):
+        time.sleep(firestore_delay)
+
+    def fake_get_default_emergency_contact():
+        time.sleep(firestore_delay)
+        return args.phone_number
+
+    class _FakeS3:
+        def put_object(self, **kwargs):
+            time.sleep(s3_delay)
+
+        def generate_presigned_url(self, operation, Params, ExpiresIn):
+            return f"http://localhost/fake-s3/{Params['Key']}?expires={ExpiresIn}"
+
+    for token in tokens:
+        token_storage.add_token(token)
+    if not tokens:
+        logging.warning("Time-to-alert: --tokens 0, sẽ không đo được mốc gửi FCM.")
+
+    firebase_client._firebase_initialized = True
+    firebase_client.send_fcm_notification = fake_send_fcm_notification
+    firebase_client.log_alert_to_firestore = fake_log_alert_to_firestore
+    firebase_client.get_default_emergency_contact = fake_get_default_emergency_contact
+    s3_client._s3_client = _FakeS3()
+    s3_client._init_attempted = True
+    config.S3_CONFIGURED = True
+    config.AWS_S3_BUCKET_NAME = config.AWS_S3_BUCKET_NAME or 'local-stand-in'
+    config.RTDB_AUDIO_LEVELS_ENABLED = False
+    # token_storage trả về set không thứ tự: sắp xếp để token đầu tiên xác định được
+    original_get_all_tokens = token_storage.get_all_tokens
+    token_storage.get_all_tokens = lambda: sorted(original_get_all_tokens())
+
+
+def _replay(recording: dict, source_ip: str, target: tuple, speed: float, grace_s: float,
+            recorder: _Recorder) -> dict:
+    """Phát lại một bản ghi từ source_ip; trả về thời điểm gửi từng gói để quy đổi mẫu -> thời gian."""
+    samples, sample_rate, scale = open_wav_memmap(recording['path'])
+    if sample_rate != config.AUDIO_SAMPLE_RATE:
+        raise ValueError(f"{recording['path']}: cần {config.AUDIO_SAMPLE_RATE} Hz, file là {sample_rate} Hz")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((source_ip, 0))
+    sock.settimeout(0.0)
+    interval = PACKET_SAMPLES / sample_rate / speed
+    num_packets = len(samples) // PACKET_SAMPLES
+    send_times = np.zeros(num_packets, dtype=np.float64)
+
+    def drain_commands():
+        while True:
+            try:
+                data, _ = sock.recvfrom(1024)
+            except (BlockingIOError, OSError):
+                return
+            if data.startswith(b'CALL:'):
+                recorder.add(recorder.calls, source_ip, time.time())
+
+    start = time.perf_counter()
+    for i in range(num_packets):
+        delay = start + i * interval - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        block = np.asarray(samples[i * PACKET_SAMPLES:(i + 1) * PACKET_SAMPLES], dtype=np.float32)
+        # Về định dạng ESP32: mono '<i4' toàn dải
+        pcm = np.clip(block.mean(axis=1) / scale, -1.0, 1.0) * (2**31 - 1)
+        sock.sendto(pcm.astype('<i4').tobytes(), target)
+        send_times[i] = time.time()
+        drain_commands()
+    # Chờ thêm để kịp nhận lệnh CALL của cảnh báo cuối
+    deadline = time.time() + grace_s
+    while time.time() < deadline:
+        drain_commands()
+        time.sleep(0.05)
+    sock.close()
+    return {'send_times': send_times, 'sample_rate': sample_rate, 'duration_s': len(samples) / sample_rate}
+
+
+def _first_in_window(times: list[float], start: float, end: float) -> float | None:
+    for t in times:
+        if start <= t <= end:
+            return t
+    return None
+
+
+def evaluate(recording: dict, source_ip: str, replay: dict, recorder: _Recorder, grace_s: float) -> dict:
+    """Ghép nhãn với các cảnh báo của thiết bị: độ trễ từng sự kiện, bỏ sót, báo động giả."""
+    send_times = replay['send_times']
+
+    def sample_time(seconds: float) -> float:
+        index = min(len(send_times) - 1, max(0, int(seconds * replay['sample_rate']) // PACKET_SAMPLES))
+        return float(send_times[index])
+
+    detections = sorted(recorder.detections.get(source_ip, []))
+    fcm_sends = sorted(recorder.fcm_sends.get(source_ip, []))
+    calls = sorted(recorder.calls.get(source_ip, []))
+    matched_detections = set()
+    events = []
+    last_alert = float('-inf')
+    for event_start_s, event_end_s in recording.get('events', []):
+        t_start = sample_time(event_start_s)
+        # Cảnh báo có thể đến sau khi tiếng hét kết thúc (chờ đủ chunk + xử lý)
+        t_end = sample_time(event_end_s) + grace_s
+        detected = _first_in_window(detections, t_start, t_end)
+        row = {'start_s': event_start_s, 'end_s': event_end_s}
+        if detected is None:
+            # Nằm trong cooldown của cảnh báo trước: server cố ý không gửi lại, không tính là bỏ sót
+            row['outcome'] = 'suppressed_by_cooldown' if t_start - last_alert <= config.SCREAM_ALERT_COOLDOWN_S else 'missed'
+        else:
+            matched_detections.add(detected)
+            last_alert = detected
+            fcm = _first_in_window(fcm_sends, detected, t_end + 30)
+            call = _first_in_window(calls, detected, t_end + 30)
+            row.update({
+                'outcome': 'detected',
+                'detection_latency_s': round(detected - t_start, 3),
+                'fcm_latency_s': round(fcm - t_start, 3) if fcm else None,
+                'call_latency_s': round(call - t_start, 3) if call else None,
+            })
+        events.append(row)
+    false_alarms = [round(t - float(send_times[0]), 3) for t in detections if t not in matched_detections]
+    return {
+        'path': recording['path'],
+        'device': source_ip,
+        'duration_s': round(replay['duration_s'], 1),
+        'events': events,
+        'false_alarms_at_s': false_alarms,
+    }
+
+
+def _summarize(results: list[dict]) -> dict:
+    events = [e for r in results for e in r['events']]
+
+    def stats(key):
+        values = sorted(e[key] for e in events if e.get(key) is not None)
+        if not values:
+            return None
+        pick = lambda q: values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+        return {'n': len(values), 'mean': round(sum(values) / len(values), 3),
+                'p50': pick(50), 'p90': pick(90), 'max': values[-1]}
+
+    detected = sum(1 for e in events if e['outcome'] == 'detected')
+    missed = sum(1 for e in events if e['outcome'] == 'missed')
+    false_alarms = sum(len(r['false_alarms_at_s']) for r in results)
+    return {
+        'recordings': len(results),
+        'audio_hours': round(sum(r['duration_s'] for r in results) / 3600, 3),
+        'events': len(events),
+        'detected': detected,
+        'missed': missed,
+        'suppressed_by_cooldown': sum(1 for e in events if e['outcome'] == 'suppressed_by_cooldown'),
+        'false_alarms': false_alarms,
+        'recall': round(detected / (detected + missed), 4) if detected + missed else None,
+        'precision': round(detected / (detected + false_alarms), 4) if detected + false_alarms else None,
+        'detection_latency_s': stats('detection_latency_s'),
+        'fcm_latency_s': stats('fcm_latency_s'),
+        'call_latency_s': stats('call_latency_s'),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Đo thời gian tới cảnh báo bằng cách phát lại bản ghi có gán nhãn.")
+    parser.add_argument('manifest', help="File JSON danh sách bản ghi và khoảng tiếng hét")
+    parser.add_argument('--port', type=int, default=15006, help="Cổng UDP dùng cho harness")
+    parser.add_argument('--speed', type=float, default=1.0, help="Hệ số tốc độ phát lại (1 = thời gian thực)")
+    parser.add_argument('--parallel', type=int, default=1, help="Số bản ghi phát lại cùng lúc (mỗi bản ghi là một thiết bị)")
+    parser.add_argument('--grace-s', type=float, default=5.0, help="Thời gian chờ cảnh báo sau khi tiếng hét kết thúc")
+    parser.add_argument('--tokens', type=int, default=3, help="Số FCM token giả (send_alert_to_all gửi lần lượt)")
+    parser.add_argument('--fcm-latency-ms', type=float, default=80.0)
+    parser.add_argument('--firestore-latency-ms', type=float, default=40.0)
+    parser.add_argument('--s3-latency-ms', type=float, default=150.0)
+    parser.add_argument('--phone-number', default='+84000000000')
+    parser.add_argument('--output', default=None, help="Ghi kết quả chi tiết ra file JSON")
+    args = parser.parse_args(argv)
+
+    with open(args.manifest, encoding='utf-8') as f:
+        recordings = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(args.manifest))
+    for recording in recordings:
+        recording['path'] = os.path.join(base_dir, recording['path'])
+
+    config.UDP_HOST = '127.0.0.1'
+    config.UDP_PORT = args.port
+    from app import ml_handler, udp_server, event_bus
+    recorder = _Recorder()
+    install_stand_ins(recorder, args)
+    if not ml_handler.load_and_warmup():
+        logging.error("Time-to-alert: Không tải được model.")
+        return 1
+
+    subscriber = event_bus.subscribe(None)
+    stop = threading.Event()
+
+    def collect_detections():
+        while not stop.is_set():
+            event = subscriber.get(timeout=0.5)
+            if event and event.get('type') == 'detection':
+                # Dùng thời điểm server quyết định cảnh báo, không tính độ trễ của bộ thu
+                recorder.add(recorder.detections, event['device'], event['timestamp'])
+    collector = threading.Thread(target=collect_detections, name="TTADetectionCollector", daemon=True)
+    collector.start()
+
+    udp_thread = udp_server.start_udp_thread()
+    time.sleep(0.5)
+    results = []
+    try:
+        for batch_start in range(0, len(recordings), args.parallel):
+            batch = recordings[batch_start:batch_start + args.parallel]
+            replays, threads = {}, []
+            for offset, recording in enumerate(batch):
+                index = batch_start + offset
+                source_ip = f"127.2.{index // 254}.{index % 254 + 1}"
+
+                def run(recording=recording, source_ip=source_ip):
+                    try:
+                        replays[source_ip] = _replay(recording, source_ip, ('127.0.0.1', args.port),
+                                                     args.speed, args.grace_s, recorder)
+                    except Exception as e:
+                        logging.error(f"Time-to-alert: Lỗi phát lại {recording['path']}: {e}")
+                thread = threading.Thread(target=run, name=f"Replay-{source_ip}", daemon=True)
+                thread.start()
+                threads.append((recording, source_ip, thread))
+            for recording, source_ip, thread in threads:
+                thread.join()
+                if source_ip in replays:
+                    results.append(evaluate(recording, source_ip, replays[source_ip], recorder, args.grace_s))
+                    logging.info(f"Time-to-alert: {recording['path']}: {results[-1]['events']}")
+    finally:
+        stop.set()
+        udp_server.stop_udp_listener()
+        udp_thread.join(timeout=5.0)
+        event_bus.unsubscribe(subscriber)
+
+    report = {
+        'summary': _summarize(results),
+        'settings': {k: v for k, v in vars(args).items() if k != 'manifest'},
+        'alert_rule': {
+            'min_consecutive_chunks': config.SCREAM_MIN_CONSECUTIVE_CHUNKS,
+            'frequency_count': config.SCREAM_FREQUENCY_COUNT,
+            'frequency_window_s': config.SCREAM_FREQUENCY_WINDOW_S,
+            'cooldown_s': config.SCREAM_ALERT_COOLDOWN_S,
+        },
+        'recordings': results,
+    }
+    print(json.dumps(report['summary'], indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+# tools/udp_load.py
+# Bộ phát tải UDP giả lập nhiều ESP32 gửi audio tới UDP server (mặc định localhost).
+# Mỗi thiết bị gửi các gói mẫu '<i4' 16 kHz (giống firmware) theo thời gian thực hoặc tăng tốc,
+# nội dung trộn giữa im lặng, nhiễu và các đoạn tiếng hét (file WAV hoặc tín hiệu tổng hợp).
+# Mỗi thiết bị bind vào một địa chỉ loopback riêng (127.x.y.z) để server thấy N client_ip khác nhau.
+# Không import package app để có thể chạy trên máy khác; định dạng phải khớp app/config.py
+# (AUDIO_SAMPLE_RATE, AUDIO_NUMPY_DTYPE).
+# Chạy từ thư mục gốc dự án:
+#   python -m tools.udp_load --devices 20 --duration 60
+#   python -m tools.udp_load --devices 50 --speed 4 --mix silence=0.5,noise=0.3,scream=0.2 --scream-dir clips/
+#   python -m tools.udp_load --devices 10 --duration 30 --report load_report.json
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import time
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+SAMPLE_DTYPE = '<i4'
+BYTES_PER_SAMPLE = 4
+INT32_SCALE = 2**31 - 1
+CHUNK_SAMPLES = SAMPLE_RATE # Khớp AUDIO_CHUNK_SAMPLES (chunk 1 giây)
+SEGMENT_KINDS = ('silence', 'noise', 'scream')
+
+
+def _to_pcm_bytes(audio: np.ndarray) -> bytes:
+    """float [-1, 1] -> bytes '<i4' như ESP32 gửi."""
+    return (np.clip(audio, -1.0, 1.0) * INT32_SCALE).astype(SAMPLE_DTYPE).tobytes()
+
+
+def _synthetic_scream(rng: np.random.Generator, seconds: float) -> np.ndarray:
+    """Tín hiệu giống tiếng hét: âm cơ bản 900-1500 Hz có rung (vibrato), nhiều họa âm, biên độ lớn."""
+    n = int(SAMPLE_RATE * seconds)
+    t = np.arange(n) / SAMPLE_RATE
+    f0 = rng.uniform(900, 1500) * (1 + 0.05 * np.sin(2 * np.pi * rng.uniform(4, 8) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+    audio = sum((0.5 / k) * np.sin(k * phase) for k in range(1, 5))
+    audio += rng.normal(0, 0.02, n)
+    return (audio / np.max(np.abs(audio)) * rng.uniform(0.5, 0.9)).astype(np.float32)
+
+
+def _load_scream_clips(scream_dir: str) -> list[np.ndarray]:
+    """Đọc các file WAV (mono 16 kHz) trong thư mục; file sai định dạng bị bỏ qua."""
+    import soundfile as sf
+    clips = []
+    for path in sorted(glob.glob(os.path.join(scream_dir, '*.wav'))):
+        audio, sr = sf.read(path, dtype='float32', always_2d=True)
+        if sr != SAMPLE_RATE:
+            logging.warning(f"UDP Load: Bỏ qua {path}: sample rate {sr} != {SAMPLE_RATE}.")
+            continue
+        clips.append(audio.mean(axis=1))
+    if not clips:
+        raise SystemExit(f"Không có file WAV {SAMPLE_RATE} Hz nào trong {scream_dir}")
+    logging.info(f"UDP Load: Đã đọc {len(clips)} clip tiếng hét từ {scream_dir}.")
+    return clips
+
+
+def build_segment_pool(rng: np.random.Generator, scream_clips: list[np.ndarray] | None, variants: int = 8) -> dict:
+    """
+    Tạo sẵn các đoạn 1 giây dạng bytes cho từng loại nội dung, dùng chung cho mọi thiết bị
+    (không phải sinh audio trong vòng lặp gửi).
+    """
+    pool = {
+        'silence': [_to_pcm_bytes(rng.normal(0, 1e-4, CHUNK_SAMPLES)) for _ in range(variants)],
+        'noise': [_to_pcm_bytes(rng.normal(0, rng.uniform(0.02, 0.1), CHUNK_SAMPLES)) for _ in range(variants)],
+    }
+    screams = []
+    sources = scream_clips or [_synthetic_scream(rng, 3.0) for _ in range(variants)]
+    for clip in sources:
+        for start in range(0, len(clip) - CHUNK_SAMPLES + 1, CHUNK_SAMPLES):
+            screams.append(_to_pcm_bytes(clip[start:start + CHUNK_SAMPLES]))
+    pool['scream'] = screams
+    return pool
+
+
+def parse_mix(value: str) -> dict:
+    """'silence=0.6,noise=0.3,scream=0.1' -> dict trọng số đã chuẩn hóa."""
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SEGMENT_KINDS:
+            raise argparse.ArgumentTypeError(f"Loại nội dung không hợp lệ: {name} (cần một trong {SEGMENT_KINDS})")
+        try:
+            weights[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Trọng số không hợp lệ cho {name}: {weight!r}")
+    total = sum(weights.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("Tổng trọng số phải > 0")
+    return {k: v / total for k, v in weights.items()}
+
+
+def device_address(prefix: str, index: int) -> str:
+    """Địa chỉ nguồn của thiết bị thứ index, ví dụ prefix '127.1' -> 127.1.0.1, 127.1.0.2, ..."""
+    return f"{prefix}.{index // 254}.{index % 254 + 1}"
+
+
+class SimulatedDevice:
+    """Một ESP32 giả lập: socket riêng, lịch nội dung theo từng giây, thống kê gửi."""
+
+    def __init__(self, index: int, source_ip: str, pool: dict, mix: dict, scream_burst_s: int,
+                 rng: random.Random, packet_samples: int):
+        self.index = index
+        self.source_ip = source_ip
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((source_ip, 0))
+        self.sock.setblocking(False)
+        self._pool = pool
+        self._mix_kinds = list(mix)
+        self._mix_weights = [mix[k] for k in self._mix_kinds]
+        self._scream_burst_s = scream_burst_s
+        self._rng = rng
+        self._packet_bytes = packet_samples * BYTES_PER_SAMPLE
+        self._segment = memoryview(b'')
+        self._offset = 0
+        self._burst_left = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.commands_received = 0
+        self.seconds_by_kind = dict.fromkeys(SEGMENT_KINDS, 0)
+        self.chunk_sent_at = [] # time.time() khi gói hoàn tất mỗi chunk 1 giây được gửi
+
+    def _next_segment(self):
+        if self._burst_left > 0:
+            kind = 'scream'
+            self._burst_left -= 1
+        else:
+            kind = self._rng.choices(self._mix_kinds, self._mix_weights)[0]
+            if kind == 'scream':
+                # Tiếng hét kéo dài vài giây liên tiếp để đủ điều kiện "liên tiếp" của server
+                self._burst_left = self._scream_burst_s - 1
+        self.seconds_by_kind[kind] += 1
+        self._segment = memoryview(self._rng.choice(self._pool[kind]))
+        self._offset = 0
+
+    def send_packet(self, target: tuple):
+        if self._offset >= len(self._segment):
+            self._next_segment()
+        # Gói có thể nằm vắt qua hai đoạn 1 giây
+        packet = bytes(self._segment[self._offset:self._offset + self._packet_bytes])
+        self._offset += len(packet)
+        if len(packet) < self._packet_bytes:
+            self._next_segment()
+            remaining = self._packet_bytes - len(packet)
+            packet += bytes(self._segment[:remaining])
+            self._offset = remaining
+        try:
+            self.sock.sendto(packet, target)
+        except (BlockingIOError, OSError):
+            self.send_errors += 1
+            return
+        chunks_before = self.bytes_sent // (CHUNK_SAMPLES * BYTES_PER_SAMPLE)
+        self.packets_sent += 1
+        self.bytes_sent += len(packet)
+        if self.bytes_sent // (CHUNK_SAMPLES * BYTES_PER_SAMPLE) > chunks_before:
+            self.chunk_sent_at.append(time.time())
+
+    def poll_commands(self):
+        """Đọc các lệnh server gửi về (ví dụ 'CALL:<số>') mà không chặn."""
+        while True:
+            try:
+                self.sock.recvfrom(1024)
+            except (BlockingIOError, OSError):
+                return
+            self.commands_received += 1
+
+    def summary(self) -> dict:
+        return {
+            'device': self.source_ip,
+            'packets_sent': self.packets_sent,
+            'bytes_sent': self.bytes_sent,
+            'send_errors': self.send_errors,
+            'commands_received': self.commands_received,
+            'seconds_by_kind': self.seconds_by_kind,
+            'chunk_sent_at': self.chunk_sent_at,
+        }
+
+
+def run_load(devices: list[SimulatedDevice], target: tuple, duration_s: float, speed: float,
+             packet_samples: int) -> dict:
+    """
+    Gửi gói cho mọi thiết bị theo nhịp chung. speed=1 là thời gian thực, speed=4 nhanh gấp 4,
+    speed=0 là gửi nhanh nhất có thể. Các thiết bị được rải đều trong mỗi chu kỳ gói.
+    """
+    interval = packet_samples / SAMPLE_RATE / speed if speed > 0 else 0.0
+    total_ticks = int(duration_s * SAMPLE_RATE / packet_samples)
+    step = interval / len(devices) if devices else 0.0
+    late_sends = 0
+    start = time.perf_counter()
+    for tick in range(total_ticks):
+        tick_start = start + tick * interval
+        for i, device in enumerate(devices):
+            if interval:
+                delay = tick_start + i * step - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -interval:
+                    late_sends += 1
+            device.send_packet(target)
+        if tick % 32 == 0:
+            for device in devices:
+                device.poll_commands()
+    elapsed = time.perf_counter() - start
+    for device in devices:
+        device.poll_commands()
+    packets = sum(d.packets_sent for d in devices)
+    return {
+        'elapsed_s': elapsed,
+        'packets_sent': packets,
+        'packets_per_s': packets / elapsed if elapsed else 0.0,
+        'late_sends': late_sends, # Số gói gửi trễ hơn một chu kỳ: máy phát tải không theo kịp nhịp yêu cầu
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Giả lập nhiều ESP32 gửi audio UDP tới server.")
+    parser.add_argument('--host', default='127.0.0.1', help="Địa chỉ UDP server")
+    parser.add_argument('--port', type=int, default=int(os.getenv("UDP_PORT", 5005)), help="Cổng UDP server")
+    parser.add_argument('--devices', type=int, default=10, help="Số thiết bị giả lập")
+    parser.add_argument('--duration', type=float, default=30.0, help="Thời lượng audio mỗi thiết bị gửi (giây audio)")
+    parser.add_argument('--speed', type=float, default=1.0, help="Hệ số tốc độ (1 = thời gian thực, 0 = nhanh nhất)")
+    parser.add_argument('--packet-samples', type=int, default=512, help="Số mẫu mỗi gói UDP (ESP32 mặc định 512)")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('silence=0.6,noise=0.3,scream=0.1'),
+                        help="Tỉ lệ nội dung theo giây, ví dụ silence=0.6,noise=0.3,scream=0.1")
+    parser.add_argument('--scream-burst-s', type=int, default=3, help="Mỗi lần hét kéo dài bao nhiêu giây")
+    parser.add_argument('--scream-dir', default=None, help="Thư mục chứa clip WAV tiếng hét (mono 16 kHz); mặc định dùng tín hiệu tổng hợp")
+    parser.add_argument('--source-prefix', default='127.1', help="Hai octet đầu của địa chỉ nguồn loopback cho các thiết bị")
+    parser.add_argument('--seed', type=int, default=1, help="Seed để lặp lại được cùng một kịch bản")
+    parser.add_argument('--report', default=None, help="Ghi thống kê (kèm thời điểm gửi từng chunk) ra file JSON")
+    args = parser.parse_args(argv)
+
+    if args.packet_samples * BYTES_PER_SAMPLE > 4096:
+        parser.error("--packet-samples quá lớn: server đọc tối đa 4096 byte mỗi gói (UDP_BUFFER_SIZE)")
+
+    np_rng = np.random.default_rng(args.seed)
+    scream_clips = _load_scream_clips(args.scream_dir) if args.scream_dir else None
+    pool = build_segment_pool(np_rng, scream_clips)
+
+    if not args.host.startswith('127.'):
+        # Ra mạng thật: không thể giả nhiều địa chỉ nguồn, mọi thiết bị sẽ gộp thành một client_ip trên server
+        logging.warning("UDP Load: Server không ở loopback, mọi thiết bị dùng chung địa chỉ nguồn của máy này.")
+    devices = []
+    for i in range(args.devices):
+        source_ip = device_address(args.source_prefix, i) if args.host.startswith('127.') else '0.0.0.0'
+        devices.append(SimulatedDevice(i, source_ip, pool, args.mix, args.scream_burst_s,
+                                       random.Random(args.seed * 100003 + i), args.packet_samples))
+
+    logging.info(f"UDP Load: {args.devices} thiết bị -> {args.host}:{args.port}, {args.duration}s audio, speed={args.speed}.")
+    result = run_load(devices, (args.host, args.port), args.duration, args.speed, args.packet_samples)
+    result.update({
+        'devices': args.devices,
+        'speed': args.speed,
+        'duration_audio_s': args.duration,
+        'packet_samples': args.packet_samples,
+        'mix': args.mix,
+        'per_device': [d.summary() for d in devices],
+    })
+    for device in devices:
+        device.sock.close()
+
+    print(f"Đã gửi {result['packets_sent']} gói trong {result['elapsed_s']:.1f}s "
+          f"({result['packets_per_s']:.0f} gói/s, trễ nhịp {result['late_sends']}), "
+          f"lệnh nhận về: {sum(d.commands_received for d in devices)}")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())